@@ -0,0 +1,46 @@
+"""
+Throughput benchmark for dialback key generation.
+
+This compares L{server.generateKey}, which hashes the shared secret for
+every key, with L{server.KeyGenerator}, which prepares the keyed HMAC
+state once and copies it for every key.
+
+Usage: python dialback_keys.py [iterations]
+"""
+
+import sys
+import time
+
+from wokkel import server
+
+SECRET = 's3cr3tf0rd14lb4ck'
+RECEIVING = 'xmpp.example.com'
+ORIGINATING = 'example.org'
+
+def bench(label, fn, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        fn(RECEIVING, ORIGINATING, str(i))
+    elapsed = time.time() - start
+    print "%-14s %8d keys in %.3fs: %10.0f keys/s" % (label, iterations,
+                                                      elapsed,
+                                                      iterations / elapsed)
+
+
+def main(iterations):
+    def generateKey(receivingServer, originatingServer, streamID):
+        return server.generateKey(SECRET, receivingServer, originatingServer,
+                                  streamID)
+
+    generator = server.KeyGenerator(SECRET)
+
+    bench('generateKey', generateKey, iterations)
+    bench('KeyGenerator', generator.generateKey, iterations)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    else:
+        iterations = 100000
+    main(iterations)
@@ -11,16 +11,22 @@ that should probably eventually move there.
 """
 
 from twisted.application import service
-from twisted.internet import reactor
-from twisted.names.srvconnect import SRVConnector
+from twisted.internet import defer, reactor
 from twisted.words.protocols.jabber import client, sasl, xmlstream
+from twisted.words.xish import domish
 
 from wokkel import generic
-from wokkel.subprotocols import StreamManager
+from wokkel.reconnect import ReconnectingXmlStreamFactory
+from wokkel.srv import CachingSRVConnector
+from wokkel.subprotocols import NS_SM, StreamManager
 
 class CheckAuthInitializer(object):
     """
     Check what authentication methods are available.
+
+    When the authenticator has a C{streamManager} with C{streamManagement}
+    set, initializers for resuming or enabling Stream Management are added
+    around resource binding.
     """
 
     def __init__(self, xs):
@@ -36,6 +42,14 @@ class CheckAuthInitializer(object):
                 init = initClass(self.xmlstream)
                 init.required = required
                 self.xmlstream.initializers.append(init)
+
+            manager = getattr(self.xmlstream.authenticator,
+                              'streamManager', None)
+            if manager is not None and manager.streamManagement:
+                resume = StreamResumptionInitializer(self.xmlstream, manager)
+                enable = StreamManagementInitializer(self.xmlstream, manager)
+                self.xmlstream.initializers.insert(-2, resume)
+                self.xmlstream.initializers.append(enable)
         elif (client.NS_IQ_AUTH_FEATURE, 'auth') in self.xmlstream.features:
             self.xmlstream.initializers.append(
                     client.IQAuthInitializer(self.xmlstream))
@@ -43,15 +57,140 @@ class CheckAuthInitializer(object):
             raise Exception("No available authentication method found")
 
 
+def _smRequest(xs, element, responseName):
+    """
+    Send a Stream Management request and wait for the response.
+
+    @param xs: The stream to send the request over.
+    @type xs: L{xmlstream.XmlStream}
+    @param element: The request.
+    @type element: L{domish.Element}
+    @param responseName: The name of the element for a successful response.
+    @type responseName: C{str}
+    @return: Deferred that fires with the response, which is either the
+             successful response or a C{failed} element.
+    @rtype: L{defer.Deferred}
+    """
+    d = defer.Deferred()
+    successQuery = "/%s[@xmlns='%s']" % (responseName, NS_SM)
+    failedQuery = "/failed[@xmlns='%s']" % NS_SM
+
+    def onSuccess(response):
+        xs.removeObserver(failedQuery, onFailed)
+        d.callback(response)
+
+    def onFailed(response):
+        xs.removeObserver(successQuery, onSuccess)
+        d.callback(response)
+
+    xs.addOnetimeObserver(successQuery, onSuccess)
+    xs.addOnetimeObserver(failedQuery, onFailed)
+    xs.send(element)
+    return d
+
+
+
+class StreamResumptionInitializer(xmlstream.BaseFeatureInitiatingInitializer):
+    """
+    Initializer that resumes a previous managed stream (XEP-0198).
+
+    This must come after authentication, but before resource binding. If
+    the previous stream was resumed, the initializers for resource binding
+    and session establishment are skipped.
+
+    @ivar manager: The stream manager holding the Stream Management state.
+    @type manager: L{StreamManager}
+    """
+
+    feature = (NS_SM, 'sm')
+
+    def __init__(self, xs, manager):
+        xmlstream.BaseFeatureInitiatingInitializer.__init__(self, xs)
+        self.manager = manager
+
+
+    def start(self):
+        if not self.manager.smId:
+            return None
+
+        resume = domish.Element((NS_SM, 'resume'))
+        resume['previd'] = self.manager.smId
+        resume['h'] = str(self.manager.smInbound)
+        d = _smRequest(self.xmlstream, resume, 'resumed')
+        d.addCallback(self.onResponse)
+        return d
+
+
+    def onResponse(self, response):
+        if response.name != 'resumed':
+            self.manager.resumptionFailed()
+            return
+
+        self.manager.resumeStreamManagement(self.xmlstream,
+                                            int(response['h']))
+        self.xmlstream.initializers[1:] = [
+                init for init in self.xmlstream.initializers[1:]
+                if not isinstance(init, (client.BindInitializer,
+                                         client.SessionInitializer))]
+
+
+
+class StreamManagementInitializer(xmlstream.BaseFeatureInitiatingInitializer):
+    """
+    Initializer that enables Stream Management (XEP-0198).
+
+    This must come after resource binding. It does nothing if the stream
+    was resumed, and enabling is not required to succeed.
+
+    @ivar manager: The stream manager holding the Stream Management state.
+    @type manager: L{StreamManager}
+    """
+
+    feature = (NS_SM, 'sm')
+
+    def __init__(self, xs, manager):
+        xmlstream.BaseFeatureInitiatingInitializer.__init__(self, xs)
+        self.manager = manager
+
+
+    def start(self):
+        if self.manager.resumed:
+            return None
+
+        enable = domish.Element((NS_SM, 'enable'))
+        enable['resume'] = 'true'
+        d = _smRequest(self.xmlstream, enable, 'enabled')
+        d.addCallback(self.onResponse)
+        return d
+
+
+    def onResponse(self, response):
+        if response.name != 'enabled':
+            return
+
+        if response.getAttribute('resume') in ('true', '1'):
+            smId = response.getAttribute('id')
+        else:
+            smId = None
+
+        self.manager.enableStreamManagement(self.xmlstream, smId)
+
+
+
 class HybridAuthenticator(xmlstream.ConnectAuthenticator):
     """
     Initializes an XmlStream connecting to an XMPP server as a Client.
 
     This is similar to L{client.XMPPAuthenticator}, but also tries non-SASL
     autentication.
+
+    @ivar streamManager: The stream manager to hand Stream Management state
+                         to, if any. See L{CheckAuthInitializer}.
+    @type streamManager: L{StreamManager}
     """
 
     namespace = 'jabber:client'
+    streamManager = None
 
     def __init__(self, jid, password):
         xmlstream.ConnectAuthenticator.__init__(self, jid.host)
@@ -67,31 +206,51 @@ class HybridAuthenticator(xmlstream.ConnectAuthenticator):
                            CheckAuthInitializer(xs)]
 
 
-def HybridClientFactory(jid, password):
+def HybridClientFactory(jid, password, policy=None):
     """
     Client factory for XMPP 1.0.
 
     This is similar to L{client.XMPPClientFactory} but also tries non-SASL
-    autentication.
+    autentication, and reconnects according to C{policy}.
+
+    @type policy: L{ReconnectPolicy}
     """
 
     a = HybridAuthenticator(jid, password)
-    return xmlstream.XmlStreamFactory(a)
+    return ReconnectingXmlStreamFactory(a, policy)
 
 
 
 class XMPPClient(StreamManager, service.Service):
     """
     Service that initiates an XMPP client connection.
+
+    @ivar racing: If set and no explicit host was given, connection attempts
+                  to all of the domain's SRV targets are raced, instead of
+                  trying them one by one. See L{XMPPClientConnector}.
+    @type racing: C{bool}
+    @ivar streamManagement: If set, Stream Management (XEP-0198) is enabled
+                            when the server supports it, and used to resume
+                            the session after the connection was lost.
+    @type streamManagement: C{bool}
+    @ivar reconnectPolicy: The policy for reconnecting after the connection
+                           failed or was lost.
+    @type reconnectPolicy: L{ReconnectPolicy}
     """
 
-    def __init__(self, jid, password, host=None, port=5222):
+    racing = False
+    streamManagement = False
+
+    def __init__(self, jid, password, host=None, port=5222,
+                       reconnectPolicy=None):
         self.jid = jid
         self.domain = jid.host
         self.host = host
         self.port = port
 
-        factory = HybridClientFactory(jid, password)
+        factory = HybridClientFactory(jid, password, reconnectPolicy)
+        self.reconnectPolicy = factory.policy
+        factory.authenticator.streamManager = self
 
         StreamManager.__init__(self, factory)
 
@@ -136,7 +295,8 @@ class XMPPClient(StreamManager, service.Service):
         if self.host:
             return reactor.connectTCP(self.host, self.port, self.factory)
         else:
-            c = XMPPClientConnector(reactor, self.domain, self.factory)
+            c = XMPPClientConnector(reactor, self.domain, self.factory,
+                                    racing=self.racing)
             c.connect()
             return c
 
@@ -165,13 +325,14 @@ class DeferredClientFactory(generic.DeferredXmlStreamFactory):
 
 
 
-class XMPPClientConnector(SRVConnector):
-    def __init__(self, reactor, domain, factory):
-        SRVConnector.__init__(self, reactor, 'xmpp-client', domain, factory)
+class XMPPClientConnector(CachingSRVConnector):
+    def __init__(self, reactor, domain, factory, cache=None, racing=False):
+        CachingSRVConnector.__init__(self, reactor, 'xmpp-client', domain,
+                                     factory, cache, racing)
 
 
     def pickServer(self):
-        host, port = SRVConnector.pickServer(self)
+        host, port = CachingSRVConnector.pickServer(self)
 
         if not self.servers and not self.orderedServers:
             # no SRV record, fall back..
@@ -3,9 +3,15 @@
 # Copyright (c) 2001-2009 Twisted Matrix Laboratories.
 # See LICENSE for details.
 
-from twisted.internet import protocol
+from collections import deque
+
+from twisted.internet import defer, protocol
+from twisted.internet.error import ConnectionLost
+from twisted.python import failure
 from twisted.words.protocols.jabber import xmlstream
 
+from wokkel.metrics import DEFAULT_BUCKETS, HandlerStats
+
 class BootstrapMixin(object):
     """
     XmlStream factory mixin to install bootstrap event observers.
@@ -96,7 +102,147 @@ class XmlStreamServerFactory(BootstrapMixin,
 
 
 
+class IQRequestTracker(object):
+    """
+    Accounting and flow control for outgoing iq requests on a stream.
+
+    At most C{maxOutstanding} requests are sent out at a time. Further
+    requests are queued, and sent as responses to earlier requests come in,
+    or those time out. Timeouts start when a request is actually sent.
+
+    @ivar maxOutstanding: Maximum number of requests awaiting a response,
+                          or C{None} for no limit.
+    @type maxOutstanding: C{int}
+    @ivar pending: Number of requests awaiting a response.
+    @type pending: C{int}
+    @ivar queue: Requests that have not been sent yet, as tuples of the
+                 request, its recipient and the deferred for the response.
+    @type queue: C{deque}
+    @ivar sent: Number of requests sent.
+    @type sent: C{int}
+    @ivar timeouts: Number of requests that timed out.
+    @type timeouts: C{int}
+    @ivar latency: Response times, and the number of requests that
+                   resulted in an error.
+    @type latency: L{HandlerStats<wokkel.metrics.HandlerStats>}
+    """
+
+    maxOutstanding = None
+
+    def __init__(self, xs, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+
+        self.pending = 0
+        self.queue = deque()
+        self.sent = 0
+        self.timeouts = 0
+        self.latency = HandlerStats(DEFAULT_BUCKETS)
+
+        xs.addObserver(xmlstream.STREAM_END_EVENT, self._disconnected)
+
+
+    def send(self, iq, to=None):
+        """
+        Send out an iq request, or queue it.
+
+        @param iq: The request.
+        @type iq: L{xmlstream.IQ}
+        @param to: The recipient, if not set on the request yet.
+        @return: Deferred that fires with the response.
+        @rtype: L{defer.Deferred}
+        """
+        if (self.maxOutstanding is not None and
+            self.pending >= self.maxOutstanding):
+            d = defer.Deferred()
+            self.queue.append((iq, to, d))
+            return d
+        else:
+            return self._send(iq, to)
+
+
+    def getStats(self):
+        """
+        Return the request statistics.
+
+        @rtype: C{dict}
+        """
+        return {'pending': self.pending,
+                'queued': len(self.queue),
+                'sent': self.sent,
+                'timeouts': self.timeouts,
+                'errors': self.latency.errors,
+                'responseTime': self.latency.mean()}
+
+
+    def _send(self, iq, to):
+        start = self._reactor.seconds()
+        self.pending += 1
+        self.sent += 1
+        d = xmlstream.IQ.send(iq, to)
+        d.addBoth(self._responded, start)
+        return d
+
+
+    def _responded(self, result, start):
+        self.pending -= 1
+
+        failed = isinstance(result, failure.Failure)
+        if failed and result.check(xmlstream.TimeoutError):
+            self.timeouts += 1
+        self.latency.add(self._reactor.seconds() - start, failed)
+
+        while self.queue and (self.maxOutstanding is None or
+                              self.pending < self.maxOutstanding):
+            iq, to, d = self.queue.popleft()
+            self._send(iq, to).chainDeferred(d)
+
+        return result
+
+
+    def _disconnected(self, _):
+        """
+        Fail queued requests when the stream is closed.
+        """
+        queue = self.queue
+        self.queue = deque()
+        for iq, to, d in queue:
+            d.errback(ConnectionLost())
+
+
+
+def getRequestTracker(xs, reactor=None):
+    """
+    Return the iq request tracker of a stream, setting one up if needed.
+
+    @type xs: L{xmlstream.XmlStream}
+    @rtype: L{IQRequestTracker}
+    """
+    try:
+        return xs.iqRequestTracker
+    except AttributeError:
+        xs.iqRequestTracker = IQRequestTracker(xs, reactor)
+        return xs.iqRequestTracker
+
+
+
 class IQ(xmlstream.IQ):
+    """
+    Wrapper for an iq stanza.
+
+    Requests are sent through the L{IQRequestTracker} of the stream, and
+    always time out, unless both L{defaultTimeout} and the stream's
+    C{iqDefaultTimeout} are C{None}.
+
+    @cvar defaultTimeout: Timeout in seconds for requests that have no
+                          timeout of their own, if the stream does not have
+                          a C{iqDefaultTimeout} either.
+    @type defaultTimeout: C{float}
+    """
+
+    defaultTimeout = 60
+
     def __init__(self, *args, **kwargs):
         # Make sure we have a reactor parameter
         try:
@@ -104,6 +250,7 @@ class IQ(xmlstream.IQ):
         except KeyError:
             from twisted.internet import reactor
         kwargs['reactor'] = reactor
+        self._reactor = reactor
 
         # Check if IQ's init accepts the reactor parameter
         try:
@@ -115,3 +262,17 @@ class IQ(xmlstream.IQ):
 
             # Patch the XmlStream instance so that it has a _callLater
             self._xmlstream._callLater = reactor.callLater
+
+
+    def send(self, to=None):
+        """
+        Send out this iq.
+
+        See L{xmlstream.IQ.send} for details.
+        """
+        if self.timeout is None:
+            self.timeout = (getattr(self._xmlstream, 'iqDefaultTimeout', None)
+                            or self.defaultTimeout)
+
+        tracker = getRequestTracker(self._xmlstream, self._reactor)
+        return tracker.send(self, to)
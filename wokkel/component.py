@@ -27,16 +27,27 @@ except ImportError:
     from wokkel.compat import XmlStreamServerFactory
 
 from wokkel.generic import XmlPipe
+from wokkel.reconnect import ReconnectingXmlStreamFactory
 from wokkel.subprotocols import StreamManager
 
 NS_COMPONENT_ACCEPT = 'jabber:component:accept'
 
 class Component(StreamManager, service.Service):
-    def __init__(self, host, port, jid, password):
+    """
+    Service that connects to a server as an external component.
+
+    @ivar reconnectPolicy: The policy for reconnecting after the connection
+                           failed or was lost.
+    @type reconnectPolicy: L{ReconnectPolicy}
+    """
+
+    def __init__(self, host, port, jid, password, reconnectPolicy=None):
         self.host = host
         self.port = port
 
-        factory = component.componentFactory(jid, password)
+        authenticator = component.ConnectComponentAuthenticator(jid, password)
+        factory = ReconnectingXmlStreamFactory(authenticator, reconnectPolicy)
+        self.reconnectPolicy = factory.policy
 
         StreamManager.__init__(self, factory)
 
@@ -65,12 +76,12 @@ class Component(StreamManager, service.Service):
     def startService(self):
         service.Service.startService(self)
 
-        self.factory.stopTrying()
         self._connection = self._getConnection()
 
     def stopService(self):
         service.Service.stopService(self)
 
+        self.factory.stopTrying()
         self._connection.disconnect()
 
     def _getConnection(self):
@@ -433,9 +433,13 @@ class DiscoHandler(XMPPHandler, IQHandlerMixin):
     iqHandlers = {DISCO_INFO: '_onDiscoInfo',
                   DISCO_ITEMS: '_onDiscoItems'}
 
+    stanzaInterests = (
+        ('iq', 'get', NS_DISCO_INFO, 'handleRequest'),
+        ('iq', 'get', NS_DISCO_ITEMS, 'handleRequest'),
+        )
+
     def connectionInitialized(self):
-        self.xmlstream.addObserver(DISCO_INFO, self.handleRequest)
-        self.xmlstream.addObserver(DISCO_ITEMS, self.handleRequest)
+        self.observeStanzaInterests()
 
 
     def _onDiscoInfo(self, iq):
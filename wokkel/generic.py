@@ -101,12 +101,16 @@ class VersionHandler(XMPPHandler, IQHandlerMixin):
 
     iqHandlers = {VERSION: 'onVersion'}
 
+    stanzaInterests = (
+        ('iq', 'get', NS_VERSION, 'handleRequest'),
+        )
+
     def __init__(self, name, version):
         self.name = name
         self.version = version
 
     def connectionInitialized(self):
-        self.xmlstream.addObserver(VERSION, self.handleRequest)
+        self.observeStanzaInterests()
 
     def onVersion(self, iq):
         response = toResponse(iq, "result")
@@ -110,6 +110,53 @@ class IXMPPHandlerCollection(Interface):
 
 
 
+class IPacketQueue(Interface):
+    """
+    Queue for data sent while there is no initialized XML stream.
+
+    Queued objects are those accepted by L{XmlStream.send
+    <twisted.words.protocols.jabber.xmlstream.XmlStream.send>}.
+    """
+
+    def __len__():
+        """
+        Return the number of queued objects.
+        """
+
+
+    def append(obj):
+        """
+        Add an object to the end of the queue.
+
+        When the queue is full, the queue's policy decides whether an older
+        object or C{obj} itself is dropped.
+        """
+
+
+    def prepend(objs):
+        """
+        Put objects at the front of the queue, keeping their order.
+
+        This is used for data that was already sent, but needs to be sent
+        again, and is not subject to the queue's size limit.
+
+        @type objs: iterable
+        """
+
+
+    def take(count=None):
+        """
+        Remove objects from the front of the queue.
+
+        @param count: The maximum number of objects to remove, or C{None}
+                      to empty the queue.
+        @type count: C{int}
+        @return: The removed objects, oldest first.
+        @rtype: C{list}
+        """
+
+
+
 class IDisco(Interface):
     """
     Interface for XMPP service discovery.
@@ -250,6 +297,51 @@ class IPubSubClient(Interface):
         @rtype: L{defer.Deferred}
         """
 
+    def addNodeObserver(service, nodeIdentifier, observer):
+        """
+        Register an observer for events of a node.
+
+        Events for a node with observers are passed to those observers
+        instead of to L{itemsReceived}, L{deleteReceived} or
+        L{purgeReceived}.
+
+        @param service: The publish-subscribe service entity.
+        @type service: L{jid.JID}
+        @param nodeIdentifier: Identifier of the node.
+        @type nodeIdentifier: L{unicode}
+        @param observer: Callable that is called with the event.
+        """
+
+    def removeNodeObserver(service, nodeIdentifier, observer):
+        """
+        Unregister an observer for events of a node.
+
+        @param service: The publish-subscribe service entity.
+        @type service: L{jid.JID}
+        @param nodeIdentifier: Identifier of the node.
+        @type nodeIdentifier: L{unicode}
+        @param observer: The previously registered observer.
+        """
+
+    def publishMany(service, publications, sender=None, window=None,
+                    batchSize=None):
+        """
+        Publish many items, keeping several publish requests in flight.
+
+        @param service: The publish-subscribe service entity.
+        @type service: L{jid.JID}
+        @param publications: Tuples of a node identifier and the items to
+                             publish to that node.
+        @type publications: iterable
+        @param window: Maximum number of publish requests in flight.
+        @type window: C{int}
+        @param batchSize: Maximum number of items per publish request.
+        @type batchSize: C{int}
+        @return: Deferred that fires with a list of C{(success, result)}
+                 tuples, one per item.
+        @rtype: L{defer.Deferred}
+        """
+
 
 class IPubSubService(Interface):
     """
@@ -279,6 +371,75 @@ class IPubSubService(Interface):
         """
 
 
+    def notifyRetract(service, nodeIdentifier, notifications):
+        """
+        Send out notifications for retracted items, in batches.
+
+        @param service: The entity the notifications will originate from.
+        @type service: L{jid.JID}
+        @param nodeIdentifier: The identifier of the node items were
+                               retracted from.
+        @type nodeIdentifier: C{unicode}
+        @param notifications: The notifications as tuples of subscriber, the
+                              list of subscriptions and the list of
+                              C{retract} elements to be notified.
+        @type notifications: C{list} of (L{jid.JID}, C{list} of
+                             L{Subscription<wokkel.pubsub.Subscription>},
+                             C{list} of L{domish.Element})
+        @return: Deferred that fires when all notifications have been sent.
+        @rtype: L{defer.Deferred}
+        """
+
+
+    def notifyPurge(service, nodeIdentifier, subscribers):
+        """
+        Send out node purge notifications.
+
+        @param service: The entity the notifications will originate from.
+        @type service: L{jid.JID}
+        @param nodeIdentifier: The identifier of the node that was purged.
+        @type nodeIdentifier: C{unicode}
+        @param subscribers: The subscribers for which a notification should
+                            be sent out, or tuples of subscriber and the
+                            subscriptions causing the notification.
+        @type subscribers: C{list} of L{jid.JID} or of (L{jid.JID},
+                           C{list} of
+                           L{Subscription<wokkel.pubsub.Subscription>})
+        @return: Deferred that fires when all notifications have been sent.
+        @rtype: L{defer.Deferred}
+        """
+
+
+    def notifyPending(service, nodeIdentifier, owners, subscriptions):
+        """
+        Ask node owners to authorize pending subscriptions.
+
+        @param service: The entity the requests will originate from.
+        @type service: L{jid.JID}
+        @param nodeIdentifier: The identifier of the node subscribed to.
+        @type nodeIdentifier: C{unicode}
+        @param owners: The owners of the node.
+        @type owners: C{list} of L{jid.JID}
+        @param subscriptions: The pending subscriptions.
+        @type subscriptions: C{list} of L{wokkel.pubsub.Subscription}
+        @return: Deferred that fires when all requests have been sent.
+        @rtype: L{defer.Deferred}
+        """
+
+
+    def notifySubscription(service, nodeIdentifier, subscription):
+        """
+        Notify a subscriber of a change of its subscription state.
+
+        @param service: The entity the notification will originate from.
+        @type service: L{jid.JID}
+        @param nodeIdentifier: The identifier of the node subscribed to.
+        @type nodeIdentifier: C{unicode}
+        @param subscription: The changed subscription.
+        @type subscription: L{wokkel.pubsub.Subscription}
+        """
+
+
     def notifyDelete(service, nodeIdentifier, subscribers,
                      redirectURI=None):
         """
@@ -610,6 +771,20 @@ class IPubSubResource(Interface):
         """
 
 
+    def getSubscriptionOptions():
+        """
+        Retrieve all known subscription options.
+
+        The returned dictionary holds the possible subscription options by
+        option name, in the same format as returned by
+        L{getConfigurationOptions}. Submitted subscription options are
+        checked against these, and they are used to render subscription
+        options forms.
+
+        @rtype: C{dict}.
+        """
+
+
     def publish(request):
         """
         Called when a publish request has been received.
@@ -726,9 +901,19 @@ class IPubSubResource(Interface):
         """
         Called when a items retrieval request has been received.
 
+        Instead of a list, the deferred may also fire with another iterable,
+        for example a generator, that produces items, or deferreds that
+        fire with an item, as they become available. Each item is
+        serialized as soon as it is produced, so large responses do not have
+        to be kept in memory as a complete element tree. The response itself
+        is sent in one piece, when all items have been produced. Items kept
+        as L{SerializedItem<wokkel.pubsub.SerializedItem>} are copied into
+        the response as they are.
+
         @param request: The publish-subscribe request.
         @type request: L{wokkel.pubsub.PubSubRequest}
-        @return: A deferred that fires with a C{list} of L{pubsub.Item}.
+        @return: A deferred that fires with a C{list} of L{pubsub.Item}, or
+                 another iterable of items.
         @rtype: L{defer.Deferred}
         """
 
@@ -749,10 +934,15 @@ class IPubSubResource(Interface):
         """
         Called when a node purge request has been received.
 
+        To purge large nodes incrementally, the deferred may instead fire
+        with an iterable that removes some of the items each step. It
+        produces the number of items removed in that step, or a deferred
+        that fires with that number, and is processed cooperatively.
+
         @param request: The publish-subscribe request.
         @type request: L{wokkel.pubsub.PubSubRequest}
         @return: A deferred that fires with C{None} when the node has been
-                 purged.
+                 purged, or with an iterable that purges the node.
         @rtype: L{defer.Deferred}
         """
 
@@ -0,0 +1,226 @@
+# -*- test-case-name: wokkel.test.test_metrics -*-
+#
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+Instrumentation of XMPP subprotocol handlers.
+
+A L{HandlerMetrics} object set as the C{metrics} attribute of a
+L{StreamManager<wokkel.subprotocols.StreamManager>} records, per handler
+and kind of stanza, how many stanzas were processed, how many of those
+failed, and how long processing took.
+"""
+
+from bisect import bisect_left
+
+from twisted.python import reflect
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+def handlerName(obj):
+    """
+    Return a name identifying the handler behind a callable or handler.
+
+    For bound methods, this is the fully qualified name of the class of
+    the object the method is bound to.
+    """
+    obj = getattr(obj, 'im_self', obj)
+    if hasattr(obj, '__class__') and not hasattr(obj, '__name__'):
+        return reflect.qual(obj.__class__)
+    else:
+        return getattr(obj, '__name__', repr(obj))
+
+
+
+class HandlerStats(object):
+    """
+    Processing statistics for one handler and kind of stanza.
+
+    @ivar count: Number of processed stanzas.
+    @type count: C{int}
+    @ivar errors: Number of stanzas for which processing failed.
+    @type errors: C{int}
+    @ivar total: Total processing time in seconds.
+    @type total: C{float}
+    @ivar buckets: Latency histogram: the number of stanzas with a
+                   processing time up to the respective bucket boundary,
+                   the last item counting those that took longer.
+    @type buckets: C{list} of C{int}
+    """
+
+    def __init__(self, boundaries):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.boundaries = boundaries
+        self.buckets = [0] * (len(boundaries) + 1)
+
+
+    def add(self, duration, failed):
+        self.count += 1
+        self.total += duration
+        if failed:
+            self.errors += 1
+        self.buckets[bisect_left(self.boundaries, duration)] += 1
+
+
+    def errorRate(self):
+        """
+        Return the fraction of stanzas for which processing failed.
+        """
+        if not self.count:
+            return 0.0
+        return float(self.errors) / self.count
+
+
+    def mean(self):
+        """
+        Return the mean processing time in seconds.
+        """
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+
+
+class HandlerMetrics(object):
+    """
+    Collector of handler processing statistics.
+
+    @ivar boundaries: Upper bounds, in seconds, of the latency histogram
+                      buckets.
+    @type boundaries: C{tuple}
+    @ivar stats: Statistics keyed by handler name and stanza kind.
+    @type stats: C{dict} of L{HandlerStats}
+    """
+
+    def __init__(self, boundaries=DEFAULT_BUCKETS, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.boundaries = tuple(boundaries)
+        self.stats = {}
+
+
+    def record(self, handler, kind, duration, failed=False):
+        """
+        Record the processing of one stanza.
+
+        @param handler: The handler name.
+        @type handler: C{str}
+        @param kind: The kind of stanza, like C{'message'} or C{'iq:get'}.
+        @type kind: C{str}
+        @param duration: The processing time in seconds.
+        @type duration: C{float}
+        @param failed: Whether processing failed.
+        @type failed: C{bool}
+        """
+        key = (handler, kind)
+        try:
+            stats = self.stats[key]
+        except KeyError:
+            stats = self.stats[key] = HandlerStats(self.boundaries)
+        stats.add(duration, failed)
+
+
+    def wrap(self, callback, kind=None):
+        """
+        Wrap an observer callback to record its processing time.
+
+        @param callback: The callback to wrap. Its first argument is
+                         expected to be the stanza.
+        @param kind: The kind of stanza. If C{None}, the name of the stanza
+                     passed to the callback is used.
+        @type kind: C{str}
+        @return: The wrapped callback.
+        """
+        def timed(stanza, *args, **kwargs):
+            return self.call(callback, kind, stanza, *args, **kwargs)
+
+        return timed
+
+
+    def call(self, callback, kind, stanza, *args, **kwargs):
+        """
+        Call an observer callback, recording its processing time.
+
+        @param callback: The callback to call with the stanza and any
+                         further arguments.
+        @param kind: The kind of stanza. If C{None}, the name of the stanza
+                     is used.
+        @type kind: C{str}
+        @return: The result of the callback.
+        """
+        seconds = self._reactor.seconds
+        start = seconds()
+        try:
+            result = callback(stanza, *args, **kwargs)
+        except:
+            self.record(handlerName(callback), kind or stanza.name,
+                        seconds() - start, True)
+            raise
+        self.record(handlerName(callback), kind or stanza.name,
+                    seconds() - start)
+        return result
+
+
+    def track(self, handler, kind, d):
+        """
+        Record the processing time of a request until a deferred fires.
+
+        @param handler: The handler processing the request.
+        @param kind: The kind of stanza.
+        @type kind: C{str}
+        @param d: The deferred that fires when processing is done.
+        @type d: L{defer.Deferred}
+        @return: C{d}, with the result passed through.
+        """
+        name = handlerName(handler)
+        start = self._reactor.seconds()
+
+        def done(result, failed):
+            self.record(name, kind, self._reactor.seconds() - start, failed)
+            return result
+
+        d.addCallbacks(done, done, callbackArgs=(False,),
+                                   errbackArgs=(True,))
+        return d
+
+
+    def reset(self):
+        """
+        Drop all recorded statistics.
+        """
+        self.stats = {}
+
+
+    def dump(self):
+        """
+        Return all statistics as plain text.
+
+        Each line has a metric name, its labels and the value, in the style
+        of the Prometheus text format.
+
+        @rtype: C{str}
+        """
+        lines = []
+        for (handler, kind), stats in sorted(self.stats.iteritems()):
+            labels = 'handler="%s",kind="%s"' % (handler, kind)
+            lines.append('handler_stanzas_total{%s} %d' % (labels,
+                                                           stats.count))
+            lines.append('handler_errors_total{%s} %d' % (labels,
+                                                          stats.errors))
+
+            cumulative = 0
+            bounds = [repr(bound) for bound in self.boundaries] + ['+Inf']
+            for bound, count in zip(bounds, stats.buckets):
+                cumulative += count
+                lines.append('handler_latency_seconds_bucket{%s,le="%s"} %d' %
+                             (labels, bound, cumulative))
+            lines.append('handler_latency_seconds_sum{%s} %r' % (labels,
+                                                                 stats.total))
+            lines.append('handler_latency_seconds_count{%s} %d' %
+                         (labels, stats.count))
+
+        return ''.join([line + '\n' for line in lines])
@@ -0,0 +1,300 @@
+# -*- test-case-name: wokkel.test.test_packetqueue -*-
+#
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+Queues for data sent while there is no initialized XML stream.
+
+The stream manager keeps outgoing data in a queue providing
+L{IPacketQueue<wokkel.iwokkel.IPacketQueue>} while it is disconnected, and
+replays the queue when a new stream has been initialized.
+"""
+
+import os
+from collections import deque
+
+from zope.interface import implements
+
+from twisted.python import log
+from twisted.words.xish.domish import IElement
+
+from wokkel.iwokkel import IPacketQueue
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+
+class MemoryPacketQueue(object):
+    """
+    In-memory packet queue.
+
+    Without a maximum size, this behaves like a plain list. With a maximum
+    size, it acts as a ring buffer: when full, either the oldest queued
+    object is dropped to make room (L{DROP_OLDEST}), or the new object is
+    not queued (L{DROP_NEWEST}).
+
+    @ivar maxSize: Maximum number of queued objects, or C{None}.
+    @type maxSize: C{int}
+    @ivar policy: What to drop when the queue is full. Either L{DROP_OLDEST}
+                  or L{DROP_NEWEST}.
+    @type policy: C{str}
+    @ivar dropped: Number of objects dropped because the queue was full.
+    @type dropped: C{int}
+    """
+
+    implements(IPacketQueue)
+
+    def __init__(self, maxSize=None, policy=DROP_OLDEST):
+        self.maxSize = maxSize
+        self.policy = policy
+        self.dropped = 0
+        self._queue = deque()
+
+
+    def __len__(self):
+        return len(self._queue)
+
+
+    def __getitem__(self, index):
+        return self._queue[index]
+
+
+    def __iter__(self):
+        return iter(self._queue)
+
+
+    def append(self, obj):
+        if self.maxSize is not None and len(self._queue) >= self.maxSize:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                log.msg("Packet queue full, dropping newest packet")
+                return
+            else:
+                log.msg("Packet queue full, dropping oldest packet")
+                self._queue.popleft()
+
+        self._queue.append(obj)
+
+
+    def prepend(self, objs):
+        self._queue.extendleft(reversed(list(objs)))
+
+
+    def take(self, count=None):
+        if count is None or count >= len(self._queue):
+            objs = list(self._queue)
+            self._queue.clear()
+        else:
+            popleft = self._queue.popleft
+            objs = [popleft() for i in xrange(count)]
+        return objs
+
+
+
+class SpoolingPacketQueue(object):
+    """
+    Packet queue that spills to disk.
+
+    Up to C{maxMemory} objects are kept in memory. Beyond that, objects are
+    serialized and appended to a spool file, and read back in as the
+    in-memory part is taken from the queue. Elements come back as
+    L{domish.Element}s, other objects as strings.
+
+    The position up to which spooled objects have been taken from the queue
+    is kept in a file next to the spool file, with the suffix C{.offset}.
+    Objects left in the spool file when the process stops, and not yet
+    taken, are picked up again by a new queue using the same file. Objects
+    only kept in memory, or read back into memory but not taken yet, are
+    lost.
+
+    @ivar path: Path of the spool file.
+    @type path: C{str}
+    @ivar maxMemory: Maximum number of objects kept in memory.
+    @type maxMemory: C{int}
+    @ivar maxSize: Maximum number of queued objects, or C{None}.
+    @type maxSize: C{int}
+    @ivar policy: What to drop when the queue is full. Either L{DROP_OLDEST}
+                  or L{DROP_NEWEST}.
+    @type policy: C{str}
+    @ivar dropped: Number of objects dropped because the queue was full.
+    @type dropped: C{int}
+    """
+
+    implements(IPacketQueue)
+
+    def __init__(self, path, maxMemory=1000, maxSize=None,
+                       policy=DROP_OLDEST):
+        self.path = path
+        self.maxMemory = maxMemory
+        self.maxSize = maxSize
+        self.policy = policy
+        self.dropped = 0
+
+        self._memory = deque()
+        self._spooled = 0
+        self._readOffset = 0
+
+        if os.path.exists(path):
+            self._readOffset = self._loadOffset()
+            spool = open(path, 'rb')
+            try:
+                spool.seek(self._readOffset)
+                while self._readRecord(spool) is not None:
+                    self._spooled += 1
+            finally:
+                spool.close()
+        elif os.path.exists(self._offsetPath()):
+            os.remove(self._offsetPath())
+
+
+    def __len__(self):
+        return len(self._memory) + self._spooled
+
+
+    def append(self, obj):
+        if self.maxSize is not None and len(self) >= self.maxSize:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                log.msg("Packet queue full, dropping newest packet")
+                return
+            else:
+                log.msg("Packet queue full, dropping oldest packet")
+                self.take(1)
+
+        if self._spooled or len(self._memory) >= self.maxMemory:
+            self._spool(obj)
+        else:
+            self._memory.append((obj, None))
+
+
+    def prepend(self, objs):
+        self._memory.extendleft([(obj, None) for obj in reversed(list(objs))])
+
+
+    def take(self, count=None):
+        if count is None:
+            count = len(self)
+
+        objs = []
+        takenOffset = None
+        while len(objs) < count:
+            if not self._memory:
+                self._unspool(count - len(objs))
+                if not self._memory:
+                    break
+            obj, offset = self._memory.popleft()
+            objs.append(obj)
+            if offset is not None:
+                takenOffset = offset
+
+        if takenOffset is not None:
+            self._taken(takenOffset)
+        return objs
+
+
+    def _offsetPath(self):
+        return self.path + '.offset'
+
+
+    def _loadOffset(self):
+        """
+        Return the offset up to which spooled objects have been taken.
+        """
+        try:
+            f = open(self._offsetPath(), 'rb')
+        except IOError:
+            return 0
+
+        try:
+            try:
+                return int(f.read())
+            except ValueError:
+                return 0
+        finally:
+            f.close()
+
+
+    def _taken(self, offset):
+        """
+        Record that spooled objects up to C{offset} have been taken.
+
+        If all spooled objects have been taken, the spool file is removed.
+        """
+        if not self._spooled and offset == self._readOffset:
+            os.remove(self.path)
+            if os.path.exists(self._offsetPath()):
+                os.remove(self._offsetPath())
+            self._readOffset = 0
+            return
+
+        temporaryPath = self._offsetPath() + '.tmp'
+        f = open(temporaryPath, 'wb')
+        try:
+            f.write(str(offset))
+        finally:
+            f.close()
+        os.rename(temporaryPath, self._offsetPath())
+
+
+    def _spool(self, obj):
+        """
+        Append an object to the spool file.
+        """
+        if IElement.providedBy(obj):
+            kind, data = 'e', obj.toXml().encode('utf-8')
+        elif isinstance(obj, unicode):
+            kind, data = 'u', obj.encode('utf-8')
+        else:
+            kind, data = 's', str(obj)
+
+        spool = open(self.path, 'ab')
+        try:
+            spool.write('%s %d\n' % (kind, len(data)))
+            spool.write(data)
+        finally:
+            spool.close()
+
+        self._spooled += 1
+
+
+    def _unspool(self, count):
+        """
+        Read up to C{count} objects from the spool file into memory.
+        """
+        if not self._spooled:
+            return
+
+        count = min(count, self.maxMemory, self._spooled)
+        spool = open(self.path, 'rb')
+        try:
+            spool.seek(self._readOffset)
+            for i in xrange(count):
+                obj = self._readRecord(spool)
+                self._memory.append((obj, spool.tell()))
+            self._readOffset = spool.tell()
+        finally:
+            spool.close()
+
+        self._spooled -= count
+
+
+    def _readRecord(self, spool):
+        """
+        Read the next object from an open spool file.
+
+        @return: The object, or C{None} at the end of the file.
+        """
+        header = spool.readline()
+        if not header:
+            return None
+
+        kind, length = header.split()
+        data = spool.read(int(length))
+
+        if kind == 'e':
+            from wokkel.generic import parseXml
+            return parseXml(data)
+        elif kind == 'u':
+            return data.decode('utf-8')
+        else:
+            return data
@@ -13,7 +13,7 @@ U{XEP-0199<http://xmpp.org/extensions/xep-0199.html>}.
 from zope.interface import implements
 
 from twisted.words.protocols.jabber.error import StanzaError
-from twisted.words.protocols.jabber.xmlstream import IQ, toResponse
+from twisted.words.protocols.jabber.xmlstream import toResponse
 
 try:
     from twisted.words.protocols.xmlstream import XMPPHandler
@@ -21,6 +21,7 @@ except ImportError:
     from wokkel.subprotocols import XMPPHandler
 
 from wokkel import disco, iwokkel
+from wokkel.compat import IQ
 
 NS_PING = 'urn:xmpp:ping'
 PING_REQUEST = "/iq[@type='get']/ping[@xmlns='%s']" % NS_PING
@@ -77,13 +78,17 @@ class PingHandler(XMPPHandler):
 
     implements(iwokkel.IDisco)
 
+    stanzaInterests = (
+        ('iq', 'get', NS_PING, 'onPing'),
+        )
+
     def connectionInitialized(self):
         """
         Called when the XML stream has been initialized.
 
         This sets up an observer for incoming ping requests.
         """
-        self.xmlstream.addObserver(PING_REQUEST, self.onPing)
+        self.observeStanzaInterests()
 
 
     def onPing(self, iq):
@@ -10,9 +10,12 @@ This protocol is specified in
 U{XEP-0060<http://www.xmpp.org/extensions/xep-0060.html>}.
 """
 
+import weakref
+from collections import deque
+
 from zope.interface import implements
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.python import log
 from twisted.words.protocols.jabber import jid, error
 from twisted.words.xish import domish
@@ -21,6 +24,7 @@ from wokkel import disco, data_form, generic, shim
 from wokkel.compat import IQ
 from wokkel.subprotocols import IQHandlerMixin, XMPPHandler
 from wokkel.iwokkel import IPubSubClient, IPubSubService, IPubSubResource
+from wokkel.xmppim import PresenceProtocol
 
 # Iq get and set XPath queries
 IQ_GET = '/iq[@type="get"]'
@@ -34,12 +38,30 @@ NS_PUBSUB_OWNER = NS_PUBSUB + "#owner"
 NS_PUBSUB_NODE_CONFIG = NS_PUBSUB + "#node_config"
 NS_PUBSUB_META_DATA = NS_PUBSUB + "#meta-data"
 NS_PUBSUB_SUBSCRIBE_OPTIONS = NS_PUBSUB + "#subscribe_options"
+NS_PUBSUB_SUBSCRIBE_AUTHORIZATION = NS_PUBSUB + "#subscribe_authorization"
 
 # XPath to match pubsub requests
 PUBSUB_REQUEST = '/iq[@type="get" or @type="set"]/' + \
                     'pubsub[@xmlns="' + NS_PUBSUB + '" or ' + \
                            '@xmlns="' + NS_PUBSUB_OWNER + '"]'
 
+# XPath to match submitted forms, like subscription authorizations
+FORM_SUBMIT = '/message/x[@xmlns="' + data_form.NS_X_DATA + '"]' + \
+                        '[@type="submit"]'
+
+# Fields of subscription authorization forms
+_authorizationOptions = {
+    'pubsub#node':
+        {'type': 'text-single',
+         'label': 'Node ID'},
+    'pubsub#subscriber_jid':
+        {'type': 'jid-single',
+         'label': 'Subscriber Address'},
+    'pubsub#allow':
+        {'type': 'boolean',
+         'label': 'Allow this JID to subscribe to this pubsub node?'},
+    }
+
 class SubscriptionPending(Exception):
     """
     Raised when the requested subscription is pending acceptance.
@@ -149,6 +171,138 @@ class Item(domish.Element):
 
 
 
+class SerializedItem(object):
+    """
+    Publish subscribe item kept as serialized XML.
+
+    Instead of a tree of elements, only the UTF-8 encoded serialization of
+    the item is kept. It is written as-is into outgoing stanzas by
+    L{PubSubService}. The item element itself is serialized without a
+    namespace declaration, so that it takes the namespace of the element it
+    is added to, like the C{items} element of a response or notification.
+    Its payload keeps explicit namespace declarations, so that it does not
+    change namespace along with the item element.
+
+    Serialized items are read-only. A L{domish.Element} is built on demand,
+    by L{toElement} or by accessing any other attribute, which is then
+    looked up on a newly built element. Such elements are not kept, so
+    repeated access builds them again, and changes to them are lost.
+    Setting or deleting XML attributes, and the methods of
+    L{domish.Element} that add children, raise C{TypeError}. To change an
+    item, change the element returned by L{toElement} and serialize it
+    again.
+
+    @ivar data: The serialized item.
+    @type data: C{str}
+    @ivar itemIdentifier: The item identifier.
+    @type itemIdentifier: C{unicode}
+    @ivar uri: The namespace of the item element built by L{toElement}.
+    @type uri: C{str}
+    """
+
+    __slots__ = ('data', 'itemIdentifier', 'uri')
+
+    name = 'item'
+
+    _mutators = frozenset(['addChild', 'addContent', 'addElement',
+                           'addRawXml', 'addUniqueId'])
+
+    def __init__(self, data, itemIdentifier=None, uri=NS_PUBSUB):
+        self.data = data
+        self.itemIdentifier = itemIdentifier
+        self.uri = uri
+
+
+    @classmethod
+    def fromElement(Class, element):
+        """
+        Serialize an item element.
+
+        @type element: L{domish.Element}
+        @rtype: L{SerializedItem}
+        """
+        item = domish.Element((None, element.name))
+        item.attributes = dict(element.attributes)
+        for child in element.children:
+            if isinstance(child, domish.Element):
+                child = domish.SerializedXML(child.toXml())
+            item.children.append(child)
+
+        data = item.toXml().encode('utf-8')
+        uri = element.uri
+        if isinstance(uri, unicode):
+            uri = uri.encode('utf-8')
+        return Class(data, element.getAttribute('id'), uri)
+
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        elif name in self._mutators:
+            raise TypeError("Serialized items are read-only")
+        return getattr(self.toElement(), name)
+
+
+    def __setitem__(self, key, value):
+        raise TypeError("Serialized items are read-only")
+
+
+    def __delitem__(self, key):
+        raise TypeError("Serialized items are read-only")
+
+
+    def __getitem__(self, key):
+        if key == 'id' and self.itemIdentifier is not None:
+            return self.itemIdentifier
+        return self.toElement()[key]
+
+
+    def getAttribute(self, attribname, default=None):
+        if attribname == 'id' and self.itemIdentifier is not None:
+            return self.itemIdentifier
+        return self.toElement().getAttribute(attribname, default)
+
+
+    def toXml(self, **kwargs):
+        """
+        Return the serialized item.
+
+        Without arguments, the item is returned as it is kept. Otherwise,
+        the element is built and serialized with the arguments of
+        L{domish.Element.toXml}.
+
+        @rtype: C{unicode}
+        """
+        if kwargs:
+            return self.toElement().toXml(**kwargs)
+        else:
+            return self.data.decode('utf-8')
+
+
+    def toElement(self):
+        """
+        Build the item element.
+
+        @rtype: L{domish.Element}
+        """
+        uri = self.uri
+        if isinstance(uri, unicode):
+            uri = uri.encode('utf-8')
+        wrapper = "<items xmlns='%s'>%s</items>" % (uri, self.data)
+        return generic.parseXml(wrapper).firstChildElement()
+
+
+
+def _itemChildren(items):
+    """
+    Return items as children for an element, keeping serialized items raw.
+    """
+    return [isinstance(item, SerializedItem) and
+            domish.SerializedXML(item.toXml()) or item
+            for item in items]
+
+
+
 class PubSubRequest(generic.Stanza):
     """
     A publish-subscribe request.
@@ -565,63 +719,607 @@ class PurgeEvent(PubSubEvent):
 
 
 
+class _CachedNode(object):
+    """
+    Cached items of a single node.
+
+    @ivar items: The most recent items, oldest first.
+    @type items: C{list} of L{SerializedItem}
+    @ivar warm: Whether the items have been retrieved from the service,
+                as opposed to only collected from notifications.
+    @type warm: C{bool}
+    @ivar complete: Whether the cached items are all items of the node.
+    @type complete: C{bool}
+    @ivar expires: The time after which the node is no longer warm, or
+                   C{None}.
+    @type expires: C{float}
+    """
+
+    def __init__(self):
+        self.items = []
+        self.warm = False
+        self.complete = False
+        self.expires = None
+
+
+
+class ItemCache(object):
+    """
+    Cache of the most recent items of publish-subscribe nodes.
+
+    For each node, identified by service and node identifier, and for each
+    entity retrieving items from it, up to C{maxItems} items are kept. Up
+    to C{maxNodes} of those are cached, the least recently used being
+    evicted when that is exceeded.
+
+    Items collected from notifications are always available through
+    L{getLastItem}. Once the items of a node have been retrieved from the
+    service, the node is warm for C{ttl} seconds, and L{getItems} can answer
+    further retrievals from the cache. Notifications update the cached
+    items of a node for all entities, as does a purge, while deletion of
+    the node drops it.
+
+    Items are kept serialized, in the namespace of items retrieved from the
+    service, whether they were retrieved or received in notifications.
+    Every lookup builds new elements, so that changes to them do not affect
+    the cache.
+
+    @ivar maxItems: Maximum number of items cached per node.
+    @type maxItems: C{int}
+    @ivar maxNodes: Maximum number of cached nodes.
+    @type maxNodes: C{int}
+    @ivar ttl: Number of seconds a node stays warm after retrieval, or
+               C{None} to keep it warm until it is dropped.
+    @type ttl: C{float}
+    @ivar hits: Number of retrievals answered from the cache.
+    @type hits: C{int}
+    @ivar misses: Number of retrievals that could not be answered from the
+                  cache.
+    @type misses: C{int}
+    @ivar evictions: Number of nodes evicted from the cache.
+    @type evictions: C{int}
+    """
+
+    def __init__(self, maxItems=10, maxNodes=1000, ttl=300, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+
+        self.maxItems = maxItems
+        self.maxNodes = maxNodes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._nodes = {}
+        self._senders = {}
+        self._ticks = {}
+        self._order = deque()
+        self._tick = 0
+
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+    def _touch(self, key):
+        """
+        Mark a node as most recently used.
+
+        Usage order is kept as a queue of (tick, key) tuples, where only the
+        tuple with the last tick of a node is current. Stale tuples are
+        skipped on eviction, and the queue is compacted when they pile up.
+        """
+        self._tick += 1
+        self._ticks[key] = self._tick
+        self._order.append((self._tick, key))
+
+        if len(self._order) > 2 * len(self._ticks) + 16:
+            self._order = deque(sorted([(tick, key) for key, tick
+                                        in self._ticks.iteritems()]))
+
+
+    def _get(self, service, nodeIdentifier, sender, create=False):
+        key = (service, nodeIdentifier, sender)
+        try:
+            node = self._nodes[key]
+        except KeyError:
+            if not create:
+                return None
+            node = self._nodes[key] = _CachedNode()
+            self._senders.setdefault(key[:2], set()).add(sender)
+            self._touch(key)
+            self._evict()
+        else:
+            self._touch(key)
+        return node
+
+
+    def _drop(self, key):
+        del self._nodes[key]
+        del self._ticks[key]
+        senders = self._senders[key[:2]]
+        senders.discard(key[2])
+        if not senders:
+            del self._senders[key[:2]]
+
+
+    def _evict(self):
+        while len(self._nodes) > self.maxNodes:
+            tick, key = self._order.popleft()
+            if self._ticks.get(key) == tick:
+                self._drop(key)
+                self.evictions += 1
+
+
+    def _serialize(self, items):
+        """
+        Serialize items into the C{pubsub} namespace.
+        """
+        serialized = []
+        for item in items:
+            if not isinstance(item, SerializedItem):
+                item = SerializedItem.fromElement(item)
+            serialized.append(SerializedItem(item.data, item.itemIdentifier,
+                                             NS_PUBSUB))
+        return serialized
+
+
+    def _store(self, node, items):
+        for item in items:
+            itemIdentifier = item.getAttribute('id')
+            if itemIdentifier is not None:
+                node.items = [cached for cached in node.items
+                              if cached.getAttribute('id') != itemIdentifier]
+            node.items.append(item)
+
+        if len(node.items) > self.maxItems:
+            del node.items[:-self.maxItems]
+            node.complete = False
+
+
+    def getItems(self, service, nodeIdentifier, maxItems=None, sender=None):
+        """
+        Return the cached items of a node, if they answer a retrieval.
+
+        @param service: The publish-subscribe service.
+        @type service: L{jid.JID}
+        @param nodeIdentifier: The identifier of the node.
+        @type nodeIdentifier: C{unicode}
+        @param maxItems: The maximum number of items to retrieve, or
+                         C{None} for all items.
+        @type maxItems: C{int}
+        @param sender: The entity retrieving the items, or C{None} for the
+                       default.
+        @type sender: L{jid.JID}
+        @return: The most recent items, oldest first, or C{None} if the
+                 cache cannot answer the retrieval.
+        @rtype: C{list} of L{domish.Element}
+        """
+        node = self._get(service, nodeIdentifier, sender)
+
+        if node is None or not node.warm:
+            items = None
+        elif (node.expires is not None and
+              node.expires <= self._reactor.seconds()):
+            node.warm = False
+            items = None
+        elif maxItems:
+            if node.complete or maxItems <= len(node.items):
+                items = node.items[-maxItems:]
+            else:
+                items = None
+        elif node.complete:
+            items = node.items
+        else:
+            items = None
+
+        if items is None:
+            self.misses += 1
+            return None
+        else:
+            self.hits += 1
+            return [item.toElement() for item in items]
+
+
+    def getLastItem(self, service, nodeIdentifier, sender=None):
+        """
+        Return the most recently published item of a node, if known.
+
+        @rtype: L{domish.Element}
+        """
+        node = self._get(service, nodeIdentifier, sender)
+        if node and node.items:
+            return node.items[-1].toElement()
+        else:
+            return None
+
+
+    def setItems(self, service, nodeIdentifier, items, complete,
+                       sender=None):
+        """
+        Fill the cache for a node with items retrieved from the service.
+
+        @param items: The retrieved items, oldest first.
+        @type items: C{list} of L{domish.Element}
+        @param complete: Whether these are all the items of the node.
+        @type complete: C{bool}
+        @param sender: The entity that retrieved the items, or C{None} for
+                       the default.
+        @type sender: L{jid.JID}
+        """
+        node = self._get(service, nodeIdentifier, sender, create=True)
+        node.items = []
+        node.warm = True
+        node.complete = complete
+        if self.ttl is not None:
+            node.expires = self._reactor.seconds() + self.ttl
+        else:
+            node.expires = None
+        self._store(node, self._serialize(items))
+
+
+    def _cachedSenders(self, service, nodeIdentifier):
+        """
+        Return the entities a node is cached for, at least the default one.
+        """
+        return list(self._senders.get((service, nodeIdentifier), [None]))
+
+
+    def itemsReceived(self, service, nodeIdentifier, items):
+        """
+        Update the cache for a node from a notification.
+
+        Items without a payload do not reveal the item's contents, so
+        receiving one drops the node from the cache.
+
+        @param items: The C{item} and C{retract} elements of the
+                      notification.
+        @type items: C{list} of L{domish.Element}
+        """
+        published = []
+        retracted = set()
+        for element in items:
+            if element.name == 'retract':
+                retracted.add(element.getAttribute('id'))
+            elif element.firstChildElement() is None:
+                self.invalidate(service, nodeIdentifier)
+                return
+            else:
+                published.append(element)
+
+        published = self._serialize(published)
+        for sender in self._cachedSenders(service, nodeIdentifier):
+            node = self._get(service, nodeIdentifier, sender, create=True)
+            if retracted:
+                node.items = [item for item in node.items
+                              if item.getAttribute('id') not in retracted]
+            self._store(node, published)
+
+
+    def purged(self, service, nodeIdentifier):
+        """
+        Record that all items of a node have been purged.
+        """
+        for sender in self._cachedSenders(service, nodeIdentifier):
+            self.setItems(service, nodeIdentifier, [], True, sender)
+
+
+    def invalidate(self, service, nodeIdentifier):
+        """
+        Drop a node from the cache, for all entities.
+        """
+        senders = self._senders.get((service, nodeIdentifier), ())
+        for sender in list(senders):
+            self._drop((service, nodeIdentifier, sender))
+
+
+    def clear(self):
+        """
+        Drop all nodes from the cache.
+        """
+        self._nodes = {}
+        self._senders = {}
+        self._ticks = {}
+        self._order = deque()
+
+
+
+class _BulkPublisher(object):
+    """
+    Publisher of many items, keeping a window of publish requests in flight.
+
+    Items for the same node are packed into publish requests of up to
+    C{batchSize} items. If the service rejects such a request with a
+    C{bad-request} error, the node is assumed to accept only one item per
+    publish request, and its items are published one by one from then on.
+
+    @ivar results: For each item, in order of the publications, a tuple of a
+                   success flag and either the item identifier or the
+                   failure.
+    @type results: C{list}
+    """
+
+    def __init__(self, client, service, publications, sender, window,
+                       batchSize):
+        self.client = client
+        self.service = service
+        self.sender = sender
+        self.window = window
+        self.batchSize = batchSize
+
+        self.results = []
+        self.inFlight = 0
+        self.retries = deque()
+        self.singleItemNodes = set()
+        self.deferred = defer.Deferred()
+        self._batches = self._generateBatches(publications)
+        self._sending = False
+
+
+    def _generateBatches(self, publications):
+        for nodeIdentifier, items in publications:
+            items = list(items)
+            start = 0
+            while start < len(items):
+                if nodeIdentifier in self.singleItemNodes:
+                    size = 1
+                else:
+                    size = self.batchSize
+                batch = items[start:start + size]
+                start += size
+
+                offset = len(self.results)
+                self.results.extend([None] * len(batch))
+                yield nodeIdentifier, batch, offset
+
+
+    def start(self):
+        self._sendNext()
+        return self.deferred
+
+
+    def _sendNext(self):
+        if self._sending:
+            return
+
+        self._sending = True
+        try:
+            while self.inFlight < self.window:
+                if self.retries:
+                    batch = self.retries.popleft()
+                else:
+                    try:
+                        batch = self._batches.next()
+                    except StopIteration:
+                        break
+                self._publish(*batch)
+        finally:
+            self._sending = False
+
+        if not self.inFlight and not self.retries and \
+           not self.deferred.called:
+            self.deferred.callback(self.results)
+
+
+    def _publish(self, nodeIdentifier, items, offset):
+        self.inFlight += 1
+        d = defer.maybeDeferred(self.client.publish, self.service,
+                                nodeIdentifier, items, self.sender)
+        d.addCallbacks(self._published, self._failed,
+                       callbackArgs=(items, offset),
+                       errbackArgs=(nodeIdentifier, items, offset))
+        d.addBoth(self._done)
+
+
+    def _published(self, iq, items, offset):
+        identifiers = []
+        if iq.pubsub and iq.pubsub.publish:
+            identifiers = [element.getAttribute('id')
+                           for element in iq.pubsub.publish.elements()
+                           if element.name == 'item']
+        if len(identifiers) != len(items):
+            identifiers = [item.getAttribute('id') for item in items]
+
+        for index, identifier in enumerate(identifiers):
+            self.results[offset + index] = (True, identifier)
+
+
+    def _failed(self, failure, nodeIdentifier, items, offset):
+        if (len(items) > 1 and failure.check(error.StanzaError) and
+            failure.value.condition == 'bad-request'):
+            self.singleItemNodes.add(nodeIdentifier)
+            for index, item in enumerate(items):
+                self.retries.append((nodeIdentifier, [item], offset + index))
+        else:
+            for index in xrange(len(items)):
+                self.results[offset + index] = (False, failure)
+
+
+    def _done(self, result):
+        self.inFlight -= 1
+        self._sendNext()
+
+
+
 class PubSubClient(XMPPHandler):
     """
     Publish subscribe client protocol.
+
+    @ivar publishWindow: Default maximum number of publish requests in
+                         flight for L{publishMany}.
+    @type publishWindow: C{int}
+    @ivar publishBatchSize: Default maximum number of items per publish
+                            request for L{publishMany}.
+    @type publishBatchSize: C{int}
+    @ivar cache: Optional cache of node items. If set, it is updated from
+                 notifications and item retrievals, and L{items} is
+                 answered from it when possible. Nodes are dropped from it
+                 on unsubscribing, and the cache is cleared when the
+                 connection is lost.
+    @type cache: L{ItemCache}
     """
 
     implements(IPubSubClient)
 
+    publishWindow = 10
+    publishBatchSize = 1
+    cache = None
+
+    stanzaInterests = (
+        ('message', None, NS_PUBSUB_EVENT, '_onEvent'),
+        )
+
+    _nodeObservers = None
+
     def connectionInitialized(self):
-        self.xmlstream.addObserver('/message/event[@xmlns="%s"]' %
-                                   NS_PUBSUB_EVENT, self._onEvent)
+        self.observeStanzaInterests()
+
+
+    def connectionLost(self, reason):
+        """
+        Drop the cached items, as notifications may be missed from now on.
+        """
+        XMPPHandler.connectionLost(self, reason)
+        if self.cache is not None:
+            self.cache.clear()
+
+
+    def _getEventHandlers(self):
+        """
+        Return the event handlers of this class, by event type.
+
+        The C{_onEvent_*} methods are collected once per class, on first
+        use, and kept on the class.
+        """
+        cls = self.__class__
+        handlers = cls.__dict__.get('_eventHandlers')
+        if handlers is None:
+            prefix = '_onEvent_'
+            handlers = dict([(name[len(prefix):], getattr(cls, name))
+                             for name in dir(cls)
+                             if name.startswith(prefix)])
+            cls._eventHandlers = handlers
+        return handlers
 
 
     def _onEvent(self, message):
         try:
-            sender = jid.JID(message["from"])
-            recipient = jid.JID(message["to"])
+            sender = jid.internJID(message["from"])
+            recipient = jid.internJID(message["to"])
         except KeyError:
             return
 
+        for event in message.elements():
+            if (event.uri, event.name) == (NS_PUBSUB_EVENT, 'event'):
+                break
+        else:
+            return
+
         actionElement = None
-        for element in message.event.elements():
+        for element in event.elements():
             if element.uri == NS_PUBSUB_EVENT:
                 actionElement = element
 
         if not actionElement:
             return
 
-        eventHandler = getattr(self, "_onEvent_%s" % actionElement.name, None)
+        eventHandler = self._getEventHandlers().get(actionElement.name)
 
         if eventHandler:
-            headers = shim.extractHeaders(message)
-            eventHandler(sender, recipient, actionElement, headers)
+            if message.headers is not None:
+                headers = shim.extractHeaders(message)
+            else:
+                headers = {}
+            eventHandler(self, sender, recipient, actionElement, headers)
             message.handled = True
 
 
+    def _dispatchEvent(self, event, default):
+        """
+        Pass an event to the observers of its node, or to C{default}.
+        """
+        if self._nodeObservers:
+            observers = self._nodeObservers.get((event.sender,
+                                                 event.nodeIdentifier))
+        else:
+            observers = None
+
+        if observers:
+            for observer in observers[:]:
+                observer(event)
+        else:
+            default(event)
+
+
+    def addNodeObserver(self, service, nodeIdentifier, observer):
+        """
+        Register an observer for events of a node.
+
+        Events for a node with observers are passed to those observers
+        instead of to L{itemsReceived}, L{deleteReceived} or
+        L{purgeReceived}.
+
+        @param service: The publish subscribe service that keeps the node.
+        @type service: L{JID}
+        @param nodeIdentifier: The identifier of the node.
+        @type nodeIdentifier: C{unicode}
+        @param observer: Callable that is called with the L{PubSubEvent}.
+        """
+        if self._nodeObservers is None:
+            self._nodeObservers = {}
+
+        key = (service, nodeIdentifier)
+        self._nodeObservers.setdefault(key, []).append(observer)
+
+
+    def removeNodeObserver(self, service, nodeIdentifier, observer):
+        """
+        Unregister an observer for events of a node.
+        """
+        if not self._nodeObservers:
+            return
+
+        key = (service, nodeIdentifier)
+        observers = self._nodeObservers.get(key, [])
+        if observer in observers:
+            observers.remove(observer)
+        if not observers:
+            self._nodeObservers.pop(key, None)
+
+
     def _onEvent_items(self, sender, recipient, action, headers):
         nodeIdentifier = action["node"]
 
         items = [element for element in action.elements()
                          if element.name in ('item', 'retract')]
 
+        if self.cache is not None:
+            self.cache.itemsReceived(sender, nodeIdentifier, items)
+
         event = ItemsEvent(sender, recipient, nodeIdentifier, items, headers)
-        self.itemsReceived(event)
+        self._dispatchEvent(event, self.itemsReceived)
 
 
     def _onEvent_delete(self, sender, recipient, action, headers):
         nodeIdentifier = action["node"]
+        if self.cache is not None:
+            self.cache.invalidate(sender, nodeIdentifier)
+
         event = DeleteEvent(sender, recipient, nodeIdentifier, headers)
         if action.redirect:
             event.redirectURI = action.redirect.getAttribute('uri')
-        self.deleteReceived(event)
+        self._dispatchEvent(event, self.deleteReceived)
 
 
     def _onEvent_purge(self, sender, recipient, action, headers):
         nodeIdentifier = action["node"]
+        if self.cache is not None:
+            self.cache.purged(sender, nodeIdentifier)
+
         event = PurgeEvent(sender, recipient, nodeIdentifier, headers)
-        self.purgeReceived(event)
+        self._dispatchEvent(event, self.purgeReceived)
 
 
     def itemsReceived(self, event):
@@ -792,6 +1490,10 @@ class PubSubClient(XMPPHandler):
         request.nodeIdentifier = nodeIdentifier
         request.subscriber = subscriber
         request.sender = sender
+
+        if self.cache is not None:
+            self.cache.invalidate(service, nodeIdentifier)
+
         return request.send(self.xmlstream)
 
 
@@ -814,6 +1516,41 @@ class PubSubClient(XMPPHandler):
         return request.send(self.xmlstream)
 
 
+    def publishMany(self, service, publications, sender=None, window=None,
+                          batchSize=None):
+        """
+        Publish many items, possibly to several nodes.
+
+        Publish requests are pipelined: up to C{window} requests are sent
+        before waiting for responses, and each response lets the next
+        request go out. The publications are consumed lazily, so they can
+        be provided by a generator.
+
+        @param service: The publish subscribe service that keeps the nodes.
+        @type service: L{JID}
+        @param publications: Tuples of a node identifier and the L{Item}s to
+                             publish to that node.
+        @type publications: iterable
+        @param window: Maximum number of publish requests in flight. If
+                       C{None}, L{publishWindow} is used.
+        @type window: C{int}
+        @param batchSize: Maximum number of items per publish request. If
+                          C{None}, L{publishBatchSize} is used. Nodes that
+                          reject publish requests with multiple items get
+                          their items published one at a time.
+        @type batchSize: C{int}
+        @return: Deferred that fires, when all items have been handled,
+                 with a list of C{(success, result)} tuples, one per item
+                 in order. On success, the result is the item identifier,
+                 otherwise the failure.
+        @rtype: L{defer.Deferred}
+        """
+        publisher = _BulkPublisher(self, service, publications, sender,
+                                   window or self.publishWindow,
+                                   batchSize or self.publishBatchSize)
+        return publisher.start()
+
+
     def items(self, service, nodeIdentifier, maxItems=None, sender=None):
         """
         Retrieve previously published items from a publish subscribe node.
@@ -825,6 +1562,12 @@ class PubSubClient(XMPPHandler):
         @param maxItems: Optional limit on the number of retrieved items.
         @type maxItems: C{int}
         """
+        if self.cache is not None:
+            cached = self.cache.getItems(service, nodeIdentifier, maxItems,
+                                         sender)
+            if cached is not None:
+                return defer.succeed(cached)
+
         request = PubSubRequest('items')
         request.recipient = service
         request.nodeIdentifier = nodeIdentifier
@@ -837,6 +1580,10 @@ class PubSubClient(XMPPHandler):
             for element in iq.pubsub.items.elements():
                 if element.uri == NS_PUBSUB and element.name == 'item':
                     items.append(element)
+
+            if self.cache is not None:
+                self.cache.setItems(service, nodeIdentifier, items,
+                                    not maxItems, sender)
             return items
 
         d = request.send(self.xmlstream)
@@ -845,6 +1592,400 @@ class PubSubClient(XMPPHandler):
 
 
 
+class NotificationRouter(object):
+    """
+    Index of subscribers for routing notifications.
+
+    The router keeps the active subscriptions by node, and the collection
+    hierarchy of nodes. From those, it determines for each node the
+    entities to notify, along with the subscriptions that cause the
+    notification: the subscriptions to the node itself and to the
+    collections it is contained in, directly or indirectly.
+
+    These fan-out lists are computed on first use for a node, and then
+    kept up to date as subscriptions come and go, so that routing a
+    notification takes time in the order of the number of subscribers to
+    notify. Changes to the collection hierarchy drop the fan-out lists of
+    the affected nodes, to be computed anew.
+    """
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._collections = {}
+        self._children = {}
+        self._fanOut = {}
+
+
+    def _walk(self, nodeIdentifier, links):
+        """
+        Return a node and all nodes reachable through the given links.
+        """
+        seen = set([nodeIdentifier])
+        pending = [nodeIdentifier]
+        while pending:
+            for linked in links.get(pending.pop(), ()):
+                if linked not in seen:
+                    seen.add(linked)
+                    pending.append(linked)
+        return seen
+
+
+    def getAncestors(self, nodeIdentifier):
+        """
+        Return the collections a node is contained in, at any depth.
+
+        @rtype: C{set}
+        """
+        nodes = self._walk(nodeIdentifier, self._collections)
+        nodes.discard(nodeIdentifier)
+        return nodes
+
+
+    def getDescendants(self, nodeIdentifier):
+        """
+        Return the nodes contained in a collection, at any depth.
+
+        @rtype: C{set}
+        """
+        nodes = self._walk(nodeIdentifier, self._children)
+        nodes.discard(nodeIdentifier)
+        return nodes
+
+
+    def getChildren(self, nodeIdentifier):
+        """
+        Return the nodes directly contained in a collection.
+
+        @rtype: C{set}
+        """
+        return set(self._children.get(nodeIdentifier, ()))
+
+
+    def _invalidate(self, nodeIdentifier):
+        for affected in self._walk(nodeIdentifier, self._children):
+            self._fanOut.pop(affected, None)
+
+
+    def addSubscription(self, subscription):
+        """
+        Add or replace a subscription.
+
+        Only subscriptions in the C{'subscribed'} state receive
+        notifications. A subscription in another state removes a previous
+        subscription of the same subscriber to the node.
+
+        @type subscription: L{Subscription}
+        """
+        nodeIdentifier = subscription.nodeIdentifier
+        subscriber = subscription.subscriber
+        if subscription.state != 'subscribed':
+            self.removeSubscription(nodeIdentifier, subscriber)
+            return
+
+        self._subscriptions.setdefault(nodeIdentifier, {})[subscriber] = \
+                subscription
+
+        for affected in self._walk(nodeIdentifier, self._children):
+            fanOut = self._fanOut.get(affected)
+            if fanOut is not None:
+                subscriptions = [s for s in fanOut.get(subscriber, ())
+                                 if s.nodeIdentifier != nodeIdentifier]
+                subscriptions.append(subscription)
+                fanOut[subscriber] = subscriptions
+
+
+    def removeSubscription(self, nodeIdentifier, subscriber):
+        """
+        Remove the subscription of a subscriber to a node, if any.
+        """
+        subscriptions = self._subscriptions.get(nodeIdentifier, {})
+        if subscriptions.pop(subscriber, None) is None:
+            return
+        if not subscriptions:
+            del self._subscriptions[nodeIdentifier]
+
+        for affected in self._walk(nodeIdentifier, self._children):
+            fanOut = self._fanOut.get(affected)
+            if fanOut is not None and subscriber in fanOut:
+                remaining = [s for s in fanOut[subscriber]
+                             if s.nodeIdentifier != nodeIdentifier]
+                if remaining:
+                    fanOut[subscriber] = remaining
+                else:
+                    del fanOut[subscriber]
+
+
+    def setCollections(self, nodeIdentifier, collections):
+        """
+        Set the collections a node is directly contained in.
+
+        @param collections: Identifiers of the collection nodes.
+        @type collections: iterable
+        """
+        self._invalidate(nodeIdentifier)
+
+        for collection in self._collections.pop(nodeIdentifier, ()):
+            children = self._children[collection]
+            children.discard(nodeIdentifier)
+            if not children:
+                del self._children[collection]
+
+        collections = set(collections)
+        if collections:
+            self._collections[nodeIdentifier] = collections
+            for collection in collections:
+                self._children.setdefault(collection, set()).add(
+                        nodeIdentifier)
+
+
+    def removeNode(self, nodeIdentifier):
+        """
+        Remove a node, its subscriptions and its place in the hierarchy.
+
+        Nodes contained in a removed collection are no longer part of it.
+        """
+        self.setCollections(nodeIdentifier, ())
+        for child in self.getChildren(nodeIdentifier):
+            collections = self._collections[child] - set([nodeIdentifier])
+            self.setCollections(child, collections)
+        self._subscriptions.pop(nodeIdentifier, None)
+        self._fanOut.pop(nodeIdentifier, None)
+
+
+    def getSubscribers(self, nodeIdentifier):
+        """
+        Return the entities to notify of events of a node.
+
+        @return: The subscriptions that lead to a notification, by
+                 subscriber.
+        @rtype: C{dict}
+        """
+        try:
+            return self._fanOut[nodeIdentifier]
+        except KeyError:
+            pass
+
+        fanOut = {}
+        for node in self._walk(nodeIdentifier, self._collections):
+            for subscriber, subscription in \
+                    self._subscriptions.get(node, {}).iteritems():
+                fanOut.setdefault(subscriber, []).append(subscription)
+
+        self._fanOut[nodeIdentifier] = fanOut
+        return fanOut
+
+
+    def getNotifications(self, nodeIdentifier, items):
+        """
+        Return the notifications for items published to a node.
+
+        @return: Notifications as expected by
+                 L{PubSubService.notifyPublish}.
+        @rtype: C{list} of C{tuple}s of subscriber, subscriptions and items
+        """
+        return [(subscriber, subscriptions, items)
+                for subscriber, subscriptions
+                in self.getSubscribers(nodeIdentifier).iteritems()]
+
+
+
+class SubscriberPresence(object):
+    """
+    View of the availability of subscribers.
+
+    Availability is tracked per resource. An entity addressed by bare JID
+    is available if any of its resources is.
+    """
+
+    def __init__(self):
+        self._available = {}
+
+
+    def setAvailable(self, entity, available):
+        """
+        Record the availability of an entity.
+
+        @type entity: L{jid.JID}
+        @type available: C{bool}
+        """
+        bare = entity.userhost()
+        resources = self._available.get(bare, set())
+        if available:
+            resources.add(entity.resource)
+            self._available[bare] = resources
+        else:
+            if entity.resource:
+                resources.discard(entity.resource)
+            else:
+                resources.clear()
+            if not resources:
+                self._available.pop(bare, None)
+
+
+    def isAvailable(self, entity):
+        """
+        Return whether an entity is available.
+
+        @type entity: L{jid.JID}
+        @rtype: C{bool}
+        """
+        resources = self._available.get(entity.userhost())
+        if not resources:
+            return False
+        elif entity.resource:
+            return entity.resource in resources or None in resources
+        else:
+            return True
+
+
+
+class SubscriberPresenceProtocol(PresenceProtocol):
+    """
+    Presence protocol that feeds the presence view of a L{PubSubService}.
+
+    This is meant to be attached to the same stream as the service. Note
+    that it only observes incoming presence. The service needs to be
+    subscribed to the presence of the subscribers, for example by having
+    them in the roster of the service's JID.
+
+    @ivar service: The publish-subscribe service.
+    @type service: L{PubSubService}
+    """
+
+    def __init__(self, service):
+        PresenceProtocol.__init__(self)
+        self.service = service
+        if service.presence is None:
+            service.presence = SubscriberPresence()
+
+
+    def availableReceived(self, presence):
+        if presence.sender is not None:
+            self.service.presence.setAvailable(presence.sender, True)
+            self.service.releaseHeld(presence.sender)
+
+
+    def unavailableReceived(self, presence):
+        if presence.sender is not None:
+            self.service.presence.setAvailable(presence.sender, False)
+
+
+
+class ConfigurationSchema(object):
+    """
+    Compiled node configuration or subscription options.
+
+    The options, as returned by C{getConfigurationOptions} or
+    C{getSubscriptionOptions} of a resource, are turned into
+    L{data_form.Field}s once. Those are then reused to check
+    submitted values, and to render forms from pre-rendered field elements
+    that only lack the values.
+
+    @ivar options: The configuration options this schema was compiled from.
+    @type options: C{dict}
+    @ivar formNamespace: The form namespace of rendered forms.
+    @type formNamespace: C{str}
+    @ivar fields: Reusable fields, keyed by option name.
+    @type fields: C{dict} of L{data_form.Field}
+    """
+
+    def __init__(self, options, formNamespace=NS_PUBSUB_NODE_CONFIG):
+        self.options = options
+        self.fields = {}
+        self._templates = {}
+
+        for name, option in options.iteritems():
+            field = data_form.Field.fromDict(dict(option, var=name))
+            field.values = []
+            self.fields[name] = field
+            self._templates[name] = field.toElement(asForm=True)
+
+        self.formNamespace = formNamespace
+        self._formType = data_form.Field('hidden', 'FORM_TYPE',
+                                         formNamespace).toElement()
+
+
+    def _typeCheck(self, name, value):
+        """
+        Check and convert a value for an option, using its reusable field.
+        """
+        field = self.fields[name]
+        if isinstance(value, list):
+            field.values = value
+        else:
+            field.value = value
+
+        try:
+            field.typeCheck()
+            return field.values
+        finally:
+            field.values = []
+
+
+    def check(self, values):
+        """
+        Check values against this schema.
+
+        Values for unknown options are dropped.
+
+        @param values: The values to check, keyed by option name.
+        @type values: C{dict}
+        @return: The type-checked values.
+        @rtype: C{dict}
+        """
+        processedValues = {}
+        for name, value in values.iteritems():
+            if name not in self.fields:
+                continue
+
+            checked = self._typeCheck(name, value)
+            if isinstance(value, list):
+                processedValues[name] = checked
+            elif checked:
+                processedValues[name] = checked[0]
+            else:
+                processedValues[name] = None
+        return processedValues
+
+
+    def render(self, values):
+        """
+        Render a configuration form with the given values.
+
+        Values for unknown options are left out. The elements for options,
+        descriptions and required flags are shared with the pre-rendered
+        fields, and should not be modified.
+
+        @param values: The values to render, keyed by option name.
+        @type values: C{dict}
+        @rtype: L{domish.Element}
+        """
+        form = domish.Element((data_form.NS_X_DATA, 'x'))
+        form['type'] = 'form'
+        form.children.append(self._formType)
+
+        for name, value in values.iteritems():
+            if name not in self.fields:
+                continue
+
+            fieldType = self.fields[name].fieldType
+            template = self._templates[name]
+            field = form.addElement('field')
+            field.attributes.update(template.attributes)
+
+            for value in self._typeCheck(name, value):
+                if fieldType == 'boolean':
+                    value = unicode(value).lower()
+                elif fieldType in ('jid-single', 'jid-multi'):
+                    value = value.full()
+                field.addElement('value', content=value)
+
+            field.children.extend(template.children)
+
+        return form
+
+
+
 class PubSubService(XMPPHandler, IQHandlerMixin):
     """
     Protocol implementation for a XMPP Publish Subscribe Service.
@@ -871,6 +2012,46 @@ class PubSubService(XMPPHandler, IQHandlerMixin):
     @ivar pubSubFeatures: List of supported publish-subscribe features for
                           service discovery, as C{str}.
     @type pubSubFeatures: C{list} or C{None}
+    @ivar coalesceWindow: If not C{None}, the number of seconds during which
+                          published items are collected before sending them
+                          to a subscriber in a single notification.
+    @type coalesceWindow: C{float}
+    @ivar defaultDigestFrequency: The number of milliseconds between digests
+                                  for subscriptions with the C{pubsub#digest}
+                                  option, if they do not set
+                                  C{pubsub#digest_frequency}.
+    @type defaultDigestFrequency: C{int}
+    @ivar presence: Optional view of the availability of subscribers, as
+                    fed by a L{SubscriberPresenceProtocol}.
+    @type presence: L{SubscriberPresence}
+    @ivar presenceBasedDelivery: Whether to only notify available
+                                 subscribers, unless overridden by the
+                                 C{pubsub#presence_based_delivery} option
+                                 of the subscription. Only applies if
+                                 L{presence} is set.
+    @type presenceBasedDelivery: C{bool}
+    @ivar holdOffline: Whether to hold notifications for unavailable
+                       subscribers until they become available, instead of
+                       dropping them.
+    @type holdOffline: C{bool}
+    @ivar maxHeld: Maximum number of notifications held per subscriber. The
+                   oldest are dropped first.
+    @type maxHeld: C{int}
+    @ivar suppressed: Number of notifications not sent to unavailable
+                      subscribers, including the ones held.
+    @type suppressed: C{int}
+    @ivar cacheDiscoInfo: Whether to cache the service discovery information
+                          of nodes. The cache entry of a node is dropped
+                          when it is created, configured, purged or deleted
+                          through this service. Node information is
+                          assumed to be the same for all requestors.
+    @type cacheDiscoInfo: C{bool}
+    @ivar maxDiscoInfo: Maximum number of nodes with cached service
+                        discovery information.
+    @type maxDiscoInfo: C{int}
+    @ivar retractBatchSize: Maximum number of retractions per notification
+                            sent by L{notifyRetract}.
+    @type retractBatchSize: C{int}
     """
 
     implements(IPubSubService)
@@ -879,6 +2060,14 @@ class PubSubService(XMPPHandler, IQHandlerMixin):
             '/*': '_onPubSubRequest',
             }
 
+    stanzaInterests = (
+        ('iq', 'get', NS_PUBSUB, 'handleRequest'),
+        ('iq', 'set', NS_PUBSUB, 'handleRequest'),
+        ('iq', 'get', NS_PUBSUB_OWNER, 'handleRequest'),
+        ('iq', 'set', NS_PUBSUB_OWNER, 'handleRequest'),
+        ('message', None, data_form.NS_X_DATA, '_onAuthorization'),
+        )
+
     _legacyHandlers = {
         'publish': ('publish', ['sender', 'recipient',
                                 'nodeIdentifier', 'items']),
@@ -905,18 +2094,44 @@ class PubSubService(XMPPHandler, IQHandlerMixin):
     }
 
     hideNodes = False
+    coalesceWindow = None
+    defaultDigestFrequency = 86400000
+    presence = None
+    presenceBasedDelivery = False
+    holdOffline = False
+    maxHeld = 100
+    cacheDiscoInfo = False
+    maxDiscoInfo = 1000
+    retractBatchSize = 100
+
+    _discoInfoVerbs = ('create', 'configureSet', 'purge', 'delete')
+
+    def __init__(self, resource=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
 
-    def __init__(self, resource=None):
         self.resource = resource
         self.discoIdentity = {'category': 'pubsub',
                               'type': 'generic',
                               'name': 'Generic Publish-Subscribe Service'}
 
         self.pubSubFeatures = []
+        self._digests = {}
+        self._held = {}
+        self._schemas = weakref.WeakKeyDictionary()
+        self._discoInfo = {}
+        self._discoInfoGeneration = 0
+        self._cooperator = task.Cooperator(
+                scheduler=lambda work: self._reactor.callLater(0, work))
+        self._purges = {}
+        self._authorizationSchema = ConfigurationSchema(
+                _authorizationOptions, NS_PUBSUB_SUBSCRIBE_AUTHORIZATION)
+        self.suppressed = 0
 
 
     def connectionMade(self):
-        self.xmlstream.addObserver(PUBSUB_REQUEST, self.handleRequest)
+        self.observeStanzaInterests()
 
 
     def getDiscoInfo(self, requestor, target, nodeIdentifier):
@@ -944,6 +2159,13 @@ class PubSubService(XMPPHandler, IQHandlerMixin):
 
             return info
 
+        key = (target, nodeIdentifier or '')
+        if self.cacheDiscoInfo:
+            try:
+                return defer.succeed(list(self._discoInfo[key]))
+            except KeyError:
+                pass
+
         info = []
 
         request = PubSubRequest('discoInfo')
@@ -967,10 +2189,44 @@ class PubSubService(XMPPHandler, IQHandlerMixin):
 
         d = getInfo(requestor, target, nodeIdentifier or '')
         d.addCallback(toInfo, info)
+        if self.cacheDiscoInfo:
+            d.addCallback(self._storeDiscoInfo, key,
+                          self._discoInfoGeneration)
         d.addErrback(log.err)
         return d
 
 
+    def _storeDiscoInfo(self, info, key, generation):
+        """
+        Cache the service discovery information of a node.
+
+        Information that was retrieved before the cache was invalidated is
+        not stored. Neither is the empty result for non-existent nodes.
+        """
+        if info and generation == self._discoInfoGeneration:
+            if (key not in self._discoInfo and
+                len(self._discoInfo) >= self.maxDiscoInfo):
+                self._discoInfo.popitem()
+            self._discoInfo[key] = list(info)
+        return info
+
+
+    def invalidateDiscoInfo(self, service, nodeIdentifier):
+        """
+        Drop the cached service discovery information of a node.
+
+        Backends that change nodes other than through requests to this
+        service can use this to keep the cache current.
+
+        @param service: The publish-subscribe service entity.
+        @type service: L{JID<twisted.words.protocols.jabber.jid.JID>}
+        @param nodeIdentifier: The node identifier.
+        @type nodeIdentifier: C{unicode}
+        """
+        self._discoInfoGeneration += 1
+        self._discoInfo.pop((service, nodeIdentifier or ''), None)
+
+
     def getDiscoItems(self, requestor, target, nodeIdentifier):
         if self.hideNodes:
             d = defer.succeed([])
@@ -1017,12 +2273,19 @@ class PubSubService(XMPPHandler, IQHandlerMixin):
                 text = "Request verb: %s" % request.verb
                 return defer.fail(Unsupported('', text))
 
-            d = handler(request)
+            d = defer.maybeDeferred(handler, request)
         else:
             handlerName, argNames = self._legacyHandlers[request.verb]
             handler = getattr(self, handlerName)
             args = [getattr(request, arg) for arg in argNames]
-            d = handler(*args)
+            d = defer.maybeDeferred(handler, *args)
+
+        if request.verb in self._discoInfoVerbs:
+            def invalidate(result):
+                self.invalidateDiscoInfo(request.recipient,
+                                         request.nodeIdentifier)
+                return result
+            d.addCallback(invalidate)
 
         # If needed, translate the result into a response
         try:
@@ -1035,6 +2298,61 @@ class PubSubService(XMPPHandler, IQHandlerMixin):
         return d
 
 
+    def _onAuthorization(self, message):
+        """
+        Handle the answer of a node owner to a subscription authorization
+        request.
+
+        The answer is passed to the resource as a request to change the
+        subscription, to C{'subscribed'} if allowed, or C{'none'} otherwise.
+        """
+        if self.resource is None:
+            return
+
+        try:
+            sender = jid.JID(message['from'])
+            recipient = jid.JID(message['to'])
+        except (KeyError, jid.InvalidFormat):
+            return
+
+        form = None
+        for element in message.elements():
+            if ((element.uri, element.name) == (data_form.NS_X_DATA, 'x') and
+                element.getAttribute('type') == 'submit'):
+                form = data_form.Form.fromElement(element)
+                if form.formNamespace == NS_PUBSUB_SUBSCRIBE_AUTHORIZATION:
+                    break
+        else:
+            return
+
+        message.handled = True
+
+        try:
+            values = self._authorizationSchema.check(form.getValues())
+            nodeIdentifier = values['pubsub#node']
+            subscriber = values['pubsub#subscriber_jid']
+        except (ValueError, KeyError, jid.InvalidFormat):
+            log.err(None, "Bad subscription authorization form")
+            return
+
+        if values.get('pubsub#allow'):
+            state = 'subscribed'
+        else:
+            state = 'none'
+
+        request = PubSubRequest('subscriptionsSet')
+        request.sender = sender
+        request.recipient = recipient
+        request.nodeIdentifier = nodeIdentifier
+        request.subscriptions = set([Subscription(nodeIdentifier,
+                                                  subscriber, state)])
+
+        resource = self.resource.locateResource(request)
+        d = defer.maybeDeferred(resource.subscriptionsSet, request)
+        d.addErrback(lambda failure: failure.trap(error.StanzaError))
+        d.addErrback(log.err)
+
+
     def _toResponse_subscribe(self, result, resource, request):
         response = domish.Element((NS_PUBSUB, "pubsub"))
         subscription = response.addElement("subscription")
@@ -1078,55 +2396,42 @@ class PubSubService(XMPPHandler, IQHandlerMixin):
             return None
 
 
-    def _makeFields(self, options, values):
-        fields = []
-        for name, value in values.iteritems():
-            if name not in options:
-                continue
-
-            option = {'var': name}
-            option.update(options[name])
-            if isinstance(value, list):
-                option['values'] = value
-            else:
-                option['value'] = value
-            fields.append(data_form.Field.fromDict(option))
-        return fields
-
-
-    def _formFromConfiguration(self, resource, values):
-        options = resource.getConfigurationOptions()
-        fields = self._makeFields(options, values)
-        form = data_form.Form(formType="form",
-                              formNamespace=NS_PUBSUB_NODE_CONFIG,
-                              fields=fields)
+    def _getSchema(self, resource, formNamespace=NS_PUBSUB_NODE_CONFIG):
+        """
+        Return the compiled configuration or subscription options schema
+        for a resource.
 
-        return form
+        The schema is compiled once, and only compiled again when the
+        resource returns different options. Schemas are kept only as long
+        as their resource is in use, and not at all for resources that
+        cannot be weakly referenced.
+        """
+        if formNamespace == NS_PUBSUB_SUBSCRIBE_OPTIONS:
+            options = resource.getSubscriptionOptions()
+        else:
+            options = resource.getConfigurationOptions()
 
+        try:
+            schemas = self._schemas.get(resource)
+            if schemas is None:
+                schemas = self._schemas[resource] = {}
+        except TypeError:
+            schemas = {}
 
-    def _checkConfiguration(self, resource, values):
-        options = resource.getConfigurationOptions()
-        processedValues = {}
+        schema = schemas.get(formNamespace)
+        if schema is None or (schema.options is not options and
+                              schema.options != options):
+            schema = schemas[formNamespace] = ConfigurationSchema(
+                    options, formNamespace)
+        return schema
 
-        for key, value in values.iteritems():
-            if key not in options:
-                continue
 
-            option = {'var': key}
-            option.update(options[key])
-            field = data_form.Field.fromDict(option)
-            if isinstance(value, list):
-                field.values = value
-            else:
-                field.value = value
-            field.typeCheck()
+    def _formFromConfiguration(self, resource, values):
+        return self._getSchema(resource).render(values)
 
-            if isinstance(value, list):
-                processedValues[key] = field.values
-            else:
-                processedValues[key] = field.value
 
-        return processedValues
+    def _checkConfiguration(self, resource, values):
+        return self._getSchema(resource).check(values)
 
 
     def _preProcess_default(self, resource, request):
@@ -1139,16 +2444,14 @@ class PubSubService(XMPPHandler, IQHandlerMixin):
     def _toResponse_default(self, options, resource, request):
         response = domish.Element((NS_PUBSUB_OWNER, "pubsub"))
         default = response.addElement("default")
-        form = self._formFromConfiguration(resource, options)
-        default.addChild(form.toElement())
+        default.addChild(self._formFromConfiguration(resource, options))
         return response
 
 
     def _toResponse_configureGet(self, options, resource, request):
         response = domish.Element((NS_PUBSUB_OWNER, "pubsub"))
         configure = response.addElement("configure")
-        form = self._formFromConfiguration(resource, options)
-        configure.addChild(form.toElement())
+        configure.addChild(self._formFromConfiguration(resource, options))
 
         if request.nodeIdentifier:
             configure["node"] = request.nodeIdentifier
@@ -1165,17 +2468,161 @@ class PubSubService(XMPPHandler, IQHandlerMixin):
             return None
 
 
+    def _toResponse_optionsGet(self, result, resource, request):
+        schema = self._getSchema(resource, NS_PUBSUB_SUBSCRIBE_OPTIONS)
+        values = dict((name, []) for name in schema.fields)
+        values.update(result)
+
+        response = domish.Element((NS_PUBSUB, 'pubsub'))
+        options = response.addElement('options')
+        if request.nodeIdentifier:
+            options['node'] = request.nodeIdentifier
+        options['jid'] = request.subscriber.full()
+        options.addChild(schema.render(values))
+        return response
+
+
+    def _preProcess_optionsSet(self, resource, request):
+        """
+        Check the subscription options against the options of the resource.
+
+        Resources that do not declare subscription options get the options
+        passed unchecked.
+        """
+        getSubscriptionOptions = getattr(resource, 'getSubscriptionOptions',
+                                         None)
+        if getSubscriptionOptions is None or not getSubscriptionOptions():
+            return request
+
+        schema = self._getSchema(resource, NS_PUBSUB_SUBSCRIBE_OPTIONS)
+        try:
+            request.options = schema.check(request.options)
+        except (ValueError, jid.InvalidFormat), e:
+            raise BadRequest(text=str(e))
+        return request
+
+
     def _toResponse_items(self, result, resource, request):
         response = domish.Element((NS_PUBSUB, 'pubsub'))
         items = response.addElement('items')
         items["node"] = request.nodeIdentifier
 
+        if not isinstance(result, (list, tuple)):
+            return self._serializeItems(result, response, items)
+
         for item in result:
-            items.addChild(item)
+            if isinstance(item, SerializedItem):
+                items.addRawXml(item.toXml())
+            else:
+                items.addChild(item)
 
         return response
 
 
+    def _serializeItems(self, result, response, items):
+        """
+        Serialize items into a response as they are produced.
+
+        Each item is rendered to XML when it becomes available, so that the
+        item element itself can be released. Items that are available right
+        away are processed cooperatively, to not block the reactor on large
+        responses.
+
+        The response is still sent as a single stanza, once all items have
+        been serialized. It cannot be written to the transport in parts.
+        Stanzas sent by other handlers in the meantime would end up inside
+        it. Stream Management only tracks complete stanzas for resending.
+        And in-process components pass elements, not text, to the router.
+
+        @param result: Iterable of items, or of deferreds that fire with an
+                       item.
+        @param response: The response element.
+        @type response: L{domish.Element}
+        @param items: The C{items} element of the response.
+        @type items: L{domish.Element}
+        @return: Deferred that fires with C{response} when all items have
+                 been serialized.
+        @rtype: L{defer.Deferred}
+        """
+        def serialize(item):
+            if isinstance(item, SerializedItem):
+                items.addRawXml(item.toXml())
+            elif item is not None:
+                items.addRawXml(item.toXml(defaultUri=NS_PUBSUB))
+
+        def produce():
+            for item in result:
+                if isinstance(item, defer.Deferred):
+                    yield item.addCallback(serialize)
+                else:
+                    serialize(item)
+                    yield None
+
+        d = self._cooperator.coiterate(produce())
+        d.addCallback(lambda _: response)
+        return d
+
+
+    def _toResponse_purge(self, result, resource, request):
+        """
+        Process an incremental purge.
+
+        Instead of C{None}, the purge of a resource may return an iterable
+        that removes some of the items each step, producing the number of
+        removed items, or a deferred that fires with that number. It is
+        processed cooperatively, and the request is answered when done.
+        """
+        if result is None:
+            return None
+
+        key = (request.recipient, request.nodeIdentifier)
+        progress = [0]
+        self._purges.setdefault(key, []).append(progress)
+
+        def count(removed):
+            progress[0] += removed or 0
+
+        def produce():
+            for removed in result:
+                if isinstance(removed, defer.Deferred):
+                    yield removed.addCallback(count)
+                else:
+                    count(removed)
+                    yield None
+
+        def done(result):
+            purges = self._purges[key]
+            purges.remove(progress)
+            if not purges:
+                del self._purges[key]
+            return result
+
+        d = self._cooperator.coiterate(produce())
+        d.addBoth(done)
+        d.addCallback(lambda _: None)
+        return d
+
+
+    def getPurgeProgress(self, service, nodeIdentifier):
+        """
+        Return the progress of a purge that is being processed.
+
+        @param service: The publish-subscribe service entity.
+        @type service: L{jid.JID}
+        @param nodeIdentifier: The identifier of the node being purged.
+        @type nodeIdentifier: C{unicode}
+        @return: The number of items removed so far by all purges of the
+                 node in progress, or C{None} if the node is not being
+                 purged incrementally.
+        @rtype: C{int}
+        """
+        purges = self._purges.get((service, nodeIdentifier))
+        if purges is None:
+            return None
+        else:
+            return sum([progress[0] for progress in purges])
+
+
     def _createNotification(self, eventType, service, nodeIdentifier,
                                   subscriber, subscriptions=None):
         headers = []
@@ -1200,17 +2647,263 @@ class PubSubService(XMPPHandler, IQHandlerMixin):
 
     # public methods
 
+    def _getDigestDelay(self, subscriptions):
+        """
+        Return the delay for notifications caused by these subscriptions.
+
+        @return: The delay in seconds, or C{None} to notify right away.
+        @rtype: C{float}
+        """
+        delays = []
+        for subscription in subscriptions or ():
+            options = subscription.options
+            if options.get('pubsub#digest') in (True, 1, '1', 'true'):
+                frequency = (options.get('pubsub#digest_frequency') or
+                             self.defaultDigestFrequency)
+                try:
+                    delays.append(int(frequency) / 1000.0)
+                except ValueError:
+                    delays.append(self.defaultDigestFrequency / 1000.0)
+
+        if delays:
+            return min(delays)
+        else:
+            return self.coalesceWindow
+
+
+    def _isDeliverable(self, subscriber, subscriptions):
+        """
+        Return whether a notification may be sent to the subscriber now.
+        """
+        if self.presence is None:
+            return True
+
+        presenceBased = self.presenceBasedDelivery
+        for subscription in subscriptions or ():
+            value = subscription.options.get('pubsub#presence_based_delivery')
+            if value is not None:
+                presenceBased = value in (True, 1, '1', 'true')
+                break
+
+        return not presenceBased or self.presence.isAvailable(subscriber)
+
+
+    def _hold(self, service, nodeIdentifier, subscriber, subscriptions,
+                    items):
+        held = self._held.setdefault(subscriber.userhost(), deque())
+        held.append((service, nodeIdentifier, subscriber, subscriptions,
+                     items))
+        while len(held) > self.maxHeld:
+            held.popleft()
+
+
+    def releaseHeld(self, entity):
+        """
+        Send notifications held for an entity that became available.
+
+        @type entity: L{jid.JID}
+        """
+        held = self._held.pop(entity.userhost(), ())
+        for (service, nodeIdentifier, subscriber, subscriptions,
+             items) in held:
+            self.notifyPublish(service, nodeIdentifier,
+                               [(subscriber, subscriptions, items)])
+
+
+    def _addToDigest(self, key, subscriptions, items, delay):
+        try:
+            digest = self._digests[key]
+        except KeyError:
+            call = self._reactor.callLater(delay, self._sendDigest, key)
+            digest = self._digests[key] = ([], [], call)
+
+        digestSubscriptions, digestItems, call = digest
+        for subscription in subscriptions or ():
+            if subscription not in digestSubscriptions:
+                digestSubscriptions.append(subscription)
+
+        for item in items:
+            itemIdentifier = item.getAttribute('id')
+            if itemIdentifier is not None:
+                digestItems[:] = [digestItem for digestItem in digestItems
+                                  if digestItem.getAttribute('id') !=
+                                     itemIdentifier]
+            digestItems.append(item)
+
+
+    def _sendDigest(self, key):
+        service, nodeIdentifier, subscriber = key
+        subscriptions, items, call = self._digests.pop(key)
+        if call.active():
+            call.cancel()
+
+        message = self._createNotification('items', service,
+                                           nodeIdentifier, subscriber,
+                                           subscriptions)
+        message.event.items.children = _itemChildren(items)
+        self.send(message)
+
+
+    def flushDigests(self):
+        """
+        Send all collected notifications right away.
+        """
+        for key in self._digests.keys():
+            self._sendDigest(key)
+
+
     def notifyPublish(self, service, nodeIdentifier, notifications):
+        """
+        Send notifications of published or retracted items.
+
+        Subscribers are notified right away, unless one of their
+        subscriptions has the C{pubsub#digest} option set, or
+        L{coalesceWindow} is set. Then the items are collected for the
+        subscriber and node, and sent as one notification after the digest
+        frequency of the subscription, or the coalesce window, has passed.
+        If an item is published again while collecting, only its last
+        version is sent.
+
+        With presence based delivery, notifications for unavailable
+        subscribers are dropped, or held if L{holdOffline} is set.
+
+        @param notifications: The notifications to send, as tuples of
+                              subscriber, the subscriptions causing the
+                              notification, and the items.
+        @type notifications: C{list}
+        """
         for subscriber, subscriptions, items in notifications:
+            if not self._isDeliverable(subscriber, subscriptions):
+                self.suppressed += 1
+                if self.holdOffline:
+                    self._hold(service, nodeIdentifier, subscriber,
+                               subscriptions, items)
+                continue
+
+            delay = self._getDigestDelay(subscriptions)
+            if delay is not None:
+                key = (service, nodeIdentifier, subscriber)
+                self._addToDigest(key, subscriptions, items, delay)
+                continue
+
             message = self._createNotification('items', service,
                                                nodeIdentifier, subscriber,
                                                subscriptions)
-            message.event.items.children = items
+            message.event.items.children = _itemChildren(items)
             self.send(message)
 
 
+    def notifyRetract(self, service, nodeIdentifier, notifications):
+        """
+        Send notifications of retracted items, in batches.
+
+        The retractions for a subscriber are split over notifications of at
+        most L{retractBatchSize} retractions, and one notification is sent
+        at a time, cooperatively. Otherwise, they are handled like
+        notifications of published items by L{notifyPublish}.
+
+        @param notifications: The notifications to send, as tuples of
+                              subscriber, the subscriptions causing the
+                              notification, and the C{retract} elements.
+        @type notifications: C{list}
+        @return: Deferred that fires when all notifications have been sent.
+        @rtype: L{defer.Deferred}
+        """
+        def produce():
+            batchSize = self.retractBatchSize
+            for subscriber, subscriptions, retractions in notifications:
+                for start in xrange(0, len(retractions), batchSize):
+                    batch = retractions[start:start + batchSize]
+                    self.notifyPublish(service, nodeIdentifier,
+                                       [(subscriber, subscriptions, batch)])
+                    yield None
+
+        return self._cooperator.coiterate(produce())
+
+
+    def notifyPurge(self, service, nodeIdentifier, subscribers):
+        """
+        Send node purge notifications.
+
+        Notifications collected for a digest are sent first. Then one
+        notification is sent at a time, cooperatively.
+
+        @param subscribers: The subscribers to notify, or tuples of
+                            subscriber and the subscriptions causing the
+                            notification, to indicate the collections the
+                            node was purged through.
+        @type subscribers: C{list}
+        @return: Deferred that fires when all notifications have been sent.
+        @rtype: L{defer.Deferred}
+        """
+        for key in self._digests.keys():
+            if key[:2] == (service, nodeIdentifier):
+                self._sendDigest(key)
+
+        def produce():
+            for subscriber in subscribers:
+                if isinstance(subscriber, tuple):
+                    subscriber, subscriptions = subscriber
+                else:
+                    subscriptions = None
+                self.send(self._createNotification('purge', service,
+                                                   nodeIdentifier,
+                                                   subscriber,
+                                                   subscriptions))
+                yield None
+
+        return self._cooperator.coiterate(produce())
+
+
+    def notifyPending(self, service, nodeIdentifier, owners, subscriptions):
+        """
+        Ask node owners to authorize pending subscriptions.
+
+        For every combination of owner and subscription, a message with its
+        own authorization form is sent, one at a time, cooperatively. The
+        forms are rendered from a schema compiled once per service.
+
+        @param owners: The owners to ask.
+        @type owners: C{list} of L{jid.JID}
+        @param subscriptions: The pending subscriptions.
+        @type subscriptions: C{list} of L{Subscription}
+        @return: Deferred that fires when all messages have been sent.
+        @rtype: L{defer.Deferred}
+        """
+        def produce():
+            for subscription in subscriptions:
+                values = {'pubsub#node': nodeIdentifier,
+                          'pubsub#subscriber_jid': subscription.subscriber,
+                          'pubsub#allow': False}
+                for owner in owners:
+                    message = domish.Element((None, 'message'))
+                    message['from'] = service.full()
+                    message['to'] = owner.full()
+                    message.addChild(self._authorizationSchema.render(values))
+                    self.send(message)
+                    yield None
+
+        return self._cooperator.coiterate(produce())
+
+
+    def notifySubscription(self, service, nodeIdentifier, subscription):
+        message = self._createNotification('subscription', service,
+                                           nodeIdentifier,
+                                           subscription.subscriber)
+        element = message.event.subscription
+        element['jid'] = subscription.subscriber.full()
+        element['subscription'] = subscription.state
+        self.send(message)
+
+
     def notifyDelete(self, service, nodeIdentifier, subscribers,
                            redirectURI=None):
+        self.invalidateDiscoInfo(service, nodeIdentifier)
+
+        for key in self._digests.keys():
+            if key[:2] == (service, nodeIdentifier):
+                self._sendDigest(key)
+
         for subscriber in subscribers:
             message = self._createNotification('delete', service,
                                                nodeIdentifier,
@@ -1313,6 +3006,10 @@ class PubSubResource(object):
         return {}
 
 
+    def getSubscriptionOptions(self):
+        return {}
+
+
     def publish(self, request):
         return defer.fail(Unsupported('publish'))
 
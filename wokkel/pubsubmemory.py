@@ -0,0 +1,1071 @@
+# -*- test-case-name: wokkel.test.test_pubsubmemory -*-
+#
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+In-memory publish-subscribe backend.
+
+L{MemoryPubSubResource} implements all verbs of
+L{IPubSubResource<wokkel.iwokkel.IPubSubResource>} on top of indexed
+in-memory structures. Optionally, all changes are written to an
+append-only journal, that is periodically compacted into a snapshot, so
+that the state survives restarts.
+"""
+
+import cPickle as pickle
+import os
+import uuid
+
+from zope.interface import implements
+
+from twisted.internet import defer
+from twisted.python import log
+from twisted.words.protocols.jabber import error, jid
+from twisted.words.xish import domish
+
+from wokkel import disco
+from wokkel.generic import parseXml
+from wokkel.iwokkel import IPubSubResource
+from wokkel.pubsub import NS_PUBSUB_EVENT, BadRequest, PubSubError
+from wokkel.pubsub import NotificationRouter, SerializedItem, Subscription
+from wokkel.pubsub import Unsupported
+
+def _asDeferred(f):
+    """
+    Decorate a method to return a deferred with its result or exception.
+    """
+    def wrapper(*args, **kwargs):
+        return defer.maybeDeferred(f, *args, **kwargs)
+
+    wrapper.__name__ = f.__name__
+    wrapper.__doc__ = f.__doc__
+    return wrapper
+
+
+
+class Node(object):
+    """
+    A publish-subscribe node.
+
+    Items are kept in a dictionary by item identifier, with a sequence
+    number that records the order of publication. The order itself is kept
+    in a list of (sequence number, item identifier) tuples, where entries
+    for retracted or republished items become stale. Stale entries are
+    skipped when iterating and compacted away when they pile up.
+
+    @ivar nodeIdentifier: The identifier of the node.
+    @type nodeIdentifier: C{unicode}
+    @ivar nodeType: The type of the node, C{'leaf'} or C{'collection'}.
+    @type nodeType: C{str}
+    @ivar config: The node configuration.
+    @type config: C{dict}
+    @ivar items: Items by item identifier, as tuples of sequence number,
+                 L{SerializedItem<wokkel.pubsub.SerializedItem>} and
+                 publisher.
+    @type items: C{dict}
+    @ivar subscriptions: Subscriptions to this node by subscriber.
+    @type subscriptions: C{dict} of L{Subscription}
+    @ivar pending: Subscriptions awaiting authorization by subscriber.
+    @type pending: C{dict} of L{Subscription}
+    @ivar affiliations: Affiliations by bare JID of the affiliated entity.
+    @type affiliations: C{dict}
+    """
+
+    def __init__(self, nodeIdentifier, nodeType, config):
+        self.nodeIdentifier = nodeIdentifier
+        self.nodeType = nodeType
+        self.config = config
+        self.items = {}
+        self.subscriptions = {}
+        self.pending = {}
+        self.affiliations = {}
+        self._order = []
+        self._sequence = 0
+
+
+    def storeItem(self, item, publisher):
+        itemIdentifier = item['id']
+        self._sequence += 1
+        self.items[itemIdentifier] = (self._sequence, item, publisher)
+        self._order.append((self._sequence, itemIdentifier))
+
+        maxItems = int(self.config.get('pubsub#max_items') or 0)
+        if maxItems and len(self.items) > maxItems:
+            for itemIdentifier in self.getItemIdentifiers()[:-maxItems]:
+                del self.items[itemIdentifier]
+
+        self._compact()
+
+
+    def removeItem(self, itemIdentifier):
+        """
+        Remove an item.
+
+        @return: Whether the item existed.
+        @rtype: C{bool}
+        """
+        if itemIdentifier in self.items:
+            del self.items[itemIdentifier]
+            self._compact()
+            return True
+        else:
+            return False
+
+
+    def purge(self):
+        self.items = {}
+        self._order = []
+
+
+    def _compact(self):
+        if len(self._order) > 2 * len(self.items) + 16:
+            self._order = [(sequence, itemIdentifier)
+                           for sequence, itemIdentifier in self._order
+                           if self._isCurrent(sequence, itemIdentifier)]
+
+
+    def _isCurrent(self, sequence, itemIdentifier):
+        entry = self.items.get(itemIdentifier)
+        return entry is not None and entry[0] == sequence
+
+
+    def getItemIdentifiers(self):
+        """
+        Return the identifiers of all items, in order of publication.
+
+        @rtype: C{list}
+        """
+        return [itemIdentifier
+                for sequence, itemIdentifier in self._order
+                if self._isCurrent(sequence, itemIdentifier)]
+
+
+    def getItems(self, maxItems=None):
+        """
+        Return the most recently published items, oldest first.
+
+        @param maxItems: Maximum number of items, or C{None} for all items.
+        @type maxItems: C{int}
+        @rtype: C{list} of L{SerializedItem<wokkel.pubsub.SerializedItem>}
+        """
+        result = []
+        for sequence, itemIdentifier in reversed(self._order):
+            if maxItems and len(result) >= maxItems:
+                break
+            if self._isCurrent(sequence, itemIdentifier):
+                result.append(self.items[itemIdentifier][1])
+        result.reverse()
+        return result
+
+
+
+class MemoryPubSubResource(object):
+    """
+    Publish-subscribe backend keeping all state in memory.
+
+    All nodes are kept for a single service, regardless of the entity the
+    requests were addressed to. Besides the nodes, the subscriptions and
+    affiliations are indexed by the bare JID of the entity, to answer
+    subscription and affiliation retrievals directly.
+
+    Every change is expressed as a record, a tuple of the kind of change
+    and its arguments, that is applied to the in-memory state by the
+    respective C{_apply_*} method. Items are kept as serialized XML, that
+    is copied into responses and notifications without building element
+    trees. If a journal path is given, records are appended to that file
+    and replayed on start up. After C{snapshotThreshold} records, the
+    complete state is written to a snapshot file, and the journal is
+    started afresh.
+
+    If C{pubsubService} is set, notifications of published and retracted
+    items and of node purges and deletion are sent through it. Recipients of
+    item and purge notifications are looked up in a L{NotificationRouter},
+    so that subscribers to collection nodes are also notified of events of
+    the nodes contained in them.
+
+    @ivar path: Path of the journal file, or C{None} to keep state in
+                memory only.
+    @type path: C{str}
+    @ivar sync: Whether to sync the journal to disk after every record.
+    @type sync: C{bool}
+    @ivar snapshotThreshold: Number of journal records after which a
+                             snapshot is made, or C{None} to only make
+                             snapshots on request.
+    @type snapshotThreshold: C{int}
+    @ivar pubsubService: The service to send notifications through.
+    @type pubsubService: L{PubSubService<wokkel.pubsub.PubSubService>}
+    @ivar nodes: Nodes by node identifier.
+    @type nodes: C{dict} of L{Node}
+    @ivar router: Index of subscribers to notify per node.
+    @type router: L{NotificationRouter}
+    """
+
+    implements(IPubSubResource)
+
+    features = ['collections',
+                'config-node',
+                'create-nodes',
+                'delete-nodes',
+                'instant-nodes',
+                'item-ids',
+                'manage-subscriptions',
+                'modify-affiliations',
+                'persistent-items',
+                'publish',
+                'purge-nodes',
+                'retract-items',
+                'retrieve-affiliations',
+                'retrieve-default',
+                'retrieve-items',
+                'retrieve-subscriptions',
+                'subscribe',
+                'subscription-options',
+                ]
+
+    discoIdentity = disco.DiscoIdentity('pubsub', 'service',
+                                        'Publish-Subscribe Service')
+
+    defaultConfiguration = {
+        'pubsub#persist_items': True,
+        'pubsub#deliver_payloads': True,
+        'pubsub#notify_retract': True,
+        'pubsub#max_items': '0',
+        'pubsub#publish_model': 'publishers',
+        'pubsub#access_model': 'open',
+        'pubsub#collection': [],
+        }
+
+    configurationOptions = {
+        'pubsub#persist_items':
+            {'type': 'boolean',
+             'label': 'Persist items to storage'},
+        'pubsub#deliver_payloads':
+            {'type': 'boolean',
+             'label': 'Deliver payloads with event notifications'},
+        'pubsub#notify_retract':
+            {'type': 'boolean',
+             'label': 'Notify subscribers when items are removed'},
+        'pubsub#max_items':
+            {'type': 'text-single',
+             'label': 'Maximum number of items to persist, '
+                      '0 for no limit'},
+        'pubsub#publish_model':
+            {'type': 'list-single',
+             'label': 'Who may publish items',
+             'options': {'publishers': 'Owners and publishers',
+                         'open': 'Anyone'}},
+        'pubsub#access_model':
+            {'type': 'list-single',
+             'label': 'Who may subscribe and retrieve items',
+             'options': {'open': 'Anyone',
+                         'authorize': 'Subscription requests must be '
+                                      'approved by an owner'}},
+        'pubsub#collection':
+            {'type': 'text-multi',
+             'label': 'The collections this node is contained in'},
+        }
+
+    subscriptionOptions = {
+        'pubsub#digest':
+            {'type': 'boolean',
+             'label': 'Receive digest notifications'},
+        'pubsub#digest_frequency':
+            {'type': 'text-single',
+             'label': 'Minimum number of milliseconds between digests'},
+        'pubsub#presence_based_delivery':
+            {'type': 'boolean',
+             'label': 'Only receive notifications when available'},
+        }
+
+    snapshotThreshold = 10000
+    sync = False
+    pubsubService = None
+
+    def __init__(self, path=None):
+        self.path = path
+        self.nodes = {}
+        self.router = NotificationRouter()
+        self._subscriptionsByEntity = {}
+        self._affiliationsByEntity = {}
+        self._journal = None
+        self._journalRecords = 0
+        self._generation = 0
+
+        if path is not None:
+            self._load()
+
+
+    def close(self):
+        """
+        Close the journal.
+        """
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+    # Persistence
+
+    def _load(self):
+        if os.path.exists(self.path + '.snapshot'):
+            self._replay(self.path + '.snapshot')
+
+        if os.path.exists(self.path):
+            count = self._replay(self.path, self._generation)
+        else:
+            count = None
+
+        if count is None:
+            self._startJournal()
+        else:
+            self._journal = open(self.path, 'ab')
+            self._journalRecords = count
+
+
+    def _startJournal(self):
+        """
+        Start an empty journal for the generation of the current snapshot.
+        """
+        self._journal = open(self.path, 'wb')
+        self._write(self._journal, ('generation', self._generation))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journalRecords = 0
+
+
+    def _replay(self, path, generation=None):
+        """
+        Apply all records stored in a file.
+
+        A record that cannot be read, because writing it was interrupted,
+        is cut off along with anything after it.
+
+        @param generation: The snapshot generation the file must belong to,
+                           or C{None} to accept any. A journal of another
+                           generation was already folded into the snapshot,
+                           and is not applied.
+        @type generation: C{int}
+        @return: The number of applied records, or C{None} if the file
+                 belongs to another generation.
+        @rtype: C{int}
+        """
+        count = 0
+        size = os.path.getsize(path)
+        f = open(path, 'r+b')
+        try:
+            while True:
+                offset = f.tell()
+                if offset == size:
+                    break
+
+                try:
+                    record = pickle.load(f)
+                except Exception:
+                    log.msg("Truncating damaged journal %r at offset %d" %
+                            (path, offset))
+                    f.truncate(offset)
+                    break
+
+                if record[0] == 'generation':
+                    if generation is not None and record[1] != generation:
+                        log.msg("Ignoring journal %r of generation %d, "
+                                "superseded by snapshot generation %d" %
+                                (path, record[1], generation))
+                        return None
+                    self._generation = record[1]
+                else:
+                    self._apply(record)
+                    count += 1
+        finally:
+            f.close()
+        return count
+
+
+    def _write(self, f, record):
+        if record[0] == 'publish':
+            record = record[:2] + ([((item.itemIdentifier, item.data),
+                                     publisher)
+                                    for item, publisher in record[2]],)
+        pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+
+
+    def _record(self, *record):
+        """
+        Apply a change and append it to the journal.
+        """
+        self._apply(record)
+
+        if self._journal is not None:
+            self._write(self._journal, record)
+            self._journal.flush()
+            if self.sync:
+                os.fsync(self._journal.fileno())
+
+            self._journalRecords += 1
+            if (self.snapshotThreshold is not None and
+                self._journalRecords >= self.snapshotThreshold):
+                self.snapshot()
+
+
+    def _apply(self, record):
+        getattr(self, '_apply_%s' % record[0])(*record[1:])
+
+
+    def _snapshotRecords(self):
+        for node in self.nodes.itervalues():
+            yield ('create', node.nodeIdentifier, node.nodeType, node.config)
+            for entity, affiliation in node.affiliations.iteritems():
+                yield ('affiliate', node.nodeIdentifier, entity, affiliation)
+            for subscription in node.subscriptions.itervalues():
+                yield ('subscribe', node.nodeIdentifier,
+                       subscription.subscriber.full(), subscription.state,
+                       subscription.options)
+            for itemIdentifier in node.getItemIdentifiers():
+                sequence, item, publisher = node.items[itemIdentifier]
+                yield ('publish', node.nodeIdentifier, [(item, publisher)])
+
+
+    def snapshot(self):
+        """
+        Write the complete state to the snapshot file and empty the journal.
+
+        The snapshot is first written to a temporary file that then replaces
+        the previous snapshot, so that a crash while making a snapshot
+        leaves the previous snapshot and the journal intact. Snapshots and
+        journals start with a generation number, that is incremented with
+        every snapshot. If the snapshot was replaced, but the journal not yet
+        emptied, the journal's generation no longer matches, and it is
+        ignored on start up.
+        """
+        if self.path is None:
+            return
+
+        generation = self._generation + 1
+        temporaryPath = self.path + '.snapshot.tmp'
+        f = open(temporaryPath, 'wb')
+        try:
+            self._write(f, ('generation', generation))
+            for record in self._snapshotRecords():
+                self._write(f, record)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temporaryPath, self.path + '.snapshot')
+        self._generation = generation
+
+        self.close()
+        self._startJournal()
+
+
+    # Applying records
+
+    def _apply_create(self, nodeIdentifier, nodeType, config):
+        if nodeIdentifier in self.nodes:
+            return
+
+        self.nodes[nodeIdentifier] = Node(nodeIdentifier, nodeType, config)
+        self.router.setCollections(nodeIdentifier,
+                                   config.get('pubsub#collection', ()))
+
+
+    def _apply_configure(self, nodeIdentifier, config):
+        if nodeIdentifier not in self.nodes:
+            return
+
+        self.nodes[nodeIdentifier].config.update(config)
+        if 'pubsub#collection' in config:
+            self.router.setCollections(nodeIdentifier,
+                                       config['pubsub#collection'])
+
+
+    def _apply_delete(self, nodeIdentifier):
+        node = self.nodes.pop(nodeIdentifier, None)
+        if node is None:
+            return
+
+        children = self.router.getChildren(nodeIdentifier)
+        self.router.removeNode(nodeIdentifier)
+        for child in children:
+            if child not in self.nodes:
+                continue
+            collections = self.nodes[child].config['pubsub#collection']
+            self.nodes[child].config['pubsub#collection'] = [
+                collection for collection in collections
+                if collection != nodeIdentifier]
+        for subscription in node.subscriptions.values():
+            self._apply_unsubscribe(nodeIdentifier,
+                                    subscription.subscriber.full(), node)
+        for entity in node.affiliations.keys():
+            self._apply_affiliate(nodeIdentifier, entity, 'none', node)
+
+
+    def _apply_publish(self, nodeIdentifier, items):
+        node = self.nodes.get(nodeIdentifier)
+        if node is None:
+            return
+
+        for item, publisher in items:
+            if isinstance(item, tuple):
+                item = SerializedItem(item[1], item[0])
+            elif not isinstance(item, SerializedItem):
+                if isinstance(item, basestring):
+                    item = parseXml(item)
+                item = SerializedItem.fromElement(item)
+            node.storeItem(item, publisher)
+
+
+    def _apply_retract(self, nodeIdentifier, itemIdentifiers):
+        node = self.nodes.get(nodeIdentifier)
+        if node is None:
+            return
+
+        for itemIdentifier in itemIdentifiers:
+            node.removeItem(itemIdentifier)
+
+
+    def _apply_purge(self, nodeIdentifier):
+        if nodeIdentifier in self.nodes:
+            self.nodes[nodeIdentifier].purge()
+
+
+    def _apply_subscribe(self, nodeIdentifier, subscriber, state, options):
+        node = self.nodes.get(nodeIdentifier)
+        if node is None:
+            return
+
+        subscriber = jid.internJID(subscriber)
+        subscription = Subscription(nodeIdentifier, subscriber, state,
+                                    options)
+        node.subscriptions[subscriber] = subscription
+        if state == 'pending':
+            node.pending[subscriber] = subscription
+        else:
+            node.pending.pop(subscriber, None)
+        self.router.addSubscription(subscription)
+        entity = subscriber.userhost()
+        self._subscriptionsByEntity.setdefault(entity, {})[
+                (nodeIdentifier, subscriber)] = subscription
+
+
+    def _apply_unsubscribe(self, nodeIdentifier, subscriber, node=None):
+        if node is None:
+            node = self.nodes.get(nodeIdentifier)
+            if node is None:
+                return
+
+        subscriber = jid.internJID(subscriber)
+        node.subscriptions.pop(subscriber, None)
+        node.pending.pop(subscriber, None)
+        self.router.removeSubscription(nodeIdentifier, subscriber)
+
+        entity = subscriber.userhost()
+        subscriptions = self._subscriptionsByEntity.get(entity, {})
+        subscriptions.pop((nodeIdentifier, subscriber), None)
+        if not subscriptions:
+            self._subscriptionsByEntity.pop(entity, None)
+
+
+    def _apply_affiliate(self, nodeIdentifier, entity, affiliation,
+                               node=None):
+        if node is None:
+            node = self.nodes.get(nodeIdentifier)
+            if node is None:
+                return
+
+        affiliations = self._affiliationsByEntity.setdefault(entity, {})
+
+        if affiliation == 'none':
+            node.affiliations.pop(entity, None)
+            affiliations.pop(nodeIdentifier, None)
+            if not affiliations:
+                del self._affiliationsByEntity[entity]
+        else:
+            node.affiliations[entity] = affiliation
+            affiliations[nodeIdentifier] = affiliation
+
+
+    # Helpers
+
+    def _getNode(self, nodeIdentifier):
+        try:
+            return self.nodes[nodeIdentifier]
+        except KeyError:
+            raise error.StanzaError('item-not-found')
+
+
+    def _getAffiliation(self, node, entity):
+        return node.affiliations.get(entity.userhost(), 'none')
+
+
+    def _checkOwner(self, node, requestor):
+        if self._getAffiliation(node, requestor) != 'owner':
+            raise error.StanzaError('forbidden')
+
+
+    def _checkNotOutcast(self, node, requestor):
+        if self._getAffiliation(node, requestor) == 'outcast':
+            raise error.StanzaError('forbidden')
+
+
+    def _checkLeaf(self, node, feature):
+        if node.nodeType != 'leaf':
+            raise Unsupported(feature)
+
+
+    def _checkMaxItems(self, config):
+        """
+        Check that the maximum number of items is a non-negative integer.
+        """
+        if 'pubsub#max_items' not in config:
+            return
+
+        try:
+            maxItems = int(config['pubsub#max_items'])
+        except (TypeError, ValueError):
+            maxItems = -1
+
+        if maxItems < 0:
+            raise BadRequest(text="Invalid pubsub#max_items value")
+        config['pubsub#max_items'] = str(maxItems)
+
+
+    def _checkCollections(self, nodeIdentifier, config):
+        """
+        Check the collections a node is to be contained in.
+
+        The collections must exist and may not be contained in the node
+        itself.
+        """
+        collections = config.get('pubsub#collection')
+        if not collections:
+            return
+        if isinstance(collections, basestring):
+            collections = config['pubsub#collection'] = [collections]
+
+        descendants = self.router.getDescendants(nodeIdentifier)
+        for collection in collections:
+            node = self.nodes.get(collection)
+            if node is None or node.nodeType != 'collection':
+                raise error.StanzaError('item-not-found')
+            if collection == nodeIdentifier or collection in descendants:
+                raise error.StanzaError('not-acceptable')
+
+
+    def _notify(self, service, node, items):
+        if self.pubsubService is None:
+            return
+
+        notifications = self.router.getNotifications(node.nodeIdentifier,
+                                                     items)
+        if notifications:
+            self.pubsubService.notifyPublish(service, node.nodeIdentifier,
+                                             notifications)
+
+
+    def _eventItem(self, node, item):
+        if node.config.get('pubsub#deliver_payloads', True):
+            return SerializedItem(item.data, item.itemIdentifier,
+                                  NS_PUBSUB_EVENT)
+        else:
+            element = domish.Element((NS_PUBSUB_EVENT, 'item'))
+            element['id'] = item.itemIdentifier
+            return element
+
+
+    def getPendingSubscriptions(self, owner):
+        """
+        Return the pending subscriptions to the nodes owned by an entity.
+
+        @param owner: The owner, only its bare JID is used.
+        @type owner: L{jid.JID}
+        @rtype: C{list} of L{Subscription}
+        """
+        affiliations = self._affiliationsByEntity.get(owner.userhost(), {})
+        subscriptions = []
+        for nodeIdentifier, affiliation in affiliations.iteritems():
+            if affiliation == 'owner':
+                subscriptions.extend(
+                        self.nodes[nodeIdentifier].pending.itervalues())
+        return subscriptions
+
+
+    def resendPending(self, service, owner):
+        """
+        Ask an owner again to authorize pending subscriptions.
+
+        This can be used when the owner becomes available.
+
+        @param service: The entity the requests will originate from.
+        @type service: L{jid.JID}
+        @param owner: The owner to ask.
+        @type owner: L{jid.JID}
+        """
+        byNode = {}
+        for subscription in self.getPendingSubscriptions(owner):
+            byNode.setdefault(subscription.nodeIdentifier, []).append(
+                    subscription)
+
+        for nodeIdentifier, subscriptions in byNode.iteritems():
+            d = self.pubsubService.notifyPending(service, nodeIdentifier,
+                                                 [owner], subscriptions)
+            d.addErrback(log.err)
+
+
+    # IPubSubResource
+
+    def locateResource(self, request):
+        return self
+
+
+    def getInfo(self, requestor, service, nodeIdentifier):
+        if not nodeIdentifier:
+            return defer.succeed(None)
+
+        node = self.nodes.get(nodeIdentifier)
+        if node is None:
+            return defer.succeed(None)
+        else:
+            return defer.succeed({'type': node.nodeType, 'meta-data': []})
+
+
+    def getNodes(self, requestor, service, nodeIdentifier):
+        if nodeIdentifier:
+            children = self.router.getChildren(nodeIdentifier)
+        else:
+            children = [nodeIdentifier for nodeIdentifier, node
+                        in self.nodes.iteritems()
+                        if not node.config.get('pubsub#collection')]
+        return defer.succeed(sorted(children))
+
+
+    def getConfigurationOptions(self):
+        return self.configurationOptions
+
+
+    def getSubscriptionOptions(self):
+        return self.subscriptionOptions
+
+
+    @_asDeferred
+    def publish(self, request):
+        node = self._getNode(request.nodeIdentifier)
+        self._checkLeaf(node, 'publish')
+
+        affiliation = self._getAffiliation(node, request.sender)
+        if affiliation == 'outcast' or (
+                affiliation not in ('owner', 'publisher') and
+                node.config.get('pubsub#publish_model') != 'open'):
+            raise error.StanzaError('forbidden')
+
+        items = request.items or []
+        for item in items:
+            if not item.getAttribute('id'):
+                item['id'] = str(uuid.uuid4())
+        items = [SerializedItem.fromElement(item) for item in items]
+
+        if node.config.get('pubsub#persist_items', True) and items:
+            publisher = request.sender.full()
+            self._record('publish', node.nodeIdentifier,
+                         [(item, publisher) for item in items])
+
+        self._notify(request.recipient, node,
+                     [self._eventItem(node, item) for item in items])
+
+
+    @_asDeferred
+    def subscribe(self, request):
+        node = self._getNode(request.nodeIdentifier)
+        self._checkNotOutcast(node, request.sender)
+
+        if request.subscriber.userhostJID() != request.sender.userhostJID():
+            raise BadRequest('invalid-jid')
+
+        subscriber = jid.internJID(request.subscriber.full())
+        subscription = node.subscriptions.get(subscriber)
+        if subscription is None:
+            if (node.config.get('pubsub#access_model') == 'authorize' and
+                self._getAffiliation(node, request.sender) != 'owner'):
+                state = 'pending'
+            else:
+                state = 'subscribed'
+
+            self._record('subscribe', node.nodeIdentifier, subscriber.full(),
+                         state, {})
+            subscription = node.subscriptions[subscriber]
+
+            if state == 'pending' and self.pubsubService is not None:
+                owners = [jid.internJID(entity) for entity, affiliation
+                          in node.affiliations.iteritems()
+                          if affiliation == 'owner']
+                d = self.pubsubService.notifyPending(request.recipient,
+                                                     node.nodeIdentifier,
+                                                     owners, [subscription])
+                d.addErrback(log.err)
+        return subscription
+
+
+    @_asDeferred
+    def unsubscribe(self, request):
+        node = self._getNode(request.nodeIdentifier)
+
+        if (request.subscriber.userhostJID() != request.sender.userhostJID()
+            and self._getAffiliation(node, request.sender) != 'owner'):
+            raise BadRequest('invalid-jid')
+
+        subscriber = jid.internJID(request.subscriber.full())
+        if subscriber not in node.subscriptions:
+            raise PubSubError('unexpected-request', 'not-subscribed')
+
+        self._record('unsubscribe', node.nodeIdentifier, subscriber.full())
+
+
+    def _getSubscription(self, request):
+        node = self._getNode(request.nodeIdentifier)
+
+        if (request.subscriber.userhostJID() != request.sender.userhostJID()
+            and self._getAffiliation(node, request.sender) != 'owner'):
+            raise error.StanzaError('forbidden')
+
+        subscriber = jid.internJID(request.subscriber.full())
+        try:
+            return node.subscriptions[subscriber]
+        except KeyError:
+            raise PubSubError('unexpected-request', 'not-subscribed')
+
+
+    @_asDeferred
+    def optionsGet(self, request):
+        return self._getSubscription(request).options
+
+
+    @_asDeferred
+    def optionsSet(self, request):
+        subscription = self._getSubscription(request)
+        options = dict(subscription.options)
+        options.update(request.options)
+        self._record('subscribe', subscription.nodeIdentifier,
+                     subscription.subscriber.full(), subscription.state,
+                     options)
+
+
+    @_asDeferred
+    def subscriptions(self, request):
+        entity = request.sender.userhost()
+        subscriptions = self._subscriptionsByEntity.get(entity, {})
+        return subscriptions.values()
+
+
+    @_asDeferred
+    def affiliations(self, request):
+        entity = request.sender.userhost()
+        affiliations = self._affiliationsByEntity.get(entity, {})
+        return affiliations.items()
+
+
+    @_asDeferred
+    def create(self, request):
+        nodeIdentifier = request.nodeIdentifier
+        if not nodeIdentifier:
+            nodeIdentifier = 'generic/%s' % uuid.uuid4()
+        elif nodeIdentifier in self.nodes:
+            raise error.StanzaError('conflict')
+
+        nodeType = 'leaf'
+        config = dict(self.defaultConfiguration)
+        if request.options:
+            nodeType = request.options.get('pubsub#node_type', nodeType)
+            for key, value in request.options.iteritems():
+                if key in config:
+                    config[key] = value
+        self._checkMaxItems(config)
+        self._checkCollections(nodeIdentifier, config)
+
+        self._record('create', nodeIdentifier, nodeType, config)
+        self._record('affiliate', nodeIdentifier, request.sender.userhost(),
+                     'owner')
+        return nodeIdentifier
+
+
+    @_asDeferred
+    def default(self, request):
+        return dict(self.defaultConfiguration)
+
+
+    @_asDeferred
+    def configureGet(self, request):
+        node = self._getNode(request.nodeIdentifier)
+        self._checkOwner(node, request.sender)
+        return dict(node.config)
+
+
+    @_asDeferred
+    def configureSet(self, request):
+        node = self._getNode(request.nodeIdentifier)
+        self._checkOwner(node, request.sender)
+
+        config = dict([(key, value)
+                       for key, value in request.options.iteritems()
+                       if key in self.defaultConfiguration])
+        self._checkMaxItems(config)
+        self._checkCollections(node.nodeIdentifier, config)
+        self._record('configure', node.nodeIdentifier, config)
+
+
+    @_asDeferred
+    def items(self, request):
+        node = self._getNode(request.nodeIdentifier)
+        self._checkNotOutcast(node, request.sender)
+        self._checkLeaf(node, 'retrieve-items')
+
+        if request.itemIdentifiers:
+            return [node.items[itemIdentifier][1]
+                    for itemIdentifier in request.itemIdentifiers
+                    if itemIdentifier in node.items]
+        else:
+            return node.getItems(request.maxItems)
+
+
+    @_asDeferred
+    def retract(self, request):
+        node = self._getNode(request.nodeIdentifier)
+        self._checkLeaf(node, 'retract-items')
+
+        itemIdentifiers = [itemIdentifier
+                           for itemIdentifier in request.itemIdentifiers or []
+                           if itemIdentifier in node.items]
+        if not itemIdentifiers:
+            raise error.StanzaError('item-not-found')
+
+        if self._getAffiliation(node, request.sender) != 'owner':
+            publisher = request.sender.userhost()
+            for itemIdentifier in itemIdentifiers:
+                itemPublisher = node.items[itemIdentifier][2]
+                if jid.internJID(itemPublisher).userhost() != publisher:
+                    raise error.StanzaError('forbidden')
+
+        self._record('retract', node.nodeIdentifier, itemIdentifiers)
+
+        if (self.pubsubService is not None and
+            node.config.get('pubsub#notify_retract', True)):
+            retractions = []
+            for itemIdentifier in itemIdentifiers:
+                retraction = domish.Element((NS_PUBSUB_EVENT, 'retract'))
+                retraction['id'] = itemIdentifier
+                retractions.append(retraction)
+
+            notifications = self.router.getNotifications(node.nodeIdentifier,
+                                                         retractions)
+            if notifications:
+                d = self.pubsubService.notifyRetract(request.recipient,
+                                                     node.nodeIdentifier,
+                                                     notifications)
+                d.addErrback(log.err)
+
+
+    @_asDeferred
+    def purge(self, request):
+        node = self._getNode(request.nodeIdentifier)
+        self._checkOwner(node, request.sender)
+        self._checkLeaf(node, 'purge-nodes')
+        self._record('purge', node.nodeIdentifier)
+
+        if self.pubsubService is None:
+            return
+
+        subscribers = self.router.getSubscribers(node.nodeIdentifier).items()
+        if subscribers:
+            d = self.pubsubService.notifyPurge(request.recipient,
+                                               node.nodeIdentifier,
+                                               subscribers)
+            d.addErrback(log.err)
+
+
+    @_asDeferred
+    def delete(self, request):
+        node = self._getNode(request.nodeIdentifier)
+        self._checkOwner(node, request.sender)
+
+        subscribers = [subscription.subscriber
+                       for subscription in node.subscriptions.itervalues()
+                       if subscription.state == 'subscribed']
+        self._record('delete', node.nodeIdentifier)
+
+        if self.pubsubService is not None and subscribers:
+            self.pubsubService.notifyDelete(request.recipient,
+                                            node.nodeIdentifier,
+                                            subscribers)
+
+
+    @_asDeferred
+    def affiliationsGet(self, request):
+        """
+        Return the affiliations with a node, by bare JID of the entity.
+        """
+        node = self._getNode(request.nodeIdentifier)
+        self._checkOwner(node, request.sender)
+        return dict(node.affiliations)
+
+
+    @_asDeferred
+    def affiliationsSet(self, request):
+        """
+        Change affiliations with a node.
+
+        The affiliations are passed in the request as a C{dict} of
+        affiliation by entity, where an affiliation of C{'none'} removes
+        the affiliation.
+        """
+        node = self._getNode(request.nodeIdentifier)
+        self._checkOwner(node, request.sender)
+
+        for entity, affiliation in (request.affiliations or {}).iteritems():
+            if affiliation not in ('owner', 'publisher', 'outcast', 'none'):
+                raise BadRequest()
+            entity = jid.internJID(unicode(entity)).userhost()
+            self._record('affiliate', node.nodeIdentifier, entity,
+                         affiliation)
+
+
+    @_asDeferred
+    def subscriptionsGet(self, request):
+        """
+        Return the subscriptions to a node.
+        """
+        node = self._getNode(request.nodeIdentifier)
+        self._checkOwner(node, request.sender)
+        return node.subscriptions.values()
+
+
+    @_asDeferred
+    def subscriptionsSet(self, request):
+        """
+        Change subscriptions to a node.
+
+        The subscriptions are passed in the request as L{Subscription}s,
+        where a state of C{'none'} removes the subscription. Subscribers
+        whose pending subscription is authorized or rejected are notified.
+        """
+        node = self._getNode(request.nodeIdentifier)
+        self._checkOwner(node, request.sender)
+
+        for subscription in request.subscriptions or ():
+            subscriber = subscription.subscriber.full()
+            wasPending = jid.internJID(subscriber) in node.pending
+            if subscription.state == 'none':
+                if jid.internJID(subscriber) in node.subscriptions:
+                    self._record('unsubscribe', node.nodeIdentifier,
+                                 subscriber)
+            elif subscription.state in ('subscribed', 'pending',
+                                        'unconfigured'):
+                self._record('subscribe', node.nodeIdentifier, subscriber,
+                             subscription.state, subscription.options)
+            else:
+                raise BadRequest()
+
+            if (wasPending and subscription.state != 'pending' and
+                self.pubsubService is not None):
+                self.pubsubService.notifySubscription(request.recipient,
+                                                      node.nodeIdentifier,
+                                                      subscription)
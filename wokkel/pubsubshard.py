@@ -0,0 +1,487 @@
+# -*- test-case-name: wokkel.test.test_pubsubshard -*-
+#
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+Node-sharded publish-subscribe service.
+
+A L{ShardedPubSubService} takes the place of a
+L{PubSubService<wokkel.pubsub.PubSubService>} for one service entity, but
+does not handle requests itself. Nodes are assigned to shards by consistent
+hashing of their node identifier, and each request is forwarded to the
+L{ShardWorker} owning the node, using AMP over a local connection. Each
+worker runs a regular L{PubSubService<wokkel.pubsub.PubSubService>} with
+its own resource, and passes the responses and the notifications it sends
+back to the front.
+
+Workers typically run in a process of their own, talking AMP over their
+standard input and output::
+
+    from twisted.internet import stdio
+    stdio.StandardIO(ShardWorker(service))
+
+The front process starts them with C{reactor.spawnProcess}, passing a
+L{ShardProcessProtocol} that wraps the L{ShardConnection} to the worker.
+
+Requests that are not about a single node are handled as follows:
+
+ - Retrieving all subscriptions or affiliations of an entity is forwarded
+   to all shards, and the results are combined.
+ - For instant nodes, the front picks the node identifier, so that the node
+   can be created on the shard owning it.
+ - Requests without a node, like retrieving the default configuration, go
+   to the shard owning the empty node identifier.
+
+Collection nodes only have the children that live on the same shard.
+"""
+
+import uuid
+from bisect import bisect
+
+from zope.interface import implements
+
+from twisted.internet import defer, protocol
+from twisted.protocols import amp
+from twisted.python import log
+from twisted.python.hashlib import md5
+from twisted.words.protocols.jabber import error, jid
+from twisted.words.protocols.jabber.xmlstream import toResponse
+from twisted.words.xish import domish
+
+from wokkel import disco, generic
+from wokkel.iwokkel import IDisco
+from wokkel.pubsub import NS_PUBSUB, PUBSUB_REQUEST, PubSubRequest
+from wokkel.subprotocols import XMPPHandler
+
+class HashRing(object):
+    """
+    Consistent hash ring of shards.
+
+    Each shard is placed on the ring at a number of points. A key belongs
+    to the shard at the first point following the hash of the key, so
+    adding or removing a shard only moves the keys of that shard.
+
+    @ivar replicas: Number of points per shard.
+    @type replicas: C{int}
+    """
+
+    def __init__(self, shards=(), replicas=100):
+        self.replicas = replicas
+        self._points = []
+        self._shards = {}
+        for shard in shards:
+            self.addShard(shard)
+
+
+    def _hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return long(md5(key).hexdigest()[:16], 16)
+
+
+    def addShard(self, shard):
+        """
+        Add a shard to the ring.
+
+        @param shard: The name of the shard.
+        @type shard: C{str}
+        """
+        for i in xrange(self.replicas):
+            point = self._hash('%s-%d' % (shard, i))
+            self._shards[point] = shard
+            self._points.insert(bisect(self._points, point), point)
+
+
+    def removeShard(self, shard):
+        """
+        Remove a shard from the ring.
+
+        @param shard: The name of the shard.
+        @type shard: C{str}
+        """
+        for i in xrange(self.replicas):
+            point = self._hash('%s-%d' % (shard, i))
+            if self._shards.get(point) == shard:
+                del self._shards[point]
+                self._points.remove(point)
+
+
+    def getShard(self, key):
+        """
+        Return the shard a key belongs to.
+
+        @param key: The key, usually a node identifier.
+        @type key: C{unicode}
+        @return: The name of the shard.
+        @rtype: C{str}
+        """
+        if not self._points:
+            raise KeyError(key)
+        index = bisect(self._points, self._hash(key)) % len(self._points)
+        return self._shards[self._points[index]]
+
+
+
+class XML(amp.Argument):
+    """
+    AMP argument for serialized XML of any length.
+
+    AMP limits values to 64KiB, so the serialized XML is split over as many
+    values as needed.
+    """
+
+    chunkSize = amp.MAX_VALUE_LENGTH
+
+    def toBox(self, name, strings, objects, proto):
+        value = self.retrieve(objects, name, proto)
+        if domish.IElement.providedBy(value):
+            value = value.toXml()
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        chunks = [value[i:i + self.chunkSize]
+                  for i in xrange(0, len(value), self.chunkSize)]
+        strings[name] = str(len(chunks))
+        for i, chunk in enumerate(chunks):
+            strings['%s.%d' % (name, i)] = chunk
+
+
+    def fromBox(self, name, strings, objects, proto):
+        count = int(self.retrieve(strings, name, proto))
+        objects[name] = ''.join([strings.pop('%s.%d' % (name, i))
+                                 for i in xrange(count)])
+
+
+
+class Request(amp.Command):
+    """
+    Handle a publish-subscribe request.
+
+    The response is the serialized result or error response.
+    """
+    arguments = [('stanza', XML())]
+    response = [('response', XML())]
+
+
+
+class Send(amp.Command):
+    """
+    Send a stanza, usually a notification, over the XML stream of the front.
+    """
+    arguments = [('stanza', XML())]
+    requiresAnswer = False
+
+
+
+class GetDiscoInfo(amp.Command):
+    """
+    Retrieve the service discovery information of a node.
+    """
+    arguments = [('requestor', amp.Unicode()),
+                 ('target', amp.Unicode()),
+                 ('nodeIdentifier', amp.Unicode())]
+    response = [('info', XML())]
+
+
+
+class GetDiscoItems(amp.Command):
+    """
+    Retrieve the service discovery items of a node.
+    """
+    arguments = [('requestor', amp.Unicode()),
+                 ('target', amp.Unicode()),
+                 ('nodeIdentifier', amp.Unicode())]
+    response = [('items', XML())]
+
+
+
+class ShardWorker(amp.AMP):
+    """
+    Worker handling the requests for the nodes of one shard.
+
+    The worker stands in for the stream manager of its service: stanzas
+    sent by the service are passed back to the front, either as the
+    response to a forwarded request, or through L{Send}.
+
+    @ivar service: The service handling the requests.
+    @type service: L{PubSubService<wokkel.pubsub.PubSubService>}
+    """
+
+    def __init__(self, service):
+        amp.AMP.__init__(self)
+        self.service = service
+        self.service.parent = self
+        self._pending = {}
+        self._counter = 0
+
+
+    def send(self, obj):
+        """
+        Pass a stanza sent by the service back to the front.
+        """
+        if domish.IElement.providedBy(obj):
+            stanzaID = obj.getAttribute('id')
+            if obj.name == 'iq' and stanzaID in self._pending:
+                d, originalID = self._pending.pop(stanzaID)
+                if originalID is None:
+                    del obj['id']
+                else:
+                    obj['id'] = originalID
+                d.callback({'response': obj})
+                return
+
+        self.callRemote(Send, stanza=obj)
+
+
+    @Request.responder
+    def request(self, stanza):
+        """
+        Have the service handle a request.
+
+        Request identifiers are only unique per requestor, so the request
+        gets an identifier of the worker while it is handled.
+        """
+        iq = generic.parseXml(stanza)
+
+        self._counter += 1
+        stanzaID = 'shard-%d' % self._counter
+        d = defer.Deferred()
+        self._pending[stanzaID] = (d, iq.getAttribute('id'))
+        iq['id'] = stanzaID
+
+        self.service.handleRequest(iq)
+        return d
+
+
+    @GetDiscoInfo.responder
+    def getDiscoInfo(self, requestor, target, nodeIdentifier):
+        def toResponse(info):
+            discoInfo = disco.DiscoInfo()
+            discoInfo.nodeIdentifier = nodeIdentifier
+            for item in info or []:
+                discoInfo.append(item)
+            return {'info': discoInfo.toElement()}
+
+        d = defer.maybeDeferred(self.service.getDiscoInfo,
+                                jid.internJID(requestor),
+                                jid.internJID(target),
+                                nodeIdentifier)
+        d.addCallback(toResponse)
+        return d
+
+
+    @GetDiscoItems.responder
+    def getDiscoItems(self, requestor, target, nodeIdentifier):
+        def toResponse(items):
+            discoItems = disco.DiscoItems()
+            discoItems.nodeIdentifier = nodeIdentifier
+            for item in items:
+                discoItems.append(item)
+            return {'items': discoItems.toElement()}
+
+        d = defer.maybeDeferred(self.service.getDiscoItems,
+                                jid.internJID(requestor),
+                                jid.internJID(target),
+                                nodeIdentifier)
+        d.addCallback(toResponse)
+        return d
+
+
+
+class ShardConnection(amp.AMP):
+    """
+    Connection of the front to a L{ShardWorker}.
+
+    @ivar service: The front service stanzas from the worker are sent
+                   through.
+    @type service: L{ShardedPubSubService}
+    """
+
+    service = None
+
+    @Send.responder
+    def sendStanza(self, stanza):
+        self.service.send(stanza)
+        return {}
+
+
+
+class ShardProcessProtocol(protocol.ProcessProtocol):
+    """
+    Process protocol for a worker process, talking AMP over its standard
+    input and output.
+
+    @ivar connection: The connection to the worker.
+    @type connection: L{ShardConnection}
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+    def connectionMade(self):
+        self.connection.makeConnection(self.transport)
+
+
+    def outReceived(self, data):
+        self.connection.dataReceived(data)
+
+
+    def errReceived(self, data):
+        log.msg("Shard worker: %s" % data)
+
+
+    def processEnded(self, reason):
+        self.connection.connectionLost(reason)
+
+
+
+class ShardedPubSubService(XMPPHandler):
+    """
+    Front of a publish-subscribe service with nodes sharded over workers.
+
+    @ivar shards: Connections to the workers, keyed by shard name.
+    @type shards: C{dict} of L{ShardConnection}
+    @ivar ring: The assignment of node identifiers to shards.
+    @type ring: L{HashRing}
+    """
+
+    implements(IDisco)
+
+    def __init__(self, shards):
+        XMPPHandler.__init__(self)
+        self.shards = shards
+        self.ring = HashRing(shards)
+        for connection in shards.itervalues():
+            connection.service = self
+
+
+    def connectionMade(self):
+        self.xmlstream.addObserver(PUBSUB_REQUEST, self._onRequest)
+
+
+    def getShard(self, nodeIdentifier):
+        """
+        Return the connection to the worker owning a node.
+
+        @param nodeIdentifier: The node identifier.
+        @type nodeIdentifier: C{unicode}
+        @rtype: L{ShardConnection}
+        """
+        return self.shards[self.ring.getShard(nodeIdentifier or '')]
+
+
+    def _onRequest(self, iq):
+        iq.handled = True
+
+        try:
+            request = PubSubRequest.fromElement(iq)
+        except error.StanzaError, exc:
+            self.send(exc.toResponse(iq))
+            return
+
+        if (request.verb in ('subscriptions', 'affiliations') and
+            not request.nodeIdentifier):
+            d = self._scatter(iq, request.verb)
+        elif request.verb == 'create' and not request.nodeIdentifier:
+            d = self._createInstant(iq)
+        else:
+            d = self._forward(self.getShard(request.nodeIdentifier), iq)
+
+        d.addErrback(self._internalError, iq)
+        d.addCallback(self.send)
+
+
+    def _forward(self, shard, iq):
+        d = shard.callRemote(Request, stanza=iq)
+        d.addCallback(lambda result: result['response'])
+        return d
+
+
+    def _internalError(self, failure, iq):
+        log.err(failure, "Error forwarding request to shard")
+        return error.StanzaError('internal-server-error').toResponse(iq)
+
+
+    def _scatter(self, iq, verb):
+        """
+        Forward a request to all shards and combine the responses.
+        """
+        def combine(results):
+            response = toResponse(iq, 'result')
+            pubsub = response.addElement((NS_PUBSUB, 'pubsub'))
+            container = pubsub.addElement(verb)
+
+            for result in results:
+                element = generic.parseXml(result['response'])
+                if element.getAttribute('type') == 'error':
+                    return result['response']
+                for child in element.pubsub.elements():
+                    if child.name == verb:
+                        for entry in child.elements():
+                            container.addChild(entry)
+
+            return response
+
+        d = defer.gatherResults([shard.callRemote(Request, stanza=iq)
+                                 for shard in self.shards.itervalues()])
+        d.addCallback(combine)
+        return d
+
+
+    def _createInstant(self, iq):
+        """
+        Create an instant node on the shard owning a new node identifier.
+        """
+        def addNode(result):
+            element = generic.parseXml(result)
+            if (element.getAttribute('type') == 'result' and
+                element.pubsub is None):
+                pubsub = element.addElement((NS_PUBSUB, 'pubsub'))
+                pubsub.addElement('create')['node'] = nodeIdentifier
+            return element
+
+        nodeIdentifier = 'generic/%s' % uuid.uuid4()
+        for child in iq.pubsub.elements():
+            if child.name == 'create':
+                child['node'] = nodeIdentifier
+
+        d = self._forward(self.getShard(nodeIdentifier), iq)
+        d.addCallback(addNode)
+        return d
+
+
+    def getDiscoInfo(self, requestor, target, nodeIdentifier=''):
+        def toInfo(result):
+            return list(disco.DiscoInfo.fromElement(
+                            generic.parseXml(result['info'])))
+
+        d = self.getShard(nodeIdentifier).callRemote(
+                GetDiscoInfo, requestor=requestor.full(),
+                              target=target.full(),
+                              nodeIdentifier=nodeIdentifier)
+        d.addCallback(toInfo)
+        return d
+
+
+    def getDiscoItems(self, requestor, target, nodeIdentifier=''):
+        def toItems(results):
+            items = []
+            for result in results:
+                items.extend(disco.DiscoItems.fromElement(
+                                 generic.parseXml(result['items'])))
+            return items
+
+        if nodeIdentifier:
+            shards = [self.getShard(nodeIdentifier)]
+        else:
+            shards = self.shards.values()
+
+        d = defer.gatherResults([
+                shard.callRemote(GetDiscoItems, requestor=requestor.full(),
+                                                target=target.full(),
+                                                nodeIdentifier=nodeIdentifier)
+                for shard in shards])
+        d.addCallback(toItems)
+        return d
@@ -0,0 +1,232 @@
+# -*- test-case-name: wokkel.test.test_reconnect -*-
+#
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+Reconnection policies for XML stream clients.
+"""
+
+import random
+
+from twisted.python import log
+from twisted.words.protocols.jabber import xmlstream
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class ReconnectPolicy(object):
+    """
+    Reconnection policy with exponential backoff and a circuit breaker.
+
+    After the n-th consecutive failure, the next attempt is delayed up to
+    C{initialDelay * factor ** n} seconds, capped at C{maxDelay}. With
+    C{jitter} set, the actual delay is picked at random between zero and
+    that value (full jitter), so that many clients losing their
+    connection at the same time do not all come back at once.
+
+    After C{failureThreshold} consecutive failures, the circuit breaker
+    opens and the next attempt is made after C{resetTimeout} seconds. That
+    attempt is the half-open probe: if it succeeds, the breaker closes
+    again, otherwise it reopens for another C{resetTimeout} seconds.
+
+    A connection counts as succeeded when the XML stream has been
+    initialized. A connection that is lost before that counts as a
+    failure.
+
+    @ivar initialDelay: Maximum delay for the first attempt after a
+                        connection was lost.
+    @type initialDelay: C{float}
+    @ivar factor: Growth factor of the delay on consecutive failures.
+    @type factor: C{float}
+    @ivar maxDelay: Maximum delay between attempts while the breaker is
+                    closed.
+    @type maxDelay: C{float}
+    @ivar jitter: Whether to pick delays at random up to the computed
+                  delay.
+    @type jitter: C{bool}
+    @ivar failureThreshold: Number of consecutive failures that opens the
+                            circuit breaker, or C{None} to never open it.
+    @type failureThreshold: C{int}
+    @ivar resetTimeout: Delay before a new attempt while the breaker is open.
+    @type resetTimeout: C{float}
+    @ivar state: State of the circuit breaker. One of L{CLOSED}, L{OPEN}
+                 and L{HALF_OPEN}.
+    @type state: C{str}
+    @ivar attempts: Number of reconnection attempts scheduled.
+    @type attempts: C{int}
+    @ivar successes: Number of successfully initialized connections.
+    @type successes: C{int}
+    @ivar failures: Number of failed connections.
+    @type failures: C{int}
+    @ivar consecutiveFailures: Number of failures since the last success.
+    @type consecutiveFailures: C{int}
+    @ivar lastDelay: The delay used for the last scheduled attempt.
+    @type lastDelay: C{float}
+    """
+
+    initialDelay = 1.0
+    factor = 2.0
+    maxDelay = 300
+    jitter = True
+    failureThreshold = None
+    resetTimeout = 600
+
+    def __init__(self, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+
+        self.state = CLOSED
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutiveFailures = 0
+        self.lastDelay = None
+        self.lastSuccess = None
+        self.lastFailure = None
+        self._up = False
+
+
+    def connectionSucceeded(self):
+        """
+        Called when the XML stream has been initialized.
+        """
+        self._up = True
+        self.state = CLOSED
+        self.successes += 1
+        self.consecutiveFailures = 0
+        self.lastSuccess = self._reactor.seconds()
+
+
+    def connectionFailed(self):
+        """
+        Called when a connection attempt failed.
+        """
+        self.failures += 1
+        self.consecutiveFailures += 1
+        self.lastFailure = self._reactor.seconds()
+
+        if self.state == HALF_OPEN or (
+                self.failureThreshold is not None and
+                self.consecutiveFailures >= self.failureThreshold):
+            if self.state != OPEN:
+                log.msg("Too many failed connection attempts, "
+                        "backing off for %d seconds" % self.resetTimeout)
+            self.state = OPEN
+
+
+    def connectionLost(self):
+        """
+        Called when a connection was lost.
+
+        This counts as a failure if the XML stream was never initialized.
+        """
+        if self._up:
+            self._up = False
+        else:
+            self.connectionFailed()
+
+
+    def nextDelay(self):
+        """
+        Compute the delay for the next attempt.
+
+        @rtype: C{float}
+        """
+        if self.state == OPEN:
+            return self.resetTimeout
+
+        delay = min(self.maxDelay,
+                    self.initialDelay * self.factor ** self.consecutiveFailures)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+    def schedule(self, connect):
+        """
+        Schedule a reconnection attempt.
+
+        @param connect: Callable that starts the attempt.
+        @return: The delayed call for the attempt.
+        @rtype: L{IDelayedCall<twisted.internet.interfaces.IDelayedCall>}
+        """
+        def attempt():
+            if self.state == OPEN:
+                self.state = HALF_OPEN
+            connect()
+
+        self.lastDelay = self.nextDelay()
+        self.attempts += 1
+        return self._reactor.callLater(self.lastDelay, attempt)
+
+
+    def getStats(self):
+        """
+        Return the reconnection statistics.
+
+        @rtype: C{dict}
+        """
+        return {'state': self.state,
+                'attempts': self.attempts,
+                'successes': self.successes,
+                'failures': self.failures,
+                'consecutiveFailures': self.consecutiveFailures,
+                'lastDelay': self.lastDelay,
+                'lastSuccess': self.lastSuccess,
+                'lastFailure': self.lastFailure}
+
+
+
+class ReconnectingXmlStreamFactory(xmlstream.XmlStreamFactory):
+    """
+    XML stream factory that reconnects according to a L{ReconnectPolicy}.
+
+    @ivar policy: The reconnection policy.
+    @type policy: L{ReconnectPolicy}
+    """
+
+    def __init__(self, authenticator, policy=None):
+        xmlstream.XmlStreamFactory.__init__(self, authenticator)
+        if policy is None:
+            policy = ReconnectPolicy()
+        self.policy = policy
+        self.addBootstrap(xmlstream.STREAM_AUTHD_EVENT, self._authd)
+
+
+    def _authd(self, xs):
+        self.policy.connectionSucceeded()
+
+
+    def clientConnectionFailed(self, connector, reason):
+        self.policy.connectionFailed()
+        xmlstream.XmlStreamFactory.clientConnectionFailed(self, connector,
+                                                          reason)
+
+
+    def clientConnectionLost(self, connector, reason):
+        self.policy.connectionLost()
+        xmlstream.XmlStreamFactory.clientConnectionLost(self, connector,
+                                                        reason)
+
+
+    def retry(self, connector=None):
+        """
+        Have the connector connect again, as scheduled by the policy.
+        """
+        if not self.continueTrying:
+            return
+
+        if connector is None:
+            connector = self.connector
+
+        def reconnect():
+            self._callID = None
+            connector.connect()
+
+        self._callID = self.policy.schedule(reconnect)
+        if self.noisy:
+            log.msg("%s will retry in %d seconds" % (connector,
+                                                    self.policy.lastDelay))
@@ -20,18 +20,19 @@ except ImportError:
     sha256 = digestmod.new
 
 import hmac
+from collections import deque
 
 from zope.interface import implements
 
 from twisted.application import service
 from twisted.internet import defer, reactor
-from twisted.names.srvconnect import SRVConnector
 from twisted.python import log, randbytes
 from twisted.words.protocols.jabber import error, ijabber, jid, xmlstream
 from twisted.words.xish import domish
 
 from wokkel.generic import DeferredXmlStreamFactory, XmlPipe
 from wokkel.compat import XmlStreamServerFactory
+from wokkel.srv import CachingSRVConnector
 
 NS_DIALBACK = 'jabber:server:dialback'
 
@@ -64,6 +65,105 @@ def generateKey(secret, receivingServer, originatingServer, streamID):
     return hash.hexdigest()
 
 
+class KeyGenerator(object):
+    """
+    Dialback key generator bound to a shared secret.
+
+    This generates the same keys as L{generateKey}, but hashes the secret
+    and sets up the keyed HMAC state only once. For each key, a copy of the
+    prepared HMAC state is used.
+
+    The secret can be replaced using L{rotate}. Keys generated with the
+    previous secret are still accepted by L{verifyKey} for C{gracePeriod}
+    seconds after rotation, so that dialback for streams set up just before
+    rotation can complete.
+
+    @ivar secret: The current shared secret.
+    @type secret: C{str}
+    @ivar gracePeriod: Number of seconds that keys generated with the
+                       previous secret remain valid after rotation.
+    @type gracePeriod: C{int}
+    """
+
+    gracePeriod = 300
+
+    def __init__(self, secret, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+
+        self.secret = secret
+        self._hmac = self._prepare(secret)
+        self._previousHMAC = None
+        self._previousExpires = None
+
+
+    def _prepare(self, secret):
+        hashedSecret = sha256(secret).hexdigest()
+        return hmac.HMAC(hashedSecret, digestmod=digestmod)
+
+
+    def _generate(self, state, receivingServer, originatingServer, streamID):
+        hash = state.copy()
+        hash.update(" ".join([receivingServer, originatingServer, streamID]))
+        return hash.hexdigest()
+
+
+    def generateKey(self, receivingServer, originatingServer, streamID):
+        """
+        Generate a dialback key using the current secret.
+
+        See L{generateKey} for the meaning of the parameters.
+
+        @return: hexadecimal digest of the generated key.
+        @rtype: C{str}
+        """
+        return self._generate(self._hmac, receivingServer, originatingServer,
+                              streamID)
+
+
+    def verifyKey(self, key, receivingServer, originatingServer, streamID):
+        """
+        Check a dialback key.
+
+        The key is checked against the key generated with the current
+        secret, and, within the grace period after rotation, against the
+        key generated with the previous secret.
+
+        @param key: The dialback key to check.
+        @type key: C{unicode}
+        @rtype: C{bool}
+        """
+        if key == self.generateKey(receivingServer, originatingServer,
+                                   streamID):
+            return True
+
+        if self._previousHMAC is None:
+            return False
+
+        if self._reactor.seconds() >= self._previousExpires:
+            self._previousHMAC = None
+            self._previousExpires = None
+            return False
+
+        return key == self._generate(self._previousHMAC, receivingServer,
+                                     originatingServer, streamID)
+
+
+    def rotate(self, secret):
+        """
+        Replace the shared secret.
+
+        @param secret: The new shared secret.
+        @type secret: C{str}
+        """
+        self._previousHMAC = self._hmac
+        self._previousExpires = self._reactor.seconds() + self.gracePeriod
+        self.secret = secret
+        self._hmac = self._prepare(secret)
+
+
+
 def trapStreamError(xs, observer):
     """
     Trap stream errors.
@@ -89,13 +189,162 @@ def trapStreamError(xs, observer):
     return wrappedObserver
 
 
-class XMPPServerConnector(SRVConnector):
-    def __init__(self, reactor, domain, factory):
-        SRVConnector.__init__(self, reactor, 'xmpp-server', domain, factory)
+def hostFromJID(jidString):
+    """
+    Extract and check the host part of a JID.
+
+    Unlike L{jid.internJID}, this only prepares the host part of the given
+    JID, leaving the user and resource parts alone.
+
+    @param jidString: The JID as a string.
+    @type jidString: C{unicode}
+    @return: The prepared host part of the JID.
+    @rtype: C{unicode}
+    @raise jid.InvalidFormat: The host part is not valid.
+    """
+    host = jidString.split('/', 1)[0].split('@', 1)[-1]
+    if not host:
+        raise jid.InvalidFormat("Server address required.")
+    parsed = jid.internJID(host)
+    if parsed.user is not None or parsed.resource is not None:
+        raise jid.InvalidFormat("Invalid host %r" % host)
+    return parsed.host
+
+
+
+class DomainRateLimiter(object):
+    """
+    Per-domain admission control for inbound stanzas.
+
+    Each remote domain gets a token bucket that fills up at C{rate} tokens
+    per second, up to C{burst} tokens. Every admitted stanza takes one
+    token. Stanzas arriving when the bucket of their domain is empty are
+    queued, and delivered as soon as new tokens become available. When
+    the queue for a domain holds C{maxQueued} stanzas, new stanzas from that
+    domain are dropped.
+
+    @ivar deliver: Callable that is called with each admitted stanza.
+    @type deliver: C{callable}
+    @ivar rate: Number of stanzas per second admitted from each domain, or
+                C{None} to admit all stanzas right away.
+    @type rate: C{float}
+    @ivar burst: Maximum number of stanzas from a domain that are admitted
+                 at once.
+    @type burst: C{int}
+    @ivar maxQueued: Maximum number of queued stanzas per domain.
+    @type maxQueued: C{int}
+    """
+
+    rate = None
+    burst = 50
+    maxQueued = 500
+
+    def __init__(self, deliver, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.deliver = deliver
+
+        self._buckets = {}
+        self._queues = {}
+        self._drainCalls = {}
+
+
+    def admit(self, domain, stanza):
+        """
+        Offer an inbound stanza from a remote domain.
+
+        @param domain: The remote domain the stanza was received from.
+        @type domain: C{unicode}
+        @param stanza: The stanza.
+        @type stanza: L{domish.Element}
+        @return: C{False} if the stanza was dropped, C{True} otherwise.
+        @rtype: C{bool}
+        """
+        if self.rate is None:
+            self.deliver(stanza)
+            return True
+
+        queue = self._queues.get(domain)
+
+        if queue is not None:
+            if len(queue) >= self.maxQueued:
+                log.msg("Dropping stanza from %r: too many queued stanzas" %
+                        domain)
+                return False
+            queue.append(stanza)
+        elif self._take(domain):
+            self.deliver(stanza)
+        else:
+            self._queues[domain] = deque([stanza])
+            self._scheduleDrain(domain)
+
+        return True
+
+
+    def _take(self, domain):
+        """
+        Take a token from the bucket of a domain, if available.
+        """
+        now = self._reactor.seconds()
+
+        try:
+            tokens, last = self._buckets[domain]
+        except KeyError:
+            tokens, last = self.burst, now
+
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+        if tokens >= 1:
+            self._buckets[domain] = (tokens - 1, now)
+            return True
+        else:
+            self._buckets[domain] = (tokens, now)
+            return False
+
+
+    def _scheduleDrain(self, domain):
+        tokens = self._buckets[domain][0]
+        delay = (1 - tokens) / self.rate
+        self._drainCalls[domain] = self._reactor.callLater(delay, self._drain,
+                                                           domain)
+
+
+    def _drain(self, domain):
+        """
+        Deliver queued stanzas for a domain as far as tokens allow.
+        """
+        del self._drainCalls[domain]
+        queue = self._queues[domain]
+
+        while queue and self._take(domain):
+            self.deliver(queue.popleft())
+
+        if queue:
+            self._scheduleDrain(domain)
+        else:
+            del self._queues[domain]
+
+
+    def stop(self):
+        """
+        Drop all queued stanzas and cancel pending deliveries.
+        """
+        for call in self._drainCalls.itervalues():
+            call.cancel()
+        self._drainCalls = {}
+        self._queues = {}
+
+
+
+class XMPPServerConnector(CachingSRVConnector):
+    def __init__(self, reactor, domain, factory, cache=None, racing=False):
+        CachingSRVConnector.__init__(self, reactor, 'xmpp-server', domain,
+                                     factory, cache, racing)
 
 
     def pickServer(self):
-        host, port = SRVConnector.pickServer(self)
+        host, port = CachingSRVConnector.pickServer(self)
 
         if not self.servers and not self.orderedServers:
             # no SRV record, fall back..
@@ -118,11 +367,14 @@ class OriginatingDialbackInitializer(object):
 
     _deferred = None
 
-    def __init__(self, xs, thisHost, otherHost, secret):
+    def __init__(self, xs, thisHost, otherHost, secret, keyGenerator=None):
         self.xmlstream = xs
         self.thisHost = thisHost
         self.otherHost = otherHost
         self.secret = secret
+        if keyGenerator is None:
+            keyGenerator = KeyGenerator(secret)
+        self.keyGenerator = keyGenerator
 
 
     def initialize(self):
@@ -132,8 +384,8 @@ class OriginatingDialbackInitializer(object):
         self.xmlstream.addObserver("/result[@xmlns='%s']" % NS_DIALBACK,
                                    self.onResult)
 
-        key = generateKey(self.secret, self.otherHost,
-                          self.thisHost, self.xmlstream.sid)
+        key = self.keyGenerator.generateKey(self.otherHost, self.thisHost,
+                                            self.xmlstream.sid)
 
         result = domish.Element((NS_DIALBACK, 'result'))
         result['from'] = self.thisHost
@@ -235,13 +487,16 @@ class XMPPServerConnectAuthenticator(xmlstream.ConnectAuthenticator):
                      Receiving Server).
     @ivar secret: The shared secret that is used for verifying the validity
                   of this new connection.
+    @ivar keyGenerator: Optional L{KeyGenerator} bound to C{secret}, used to
+                        generate the dialback key.
     """
     namespace = 'jabber:server'
 
-    def __init__(self, thisHost, otherHost, secret):
+    def __init__(self, thisHost, otherHost, secret, keyGenerator=None):
         self.thisHost = thisHost
         self.otherHost = otherHost
         self.secret = secret
+        self.keyGenerator = keyGenerator
         xmlstream.ConnectAuthenticator.__init__(self, otherHost)
 
 
@@ -255,7 +510,8 @@ class XMPPServerConnectAuthenticator(xmlstream.ConnectAuthenticator):
     def associateWithStream(self, xs):
         xmlstream.ConnectAuthenticator.associateWithStream(self, xs)
         init = OriginatingDialbackInitializer(xs, self.thisHost,
-                                              self.otherHost, self.secret)
+                                              self.otherHost, self.secret,
+                                              self.keyGenerator)
         xs.initializers = [init]
 
 
@@ -318,7 +574,10 @@ class XMPPServerListenAuthenticator(xmlstream.ListenAuthenticator):
     request, checks the key and then returns the result.
 
     @ivar service: The service that keeps the list of domains we accept
-                   connections for.
+                   connections for, and the shared C{secret} to verify
+                   dialback keys with. If the service has a L{KeyGenerator}
+                   bound to that secret in its C{keyGenerator} attribute, it
+                   is used to verify keys.
     """
     namespace = 'jabber:server'
 
@@ -390,9 +649,15 @@ class XMPPServerListenAuthenticator(xmlstream.ListenAuthenticator):
         streamID = verify.getAttribute('id', '')
         key = unicode(verify)
 
-        calculatedKey = generateKey(self.service.secret, receivingServer,
-                                    originatingServer, streamID)
-        validity = (key == calculatedKey) and 'valid' or 'invalid'
+        keyGenerator = getattr(self.service, 'keyGenerator', None)
+        if (keyGenerator is not None and
+            keyGenerator.secret == self.service.secret):
+            valid = keyGenerator.verifyKey(key, receivingServer,
+                                           originatingServer, streamID)
+        else:
+            valid = key == generateKey(self.service.secret, receivingServer,
+                                       originatingServer, streamID)
+        validity = valid and 'valid' or 'invalid'
 
         reply = domish.Element((NS_DIALBACK, 'verify'))
         reply['from'] = originatingServer
@@ -440,9 +705,15 @@ class DeferredS2SClientFactory(DeferredXmlStreamFactory):
     The deferred has its callbacks called upon succesful authentication with
     the other server. In case of failed authentication or connection, the
     deferred will have its errbacks called instead.
+
+    @ivar racing: If set, connection attempts to all of the other server's
+                  SRV targets are raced, instead of trying them one by one.
+                  See L{CachingSRVConnector}.
+    @type racing: C{bool}
     """
 
     logTraffic = False
+    racing = False
 
     def __init__(self, authenticator):
         DeferredXmlStreamFactory.__init__(self, authenticator)
@@ -471,7 +742,7 @@ class DeferredS2SClientFactory(DeferredXmlStreamFactory):
 
 def initiateS2S(factory):
     domain = factory.authenticator.otherHost
-    c = XMPPServerConnector(reactor, domain, factory)
+    c = XMPPServerConnector(reactor, domain, factory, racing=factory.racing)
     c.connect()
     return factory.deferred
 
@@ -559,9 +830,206 @@ class XMPPS2SServerFactory(XmlStreamServerFactory):
 
 
 
+class OutgoingStreamPool(object):
+    """
+    Pool of outgoing XMPP server-to-server streams.
+
+    Streams are kept by the pair of the local domain and the remote domain
+    they connect. Stanzas for a pair of domains without an initialized
+    stream are queued, and a new stream is requested by calling
+    C{initiate}. Once that stream has been initialized, it is to be passed
+    to L{streamInitialized}, upon which the queue is flushed.
+
+    Streams that have not been used to send stanzas for C{idleTimeout}
+    seconds are closed. Also, when setting up a new stream would exceed
+    C{maxStreams}, the least recently used stream is closed to make room.
+    Closed streams are set up again on demand, as soon as a new stanza
+    needs to be sent to their remote domain.
+
+    @ivar initiate: Callable that is called with the local and the remote
+                    domain to set up a new outgoing stream.
+    @type initiate: C{callable}
+    @ivar idleTimeout: Number of seconds after which an unused stream is
+                       closed, or C{None} to keep idle streams open.
+    @type idleTimeout: C{int}
+    @ivar maxStreams: Maximum number of streams that are kept open or are
+                      being set up at any one time, or C{None} for no limit.
+    @type maxStreams: C{int}
+    """
+
+    idleTimeout = 600
+    maxStreams = None
+
+    def __init__(self, initiate, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.initiate = initiate
+
+        self._streams = {}
+        self._queues = {}
+        self._lastUsed = {}
+        self._idleCalls = {}
+
+
+    def __len__(self):
+        return len(self._streams)
+
+
+    def __contains__(self, key):
+        return key in self._streams
+
+
+    def getStream(self, thisHost, otherHost):
+        """
+        Return the initialized stream for a pair of domains, or C{None}.
+        """
+        return self._streams.get((thisHost, otherHost))
+
+
+    def send(self, thisHost, otherHost, stanza):
+        """
+        Send a stanza from C{thisHost} to C{otherHost}.
+
+        If there is no initialized stream between the two domains, the
+        stanza is queued. If there is not already a stream being set up, a
+        new one is requested.
+        """
+        key = (thisHost, otherHost)
+        xs = self._streams.get(key)
+
+        if xs is not None:
+            self._touch(key)
+            xs.send(stanza)
+        elif key in self._queues:
+            self._queues[key].append(stanza)
+        else:
+            self._makeRoom()
+            self._queues[key] = [stanza]
+            self.initiate(thisHost, otherHost)
+
+
+    def streamInitialized(self, xs):
+        """
+        Add a newly initialized outgoing stream and flush its queue.
+        """
+        key = (xs.thisEntity.host, xs.otherEntity.host)
+
+        if key not in self._queues:
+            self._makeRoom()
+
+        self._streams[key] = xs
+        self._touch(key)
+
+        for element in self._queues.pop(key, []):
+            xs.send(element)
+
+
+    def streamDisconnected(self, xs):
+        """
+        Remove an outgoing stream that has been disconnected.
+        """
+        key = (xs.thisEntity.host, xs.otherEntity.host)
+
+        if self._streams.get(key) is xs:
+            self._remove(key)
+
+
+    def streamFailed(self, thisHost, otherHost, reason=None):
+        """
+        Drop the queue of stanzas for a stream that could not be set up.
+
+        @return: The dropped stanzas.
+        @rtype: C{list}
+        """
+        return self._queues.pop((thisHost, otherHost), [])
+
+
+    def closeStream(self, thisHost, otherHost):
+        """
+        Close the stream between two domains, if any.
+
+        The stream is removed from the pool immediately, so that subsequent
+        stanzas for this pair of domains result in a new stream.
+        """
+        key = (thisHost, otherHost)
+        xs = self._streams.get(key)
+        if xs is None:
+            return
+
+        self._remove(key)
+        xs.sendFooter()
+        if xs.transport is not None:
+            xs.transport.loseConnection()
+
+
+    def _touch(self, key):
+        """
+        Record use of a stream and postpone its idle timeout.
+        """
+        self._lastUsed[key] = self._reactor.seconds()
+
+        if self.idleTimeout is None:
+            return
+
+        call = self._idleCalls.get(key)
+        if call is not None and call.active():
+            call.reset(self.idleTimeout)
+        else:
+            self._idleCalls[key] = self._reactor.callLater(
+                    self.idleTimeout, self._onIdle, key)
+
+
+    def _onIdle(self, key):
+        del self._idleCalls[key]
+        log.msg("Closing idle outgoing connection from %r to %r" % key)
+        self.closeStream(*key)
+
+
+    def _remove(self, key):
+        del self._streams[key]
+        del self._lastUsed[key]
+
+        call = self._idleCalls.pop(key, None)
+        if call is not None and call.active():
+            call.cancel()
+
+
+    def _makeRoom(self):
+        """
+        Close the least recently used stream if the pool is full.
+        """
+        if self.maxStreams is None:
+            return
+
+        if len(self._streams) + len(self._queues) < self.maxStreams:
+            return
+
+        if not self._lastUsed:
+            return
+
+        key = min(self._lastUsed, key=self._lastUsed.__getitem__)
+        log.msg("Closing outgoing connection from %r to %r to make room" %
+                key)
+        self.closeStream(*key)
+
+
+
 class ServerService(object):
     """
     Service for managing XMPP server to server connections.
+
+    Outgoing streams are managed by an L{OutgoingStreamPool} in L{pool}.
+
+    @ivar pool: The pool of outgoing streams.
+    @type pool: L{OutgoingStreamPool}
+    @ivar keyGenerator: Generator for dialback keys, bound to L{secret}.
+    @type keyGenerator: L{KeyGenerator}
+    @ivar admission: Admission control for inbound stanzas. This object
+                     must have an C{admit} method that takes the remote
+                     domain and the stanza, and eventually passes admitted
+                     stanzas to L{route}.
+    @type admission: L{DomainRateLimiter}
     """
 
     logTraffic = False
@@ -579,8 +1047,10 @@ class ServerService(object):
         else:
             self.secret = randbytes.secureRandom(16).encode('hex')
 
-        self._outgoingStreams = {}
-        self._outgoingQueues = {}
+        self.keyGenerator = KeyGenerator(self.secret)
+        self.admission = DomainRateLimiter(self.route)
+
+        self.pool = OutgoingStreamPool(self.initiateOutgoingStream)
         self._outgoingConnecting = set()
         self.serial = 0
 
@@ -597,14 +1067,9 @@ class ServerService(object):
         log.msg("Outgoing connection %d from %r to %r established" %
                 (xs.serial, thisHost, otherHost))
 
-        self._outgoingStreams[thisHost, otherHost] = xs
         xs.addObserver(xmlstream.STREAM_END_EVENT,
                        lambda _: self.outgoingDisconnected(xs))
-
-        if (thisHost, otherHost) in self._outgoingQueues:
-            for element in self._outgoingQueues[thisHost, otherHost]:
-                xs.send(element)
-            del self._outgoingQueues[thisHost, otherHost]
+        self.pool.streamInitialized(xs)
 
 
     def outgoingDisconnected(self, xs):
@@ -614,7 +1079,7 @@ class ServerService(object):
         log.msg("Outgoing connection %d from %r to %r disconnected" %
                 (xs.serial, thisHost, otherHost))
 
-        del self._outgoingStreams[thisHost, otherHost]
+        self.pool.streamDisconnected(xs)
 
 
     def initiateOutgoingStream(self, thisHost, otherHost):
@@ -622,15 +1087,27 @@ class ServerService(object):
         Initiate an outgoing XMPP server-to-server connection.
         """
 
-        def resetConnecting(_):
+        def resetConnecting(result):
             self._outgoingConnecting.remove((thisHost, otherHost))
+            return result
+
+        def dropQueue(failure):
+            dropped = self.pool.streamFailed(thisHost, otherHost, failure)
+            log.msg("Outgoing connection from %r to %r failed, "
+                    "dropping %d stanzas" % (thisHost, otherHost,
+                                             len(dropped)))
+            log.err(failure)
 
         if (thisHost, otherHost) in self._outgoingConnecting:
             return
 
+        if self.keyGenerator.secret != self.secret:
+            self.keyGenerator.rotate(self.secret)
+
         authenticator = XMPPServerConnectAuthenticator(thisHost,
                                                        otherHost,
-                                                       self.secret)
+                                                       self.secret,
+                                                       self.keyGenerator)
         factory = DeferredS2SClientFactory(authenticator)
         factory.addBootstrap(xmlstream.STREAM_AUTHD_EVENT,
                              self.outgoingInitialized)
@@ -640,9 +1117,21 @@ class ServerService(object):
 
         d = initiateS2S(factory)
         d.addBoth(resetConnecting)
+        d.addErrback(dropQueue)
         return d
 
 
+    def rotateSecret(self, secret):
+        """
+        Replace the shared secret for dialback.
+
+        Keys generated with the previous secret remain valid for the grace
+        period of L{keyGenerator}.
+        """
+        self.secret = secret
+        self.keyGenerator.rotate(secret)
+
+
     def validateConnection(self, thisHost, otherHost, sid, key):
         """
         Validate an incoming XMPP server-to-server connection.
@@ -676,36 +1165,44 @@ class ServerService(object):
         otherHost = jid.internJID(stanza["to"]).host
         thisHost = jid.internJID(stanza["from"]).host
 
-        if (thisHost, otherHost) not in self._outgoingStreams:
-            # There is no connection with the destination (yet). Cache the
-            # outgoing stanza until the connection has been established.
-            # XXX: If the connection cannot be established, the queue should
-            #      be emptied at some point.
-            if (thisHost, otherHost) not in self._outgoingQueues:
-                self._outgoingQueues[(thisHost, otherHost)] = []
-            self._outgoingQueues[(thisHost, otherHost)].append(stanza)
-            self.initiateOutgoingStream(thisHost, otherHost)
-        else:
-            self._outgoingStreams[(thisHost, otherHost)].send(stanza)
+        # If there is no connection with the destination (yet), the pool
+        # queues the stanza until the connection has been established.
+        self.pool.send(thisHost, otherHost, stanza)
 
 
     def dispatch(self, xs, stanza):
         """
         Send on element to be routed within the server.
+
+        Incoming stanzas first have the host parts of their addressing
+        checked. The sender must be at the remote domain of the stream, and
+        the recipient at one of L{domains}. Stanzas that pass are offered to
+        L{admission}, that passes them on to L{route}.
         """
         stanzaFrom = stanza.getAttribute('from')
         stanzaTo = stanza.getAttribute('to')
 
         if not stanzaFrom or not stanzaTo:
             xs.sendStreamError(error.StreamError('improper-addressing'))
+            return
+
+        try:
+            senderHost = hostFromJID(stanzaFrom)
+            recipientHost = hostFromJID(stanzaTo)
+        except jid.InvalidFormat:
+            log.msg("Dropping stanza with malformed JID")
+            return
+
+        if senderHost != xs.otherEntity.host:
+            xs.sendStreamError(error.StreamError('invalid-from'))
+        elif recipientHost not in self.domains:
+            log.msg("Dropping stanza for unknown domain %r" % recipientHost)
         else:
-            try:
-                sender = jid.internJID(stanzaFrom)
-                recipient = jid.internJID(stanzaTo)
-            except jid.InvalidFormat:
-                log.msg("Dropping error stanza with malformed JID")
-
-            if sender.host != xs.otherEntity.host:
-                xs.sendStreamError(error.StreamError('invalid-from'))
-            else:
-                self.xmlstream.send(stanza)
+            self.admission.admit(senderHost, stanza)
+
+
+    def route(self, stanza):
+        """
+        Pass an admitted inbound stanza on to the router.
+        """
+        self.xmlstream.send(stanza)
@@ -0,0 +1,540 @@
+# -*- test-case-name: wokkel.test.test_srv -*-
+#
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+DNS SRV based connection support.
+
+XMPP entities find the hosts to connect to using DNS SRV records, as
+described in XMPP Core (RFC 3920). This module provides a cache for the
+results of these lookups, shared by the client and server connectors, so
+that reconnecting to a domain does not require new DNS queries every time.
+
+Instead of trying the SRV targets one at a time, connectors can also race
+connection attempts to all of the targets and their addresses, keeping the
+first stream that has been successfully initialized.
+"""
+
+import copy
+
+from twisted.internet import defer, error, protocol
+from twisted.internet.abstract import isIPAddress
+from twisted.names import dns
+from twisted.names.error import DNSNameError
+from twisted.names.srvconnect import SRVConnector, \
+                                     _SRVConnector_ClientFactoryWrapper
+from twisted.python import failure, log
+from twisted.words.protocols.jabber import xmlstream
+
+class SRVCache(object):
+    """
+    Cache for DNS SRV and address lookups.
+
+    Successful lookups are kept for the time-to-live of the returned
+    records, limited by L{minTTL} and L{maxTTL}. Lookups for names that
+    don't exist, or that have no records, are kept for L{negativeTTL}
+    seconds. Other lookup failures, like timeouts, are not cached.
+
+    Expired positive results are still returned for L{staleTTL} seconds,
+    while a new lookup is done in the background. Concurrent lookups for the
+    same name result in a single query to the resolver.
+
+    @ivar minTTL: Minimum number of seconds to keep positive results.
+    @type minTTL: C{int}
+    @ivar maxTTL: Maximum number of seconds to keep positive results.
+    @type maxTTL: C{int}
+    @ivar negativeTTL: Number of seconds to keep negative results.
+    @type negativeTTL: C{int}
+    @ivar staleTTL: Number of seconds past expiry that a positive result
+                    may still be used while it is being refreshed.
+    @type staleTTL: C{int}
+    """
+
+    minTTL = 60
+    maxTTL = 86400
+    negativeTTL = 300
+    staleTTL = 3600
+
+    def __init__(self, resolver=None, reactor=None):
+        """
+        @param resolver: The resolver to do the actual lookups with. If not
+                         given, the default resolver of
+                         L{twisted.names.client} is used.
+        @type resolver: object providing
+                        L{IResolver<twisted.internet.interfaces.IResolver>}
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._resolver = resolver
+
+        self._entries = {}
+        self._pending = {}
+
+
+    def _getResolver(self):
+        if self._resolver is None:
+            from twisted.names import client
+            self._resolver = client.getResolver()
+        return self._resolver
+
+
+    def lookupService(self, name):
+        """
+        Look up SRV records for a name.
+
+        @param name: The SRV name, e.g. C{'_xmpp-server._tcp.example.org'}.
+        @type name: C{str}
+        @return: Deferred that fires with a tuple of answers, authority and
+                 additional records, like the resolver's C{lookupService}.
+        @rtype: L{defer.Deferred}
+        """
+        return self._lookup('lookupService', name)
+
+
+    def lookupAddress(self, name):
+        """
+        Look up A records for a name.
+
+        @param name: The host name.
+        @type name: C{str}
+        @return: Deferred that fires with a tuple of answers, authority and
+                 additional records, like the resolver's C{lookupAddress}.
+        @rtype: L{defer.Deferred}
+        """
+        return self._lookup('lookupAddress', name)
+
+
+    def getHostByName(self, name):
+        """
+        Resolve a host name to an IPv4 address.
+
+        @param name: The host name.
+        @type name: C{str}
+        @return: Deferred that fires with the dotted quad address.
+        @rtype: L{defer.Deferred}
+        """
+        def cb((answers, authority, additional)):
+            for answer in answers:
+                if answer.type == dns.A and answer.payload:
+                    return answer.payload.dottedQuad()
+            raise error.DNSLookupError(name)
+
+        d = self.lookupAddress(name)
+        d.addCallback(cb)
+        return d
+
+
+    def flush(self):
+        """
+        Remove all cached results.
+        """
+        self._entries = {}
+
+
+    def _lookup(self, method, name):
+        key = (method, name)
+        now = self._reactor.seconds()
+
+        try:
+            result, expires = self._entries[key]
+        except KeyError:
+            pass
+        else:
+            if now < expires:
+                return self._fromResult(result)
+            elif now < expires + self.staleTTL and \
+                 not isinstance(result, Exception):
+                self._refresh(method, name)
+                return self._fromResult(result)
+            else:
+                del self._entries[key]
+
+        d = defer.Deferred()
+        self._refresh(method, name, d)
+        return d
+
+
+    def _fromResult(self, result):
+        if isinstance(result, Exception):
+            return defer.fail(result)
+        else:
+            return defer.succeed(result)
+
+
+    def _refresh(self, method, name, waiter=None):
+        """
+        Do a lookup and update the cache, unless one is already in progress.
+
+        @param waiter: Optional deferred that is to be fired with the result
+                       of the lookup.
+        @type waiter: L{defer.Deferred}
+        """
+        key = (method, name)
+
+        if key in self._pending:
+            if waiter is not None:
+                self._pending[key].append(waiter)
+            return
+
+        def cb(result):
+            answers = result[0]
+            ttls = [answer.ttl for answer in answers]
+            if ttls:
+                ttl = max(self.minTTL, min(self.maxTTL, min(ttls)))
+            else:
+                ttl = self.negativeTTL
+            store(result, ttl)
+            return result
+
+        def eb(reason):
+            if reason.check(DNSNameError):
+                store(reason.value, self.negativeTTL)
+            return reason
+
+        def store(result, ttl):
+            self._entries[key] = (result, self._reactor.seconds() + ttl)
+
+        def notify(result):
+            waiters = self._pending.pop(key)
+            for d in waiters:
+                d.callback(result)
+            if not waiters and isinstance(result, failure.Failure):
+                log.msg("Background lookup of %r failed: %s" %
+                        (name, result.getErrorMessage()))
+
+        if waiter is not None:
+            self._pending[key] = [waiter]
+        else:
+            self._pending[key] = []
+
+        d = getattr(self._getResolver(), method)(name)
+        d.addCallbacks(cb, eb)
+        d.addBoth(notify)
+
+
+
+theCache = None
+
+def getCache():
+    """
+    Get the shared L{SRVCache}, creating it if needed.
+
+    @rtype: L{SRVCache}
+    """
+    global theCache
+    if theCache is None:
+        theCache = SRVCache()
+    return theCache
+
+
+
+class CachingSRVConnector(SRVConnector):
+    """
+    SRV connector that uses an L{SRVCache} for its lookups.
+
+    Both the SRV lookup and the resolution of the picked target host to an
+    address go through the cache. If the target host cannot be resolved
+    from the cache, the connection is attempted by host name.
+
+    In racing mode, the connector resolves all SRV targets to their
+    addresses and starts connection attempts to each of them, in order of
+    SRV priority and weight. Attempts are started C{staggerDelay} seconds
+    apart, or right away when the previous attempt has failed. The factory
+    must be an XML stream factory: each attempt gets a copy of the
+    factory's authenticator, and the first attempt that results in an
+    initialized stream wins. The other attempts are then aborted, and the
+    winning stream is handed to the factory as if it was the only
+    connection that was made.
+
+    @ivar cache: The cache to use. If C{None}, the shared cache returned by
+                 L{getCache} is used.
+    @type cache: L{SRVCache}
+    @ivar racing: Whether to race connection attempts to all targets.
+    @type racing: C{bool}
+    @ivar staggerDelay: Number of seconds between starting connection
+                        attempts in racing mode.
+    @type staggerDelay: C{float}
+    """
+
+    staggerDelay = 0.25
+
+    _winner = None
+    _staggerCall = None
+    _lastReason = None
+
+    def __init__(self, reactor, service, domain, factory, cache=None,
+                       racing=False, **kwargs):
+        SRVConnector.__init__(self, reactor, service, domain, factory,
+                              **kwargs)
+        if cache is None:
+            cache = getCache()
+        self.cache = cache
+        self.racing = racing
+        self._attempts = []
+        self._queue = []
+
+
+    def connect(self):
+        """
+        Start connection to remote server.
+        """
+        self.factory.doStart()
+        self.factory.startedConnecting(self)
+
+        if not self.servers:
+            if self.domain is None:
+                self.connectionFailed(
+                        error.DNSLookupError("Domain is not defined."))
+                return
+            d = self.cache.lookupService('_%s._%s.%s' % (self.service,
+                                                         self.protocol,
+                                                         self.domain))
+            d.addCallbacks(self._cbGotServers, self._ebGotServers)
+            if self.racing:
+                d.addCallback(lambda _: self._gatherAddresses())
+                d.addCallback(self._race)
+            else:
+                d.addCallback(lambda _: self._reallyConnect())
+            d.addErrback(self.connectionFailed)
+        elif self.connector is None:
+            self._reallyConnect()
+        else:
+            self.connector.connect()
+
+
+    def _reallyConnect(self):
+        if self.stopAfterDNS:
+            self.stopAfterDNS = 0
+            return
+
+        self.host, self.port = self.pickServer()
+        assert self.host is not None, 'Must have a host to connect to.'
+        assert self.port is not None, 'Must have a port to connect to.'
+
+        if isIPAddress(self.host):
+            self._connectAddress(self.host)
+        else:
+            d = self.cache.getHostByName(self.host)
+            d.addErrback(lambda _: self.host)
+            d.addCallback(self._connectAddress)
+            d.addErrback(self.connectionFailed)
+
+
+    def _connectAddress(self, address):
+        if self.stopAfterDNS:
+            self.stopAfterDNS = 0
+            return
+
+        connectFunc = getattr(self.reactor, self.connectFuncName)
+        self.connector = connectFunc(
+            address, self.port,
+            _SRVConnector_ClientFactoryWrapper(self, self.factory),
+            *self.connectFuncArgs, **self.connectFuncKwArgs)
+
+
+    def stopConnecting(self):
+        """
+        Stop attempting to connect.
+        """
+        if self._attempts or self._queue:
+            self._stopRace()
+            self.connectionFailed(failure.Failure(error.UserError()))
+        else:
+            SRVConnector.stopConnecting(self)
+
+
+    def _gatherAddresses(self):
+        """
+        Resolve all SRV targets to the addresses to connect to.
+
+        @return: Deferred that fires with a list of tuples of address and
+                 port, in the order they should be tried.
+        @rtype: L{defer.Deferred}
+        """
+        def toAddresses((answers, authority, additional), host, port):
+            addresses = [(answer.payload.dottedQuad(), port)
+                         for answer in answers
+                         if answer.type == dns.A and answer.payload]
+            return addresses or [(host, port)]
+
+        def resolve(host, port):
+            if isIPAddress(host):
+                return defer.succeed([(host, port)])
+
+            d = self.cache.lookupAddress(host)
+            d.addCallback(toAddresses, host, port)
+            d.addErrback(lambda _: [(host, port)])
+            return d
+
+        targets = [self.pickServer()]
+        while self.servers:
+            targets.append(self.pickServer())
+
+        d = defer.gatherResults([resolve(host, port)
+                                 for host, port in targets])
+        d.addCallback(lambda results: [address for addresses in results
+                                               for address in addresses])
+        return d
+
+
+    def _race(self, addresses):
+        if self.stopAfterDNS:
+            self.stopAfterDNS = 0
+            return
+
+        self.connector = None
+        self._winner = None
+        self._lastReason = None
+        self._queue = list(addresses)
+        self._startAttempt()
+
+
+    def _startAttempt(self):
+        """
+        Start a connection attempt to the next address in the queue.
+        """
+        self._staggerCall = None
+
+        if self._winner is not None:
+            return
+
+        if not self._queue:
+            if not self._attempts:
+                reason = self._lastReason or \
+                         failure.Failure(error.ConnectError())
+                self.connectionFailed(reason)
+            return
+
+        address, port = self._queue.pop(0)
+        attempt = _RaceAttemptFactory(self)
+        self._attempts.append(attempt)
+
+        connectFunc = getattr(self.reactor, self.connectFuncName)
+        attempt.connector = connectFunc(address, port, attempt,
+                                        *self.connectFuncArgs,
+                                        **self.connectFuncKwArgs)
+
+        if self._queue and self._winner is None and attempt in self._attempts:
+            self._staggerCall = self.reactor.callLater(self.staggerDelay,
+                                                       self._startAttempt)
+
+
+    def _stopRace(self):
+        """
+        Abort all pending connection attempts.
+        """
+        if self._staggerCall is not None and self._staggerCall.active():
+            self._staggerCall.cancel()
+        self._staggerCall = None
+        self._queue = []
+
+        attempts, self._attempts = self._attempts, []
+        for attempt in attempts:
+            attempt.connector.disconnect()
+
+
+    def _attemptSucceeded(self, attempt, xs):
+        """
+        Called when the stream of a connection attempt has been initialized.
+
+        The first attempt to get here wins. Other attempts are aborted, and
+        the stream is handed over to the factory.
+        """
+        if self._winner is not None or attempt not in self._attempts:
+            xs.transport.loseConnection()
+            return
+
+        self._winner = attempt
+        self._attempts.remove(attempt)
+        self._stopRace()
+        self.connector = attempt.connector
+
+        factory = self.factory
+        xs.factory = factory
+        factory.authenticator = xs.authenticator
+
+        # The stream has already been connected and initialized, so call the
+        # bootstrap observers for these events directly.
+        for event, fn in factory.bootstraps:
+            if event == xmlstream.STREAM_CONNECTED_EVENT:
+                fn(xs)
+
+        for event, fn in factory.bootstraps:
+            if event == xmlstream.STREAM_AUTHD_EVENT:
+                fn(xs)
+            elif event != xmlstream.STREAM_CONNECTED_EVENT:
+                xs.addObserver(event, fn)
+
+
+    def _attemptFailed(self, attempt, reason):
+        """
+        Called when a connection attempt failed before its stream was
+        initialized.
+
+        This starts the next attempt right away.
+        """
+        if attempt not in self._attempts:
+            return
+
+        self._attempts.remove(attempt)
+        self._lastReason = reason
+
+        if attempt.xmlstream is not None and \
+           attempt.xmlstream.transport is not None:
+            attempt.xmlstream.transport.loseConnection()
+
+        if self._staggerCall is not None and self._staggerCall.active():
+            self._staggerCall.cancel()
+        self._startAttempt()
+
+
+    def _attemptLost(self, attempt, reason):
+        """
+        Called when the connection of an attempt was lost.
+        """
+        if attempt is self._winner:
+            self._winner = None
+            self.connectionLost(reason)
+        else:
+            self._attemptFailed(attempt, reason)
+
+
+
+class _RaceAttemptFactory(protocol.ClientFactory):
+    """
+    Factory for a single connection attempt of a racing connector.
+
+    This creates an XML stream using the protocol and a copy of the
+    authenticator of the connector's factory, and reports back the
+    progress of the connection attempt to the connector.
+
+    @ivar connector: The connector of this attempt.
+    @ivar xmlstream: The XML stream of this attempt, once connected.
+    """
+
+    connector = None
+    xmlstream = None
+
+    def __init__(self, race):
+        self.race = race
+
+
+    def buildProtocol(self, addr):
+        factory = self.race.factory
+        xs = factory.protocol(copy.copy(factory.authenticator))
+        xs.addObserver(xmlstream.STREAM_AUTHD_EVENT,
+                       self.race._attemptSucceeded, 0, self)
+        xs.addObserver(xmlstream.INIT_FAILED_EVENT,
+                       self.race._attemptFailed, 0, self)
+        self.xmlstream = xs
+        return xs
+
+
+    def clientConnectionFailed(self, connector, reason):
+        self.race._attemptFailed(self, reason)
+
+
+    def clientConnectionLost(self, connector, reason):
+        self.race._attemptLost(self, reason)
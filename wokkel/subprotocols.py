@@ -7,16 +7,26 @@
 XMPP subprotocol support.
 """
 
+from collections import deque
+
 from zope.interface import implements
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.python import log
 from twisted.words.protocols.jabber import error, xmlstream
 from twisted.words.protocols.jabber.xmlstream import toResponse
-from twisted.words.xish import xpath
+from twisted.words.xish import domish, xpath
 from twisted.words.xish.domish import IElement
 
 from wokkel.iwokkel import IXMPPHandler, IXMPPHandlerCollection
+from wokkel.packetqueue import MemoryPacketQueue
+
+NS_SM = 'urn:xmpp:sm:3'
+
+SM_REQUEST = "/r[@xmlns='%s']" % NS_SM
+SM_ANSWER = "/a[@xmlns='%s']" % NS_SM
+
+STANZA_NAMES = ('message', 'presence', 'iq')
 
 class XMPPHandler(object):
     """
@@ -24,10 +34,23 @@ class XMPPHandler(object):
 
     Classes derived from this class implement (part of) one or more XMPP
     extension protocols, and are referred to as a subprotocol implementation.
+
+    @cvar stanzaInterests: Incoming stanzas this handler wants to receive
+                           from its L{StreamManager}, as a sequence of tuples
+                           of stanza name, stanza type, child namespace and
+                           the name of the method to call. A type or
+                           namespace of C{None} matches any. See
+                           L{StreamManager.addStanzaObserver}. Handlers with
+                           a parent that does not pass on stanzas, call
+                           L{observeStanzaInterests} to observe them on the
+                           XML stream themselves.
+    @type stanzaInterests: C{tuple}
     """
 
     implements(IXMPPHandler)
 
+    stanzaInterests = ()
+
     def __init__(self):
         self.parent = None
         self.xmlstream = None
@@ -75,6 +98,24 @@ class XMPPHandler(object):
         self.xmlstream = None
 
 
+    def observeStanzaInterests(self):
+        """
+        Observe the stanzas declared in C{stanzaInterests} on the XML stream.
+
+        If the parent passes on these stanzas itself, like L{StreamManager},
+        this does nothing. Otherwise, an XPath observer is added for each
+        interest, matching the same stanzas.
+        """
+        parent = getattr(self, 'parent', None)
+        if getattr(parent, 'addStanzaObserver', None) is not None:
+            return
+
+        for name, stanzaType, namespace, method in _getInterests(self):
+            self.xmlstream.addObserver(
+                    _interestQuery(name, stanzaType, namespace),
+                    getattr(self, method))
+
+
     def send(self, obj):
         """
         Send data over the managed XML stream.
@@ -94,6 +135,27 @@ class XMPPHandler(object):
 
 
 
+def _getInterests(handler):
+    """
+    Return the stanza interests declared by a handler.
+    """
+    return getattr(handler, 'stanzaInterests', ())
+
+
+
+def _interestQuery(name, stanzaType, namespace):
+    """
+    Return the XPath query matching the stanzas of a stanza interest.
+    """
+    query = '/' + name
+    if stanzaType is not None:
+        query += '[@type="%s"]' % stanzaType
+    if namespace is not None:
+        query += '/*[@xmlns="%s"]' % namespace
+    return query
+
+
+
 class XMPPHandlerCollection(object):
     """
     Collection of XMPP subprotocol handlers.
@@ -154,16 +216,103 @@ class StreamManager(XMPPHandlerCollection):
                         stanzas.
     @type _initialized: C{bool}
     @ivar _packetQueue: internal buffer of unsent data. See L{send} for details.
-    @type _packetQueue: L{list}
+    @type _packetQueue: object providing L{IPacketQueue}
+    @ivar replayBatchSize: Maximum number of queued objects sent at once
+                           when a stream has been initialized. The rest is
+                           sent in later batches, with L{replayInterval}
+                           seconds in between. If C{None}, the whole queue is
+                           sent at once.
+    @type replayBatchSize: C{int}
+    @ivar replayInterval: Delay in seconds between batches of queued objects.
+    @type replayInterval: C{float}
+
+    Stream Management (XEP-0198) is started on a stream by calling
+    L{enableStreamManagement} or L{resumeStreamManagement}, usually from an
+    initializer. From then on, outgoing stanzas are kept in a buffer until
+    the other end acknowledges them, and incoming stanzas are counted. When
+    the stream is lost, unacknowledged stanzas are sent again on the next
+    stream. If that stream resumed the previous one, L{resumed} is set while
+    the handlers' C{connectionInitialized} methods are called, so that they
+    can skip setting up state again, like retrieving the roster and sending
+    initial presence.
+
+    Only stanzas sent as L{domish.Element} objects are tracked, so
+    serialized stanzas should not be sent on a managed stream.
+
+    @ivar maxUnacked: Maximum number of unacknowledged stanzas kept for
+                      sending again. When exceeded, the oldest stanza is
+                      dropped from the buffer.
+    @type maxUnacked: C{int}
+    @ivar ackRequestInterval: Interval, in seconds, for requesting
+                              acknowledgement of outstanding stanzas. If
+                              C{None}, acknowledgements are not requested.
+    @type ackRequestInterval: C{float}
+    @ivar smId: Identifier of the current managed stream for resumption, or
+                C{None} if it cannot be resumed.
+    @type smId: C{unicode}
+    @ivar smInbound: Number of stanzas received on the current managed
+                     stream.
+    @type smInbound: C{int}
+    @ivar resumed: Whether the current stream resumed a previous one.
+    @type resumed: C{bool}
+    @ivar _unacked: Sent stanzas that have not been acknowledged, oldest
+                    first.
+    @type _unacked: C{deque}
+    @ivar _unackedBase: Number of stanzas sent before the first one in
+                        L{_unacked}, modulo 2^32.
+    @type _unackedBase: C{int}
+
+    Instead of setting up XPath observers on the stream, handlers can
+    declare the incoming stanzas they are interested in through their
+    C{stanzaInterests}, or register callbacks with L{addStanzaObserver}.
+    Once the stream has been initialized, incoming stanzas are then passed
+    to the matching callbacks through a dictionary lookup on stanza name,
+    type and the namespaces of its child elements, instead of having every
+    stanza evaluated against the XPath queries of all observers. Only for
+    stanza names that callbacks are registered for, an observer is added to
+    the stream.
+
+    @ivar _stanzaObservers: Callbacks for incoming stanzas, keyed by stanza
+                            name, type and child namespace.
+    @type _stanzaObservers: C{dict}
+
+    @ivar metrics: If set, processing of incoming stanzas by handlers is
+                   recorded here. This covers callbacks registered through
+                   L{addStanzaObserver}, XPath observers added to streams
+                   connected after it was set, and requests handled by
+                   L{IQHandlerMixin}.
+    @type metrics: L{HandlerMetrics<wokkel.metrics.HandlerMetrics>}
     """
 
     logTraffic = False
+    metrics = None
+    maxUnacked = 1000
+    ackRequestInterval = 30
+    replayBatchSize = 100
+    replayInterval = 0
 
-    def __init__(self, factory):
+    def __init__(self, factory, reactor=None, packetQueue=None):
         XMPPHandlerCollection.__init__(self)
         self.xmlstream = None
-        self._packetQueue = []
+        if packetQueue is None:
+            packetQueue = MemoryPacketQueue()
+        self._packetQueue = packetQueue
+        self._replayCall = None
         self._initialized = False
+        self._stanzaObservers = {}
+        self._demuxNames = set()
+
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+
+        self.smId = None
+        self.smInbound = 0
+        self.resumed = False
+        self._smEnabled = False
+        self._unacked = deque()
+        self._unackedBase = 0
+        self._ackRequestCall = None
 
         factory.addBootstrap(xmlstream.STREAM_CONNECTED_EVENT, self._connected)
         factory.addBootstrap(xmlstream.STREAM_AUTHD_EVENT, self._authd)
@@ -179,9 +328,16 @@ class StreamManager(XMPPHandlerCollection):
 
         When an XML stream has already been established, the handler's
         C{connectionInitialized} will be called to get it up to speed.
+
+        The stanzas declared in the handler's C{stanzaInterests}, if any,
+        will be passed to it.
         """
         XMPPHandlerCollection.addHandler(self, handler)
 
+        for name, stanzaType, namespace, method in _getInterests(handler):
+            self.addStanzaObserver(getattr(handler, method), name,
+                                   stanzaType, namespace)
+
         # get protocol handler up to speed when a connection has already
         # been established
         if self.xmlstream and self._initialized:
@@ -189,6 +345,116 @@ class StreamManager(XMPPHandlerCollection):
             handler.connectionInitialized()
 
 
+    def removeHandler(self, handler):
+        """
+        Remove protocol handler.
+
+        This also stops passing stanzas to the handler as declared by its
+        C{stanzaInterests}.
+        """
+        XMPPHandlerCollection.removeHandler(self, handler)
+
+        for name, stanzaType, namespace, method in _getInterests(handler):
+            self.removeStanzaObserver(getattr(handler, method), name,
+                                      stanzaType, namespace)
+
+
+    def addStanzaObserver(self, callback, name, stanzaType=None,
+                                namespace=None):
+        """
+        Have matching incoming stanzas passed to a callback.
+
+        Callbacks are called after the stream has been initialized. Those
+        registered for a namespace come before those for any namespace, and
+        those for a type before those for any type. Otherwise, they are
+        called in the order they were added. Once a callback has marked the
+        stanza as handled, the remaining callbacks are skipped.
+
+        @param callback: Callable that is called with the stanza.
+        @param name: The stanza name, one of C{'message'}, C{'presence'}
+                     and C{'iq'}.
+        @type name: C{str}
+        @param stanzaType: The value of the stanza's C{type} attribute, or
+                           C{None} to match stanzas of any type.
+        @type stanzaType: C{str}
+        @param namespace: The namespace of a child element of the stanza,
+                          or C{None} to match any stanza.
+        @type namespace: C{str}
+        """
+        key = (name, stanzaType, namespace)
+        self._stanzaObservers.setdefault(key, []).append(callback)
+        if self._initialized:
+            self._observeStanzas(name)
+
+
+    def removeStanzaObserver(self, callback, name, stanzaType=None,
+                                   namespace=None):
+        """
+        Stop passing incoming stanzas to a callback.
+
+        The arguments are the same as for L{addStanzaObserver}.
+        """
+        key = (name, stanzaType, namespace)
+        callbacks = self._stanzaObservers[key]
+        callbacks.remove(callback)
+        if not callbacks:
+            del self._stanzaObservers[key]
+
+            remaining = [other for other in self._stanzaObservers
+                         if other[0] == name]
+            if name in self._demuxNames and not remaining:
+                self._demuxNames.remove(name)
+                self.xmlstream.removeObserver('/' + name,
+                                              self._onStanzaReceived)
+
+
+    def _observeStanzas(self, name):
+        """
+        Make sure incoming stanzas of this name are passed to
+        L{_onStanzaReceived}.
+        """
+        if name not in self._demuxNames:
+            self._demuxNames.add(name)
+            self.xmlstream.addObserver('/' + name, self._onStanzaReceived)
+
+
+    def _onStanzaReceived(self, stanza):
+        """
+        Pass an incoming stanza to the callbacks interested in it.
+        """
+        observers = self._stanzaObservers
+        if not observers:
+            return
+
+        name = stanza.name
+        stanzaType = stanza.getAttribute('type')
+
+        namespaces = []
+        for child in stanza.elements():
+            if child.uri not in namespaces:
+                namespaces.append(child.uri)
+        namespaces.append(None)
+
+        types = [None]
+        if stanzaType is not None:
+            types.insert(0, stanzaType)
+
+        callbacks = []
+        for namespace in namespaces:
+            for stanzaType in types:
+                callbacks.extend(observers.get((name, stanzaType, namespace),
+                                               ()))
+
+        metrics = self.metrics
+        for callback in callbacks:
+            if stanza.handled:
+                break
+            elif metrics is None:
+                callback(stanza)
+            else:
+                metrics.call(callback, name, stanza)
+
+
     def _connected(self, xs):
         """
         Called when the transport connection has been established.
@@ -207,25 +473,66 @@ class StreamManager(XMPPHandlerCollection):
             xs.rawDataInFn = logDataIn
             xs.rawDataOutFn = logDataOut
 
+        if self.metrics is not None:
+            self._instrumentObservers(xs)
+
         self.xmlstream = xs
 
         for e in self:
             e.makeConnection(xs)
 
 
+    def _instrumentObservers(self, xs):
+        """
+        Have XPath observers added by handlers record their processing time.
+        """
+        metrics = self.metrics
+        addObserver = xs.addObserver
+        removeObserver = xs.removeObserver
+        wrappers = {}
+
+        def instrumentedAddObserver(event, observerfn, *args, **kwargs):
+            isEvent = (isinstance(event, basestring) and
+                       event.startswith(xs.prefix))
+            if not isEvent and getattr(observerfn, 'im_self', None) is not self:
+                wrapper = metrics.wrap(observerfn)
+                wrappers[(event, observerfn)] = wrapper
+                observerfn = wrapper
+            addObserver(event, observerfn, *args, **kwargs)
+
+        def instrumentedRemoveObserver(event, observerfn):
+            observerfn = wrappers.pop((event, observerfn), observerfn)
+            removeObserver(event, observerfn)
+
+        xs.addObserver = instrumentedAddObserver
+        xs.removeObserver = instrumentedRemoveObserver
+
+
     def _authd(self, xs):
         """
         Called when the stream has been initialized.
 
         Send out cached stanzas and call each handler's
         C{connectionInitialized} method.
+
+        Stanzas that were not acknowledged on a previous stream are sent
+        first. If Stream Management was started on this stream, these have
+        already been queued by L{enableStreamManagement} or
+        L{resumeStreamManagement}.
         """
-        # Flush all pending packets
-        for p in self._packetQueue:
-            xs.send(p)
-        self._packetQueue = []
+        if not self._smEnabled:
+            self.smId = None
+            self._requeueUnacked()
+
         self._initialized = True
 
+        self._demuxNames = set()
+        for name, stanzaType, namespace in self._stanzaObservers.keys():
+            self._observeStanzas(name)
+
+        # Flush pending packets, starting with the first batch.
+        self._replay()
+
         # Notify all child services which implement
         # the IService interface
         for e in self:
@@ -256,6 +563,17 @@ class StreamManager(XMPPHandlerCollection):
         """
         self.xmlstream = None
         self._initialized = False
+        self._demuxNames = set()
+        self._smEnabled = False
+        self.resumed = False
+
+        if self._replayCall is not None:
+            self._replayCall.cancel()
+            self._replayCall = None
+
+        if self._ackRequestCall is not None:
+            self._ackRequestCall.stop()
+            self._ackRequestCall = None
 
         # Notify all child services which implement
         # the IService interface
@@ -268,17 +586,175 @@ class StreamManager(XMPPHandlerCollection):
         Send data over the XML stream.
 
         When there is no established XML stream, the data is queued and sent
-        out when a new XML stream has been established and initialized.
+        out when a new XML stream has been established and initialized. Data
+        is also queued while earlier queued data is still being sent out, to
+        keep it in order.
 
         @param obj: data to be sent over the XML stream. See
                     L{xmlstream.XmlStream.send} for details.
         """
-        if self._initialized:
+        if self._initialized and not len(self._packetQueue):
             self.xmlstream.send(obj)
         else:
             self._packetQueue.append(obj)
 
 
+    def _replay(self):
+        """
+        Send a batch of queued data, and schedule the next one.
+        """
+        self._replayCall = None
+
+        batch = self._packetQueue.take(self.replayBatchSize)
+        for index, obj in enumerate(batch):
+            if not self._initialized:
+                # The stream was lost while sending, keep the rest.
+                self._packetQueue.prepend(batch[index:])
+                return
+            self.xmlstream.send(obj)
+
+        if self._initialized and len(self._packetQueue):
+            self._replayCall = self._reactor.callLater(self.replayInterval,
+                                                       self._replay)
+
+
+    def enableStreamManagement(self, xs, smId=None):
+        """
+        Start Stream Management on a new stream.
+
+        Stanzas that were not acknowledged on a previous stream are queued
+        to be sent again.
+
+        @param xs: The stream that stream management was enabled on.
+        @type xs: L{xmlstream.XmlStream}
+        @param smId: The identifier for resuming this stream, or C{None} if
+                     the other end does not allow resumption.
+        @type smId: C{unicode}
+        """
+        self._requeueUnacked()
+        self.smId = smId
+        self.smInbound = 0
+        self._unackedBase = 0
+        self._startTracking(xs)
+
+
+    def resumeStreamManagement(self, xs, h):
+        """
+        Continue Stream Management of a previous stream on a new stream.
+
+        Stanzas acknowledged by C{h} are dropped, the others are queued to be
+        sent again.
+
+        @param xs: The stream that resumed the previous one.
+        @type xs: L{xmlstream.XmlStream}
+        @param h: The number of stanzas handled by the other end.
+        @type h: C{int}
+        """
+        self._ack(h)
+        self._requeueUnacked()
+        self._unackedBase = h
+        self.resumed = True
+        self._startTracking(xs)
+
+
+    def resumptionFailed(self):
+        """
+        Called when the other end refused to resume the previous stream.
+
+        Stanzas that were not acknowledged are sent again on the new
+        stream, once it has been initialized.
+        """
+        self.smId = None
+
+
+    def requestAck(self):
+        """
+        Request acknowledgement of outstanding stanzas.
+        """
+        if self._smEnabled and self._unacked:
+            self.xmlstream.send(domish.Element((NS_SM, 'r')))
+
+
+    def _startTracking(self, xs):
+        """
+        Set up tracking of incoming and outgoing stanzas on a stream.
+        """
+        send = xs.send
+
+        def trackingSend(obj):
+            if IElement.providedBy(obj) and obj.name in STANZA_NAMES:
+                self._track(obj)
+            send(obj)
+
+        xs.send = trackingSend
+
+        for name in STANZA_NAMES:
+            xs.addObserver('/' + name, self._onStanza, 100)
+        xs.addObserver(SM_REQUEST, self._onAckRequest)
+        xs.addObserver(SM_ANSWER, self._onAck)
+
+        self._smEnabled = True
+
+        if self.ackRequestInterval:
+            self._ackRequestCall = task.LoopingCall(self.requestAck)
+            self._ackRequestCall.clock = self._reactor
+            self._ackRequestCall.start(self.ackRequestInterval, now=False)
+
+
+    def _track(self, stanza):
+        """
+        Keep a sent stanza until it has been acknowledged.
+        """
+        self._unacked.append(stanza)
+
+        if len(self._unacked) > self.maxUnacked:
+            self._unacked.popleft()
+            self._unackedBase = (self._unackedBase + 1) % 2**32
+            log.msg("Too many unacknowledged stanzas, dropping the oldest")
+
+
+    def _ack(self, h):
+        """
+        Drop stanzas acknowledged by the other end.
+        """
+        count = (h - self._unackedBase) % 2**32
+
+        if count > len(self._unacked):
+            log.msg("Ignoring acknowledgement of %d unknown stanzas" % count)
+            return
+
+        for i in xrange(count):
+            self._unacked.popleft()
+        self._unackedBase = h
+
+
+    def _requeueUnacked(self):
+        """
+        Queue unacknowledged stanzas to be sent before any other.
+        """
+        self._packetQueue.prepend(self._unacked)
+        self._unacked = deque()
+
+
+    def _onStanza(self, stanza):
+        self.smInbound = (self.smInbound + 1) % 2**32
+
+
+    def _onAckRequest(self, request):
+        answer = domish.Element((NS_SM, 'a'))
+        answer['h'] = str(self.smInbound)
+        self.xmlstream.send(answer)
+
+
+    def _onAck(self, answer):
+        try:
+            h = int(answer['h'])
+        except (KeyError, ValueError):
+            log.msg("Ignoring malformed acknowledgement")
+        else:
+            self._ack(h)
+
+
 
 class IQHandlerMixin(object):
     """
@@ -365,6 +841,10 @@ class IQHandlerMixin(object):
         else:
             d = defer.fail(NotImplementedError())
 
+        metrics = getattr(getattr(self, 'parent', None), 'metrics', None)
+        if metrics is not None:
+            metrics.track(self, 'iq:%s' % iq.getAttribute('type'), d)
+
         d.addCallback(toResult, iq)
         d.addErrback(checkNotImplemented)
         d.addErrback(fromStanzaError, iq)
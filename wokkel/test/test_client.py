@@ -5,20 +5,22 @@
 Tests for L{wokkel.client}.
 """
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
-from twisted.words.protocols.jabber import xmlstream
+from twisted.words.protocols.jabber import client as jclient, sasl, xmlstream
 from twisted.words.protocols.jabber.client import XMPPAuthenticator
 from twisted.words.protocols.jabber.jid import JID
 from twisted.words.protocols.jabber.xmlstream import STREAM_AUTHD_EVENT
 from twisted.words.protocols.jabber.xmlstream import INIT_FAILED_EVENT
+from twisted.words.xish import domish
 
 try:
     from twisted.words.protocols.jabber.xmlstream import XMPPHandler
 except ImportError:
     from wokkel.subprotocols import XMPPHandler
 
-from wokkel import client
+from wokkel import client, reconnect
+from wokkel.subprotocols import NS_SM
 from wokkel.test.test_compat import BootstrapMixinTest
 
 class XMPPClientTest(unittest.TestCase):
@@ -47,6 +49,159 @@ class XMPPClientTest(unittest.TestCase):
         self.assertEquals(JID('user@example.org/test'), self.client.jid)
 
 
+    def test_reconnectPolicy(self):
+        """
+        The reconnect policy passed in is used by the factory.
+        """
+        policy = reconnect.ReconnectPolicy()
+        xmppClient = client.XMPPClient(JID('user@example.org'), 'secret',
+                                       reconnectPolicy=policy)
+        self.assertIdentical(policy, xmppClient.reconnectPolicy)
+        self.assertIdentical(policy, xmppClient.factory.policy)
+
+
+
+class StreamManagementInitializerTest(unittest.TestCase):
+    """
+    Tests for the Stream Management initializers.
+    """
+
+    def setUp(self):
+        self.client = client.XMPPClient(JID('user@example.org'), 'secret')
+        self.client.streamManagement = True
+        self.client._reactor = task.Clock()
+        self.output = []
+        self.xmlstream = self.client.factory.buildProtocol(None)
+        self.xmlstream.send = self.output.append
+        self.xmlstream.features = {(sasl.NS_XMPP_SASL, 'mechanisms'): None,
+                                   (NS_SM, 'sm'): None}
+
+
+    def respond(self, name, **attributes):
+        response = domish.Element((NS_SM, name))
+        for key, value in attributes.iteritems():
+            response[key] = value
+        self.xmlstream.dispatch(response)
+
+
+    def test_checkAuth(self):
+        """
+        Resumption goes before binding, enabling after session establishment.
+        """
+        xs = self.xmlstream
+        xs.initializers = [client.CheckAuthInitializer(xs)]
+        xs.initializers[0].initialize()
+
+        classes = [init.__class__ for init in xs.initializers[1:]]
+        self.assertEqual([sasl.SASLInitiatingInitializer,
+                          client.StreamResumptionInitializer,
+                          jclient.BindInitializer,
+                          jclient.SessionInitializer,
+                          client.StreamManagementInitializer],
+                         classes)
+
+
+    def test_checkAuthDisabled(self):
+        """
+        Without streamManagement set, no initializers are added for it.
+        """
+        self.client.streamManagement = False
+        xs = self.xmlstream
+        xs.initializers = [client.CheckAuthInitializer(xs)]
+        xs.initializers[0].initialize()
+        self.assertEqual(4, len(xs.initializers))
+
+
+    def test_enable(self):
+        """
+        Stream Management is enabled with the resumption id from the server.
+        """
+        init = client.StreamManagementInitializer(self.xmlstream, self.client)
+        d = init.initialize()
+
+        request = self.output[-1]
+        self.assertEqual((NS_SM, 'enable'), (request.uri, request.name))
+        self.assertEqual('true', request['resume'])
+
+        self.respond('enabled', id='sm-1', resume='true')
+        self.assertEqual('sm-1', self.client.smId)
+        self.assertTrue(self.client._smEnabled)
+        return d
+
+
+    def test_enableFailed(self):
+        """
+        A failure to enable Stream Management does not fail initialization.
+        """
+        init = client.StreamManagementInitializer(self.xmlstream, self.client)
+        d = init.initialize()
+        self.respond('failed')
+        self.assertFalse(self.client._smEnabled)
+        return d
+
+
+    def test_enableResumed(self):
+        """
+        Stream Management is not enabled again on a resumed stream.
+        """
+        self.client.resumed = True
+        init = client.StreamManagementInitializer(self.xmlstream, self.client)
+        init.initialize()
+        self.assertEqual([], self.output)
+
+
+    def test_resume(self):
+        """
+        A previous stream is resumed, skipping binding and session.
+        """
+        self.client.smId = 'sm-1'
+        self.client.smInbound = 5
+        xs = self.xmlstream
+        init = client.StreamResumptionInitializer(xs, self.client)
+        bind = jclient.BindInitializer(xs)
+        session = jclient.SessionInitializer(xs)
+        enable = client.StreamManagementInitializer(xs, self.client)
+        xs.initializers = [init, bind, session, enable]
+
+        d = init.initialize()
+        request = self.output[-1]
+        self.assertEqual((NS_SM, 'resume'), (request.uri, request.name))
+        self.assertEqual('sm-1', request['previd'])
+        self.assertEqual('5', request['h'])
+
+        self.respond('resumed', previd='sm-1', h='0')
+        self.assertTrue(self.client.resumed)
+        self.assertEqual([init, enable], xs.initializers)
+        return d
+
+
+    def test_resumeFailed(self):
+        """
+        If resumption fails, binding proceeds as usual.
+        """
+        self.client.smId = 'sm-1'
+        xs = self.xmlstream
+        init = client.StreamResumptionInitializer(xs, self.client)
+        bind = jclient.BindInitializer(xs)
+        xs.initializers = [init, bind]
+
+        d = init.initialize()
+        self.respond('failed')
+        self.assertFalse(self.client.resumed)
+        self.assertIdentical(None, self.client.smId)
+        self.assertEqual([init, bind], xs.initializers)
+        return d
+
+
+    def test_resumeNothing(self):
+        """
+        Without a previous managed stream, resumption is not attempted.
+        """
+        init = client.StreamResumptionInitializer(self.xmlstream, self.client)
+        init.initialize()
+        self.assertEqual([], self.output)
+
+
 
 class DeferredClientFactoryTest(BootstrapMixinTest):
     """
@@ -154,7 +309,7 @@ class ClientCreatorTest(unittest.TestCase):
             d1.callback(connector)
 
         d1.addCallback(cb)
-        self.patch(client.SRVConnector, 'connect', connect)
+        self.patch(client.XMPPClientConnector, 'connect', connect)
 
         d2 = client.clientCreator(factory)
         self.assertEqual(factory.deferred, d2)
@@ -8,12 +8,14 @@ Tests for L{wokkel.compat}.
 
 from zope.interface import implements
 from zope.interface.verify import verifyObject
-from twisted.internet import protocol, task
+from twisted.internet import defer, protocol, task
+from twisted.internet.error import ConnectionLost
 from twisted.internet.interfaces import IProtocolFactory, IReactorTime
 from twisted.trial import unittest
-from twisted.words.xish import utility
+from twisted.words.xish import domish, utility
 from twisted.words.protocols.jabber import xmlstream
 from wokkel.compat import BootstrapMixin, IQ, XmlStreamServerFactory
+from wokkel.compat import getRequestTracker
 
 class DummyProtocol(protocol.Protocol, utility.EventDispatcher):
     """
@@ -176,6 +178,7 @@ class FakeReactor(object):
         self.clock = task.Clock()
         self.callLater = self.clock.callLater
         self.getDelayedCalls = self.clock.getDelayedCalls
+        self.seconds = self.clock.seconds
 
 
 
@@ -207,3 +210,133 @@ class IQTest(unittest.TestCase):
         self.assertFalse(self.reactor.getDelayedCalls())
         self.assertFalse(xs.iqDeferreds)
         return d
+
+
+    def test_defaultTimeout(self):
+        """
+        Requests without a timeout get the default timeout.
+        """
+        xs = utility.EventDispatcher()
+        xs.send = lambda obj: None
+
+        iq = IQ(xs, reactor=self.reactor)
+        d = iq.send()
+        self.assertFailure(d, xmlstream.TimeoutError)
+
+        self.clock.advance(IQ.defaultTimeout)
+        self.assertFalse(xs.iqDeferreds)
+        return d
+
+
+    def test_streamDefaultTimeout(self):
+        """
+        The default timeout of the stream takes precedence.
+        """
+        xs = utility.EventDispatcher()
+        xs.send = lambda obj: None
+        xs.iqDefaultTimeout = 5
+
+        iq = IQ(xs, reactor=self.reactor)
+        d = iq.send()
+        self.assertFailure(d, xmlstream.TimeoutError)
+        self.clock.advance(5)
+        return d
+
+
+    def makeResponse(self, iq):
+        response = domish.Element((None, 'iq'))
+        response['type'] = 'result'
+        response['id'] = iq['id']
+        return response
+
+
+    def test_maxOutstanding(self):
+        """
+        Requests beyond the maximum outstanding are queued.
+        """
+        output = []
+        xs = utility.EventDispatcher()
+        xs.send = output.append
+        tracker = getRequestTracker(xs, self.reactor)
+        tracker.maxOutstanding = 1
+
+        iq1 = IQ(xs, reactor=self.reactor)
+        iq2 = IQ(xs, reactor=self.reactor)
+        d1 = iq1.send()
+        d2 = iq2.send()
+        self.assertEqual([iq1], output)
+        self.assertEqual(1, tracker.pending)
+        self.assertEqual(1, len(tracker.queue))
+
+        self.clock.advance(2)
+        xs.dispatch(self.makeResponse(iq1))
+        self.assertEqual([iq1, iq2], output)
+
+        xs.dispatch(self.makeResponse(iq2))
+        self.assertEqual(0, tracker.pending)
+        return defer.gatherResults([d1, d2])
+
+
+    def test_queuedTimeout(self):
+        """
+        Timing out outstanding requests sends queued ones.
+        """
+        output = []
+        xs = utility.EventDispatcher()
+        xs.send = output.append
+        tracker = getRequestTracker(xs, self.reactor)
+        tracker.maxOutstanding = 1
+
+        d1 = IQ(xs, reactor=self.reactor).send()
+        IQ(xs, reactor=self.reactor).send()
+        self.assertFailure(d1, xmlstream.TimeoutError)
+
+        self.clock.advance(IQ.defaultTimeout)
+        self.assertEqual(2, len(output))
+        self.assertEqual(1, tracker.timeouts)
+        return d1
+
+
+    def test_disconnectedQueued(self):
+        """
+        Queued requests fail when the stream is closed.
+        """
+        xs = utility.EventDispatcher()
+        xs.send = lambda obj: None
+        tracker = getRequestTracker(xs, self.reactor)
+        tracker.maxOutstanding = 1
+
+        d1 = IQ(xs, reactor=self.reactor).send()
+        d2 = IQ(xs, reactor=self.reactor).send()
+        xs.dispatch(xs, xmlstream.STREAM_END_EVENT)
+
+        self.assertFailure(d1, ConnectionLost)
+        self.assertFailure(d2, ConnectionLost)
+        self.assertEqual(0, len(tracker.queue))
+        return defer.gatherResults([d1, d2])
+
+
+    def test_getStats(self):
+        """
+        Statistics cover pending and queued requests and response times.
+        """
+        xs = utility.EventDispatcher()
+        xs.send = lambda obj: None
+        tracker = getRequestTracker(xs, self.reactor)
+
+        iq = IQ(xs, reactor=self.reactor)
+        iq.send()
+        self.clock.advance(2)
+        xs.dispatch(self.makeResponse(iq))
+        d = IQ(xs, reactor=self.reactor).send()
+
+        stats = tracker.getStats()
+        self.assertEqual(1, stats['pending'])
+        self.assertEqual(0, stats['queued'])
+        self.assertEqual(2, stats['sent'])
+        self.assertEqual(0, stats['errors'])
+        self.assertEqual(2, stats['responseTime'])
+
+        xs.dispatch(xs, xmlstream.STREAM_END_EVENT)
+        self.assertFailure(d, ConnectionLost)
+        return d
@@ -0,0 +1,173 @@
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+Tests for L{wokkel.metrics}.
+"""
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from twisted.words.xish import domish
+
+from wokkel import metrics
+
+class SlowHandler(object):
+
+    def __init__(self, clock):
+        self.clock = clock
+
+
+    def onMessage(self, message):
+        self.clock.advance(0.02)
+        return 'done'
+
+
+    def onBroken(self, message):
+        self.clock.advance(2)
+        raise ValueError()
+
+
+
+class HandlerNameTest(unittest.TestCase):
+    """
+    Tests for L{metrics.handlerName}.
+    """
+
+    def test_boundMethod(self):
+        """
+        Bound methods are named after the class of their object.
+        """
+        handler = SlowHandler(None)
+        self.assertEqual('wokkel.test.test_metrics.SlowHandler',
+                         metrics.handlerName(handler.onMessage))
+
+
+    def test_instance(self):
+        """
+        Handlers are named after their class.
+        """
+        self.assertEqual('wokkel.test.test_metrics.SlowHandler',
+                         metrics.handlerName(SlowHandler(None)))
+
+
+    def test_function(self):
+        """
+        Functions are named after themselves.
+        """
+        def onMessage(message):
+            pass
+
+        self.assertEqual('onMessage', metrics.handlerName(onMessage))
+
+
+
+class HandlerMetricsTest(unittest.TestCase):
+    """
+    Tests for L{metrics.HandlerMetrics}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = metrics.HandlerMetrics(boundaries=(0.01, 0.1, 1),
+                                              reactor=self.clock)
+        self.handler = SlowHandler(self.clock)
+        self.name = 'wokkel.test.test_metrics.SlowHandler'
+        self.message = domish.Element((None, 'message'))
+
+
+    def test_record(self):
+        """
+        Recorded processing times end up in the histogram buckets.
+        """
+        for duration in (0.005, 0.01, 0.05, 5):
+            self.metrics.record('handler', 'message', duration)
+        self.metrics.record('handler', 'message', 0.5, failed=True)
+
+        stats = self.metrics.stats[('handler', 'message')]
+        self.assertEqual(5, stats.count)
+        self.assertEqual(1, stats.errors)
+        self.assertEqual([2, 1, 1, 1], stats.buckets)
+        self.assertAlmostEqual(0.2, stats.errorRate())
+        self.assertAlmostEqual(5.565 / 5, stats.mean())
+
+
+    def test_wrap(self):
+        """
+        Wrapped callbacks record processing time by stanza name.
+        """
+        wrapped = self.metrics.wrap(self.handler.onMessage)
+        self.assertEqual('done', wrapped(self.message))
+
+        stats = self.metrics.stats[(self.name, 'message')]
+        self.assertEqual(1, stats.count)
+        self.assertAlmostEqual(0.02, stats.total)
+
+
+    def test_callFailure(self):
+        """
+        Exceptions raised by callbacks are recorded as errors and re-raised.
+        """
+        self.assertRaises(ValueError, self.metrics.call,
+                          self.handler.onBroken, 'chat', self.message)
+
+        stats = self.metrics.stats[(self.name, 'chat')]
+        self.assertEqual(1, stats.errors)
+        self.assertEqual([0, 0, 0, 1], stats.buckets)
+
+
+    def test_track(self):
+        """
+        The time until a deferred fires is recorded.
+        """
+        d = defer.Deferred()
+        self.metrics.track(self.handler, 'iq:get', d)
+        self.clock.advance(0.5)
+        d.callback(None)
+
+        stats = self.metrics.stats[(self.name, 'iq:get')]
+        self.assertEqual(0, stats.errors)
+        self.assertEqual([0, 0, 1, 0], stats.buckets)
+
+
+    def test_trackFailure(self):
+        """
+        Failures of tracked deferreds are recorded and passed through.
+        """
+        d = defer.fail(ValueError())
+        self.metrics.track(self.handler, 'iq:get', d)
+        self.assertFailure(d, ValueError)
+
+        stats = self.metrics.stats[(self.name, 'iq:get')]
+        self.assertEqual(1, stats.errors)
+        return d
+
+
+    def test_reset(self):
+        self.metrics.record('handler', 'message', 0.005)
+        self.metrics.reset()
+        self.assertEqual({}, self.metrics.stats)
+
+
+    def test_dump(self):
+        """
+        The dump has counters and a cumulative histogram per handler and kind.
+        """
+        self.metrics.record('handler', 'message', 0.005)
+        self.metrics.record('handler', 'message', 0.5, failed=True)
+
+        labels = 'handler="handler",kind="message"'
+        expected = ['handler_stanzas_total{%s} 2',
+                    'handler_errors_total{%s} 1',
+                    'handler_latency_seconds_bucket{%s,le="0.01"} 1',
+                    'handler_latency_seconds_bucket{%s,le="0.1"} 1',
+                    'handler_latency_seconds_bucket{%s,le="1"} 2',
+                    'handler_latency_seconds_bucket{%s,le="+Inf"} 2',
+                    'handler_latency_seconds_sum{%s} 0.505',
+                    'handler_latency_seconds_count{%s} 2']
+        self.assertEqual(''.join([(line % labels) + '\n'
+                                  for line in expected]),
+                         self.metrics.dump())
+
+
+    def test_dumpEmpty(self):
+        self.assertEqual('', self.metrics.dump())
@@ -0,0 +1,196 @@
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+Tests for L{wokkel.packetqueue}.
+"""
+
+import os
+
+from zope.interface.verify import verifyObject
+
+from twisted.trial import unittest
+from twisted.words.xish import domish
+
+from wokkel import packetqueue
+from wokkel.iwokkel import IPacketQueue
+
+class MemoryPacketQueueTest(unittest.TestCase):
+    """
+    Tests for L{packetqueue.MemoryPacketQueue}.
+    """
+
+    def setUp(self):
+        self.queue = packetqueue.MemoryPacketQueue()
+
+
+    def test_interface(self):
+        verifyObject(IPacketQueue, self.queue)
+
+
+    def test_unbounded(self):
+        """
+        Without a maximum size, everything is kept in order.
+        """
+        for i in xrange(5):
+            self.queue.append(i)
+        self.assertEqual(5, len(self.queue))
+        self.assertEqual(0, self.queue[0])
+        self.assertEqual(range(5), self.queue.take())
+        self.assertEqual(0, len(self.queue))
+
+
+    def test_take(self):
+        """
+        Objects can be taken in batches.
+        """
+        for i in xrange(5):
+            self.queue.append(i)
+        self.assertEqual([0, 1], self.queue.take(2))
+        self.assertEqual([2, 3, 4], self.queue.take(10))
+
+
+    def test_prepend(self):
+        """
+        Prepended objects come before the queued ones, in order.
+        """
+        self.queue.append(2)
+        self.queue.prepend([0, 1])
+        self.assertEqual([0, 1, 2], self.queue.take())
+
+
+    def test_dropOldest(self):
+        """
+        When full, the oldest object is dropped.
+        """
+        self.queue.maxSize = 2
+        for i in xrange(3):
+            self.queue.append(i)
+        self.assertEqual([1, 2], self.queue.take())
+        self.assertEqual(1, self.queue.dropped)
+
+
+    def test_dropNewest(self):
+        """
+        When full with the drop-newest policy, new objects are dropped.
+        """
+        self.queue.maxSize = 2
+        self.queue.policy = packetqueue.DROP_NEWEST
+        for i in xrange(3):
+            self.queue.append(i)
+        self.assertEqual([0, 1], self.queue.take())
+        self.assertEqual(1, self.queue.dropped)
+
+
+
+class SpoolingPacketQueueTest(unittest.TestCase):
+    """
+    Tests for L{packetqueue.SpoolingPacketQueue}.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.queue = packetqueue.SpoolingPacketQueue(self.path, maxMemory=2)
+
+
+    def makeStanza(self, body):
+        message = domish.Element((None, 'message'))
+        message.addElement('body', content=body)
+        return message
+
+
+    def test_interface(self):
+        verifyObject(IPacketQueue, self.queue)
+
+
+    def test_inMemory(self):
+        """
+        Up to maxMemory objects are not spooled to disk.
+        """
+        self.queue.append('<presence/>')
+        self.queue.append('<presence/>')
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(2, len(self.queue))
+
+
+    def test_spool(self):
+        """
+        Objects beyond maxMemory are spooled to disk and read back in order.
+        """
+        self.queue.append('one')
+        self.queue.append(u'tw\u00f6')
+        self.queue.append(self.makeStanza(u'thr\u00e9e'))
+        self.queue.append('four')
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(4, len(self.queue))
+
+        objs = self.queue.take()
+        self.assertEqual(['one', u'tw\u00f6'], objs[:2])
+        self.assertEqual(u'thr\u00e9e', unicode(objs[2].body))
+        self.assertEqual('four', objs[3])
+        self.assertEqual(0, len(self.queue))
+        self.assertFalse(os.path.exists(self.path))
+
+
+    def test_spoolKeepsOrder(self):
+        """
+        Once spooling, new objects go to disk even if memory frees up.
+        """
+        for i in xrange(3):
+            self.queue.append(str(i))
+        self.assertEqual(['0'], self.queue.take(1))
+        self.queue.append('3')
+        self.assertEqual(['1', '2', '3'], self.queue.take())
+
+
+    def test_persistent(self):
+        """
+        A new queue picks up objects spooled by a previous one.
+        """
+        for i in xrange(4):
+            self.queue.append(self.makeStanza(unicode(i)))
+
+        queue = packetqueue.SpoolingPacketQueue(self.path, maxMemory=2)
+        self.assertEqual(2, len(queue))
+        self.assertEqual([u'2', u'3'],
+                         [unicode(obj.body) for obj in queue.take()])
+
+
+    def test_persistentAfterTake(self):
+        """
+        Spooled objects that were taken are not picked up again by a new
+        queue.
+        """
+        self.queue.maxMemory = 1
+        for obj in 'abcd':
+            self.queue.append(obj)
+        self.assertEqual(['a', 'b'], self.queue.take(2))
+
+        queue = packetqueue.SpoolingPacketQueue(self.path, maxMemory=1)
+        self.assertEqual(2, len(queue))
+        self.assertEqual(['c', 'd'], queue.take())
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.offset'))
+
+
+    def test_dropOldest(self):
+        """
+        When full, the oldest object is dropped, also from disk.
+        """
+        self.queue.maxSize = 3
+        for i in xrange(5):
+            self.queue.append(str(i))
+        self.assertEqual(['2', '3', '4'], self.queue.take())
+        self.assertEqual(2, self.queue.dropped)
+
+
+    def test_dropNewest(self):
+        """
+        When full with the drop-newest policy, new objects are dropped.
+        """
+        self.queue.maxSize = 3
+        self.queue.policy = packetqueue.DROP_NEWEST
+        for i in xrange(5):
+            self.queue.append(str(i))
+        self.assertEqual(['0', '1', '2'], self.queue.take())
+        self.assertEqual(2, self.queue.dropped)
@@ -8,13 +8,13 @@ Tests for L{wokkel.pubsub}
 from zope.interface import verify
 
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.words.xish import domish
-from twisted.words.protocols.jabber import error
+from twisted.words.protocols.jabber import error, xmlstream
 from twisted.words.protocols.jabber.jid import JID
 from twisted.words.protocols.jabber.xmlstream import toResponse
 
-from wokkel import data_form, disco, iwokkel, pubsub, shim
+from wokkel import data_form, disco, iwokkel, pubsub, shim, subprotocols
 from wokkel.generic import parseXml
 from wokkel.test.helpers import TestableRequestHandlerMixin, XmlStreamStub
 
@@ -24,6 +24,10 @@ NS_PUBSUB_ERRORS = 'http://jabber.org/protocol/pubsub#errors'
 NS_PUBSUB_EVENT = 'http://jabber.org/protocol/pubsub#event'
 NS_PUBSUB_OWNER = 'http://jabber.org/protocol/pubsub#owner'
 NS_PUBSUB_META_DATA = 'http://jabber.org/protocol/pubsub#meta-data'
+NS_PUBSUB_SUBSCRIBE_OPTIONS = \
+        'http://jabber.org/protocol/pubsub#subscribe_options'
+NS_PUBSUB_SUBSCRIBE_AUTHORIZATION = \
+        'http://jabber.org/protocol/pubsub#subscribe_authorization'
 
 def calledAsync(fn):
     """
@@ -87,6 +91,32 @@ class PubSubClientTest(unittest.TestCase):
         return d
 
 
+    def test_eventStreamManager(self):
+        """
+        Events are passed on by a stream manager as parent, once.
+        """
+        factory = xmlstream.XmlStreamFactory(xmlstream.Authenticator())
+        streamManager = subprotocols.StreamManager(factory)
+        protocol = pubsub.PubSubClient()
+        protocol.setHandlerParent(streamManager)
+        stub = XmlStreamStub()
+        streamManager._connected(stub.xmlstream)
+        streamManager._authd(stub.xmlstream)
+
+        message = domish.Element((None, 'message'))
+        message['from'] = 'pubsub.example.org'
+        message['to'] = 'user@example.org/home'
+        event = message.addElement((NS_PUBSUB_EVENT, 'event'))
+        items = event.addElement('items')
+        items['node'] = 'test'
+
+        received = []
+        protocol.itemsReceived = received.append
+        stub.send(message)
+        self.assertEqual(1, len(received))
+        self.assertEqual('test', received[0].nodeIdentifier)
+
+
     def test_eventItemsCollection(self):
         """
         Test receiving an items event resulting in a call to itemsReceived.
@@ -178,6 +208,231 @@ class PubSubClientTest(unittest.TestCase):
         return d
 
 
+    def makeItemsEvent(self, *elements):
+        message = domish.Element((None, 'message'))
+        message['from'] = 'pubsub.example.org'
+        message['to'] = 'user@example.org/home'
+        event = message.addElement((NS_PUBSUB_EVENT, 'event'))
+        items = event.addElement('items')
+        items['node'] = 'test'
+        for name, itemIdentifier in elements:
+            item = items.addElement(name)
+            item['id'] = itemIdentifier
+            if name == 'item':
+                item.addElement(('http://example.org/', 'payload'))
+        return message
+
+
+    def test_eventItemsCache(self):
+        """
+        Items notifications update the cache.
+        """
+        self.protocol.cache = pubsub.ItemCache()
+        self.stub.send(self.makeItemsEvent(('item', 'item1'),
+                                           ('item', 'item2')))
+        self.stub.send(self.makeItemsEvent(('retract', 'item2')))
+
+        item = self.protocol.cache.getLastItem(JID('pubsub.example.org'),
+                                               'test')
+        self.assertEqual('item1', item['id'])
+
+
+    def test_itemsCached(self):
+        """
+        Once items were retrieved, retrievals are answered from the cache.
+        """
+        self.protocol.cache = pubsub.ItemCache()
+        service = JID('pubsub.example.org')
+        d = self.protocol.items(service, 'test')
+
+        iq = self.stub.output[-1]
+        response = toResponse(iq, 'result')
+        items = response.addElement((NS_PUBSUB, 'pubsub')).addElement('items')
+        items['node'] = 'test'
+        items.addElement('item')['id'] = 'item1'
+        self.stub.send(response)
+
+        def cb(result):
+            self.stub.send(self.makeItemsEvent(('item', 'item2')))
+            return self.protocol.items(service, 'test')
+
+        def cb2(result):
+            self.assertEqual(['item1', 'item2'],
+                             [item['id'] for item in result])
+            self.assertEqual(1, len(self.stub.output))
+            self.assertEqual(1, self.protocol.cache.hits)
+
+        d.addCallback(cb)
+        d.addCallback(cb2)
+        return d
+
+
+    def test_eventDeleteCache(self):
+        """
+        Deleting a node drops it from the cache.
+        """
+        cache = self.protocol.cache = pubsub.ItemCache()
+        service = JID('pubsub.example.org')
+        cache.setItems(service, 'test', [pubsub.Item('item1')], True)
+
+        message = domish.Element((None, 'message'))
+        message['from'] = 'pubsub.example.org'
+        message['to'] = 'user@example.org/home'
+        event = message.addElement((NS_PUBSUB_EVENT, 'event'))
+        event.addElement('delete')['node'] = 'test'
+        self.stub.send(message)
+
+        self.assertEqual(0, len(cache))
+
+
+    def test_connectionLostCache(self):
+        """
+        Losing the connection clears the cache.
+        """
+        cache = self.protocol.cache = pubsub.ItemCache()
+        cache.setItems(JID('pubsub.example.org'), 'test',
+                       [pubsub.Item('item1')], True)
+        self.protocol.connectionLost(None)
+        self.assertEqual(0, len(cache))
+
+
+    def test_unsubscribeCache(self):
+        """
+        Unsubscribing from a node drops it from the cache.
+        """
+        cache = self.protocol.cache = pubsub.ItemCache()
+        service = JID('pubsub.example.org')
+        cache.setItems(service, 'test', [pubsub.Item('item1')], True)
+        d = self.protocol.unsubscribe(service, 'test',
+                                      JID('user@example.org'))
+        self.assertEqual(0, len(cache))
+
+        self.stub.send(toResponse(self.stub.output[-1], 'result'))
+        return d
+
+
+    def test_eventItemsNoHeaders(self):
+        """
+        Without SHIM headers, events have empty headers.
+        """
+        message = self.makeItemsEvent(('item', 'item1'))
+        d, self.protocol.itemsReceived = calledAsync(
+                lambda event: self.assertEqual({}, event.headers))
+        self.stub.send(message)
+        return d
+
+
+    def test_eventUnknown(self):
+        """
+        Unknown event types are not handled.
+        """
+        message = domish.Element((None, 'message'))
+        message['from'] = 'pubsub.example.org'
+        message['to'] = 'user@example.org/home'
+        event = message.addElement((NS_PUBSUB_EVENT, 'event'))
+        event.addElement('configuration')['node'] = 'test'
+        self.stub.send(message)
+        self.assertFalse(getattr(message, 'handled', False))
+
+
+    def test_nodeObserver(self):
+        """
+        Events for a node with observers are passed to those observers.
+        """
+        received = []
+        other = []
+        self.protocol.itemsReceived = other.append
+        self.protocol.addNodeObserver(JID('pubsub.example.org'), 'test',
+                                      received.append)
+
+        self.stub.send(self.makeItemsEvent(('item', 'item1')))
+        self.assertEqual(1, len(received))
+        self.assertEqual('test', received[0].nodeIdentifier)
+        self.assertEqual([], other)
+
+
+    def test_removeNodeObserver(self):
+        """
+        Without observers left, events go to itemsReceived again.
+        """
+        received = []
+        other = []
+        self.protocol.itemsReceived = other.append
+        service = JID('pubsub.example.org')
+        self.protocol.addNodeObserver(service, 'test', received.append)
+        self.protocol.removeNodeObserver(service, 'test', received.append)
+
+        self.stub.send(self.makeItemsEvent(('item', 'item1')))
+        self.assertEqual([], received)
+        self.assertEqual(1, len(other))
+
+
+    def test_eventSubclassHandler(self):
+        """
+        Event handlers defined in subclasses receive their events.
+        """
+        class Client(pubsub.PubSubClient):
+            def _onEvent_configuration(self, sender, recipient, action,
+                                             headers):
+                received.append(action)
+
+        received = []
+        self.protocol = Client()
+        self.protocol.xmlstream = self.stub.xmlstream
+        self.protocol.connectionInitialized()
+
+        message = domish.Element((None, 'message'))
+        message['from'] = 'pubsub.example.org'
+        message['to'] = 'user@example.org/home'
+        event = message.addElement((NS_PUBSUB_EVENT, 'event'))
+        event.addElement('configuration')['node'] = 'test'
+        self.stub.send(message)
+
+        self.assertEqual(1, len(received))
+        self.assertTrue(message.handled)
+        self.assertNotIn('configuration',
+                         pubsub.PubSubClient._getEventHandlers(
+                             pubsub.PubSubClient()))
+
+
+    def test_eventLastAction(self):
+        """
+        The last event child determines the event type.
+        """
+        purged = []
+        self.protocol.purgeReceived = purged.append
+        message = self.makeItemsEvent(('item', 'item1'))
+        message.event.addElement('purge')['node'] = 'test'
+        self.stub.send(message)
+        self.assertEqual(1, len(purged))
+
+
+    def test_eventSubclassWithoutInit(self):
+        """
+        Subclasses that do not call the base initializer receive events.
+        """
+        class Client(pubsub.PubSubClient):
+            def __init__(self):
+                self.received = []
+
+            def itemsReceived(self, event):
+                self.received.append(event)
+
+        self.protocol = Client()
+        self.protocol.xmlstream = self.stub.xmlstream
+        self.protocol.connectionInitialized()
+
+        self.stub.send(self.makeItemsEvent(('item', 'item1')))
+        self.assertEqual(1, len(self.protocol.received))
+
+        observed = []
+        service = JID('pubsub.example.org')
+        self.protocol.addNodeObserver(service, 'test', observed.append)
+        self.stub.send(self.makeItemsEvent(('item', 'item2')))
+        self.assertEqual(1, len(observed))
+        self.assertIdentical(None, pubsub.PubSubClient._nodeObservers)
+
+
     def test_createNode(self):
         """
         Test sending create request.
@@ -378,6 +633,126 @@ class PubSubClientTest(unittest.TestCase):
         return d
 
 
+    def publishElements(self, iq):
+        publish = iq.pubsub.publish
+        return publish['node'], [item['id'] for item in publish.elements()]
+
+
+    def test_publishMany(self):
+        """
+        Publish requests are pipelined up to the window size.
+        """
+        publications = [('a', [pubsub.Item(id=str(i)) for i in xrange(3)]),
+                        ('b', [pubsub.Item(id='3')])]
+        d = self.protocol.publishMany(JID('pubsub.example.org'),
+                                      iter(publications), window=2)
+
+        self.assertEqual(2, len(self.stub.output))
+        self.assertEqual(('a', ['0']), self.publishElements(self.stub.output[0]))
+        self.assertEqual(('a', ['1']), self.publishElements(self.stub.output[1]))
+
+        self.stub.send(toResponse(self.stub.output[1], 'result'))
+        self.assertEqual(3, len(self.stub.output))
+        self.stub.send(toResponse(self.stub.output[0], 'result'))
+        self.assertEqual(4, len(self.stub.output))
+        self.assertEqual(('b', ['3']), self.publishElements(self.stub.output[3]))
+
+        response = toResponse(self.stub.output[2], 'error')
+        response.addChild(error.StanzaError('item-not-found').getElement())
+        self.stub.send(response)
+        self.stub.send(toResponse(self.stub.output[3], 'result'))
+
+        def cb(results):
+            self.assertEqual([(True, '0'), (True, '1')], results[:2])
+            self.assertFalse(results[2][0])
+            results[2][1].trap(error.StanzaError)
+            self.assertEqual((True, '3'), results[3])
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_publishManyConnectionLost(self):
+        """
+        Items that cannot be sent after the connection was lost fail,
+        without stopping the run.
+        """
+        publications = [('a', [pubsub.Item(id=str(i)) for i in xrange(3)])]
+        d = self.protocol.publishMany(JID('pubsub.example.org'),
+                                      publications, window=1)
+
+        self.assertEqual(1, len(self.stub.output))
+        self.protocol.connectionLost(None)
+        self.stub.send(toResponse(self.stub.output[0], 'result'))
+
+        def cb(results):
+            self.assertEqual((True, '0'), results[0])
+            for success, failure in results[1:]:
+                self.assertFalse(success)
+                failure.trap(AttributeError)
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_publishManyBatch(self):
+        """
+        Items for the same node are packed into one request.
+        """
+        items = [pubsub.Item(id=str(i)) for i in xrange(3)]
+        d = self.protocol.publishMany(JID('pubsub.example.org'),
+                                      [('a', items)], batchSize=2)
+
+        self.assertEqual(2, len(self.stub.output))
+        self.assertEqual(('a', ['0', '1']),
+                         self.publishElements(self.stub.output[0]))
+        self.assertEqual(('a', ['2']),
+                         self.publishElements(self.stub.output[1]))
+
+        response = toResponse(self.stub.output[0], 'result')
+        publish = response.addElement((NS_PUBSUB, 'pubsub')).addElement(
+                'publish')
+        publish['node'] = 'a'
+        publish.addElement('item')['id'] = 'x'
+        publish.addElement('item')['id'] = 'y'
+        self.stub.send(response)
+        self.stub.send(toResponse(self.stub.output[1], 'result'))
+
+        d.addCallback(self.assertEqual, [(True, 'x'), (True, 'y'), (True, '2')])
+        return d
+
+
+    def test_publishManyBatchRejected(self):
+        """
+        If a node rejects multiple items, they are published one by one.
+        """
+        items = [pubsub.Item(id=str(i)) for i in xrange(3)]
+        d = self.protocol.publishMany(JID('pubsub.example.org'),
+                                      [('a', items)], window=1, batchSize=2)
+
+        self.assertEqual(1, len(self.stub.output))
+        response = toResponse(self.stub.output[0], 'error')
+        response.addChild(error.StanzaError('bad-request').getElement())
+        self.stub.send(response)
+
+        for index, itemIdentifier in enumerate(['0', '1', '2']):
+            iq = self.stub.output[index + 1]
+            self.assertEqual(('a', [itemIdentifier]), self.publishElements(iq))
+            self.stub.send(toResponse(iq, 'result'))
+
+        d.addCallback(self.assertEqual, [(True, '0'), (True, '1'), (True, '2')])
+        return d
+
+
+    def test_publishManyEmpty(self):
+        """
+        Without any items, the result is an empty list.
+        """
+        d = self.protocol.publishMany(JID('pubsub.example.org'), [])
+        d.addCallback(self.assertEqual, [])
+        return d
+
+
     def test_subscribe(self):
         """
         Test sending subscription request.
@@ -591,102 +966,437 @@ class PubSubClientTest(unittest.TestCase):
 
 
 
-class PubSubRequestTest(unittest.TestCase):
+class ItemCacheTest(unittest.TestCase):
+    """
+    Tests for L{pubsub.ItemCache}.
+    """
 
-    def test_fromElementPublish(self):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = pubsub.ItemCache(maxItems=2, maxNodes=2, ttl=60,
+                                      reactor=self.clock)
+        self.service = JID('pubsub.example.org')
+
+
+    def makeItem(self, itemIdentifier):
+        return pubsub.Item(itemIdentifier,
+                           domish.Element(('http://example.org/', 'payload')))
+
+
+    def itemIdentifiers(self, items):
+        return [item['id'] for item in items]
+
+
+    def test_coldMiss(self):
         """
-        Test parsing a publish request.
+        Nodes that were never retrieved are not answered from the cache.
         """
+        self.cache.itemsReceived(self.service, 'test', [self.makeItem('1')])
+        self.assertIdentical(None, self.cache.getItems(self.service, 'test',
+                                                       1))
+        self.assertEqual(1, self.cache.misses)
+        self.assertEqual('1', self.cache.getLastItem(self.service,
+                                                     'test')['id'])
 
-        xml = """
-        <iq type='set' to='pubsub.example.org'
-                       from='user@example.org'>
-          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
-            <publish node='test'/>
-          </pubsub>
-        </iq>
+
+    def test_complete(self):
+        """
+        All items of a completely retrieved node are answered.
         """
+        self.cache.setItems(self.service, 'test', [self.makeItem('1')], True)
+        self.assertEqual(['1'], self.itemIdentifiers(
+            self.cache.getItems(self.service, 'test')))
+        self.assertEqual(['1'], self.itemIdentifiers(
+            self.cache.getItems(self.service, 'test', 5)))
+        self.assertEqual(2, self.cache.hits)
 
-        request = pubsub.PubSubRequest.fromElement(parseXml(xml))
-        self.assertEqual('publish', request.verb)
-        self.assertEqual(JID('user@example.org'), request.sender)
-        self.assertEqual(JID('pubsub.example.org'), request.recipient)
-        self.assertEqual('test', request.nodeIdentifier)
-        self.assertEqual([], request.items)
+
+    def test_maxItems(self):
+        """
+        Only the most recent items are kept, and retrieving all of them
+        then needs the service.
+        """
+        self.cache.setItems(self.service, 'test',
+                            [self.makeItem(str(i)) for i in xrange(3)], True)
+        self.assertEqual(['1', '2'], self.itemIdentifiers(
+            self.cache.getItems(self.service, 'test', 2)))
+        self.assertIdentical(None, self.cache.getItems(self.service, 'test'))
+        self.assertIdentical(None, self.cache.getItems(self.service, 'test',
+                                                       3))
 
 
-    def test_fromElementPublishItems(self):
+    def test_republish(self):
         """
-        Test parsing a publish request with items.
+        Republishing an item replaces the cached version.
         """
+        self.cache.setItems(self.service, 'test',
+                            [self.makeItem('1'), self.makeItem('2')], True)
+        self.cache.itemsReceived(self.service, 'test', [self.makeItem('1')])
+        self.assertEqual(['2', '1'], self.itemIdentifiers(
+            self.cache.getItems(self.service, 'test')))
 
-        xml = """
-        <iq type='set' to='pubsub.example.org'
-                       from='user@example.org'>
-          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
-            <publish node='test'>
-              <item id="item1"/>
-              <item id="item2"/>
-            </publish>
-          </pubsub>
-        </iq>
+
+    def test_retract(self):
+        """
+        Retracted items are removed from the cache.
         """
+        self.cache.setItems(self.service, 'test',
+                            [self.makeItem('1'), self.makeItem('2')], True)
+        retract = domish.Element((NS_PUBSUB_EVENT, 'retract'))
+        retract['id'] = '1'
+        self.cache.itemsReceived(self.service, 'test', [retract])
+        self.assertEqual(['2'], self.itemIdentifiers(
+            self.cache.getItems(self.service, 'test')))
 
-        request = pubsub.PubSubRequest.fromElement(parseXml(xml))
-        self.assertEqual(2, len(request.items))
-        self.assertEqual(u'item1', request.items[0]["id"])
-        self.assertEqual(u'item2', request.items[1]["id"])
 
+    def test_noPayload(self):
+        """
+        Notifications without payload drop the node from the cache.
+        """
+        self.cache.setItems(self.service, 'test', [self.makeItem('1')], True)
+        self.cache.itemsReceived(self.service, 'test', [pubsub.Item('2')])
+        self.assertEqual(0, len(self.cache))
 
-    def test_fromElementPublishNoNode(self):
+
+    def test_purged(self):
         """
-        A publish request to the root node should raise an exception.
+        A purged node is known to have no items.
         """
-        xml = """
-        <iq type='set' to='pubsub.example.org'
-                       from='user@example.org'>
-          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
-            <publish/>
-          </pubsub>
-        </iq>
+        self.cache.setItems(self.service, 'test', [self.makeItem('1')], True)
+        self.cache.purged(self.service, 'test')
+        self.assertEqual([], self.cache.getItems(self.service, 'test'))
+
+
+    def test_expired(self):
         """
+        Retrieved items are only answered from the cache until they expire.
+        """
+        self.cache.setItems(self.service, 'test', [self.makeItem('1')], True)
+        self.clock.advance(59)
+        self.assertEqual(['1'], self.itemIdentifiers(
+            self.cache.getItems(self.service, 'test')))
+        self.clock.advance(1)
+        self.assertIdentical(None, self.cache.getItems(self.service, 'test'))
+        self.assertEqual('1', self.cache.getLastItem(self.service,
+                                                     'test')['id'])
 
-        err = self.assertRaises(error.StanzaError,
-                                pubsub.PubSubRequest.fromElement,
-                                parseXml(xml))
-        self.assertEqual('bad-request', err.condition)
-        self.assertEqual(NS_PUBSUB_ERRORS, err.appCondition.uri)
-        self.assertEqual('nodeid-required', err.appCondition.name)
 
+    def test_noTTL(self):
+        """
+        Without a time to live, retrieved items do not expire.
+        """
+        self.cache.ttl = None
+        self.cache.setItems(self.service, 'test', [self.makeItem('1')], True)
+        self.clock.advance(3600)
+        self.assertEqual(['1'], self.itemIdentifiers(
+            self.cache.getItems(self.service, 'test')))
 
-    def test_fromElementSubscribe(self):
+
+    def test_sender(self):
         """
-        Test parsing a subscription request.
+        Items retrieved by one entity are not answered to another.
         """
+        sender = JID('user@example.org')
+        self.cache.setItems(self.service, 'test', [self.makeItem('1')], True,
+                            sender)
+        self.assertIdentical(None, self.cache.getItems(self.service, 'test'))
+        self.assertEqual(['1'], self.itemIdentifiers(
+            self.cache.getItems(self.service, 'test', sender=sender)))
 
-        xml = """
-        <iq type='set' to='pubsub.example.org'
-                       from='user@example.org'>
-          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
-            <subscribe node='test' jid='user@example.org/Home'/>
-          </pubsub>
-        </iq>
+
+    def test_notificationsAllSenders(self):
         """
+        Notifications update the node for all entities it is cached for.
+        """
+        sender = JID('user@example.org')
+        self.cache.setItems(self.service, 'test', [], True)
+        self.cache.setItems(self.service, 'test', [], True, sender)
+        self.cache.itemsReceived(self.service, 'test', [self.makeItem('1')])
+        self.assertEqual(['1'], self.itemIdentifiers(
+            self.cache.getItems(self.service, 'test')))
+        self.assertEqual(['1'], self.itemIdentifiers(
+            self.cache.getItems(self.service, 'test', sender=sender)))
 
-        request = pubsub.PubSubRequest.fromElement(parseXml(xml))
-        self.assertEqual('subscribe', request.verb)
-        self.assertEqual(JID('user@example.org'), request.sender)
-        self.assertEqual(JID('pubsub.example.org'), request.recipient)
-        self.assertEqual('test', request.nodeIdentifier)
-        self.assertEqual(JID('user@example.org/Home'), request.subscriber)
+        self.cache.invalidate(self.service, 'test')
+        self.assertEqual(0, len(self.cache))
 
 
-    def test_fromElementSubscribeEmptyNode(self):
+    def test_mixedSources(self):
         """
-        Test parsing a subscription request to the root node.
+        Retrieved and notified items are returned alike, as copies in the
+        C{pubsub} namespace.
         """
+        self.cache.setItems(self.service, 'test', [self.makeItem('1')], True)
+        event = domish.Element((NS_PUBSUB_EVENT, 'item'))
+        event['id'] = '2'
+        event.addElement(('http://example.org/', 'payload'))
+        self.cache.itemsReceived(self.service, 'test', [event])
 
-        xml = """
+        items = self.cache.getItems(self.service, 'test')
+        self.assertEqual(['1', '2'], self.itemIdentifiers(items))
+        for item in items:
+            self.assertEqual(NS_PUBSUB, item.uri)
+            self.assertEqual('http://example.org/', item.payload.uri)
+
+        items[1]['id'] = 'changed'
+        items[1].addElement('extra')
+        item = self.cache.getLastItem(self.service, 'test')
+        self.assertEqual('2', item['id'])
+        self.assertEqual(['payload'],
+                         [child.name for child in item.elements()])
+
+
+    def test_clear(self):
+        """
+        Clearing the cache drops all nodes.
+        """
+        self.cache.setItems(self.service, 'test', [self.makeItem('1')], True)
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+        self.assertIdentical(None, self.cache.getItems(self.service, 'test'))
+        self.cache.setItems(self.service, 'test', [self.makeItem('2')], True)
+        self.assertEqual(1, len(self.cache))
+
+
+    def test_evictLeastRecentlyUsed(self):
+        """
+        When too many nodes are cached, the least recently used goes.
+        """
+        for nodeIdentifier in ('a', 'b'):
+            self.cache.setItems(self.service, nodeIdentifier,
+                                [self.makeItem('1')], True)
+        self.cache.getItems(self.service, 'a')
+        self.cache.setItems(self.service, 'c', [], True)
+
+        self.assertEqual(2, len(self.cache))
+        self.assertEqual(1, self.cache.evictions)
+        self.assertIdentical(None, self.cache.getItems(self.service, 'b'))
+        self.assertNotIdentical(None, self.cache.getItems(self.service, 'a'))
+
+
+    def test_evictManyTouches(self):
+        """
+        Usage order stays correct when the usage queue is compacted.
+        """
+        for nodeIdentifier in ('a', 'b'):
+            self.cache.setItems(self.service, nodeIdentifier, [], True)
+        for i in xrange(50):
+            self.cache.getItems(self.service, 'b')
+            self.cache.getItems(self.service, 'a')
+        self.cache.setItems(self.service, 'c', [], True)
+        self.assertIdentical(None, self.cache.getItems(self.service, 'b'))
+        self.assertEqual([], self.cache.getItems(self.service, 'a'))
+
+
+
+class NotificationRouterTest(unittest.TestCase):
+    """
+    Tests for L{pubsub.NotificationRouter}.
+    """
+
+    def setUp(self):
+        self.router = pubsub.NotificationRouter()
+        self.user1 = JID('user1@example.org/home')
+        self.user2 = JID('user2@example.org/home')
+
+
+    def subscribe(self, nodeIdentifier, subscriber, state='subscribed'):
+        subscription = pubsub.Subscription(nodeIdentifier, subscriber, state)
+        self.router.addSubscription(subscription)
+        return subscription
+
+
+    def test_subscribers(self):
+        subscription = self.subscribe('test', self.user1)
+        self.subscribe('other', self.user2)
+        self.assertEqual({self.user1: [subscription]},
+                         self.router.getSubscribers('test'))
+
+
+    def test_notSubscribed(self):
+        """
+        Pending subscriptions do not receive notifications.
+        """
+        self.subscribe('test', self.user1, 'pending')
+        self.assertEqual({}, self.router.getSubscribers('test'))
+
+
+    def test_collection(self):
+        """
+        Subscribers to collections are notified of contained nodes.
+        """
+        self.router.setCollections('test', ['collection'])
+        self.router.setCollections('collection', ['root'])
+        subscription1 = self.subscribe('test', self.user1)
+        subscription2 = self.subscribe('root', self.user1)
+        subscription3 = self.subscribe('collection', self.user2)
+
+        subscribers = self.router.getSubscribers('test')
+        self.assertEqual(set([subscription1, subscription2]),
+                         set(subscribers[self.user1]))
+        self.assertEqual([subscription3], subscribers[self.user2])
+        self.assertEqual(set(['collection', 'root']),
+                         self.router.getAncestors('test'))
+        self.assertEqual(set(['collection', 'test']),
+                         self.router.getDescendants('root'))
+
+
+    def test_incremental(self):
+        """
+        Subscription changes update previously computed fan-out lists.
+        """
+        self.router.setCollections('test', ['collection'])
+        self.assertEqual({}, self.router.getSubscribers('test'))
+
+        subscription = self.subscribe('collection', self.user1)
+        self.assertEqual({self.user1: [subscription]},
+                         self.router.getSubscribers('test'))
+
+        self.router.removeSubscription('collection', self.user1)
+        self.assertEqual({}, self.router.getSubscribers('test'))
+
+
+    def test_setCollections(self):
+        """
+        Moving a node to another collection changes its subscribers.
+        """
+        self.router.setCollections('test', ['a'])
+        self.subscribe('a', self.user1)
+        subscription = self.subscribe('b', self.user2)
+        self.router.getSubscribers('test')
+
+        self.router.setCollections('test', ['b'])
+        self.assertEqual({self.user2: [subscription]},
+                         self.router.getSubscribers('test'))
+
+
+    def test_cycle(self):
+        """
+        Cycles in the collection hierarchy do not cause endless loops.
+        """
+        self.router.setCollections('a', ['b'])
+        self.router.setCollections('b', ['a'])
+        subscription = self.subscribe('b', self.user1)
+        self.assertEqual({self.user1: [subscription]},
+                         self.router.getSubscribers('a'))
+
+
+    def test_removeNode(self):
+        """
+        Removing a collection detaches the nodes contained in it.
+        """
+        self.router.setCollections('test', ['collection'])
+        self.subscribe('collection', self.user1)
+        self.router.removeNode('collection')
+
+        self.assertEqual({}, self.router.getSubscribers('test'))
+        self.assertEqual(set(), self.router.getChildren('collection'))
+
+
+    def test_getNotifications(self):
+        subscription = self.subscribe('test', self.user1)
+        items = [pubsub.Item('1')]
+        self.assertEqual([(self.user1, [subscription], items)],
+                         self.router.getNotifications('test', items))
+
+
+
+class PubSubRequestTest(unittest.TestCase):
+
+    def test_fromElementPublish(self):
+        """
+        Test parsing a publish request.
+        """
+
+        xml = """
+        <iq type='set' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <publish node='test'/>
+          </pubsub>
+        </iq>
+        """
+
+        request = pubsub.PubSubRequest.fromElement(parseXml(xml))
+        self.assertEqual('publish', request.verb)
+        self.assertEqual(JID('user@example.org'), request.sender)
+        self.assertEqual(JID('pubsub.example.org'), request.recipient)
+        self.assertEqual('test', request.nodeIdentifier)
+        self.assertEqual([], request.items)
+
+
+    def test_fromElementPublishItems(self):
+        """
+        Test parsing a publish request with items.
+        """
+
+        xml = """
+        <iq type='set' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <publish node='test'>
+              <item id="item1"/>
+              <item id="item2"/>
+            </publish>
+          </pubsub>
+        </iq>
+        """
+
+        request = pubsub.PubSubRequest.fromElement(parseXml(xml))
+        self.assertEqual(2, len(request.items))
+        self.assertEqual(u'item1', request.items[0]["id"])
+        self.assertEqual(u'item2', request.items[1]["id"])
+
+
+    def test_fromElementPublishNoNode(self):
+        """
+        A publish request to the root node should raise an exception.
+        """
+        xml = """
+        <iq type='set' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <publish/>
+          </pubsub>
+        </iq>
+        """
+
+        err = self.assertRaises(error.StanzaError,
+                                pubsub.PubSubRequest.fromElement,
+                                parseXml(xml))
+        self.assertEqual('bad-request', err.condition)
+        self.assertEqual(NS_PUBSUB_ERRORS, err.appCondition.uri)
+        self.assertEqual('nodeid-required', err.appCondition.name)
+
+
+    def test_fromElementSubscribe(self):
+        """
+        Test parsing a subscription request.
+        """
+
+        xml = """
+        <iq type='set' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <subscribe node='test' jid='user@example.org/Home'/>
+          </pubsub>
+        </iq>
+        """
+
+        request = pubsub.PubSubRequest.fromElement(parseXml(xml))
+        self.assertEqual('subscribe', request.verb)
+        self.assertEqual(JID('user@example.org'), request.sender)
+        self.assertEqual(JID('pubsub.example.org'), request.recipient)
+        self.assertEqual('test', request.nodeIdentifier)
+        self.assertEqual(JID('user@example.org/Home'), request.subscriber)
+
+
+    def test_fromElementSubscribeEmptyNode(self):
+        """
+        Test parsing a subscription request to the root node.
+        """
+
+        xml = """
         <iq type='set' to='pubsub.example.org'
                        from='user@example.org'>
           <pubsub xmlns='http://jabber.org/protocol/pubsub'>
@@ -1215,6 +1925,219 @@ class PubSubRequestTest(unittest.TestCase):
 
 
 
+class SerializedItemTest(unittest.TestCase):
+    """
+    Tests for L{pubsub.SerializedItem}.
+    """
+
+    def setUp(self):
+        element = pubsub.Item('item1')
+        element.addElement(('http://example.org/', 'entry'),
+                           content=u'\u00e9')
+        self.item = pubsub.SerializedItem.fromElement(element)
+
+
+    def test_fromElement(self):
+        """
+        The item is kept UTF-8 encoded, without a namespace of its own.
+        """
+        self.assertEqual("<item id='item1'>"
+                         "<entry xmlns='http://example.org/'>\xc3\xa9</entry>"
+                         "</item>", self.item.data)
+        self.assertEqual('item1', self.item.itemIdentifier)
+        self.assertEqual(NS_PUBSUB, self.item.uri)
+
+
+    def test_fromElementPayloadNamespace(self):
+        """
+        Payload in the namespace of the item keeps its namespace when the
+        item is added to another namespace.
+        """
+        element = parseXml("<item xmlns='%s' id='item1'><entry/></item>" %
+                           NS_PUBSUB)
+        item = pubsub.SerializedItem.fromElement(element)
+        self.assertEqual("<item id='item1'><entry xmlns='%s'/></item>" %
+                         NS_PUBSUB, item.data)
+
+        item.uri = NS_PUBSUB_EVENT
+        element = item.toElement()
+        self.assertEqual(NS_PUBSUB_EVENT, element.uri)
+        self.assertEqual(NS_PUBSUB, element.entry.uri)
+
+
+    def test_fromElementParsedNonASCII(self):
+        """
+        Parsed items with non-ASCII payload survive the round trip.
+        """
+        xml = (u"<item xmlns='%s' id='1'>"
+               u"<entry xmlns='urn:x'>caf\u00e9</entry>"
+               u"</item>" % NS_PUBSUB)
+        element = parseXml(xml.encode('utf-8'))
+        item = pubsub.SerializedItem.fromElement(element)
+        self.assertEqual(str, type(item.uri))
+
+        element = item.toElement()
+        self.assertEqual(NS_PUBSUB, element.uri)
+        self.assertEqual(u'caf\u00e9', unicode(element.entry))
+        self.assertEqual(u'caf\u00e9', unicode(item.entry))
+
+        item = pubsub.SerializedItem(item.data, '1', unicode(NS_PUBSUB))
+        self.assertEqual(u'caf\u00e9', unicode(item.toElement().entry))
+
+
+    def test_toXml(self):
+        """
+        The serialized item is returned as unicode.
+        """
+        self.assertEqual(self.item.data.decode('utf-8'), self.item.toXml())
+
+
+    def test_toXmlArguments(self):
+        """
+        With arguments, the item is serialized like an element.
+        """
+        self.assertEqual(self.item.toElement().toXml(defaultUri=NS_PUBSUB),
+                         self.item.toXml(defaultUri=NS_PUBSUB))
+        self.assertEqual(u"<item xmlns='%s' id='item1'>"
+                         u"<entry xmlns='http://example.org/'>\u00e9</entry>"
+                         u"</item>" % NS_PUBSUB,
+                         self.item.toXml(closeElement=1))
+
+
+    def test_toElement(self):
+        """
+        The element is built in the namespace of the item.
+        """
+        item = pubsub.SerializedItem(self.item.data, 'item1',
+                                     NS_PUBSUB_EVENT)
+        element = item.toElement()
+        self.assertEqual((NS_PUBSUB_EVENT, 'item'),
+                         (element.uri, element.name))
+        self.assertEqual('item1', element['id'])
+        self.assertEqual(u'\u00e9', unicode(element.entry))
+
+
+    def test_attributes(self):
+        """
+        The identifier is known without building the element, other
+        attributes are looked up on a newly built element.
+        """
+        self.assertEqual('item1', self.item['id'])
+        self.assertEqual('item1', self.item.getAttribute('id'))
+        self.assertEqual('item', self.item.name)
+        self.assertEqual(u'\u00e9', unicode(self.item.entry))
+        self.assertEqual(['entry'],
+                         [child.name for child in self.item.elements()])
+        self.assertRaises(AttributeError, getattr, self.item, '__getstate__')
+
+
+    def test_readOnly(self):
+        """
+        Changing a serialized item raises an error.
+        """
+        self.assertRaises(TypeError, self.item.__setitem__, 'id', 'item2')
+        self.assertRaises(TypeError, self.item.__delitem__, 'id')
+        self.assertRaises(TypeError, getattr, self.item, 'addElement')
+        self.assertRaises(AttributeError, setattr, self.item, 'children', [])
+
+
+
+class ConfigurationSchemaTest(unittest.TestCase):
+    """
+    Tests for L{pubsub.ConfigurationSchema}.
+    """
+
+    def setUp(self):
+        self.options = {
+            'pubsub#persist_items':
+                {'type': 'boolean',
+                 'label': 'Persist items to storage'},
+            'pubsub#owner':
+                {'type': 'jid-single',
+                 'label': 'Owner of the node'},
+            'pubsub#publish_model':
+                {'type': 'list-single',
+                 'label': 'Who may publish items',
+                 'options': {'publishers': 'Owners and publishers',
+                             'open': 'Anyone'}},
+            'pubsub#collection':
+                {'type': 'text-multi'},
+            }
+        self.schema = pubsub.ConfigurationSchema(self.options)
+        self.values = {'pubsub#persist_items': '1',
+                       'pubsub#owner': 'user@example.org',
+                       'pubsub#publish_model': 'open',
+                       'pubsub#collection': ['a', 'b'],
+                       'x-myfield': 'x'}
+
+
+    def test_check(self):
+        """
+        Values are type checked and unknown options dropped.
+        """
+        values = self.schema.check(self.values)
+        self.assertEqual({'pubsub#persist_items': True,
+                          'pubsub#owner': JID('user@example.org'),
+                          'pubsub#publish_model': 'open',
+                          'pubsub#collection': ['a', 'b']}, values)
+
+
+    def test_checkInvalid(self):
+        """
+        An invalid value raises an exception and leaves the field reusable.
+        """
+        self.assertRaises(ValueError, self.schema.check,
+                          {'pubsub#persist_items': 'maybe'})
+        self.assertEqual([], self.schema.fields['pubsub#persist_items'].values)
+        self.assertEqual({'pubsub#persist_items': False},
+                         self.schema.check({'pubsub#persist_items': '0'}))
+
+
+    def test_render(self):
+        """
+        The rendered form is the same as one built from new fields.
+        """
+        fields = []
+        for name, value in self.values.iteritems():
+            if name not in self.options:
+                continue
+            option = dict(self.options[name], var=name)
+            if isinstance(value, list):
+                option['values'] = value
+            else:
+                option['value'] = value
+            fields.append(data_form.Field.fromDict(option))
+        form = data_form.Form(formType='form',
+                              formNamespace=NS_PUBSUB_CONFIG,
+                              fields=fields)
+
+        self.assertEqual(form.toElement().toXml(),
+                         self.schema.render(self.values).toXml())
+
+
+    def test_renderTwice(self):
+        """
+        Rendering does not leave values behind in the pre-rendered fields.
+        """
+        self.schema.render(self.values)
+        element = self.schema.render({'pubsub#collection': []})
+        form = data_form.Form.fromElement(element)
+        self.assertEqual(NS_PUBSUB_CONFIG, form.formNamespace)
+        self.assertEqual(['pubsub#collection'], form.fields.keys())
+        self.assertEqual([], form.fields['pubsub#collection'].values)
+
+
+    def test_formNamespace(self):
+        """
+        Rendered forms carry the form namespace of the schema.
+        """
+        schema = pubsub.ConfigurationSchema(self.options,
+                                            NS_PUBSUB_SUBSCRIBE_OPTIONS)
+        form = data_form.Form.fromElement(schema.render(self.values))
+        self.assertEqual(NS_PUBSUB_SUBSCRIBE_OPTIONS, form.formNamespace)
+
+
+
 class PubSubServiceTest(unittest.TestCase, TestableRequestHandlerMixin):
     """
     Tests for L{pubsub.PubSubService}.
@@ -1339,44 +2262,160 @@ class PubSubServiceTest(unittest.TestCase, TestableRequestHandlerMixin):
         return d
 
 
-    def test_getDiscoItemsRoot(self):
+    def test_getDiscoInfoCached(self):
         """
-        Test getDiscoItems on the root node.
+        With caching enabled, node information is only retrieved once.
         """
-        def getNodes(requestor, service, nodeIdentifier):
-            return defer.succeed(['node1', 'node2'])
+        calls = []
 
-        def cb(items):
-            self.assertEqual(2, len(items))
-            item1, item2 = items
+        def getInfo(requestor, target, nodeIdentifier):
+            calls.append(nodeIdentifier)
+            return defer.succeed({'type': 'leaf', 'meta-data': []})
 
-            self.assertEqual(JID('pubsub.example.org'), item1.entity)
-            self.assertEqual('node1', item1.nodeIdentifier)
+        self.resource.getInfo = getInfo
+        self.service.cacheDiscoInfo = True
+        requestor = JID('user@example.org/home')
+        service = JID('pubsub.example.org')
 
-            self.assertEqual(JID('pubsub.example.org'), item2.entity)
-            self.assertEqual('node2', item2.nodeIdentifier)
+        results = []
+        for i in xrange(2):
+            d = self.service.getDiscoInfo(requestor, service, 'test')
+            d.addCallback(results.append)
+        self.assertEqual(['test'], calls)
+        self.assertEqual(results[0], results[1])
 
-        self.resource.getNodes = getNodes
-        d = self.service.getDiscoItems(JID('user@example.org/home'),
-                                       JID('pubsub.example.org'),
-                                       '')
-        d.addCallback(cb)
-        return d
+        self.service.invalidateDiscoInfo(service, 'test')
+        self.service.getDiscoInfo(requestor, service, 'test')
+        self.assertEqual(['test', 'test'], calls)
 
 
-    def test_getDiscoItemsRootHideNodes(self):
+    def test_getDiscoInfoCachedNotFound(self):
         """
-        Test getDiscoItems on the root node.
+        Information of non-existent nodes is not cached.
         """
-        def getNodes(requestor, service, nodeIdentifier):
-            raise Exception("Unexpected call to getNodes")
+        calls = []
 
-        def cb(items):
-            self.assertEqual([], items)
+        def getInfo(requestor, target, nodeIdentifier):
+            calls.append(nodeIdentifier)
+            return defer.succeed(None)
 
-        self.service.hideNodes = True
-        self.resource.getNodes = getNodes
-        d = self.service.getDiscoItems(JID('user@example.org/home'),
+        self.resource.getInfo = getInfo
+        self.service.cacheDiscoInfo = True
+        requestor = JID('user@example.org/home')
+        service = JID('pubsub.example.org')
+
+        self.service.getDiscoInfo(requestor, service, 'test')
+        self.service.getDiscoInfo(requestor, service, 'test')
+        self.assertEqual(['test', 'test'], calls)
+
+
+    def test_getDiscoInfoCachedInvalidatedWhilePending(self):
+        """
+        Information retrieved before an invalidation is not cached.
+        """
+        pending = defer.Deferred()
+        self.resource.getInfo = lambda requestor, target, node: pending
+        self.service.cacheDiscoInfo = True
+        service = JID('pubsub.example.org')
+
+        self.service.getDiscoInfo(JID('user@example.org/home'),
+                                  service, 'test')
+        self.service.invalidateDiscoInfo(service, 'test')
+        pending.callback({'type': 'leaf', 'meta-data': []})
+        self.assertEqual({}, self.service._discoInfo)
+
+
+    def test_getDiscoInfoCachedMaximum(self):
+        """
+        The number of cached nodes is bounded by maxDiscoInfo.
+        """
+        def getInfo(requestor, target, nodeIdentifier):
+            return defer.succeed({'type': 'leaf', 'meta-data': []})
+
+        self.resource.getInfo = getInfo
+        self.service.cacheDiscoInfo = True
+        self.service.maxDiscoInfo = 2
+        for node in ('a', 'b', 'c'):
+            self.service.getDiscoInfo(JID('user@example.org/home'),
+                                      JID('pubsub.example.org'), node)
+        self.assertEqual(2, len(self.service._discoInfo))
+
+
+    def test_on_configureSetInvalidatesDiscoInfo(self):
+        """
+        Configuring a node drops its cached service discovery information.
+        """
+        xml = """
+        <iq type='set' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub#owner'>
+            <configure node='test'>
+              <x xmlns='jabber:x:data' type='submit'>
+                <field var='FORM_TYPE' type='hidden'>
+                  <value>http://jabber.org/protocol/pubsub#node_config</value>
+                </field>
+                <field var='pubsub#deliver_payloads'><value>0</value></field>
+              </x>
+            </configure>
+          </pubsub>
+        </iq>
+        """
+
+        def getConfigurationOptions():
+            return {
+                "pubsub#deliver_payloads":
+                    {"type": "boolean",
+                     "label": "Deliver payloads with event notifications"},
+                }
+
+        key = (JID('pubsub.example.org'), 'test')
+        self.service._discoInfo[key] = []
+        self.resource.getConfigurationOptions = getConfigurationOptions
+        self.resource.configureSet = lambda request: defer.succeed(None)
+        d = self.handleRequest(xml)
+        d.addCallback(lambda _: self.assertNotIn(key,
+                                                 self.service._discoInfo))
+        return d
+
+
+    def test_getDiscoItemsRoot(self):
+        """
+        Test getDiscoItems on the root node.
+        """
+        def getNodes(requestor, service, nodeIdentifier):
+            return defer.succeed(['node1', 'node2'])
+
+        def cb(items):
+            self.assertEqual(2, len(items))
+            item1, item2 = items
+
+            self.assertEqual(JID('pubsub.example.org'), item1.entity)
+            self.assertEqual('node1', item1.nodeIdentifier)
+
+            self.assertEqual(JID('pubsub.example.org'), item2.entity)
+            self.assertEqual('node2', item2.nodeIdentifier)
+
+        self.resource.getNodes = getNodes
+        d = self.service.getDiscoItems(JID('user@example.org/home'),
+                                       JID('pubsub.example.org'),
+                                       '')
+        d.addCallback(cb)
+        return d
+
+
+    def test_getDiscoItemsRootHideNodes(self):
+        """
+        Test getDiscoItems on the root node.
+        """
+        def getNodes(requestor, service, nodeIdentifier):
+            raise Exception("Unexpected call to getNodes")
+
+        def cb(items):
+            self.assertEqual([], items)
+
+        self.service.hideNodes = True
+        self.resource.getNodes = getNodes
+        d = self.service.getDiscoItems(JID('user@example.org/home'),
                                        JID('pubsub.example.org'),
                                        '')
         d.addCallback(cb)
@@ -1933,6 +2972,276 @@ class PubSubServiceTest(unittest.TestCase, TestableRequestHandlerMixin):
         return d
 
 
+    def test_getSchema(self):
+        """
+        The configuration schema is compiled once per resource, and again
+        when the options change.
+        """
+        options = {'pubsub#persist_items': {'type': 'boolean'}}
+        self.resource.getConfigurationOptions = lambda: options
+
+        schema = self.service._getSchema(self.resource)
+        self.assertIdentical(options, schema.options)
+        self.assertIdentical(schema, self.service._getSchema(self.resource))
+
+        options = {'pubsub#persist_items': {'type': 'boolean'}}
+        self.assertIdentical(schema, self.service._getSchema(self.resource))
+
+        options = {'pubsub#deliver_payloads': {'type': 'boolean'}}
+        newSchema = self.service._getSchema(self.resource)
+        self.assertNotIdentical(schema, newSchema)
+        self.assertIdentical(options, newSchema.options)
+
+
+    def test_getSchemaResourceGone(self):
+        """
+        Schemas are dropped along with their resource.
+        """
+        resource = pubsub.PubSubResource()
+        self.service._getSchema(resource)
+        self.assertEqual(1, len(self.service._schemas))
+
+        del resource
+        self.assertEqual(0, len(self.service._schemas))
+
+
+    def test_getSchemaSubscriptionOptions(self):
+        """
+        Subscription options are compiled into a separate schema.
+        """
+        options = {'pubsub#digest': {'type': 'boolean'}}
+        self.resource.getSubscriptionOptions = lambda: options
+
+        schema = self.service._getSchema(self.resource,
+                                         NS_PUBSUB_SUBSCRIBE_OPTIONS)
+        self.assertIdentical(options, schema.options)
+        self.assertEqual(NS_PUBSUB_SUBSCRIBE_OPTIONS, schema.formNamespace)
+        self.assertNotIdentical(schema,
+                                self.service._getSchema(self.resource))
+
+
+    def test_on_optionsGetSchema(self):
+        """
+        The subscription options are returned in a form with all known
+        options.
+        """
+        xml = """
+        <iq type='get' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <options node='test' jid='user@example.org'/>
+          </pubsub>
+        </iq>
+        """
+
+        def getSubscriptionOptions():
+            return {'pubsub#digest': {'type': 'boolean'},
+                    'pubsub#digest_frequency': {'type': 'text-single'}}
+
+        def optionsGet(request):
+            return defer.succeed({'pubsub#digest': True})
+
+        def cb(element):
+            self.assertEqual('test', element.options['node'])
+            self.assertEqual('user@example.org', element.options['jid'])
+            form = data_form.Form.fromElement(element.options.x)
+            self.assertEqual(NS_PUBSUB_SUBSCRIBE_OPTIONS, form.formNamespace)
+            self.assertEqual('form', form.formType)
+            self.assertEqual([u'true'],
+                             form.fields['pubsub#digest'].values)
+            self.assertEqual([],
+                             form.fields['pubsub#digest_frequency'].values)
+
+        self.resource.getSubscriptionOptions = getSubscriptionOptions
+        self.resource.optionsGet = optionsGet
+        d = self.handleRequest(xml)
+        d.addCallback(cb)
+        return d
+
+
+    def test_on_optionsSetChecked(self):
+        """
+        Submitted subscription options are checked before they are passed
+        to the resource.
+        """
+        xml = """
+        <iq type='set' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <options node='test' jid='user@example.org'>
+              <x xmlns='jabber:x:data' type='submit'>
+                <field var='FORM_TYPE' type='hidden'>
+                  <value>http://jabber.org/protocol/pubsub#subscribe_options</value>
+                </field>
+                <field var='pubsub#digest'><value>1</value></field>
+                <field var='x-unknown'><value>1</value></field>
+              </x>
+            </options>
+          </pubsub>
+        </iq>
+        """
+
+        def getSubscriptionOptions():
+            return {'pubsub#digest': {'type': 'boolean'}}
+
+        def optionsSet(request):
+            self.assertEqual({'pubsub#digest': True}, request.options)
+            return defer.succeed(None)
+
+        self.resource.getSubscriptionOptions = getSubscriptionOptions
+        self.resource.optionsSet = optionsSet
+        return self.handleRequest(xml)
+
+
+    def test_on_optionsSetInvalid(self):
+        """
+        Invalid subscription option values result in a bad request error.
+        """
+        xml = """
+        <iq type='set' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <options node='test' jid='user@example.org'>
+              <x xmlns='jabber:x:data' type='submit'>
+                <field var='FORM_TYPE' type='hidden'>
+                  <value>http://jabber.org/protocol/pubsub#subscribe_options</value>
+                </field>
+                <field var='pubsub#digest'><value>maybe</value></field>
+              </x>
+            </options>
+          </pubsub>
+        </iq>
+        """
+
+        def getSubscriptionOptions():
+            return {'pubsub#digest': {'type': 'boolean'}}
+
+        def cb(result):
+            self.assertEqual('bad-request', result.condition)
+
+        self.resource.getSubscriptionOptions = getSubscriptionOptions
+        d = self.handleRequest(xml)
+        self.assertFailure(d, error.StanzaError)
+        d.addCallback(cb)
+        return d
+
+
+    def test_on_optionsSetNoOptions(self):
+        """
+        Without subscription options declared by the resource, submitted
+        options are passed unchecked.
+        """
+        xml = """
+        <iq type='set' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <options node='test' jid='user@example.org'>
+              <x xmlns='jabber:x:data' type='submit'>
+                <field var='FORM_TYPE' type='hidden'>
+                  <value>http://jabber.org/protocol/pubsub#subscribe_options</value>
+                </field>
+                <field var='pubsub#digest'><value>1</value></field>
+              </x>
+            </options>
+          </pubsub>
+        </iq>
+        """
+
+        def optionsSet(request):
+            self.assertEqual({'pubsub#digest': u'1'}, request.options)
+            return defer.succeed(None)
+
+        self.resource.optionsSet = optionsSet
+        return self.handleRequest(xml)
+
+
+    def test_onAuthorization(self):
+        """
+        The answer of an owner to an authorization request changes the
+        subscription.
+        """
+        requests = []
+
+        def subscriptionsSet(request):
+            requests.append(request)
+            return defer.succeed(None)
+
+        self.resource.subscriptionsSet = subscriptionsSet
+        self.service.xmlstream = self.stub.xmlstream
+        self.service.connectionMade()
+        self.stub.xmlstream.dispatch(parseXml("""
+            <message from='owner@example.org/home' to='pubsub.example.org'>
+              <x xmlns='jabber:x:data' type='submit'>
+                <field var='FORM_TYPE' type='hidden'>
+                  <value>http://jabber.org/protocol/pubsub#subscribe_authorization</value>
+                </field>
+                <field var='pubsub#node'><value>test</value></field>
+                <field var='pubsub#subscriber_jid'>
+                  <value>user@example.org/home</value>
+                </field>
+                <field var='pubsub#allow'><value>true</value></field>
+              </x>
+            </message>
+            """))
+
+        self.assertEqual(1, len(requests))
+        request = requests[0]
+        self.assertEqual('subscriptionsSet', request.verb)
+        self.assertEqual(JID('owner@example.org/home'), request.sender)
+        self.assertEqual(JID('pubsub.example.org'), request.recipient)
+        self.assertEqual('test', request.nodeIdentifier)
+        [subscription] = request.subscriptions
+        self.assertEqual(JID('user@example.org/home'),
+                         subscription.subscriber)
+        self.assertEqual('subscribed', subscription.state)
+
+
+    def test_onAuthorizationOtherForm(self):
+        """
+        Other submitted forms are left alone.
+        """
+        self.resource.subscriptionsSet = lambda request: self.fail()
+        self.service.xmlstream = self.stub.xmlstream
+        self.service.connectionMade()
+        message = parseXml("""
+            <message from='owner@example.org/home' to='pubsub.example.org'>
+              <x xmlns='jabber:x:data' type='submit'>
+                <field var='FORM_TYPE' type='hidden'>
+                  <value>urn:example:other</value>
+                </field>
+              </x>
+            </message>
+            """)
+        self.stub.xmlstream.dispatch(message)
+        self.assertFalse(getattr(message, 'handled', False))
+
+
+    def test_onAuthorizationNoSender(self):
+        """
+        Answers without a sender are left alone.
+        """
+        self.resource.subscriptionsSet = lambda request: self.fail()
+        self.service.xmlstream = self.stub.xmlstream
+        self.service.connectionMade()
+        message = parseXml("""
+            <message to='pubsub.example.org'>
+              <x xmlns='jabber:x:data' type='submit'>
+                <field var='FORM_TYPE' type='hidden'>
+                  <value>http://jabber.org/protocol/pubsub#subscribe_authorization</value>
+                </field>
+                <field var='pubsub#node'><value>test</value></field>
+                <field var='pubsub#subscriber_jid'>
+                  <value>user@example.org/home</value>
+                </field>
+                <field var='pubsub#allow'><value>true</value></field>
+              </x>
+            </message>
+            """)
+        self.stub.xmlstream.dispatch(message)
+        self.assertFalse(getattr(message, 'handled', False))
+        self.assertEqual([], self.flushLoggedErrors())
+
+
     def test_on_configureSet(self):
         """
         On a node configuration set request the Data Form is parsed and
@@ -2112,6 +3421,104 @@ class PubSubServiceTest(unittest.TestCase, TestableRequestHandlerMixin):
         return d
 
 
+    def test_on_itemsSerialized(self):
+        """
+        Serialized items are copied into the response as they are.
+        """
+        xml = """
+        <iq type='get' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <items node='test'/>
+          </pubsub>
+        </iq>
+        """
+
+        item = pubsub.SerializedItem("<item id='item1'>\xc3\xa9</item>",
+                                     'item1')
+
+        def items(request):
+            return defer.succeed([item])
+
+        def cb(element):
+            self.assertEqual(
+                u"<pubsub xmlns='http://jabber.org/protocol/pubsub'>"
+                u"<items node='test'>"
+                u"<item id='item1'>\u00e9</item>"
+                u"</items></pubsub>", element.toXml())
+
+        self.resource.items = items
+        d = self.handleRequest(xml)
+        d.addCallback(cb)
+        return d
+
+
+    def test_on_itemsIterable(self):
+        """
+        Items produced by an iterable, possibly deferred, are serialized
+        into the response.
+        """
+        xml = """
+        <iq type='get' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <items node='test'/>
+          </pubsub>
+        </iq>
+        """
+
+        def produce():
+            yield pubsub.Item('item1')
+            yield defer.succeed(pubsub.Item('item2', payload=u'\u00e9'))
+
+        def items(request):
+            return defer.succeed(produce())
+
+        def cb(element):
+            self.assertEqual(NS_PUBSUB, element.uri)
+            self.assertEqual(
+                u"<pubsub xmlns='http://jabber.org/protocol/pubsub'>"
+                u"<items node='test'>"
+                u"<item id='item1'/>"
+                u"<item id='item2'>\u00e9</item>"
+                u"</items></pubsub>", element.toXml())
+
+        self.resource.items = items
+        d = self.handleRequest(xml)
+        d.addCallback(cb)
+        return d
+
+
+    def test_on_itemsIterableFailure(self):
+        """
+        A failure while producing items results in an error response.
+        """
+        xml = """
+        <iq type='get' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+            <items node='test'/>
+          </pubsub>
+        </iq>
+        """
+
+        def produce():
+            yield pubsub.Item('item1')
+            yield defer.fail(error.StanzaError('forbidden'))
+
+        def items(request):
+            return defer.succeed(produce())
+
+        def cb(result):
+            self.assertEqual('forbidden', result.condition)
+
+        self.resource.items = items
+        d = self.handleRequest(xml)
+        self.assertFailure(d, error.StanzaError)
+        d.addCallback(cb)
+        return d
+
+
     def test_on_retract(self):
         """
         A retract request should result in L{PubSubResource.retract}
@@ -2161,6 +3568,88 @@ class PubSubServiceTest(unittest.TestCase, TestableRequestHandlerMixin):
         return self.handleRequest(xml)
 
 
+    def test_on_purgeIncremental(self):
+        """
+        A purge that returns an iterable is processed cooperatively, while
+        its progress is kept.
+        """
+        xml = """
+        <iq type='set' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub#owner'>
+            <purge node='test'/>
+          </pubsub>
+        </iq>
+        """
+
+        pending = defer.Deferred()
+
+        def purge(request):
+            return defer.succeed(iter([10, 10, pending]))
+
+        clock = task.Clock()
+        self.service = pubsub.PubSubService(self.resource, reactor=clock)
+        self.resource.purge = purge
+        service = JID('pubsub.example.org')
+        results = []
+
+        d = self.handleRequest(xml)
+        d.addCallback(results.append)
+        clock.advance(0)
+        self.assertEqual(20, self.service.getPurgeProgress(service, 'test'))
+        self.assertEqual([], results)
+
+        pending.callback(5)
+        clock.advance(0)
+        self.assertEqual([None], results)
+        self.assertIdentical(None,
+                             self.service.getPurgeProgress(service, 'test'))
+
+
+    def test_on_purgeIncrementalConcurrent(self):
+        """
+        Concurrent incremental purges of a node each keep their progress.
+        """
+        xml = """
+        <iq type='set' to='pubsub.example.org'
+                       from='user@example.org'>
+          <pubsub xmlns='http://jabber.org/protocol/pubsub#owner'>
+            <purge node='test'/>
+          </pubsub>
+        </iq>
+        """
+
+        pending = [defer.Deferred(), defer.Deferred()]
+
+        def purge(request):
+            return defer.succeed(iter([10, pending.pop(0)]))
+
+        clock = task.Clock()
+        self.service = pubsub.PubSubService(self.resource, reactor=clock)
+        self.resource.purge = purge
+        service = JID('pubsub.example.org')
+        first, second = pending
+        results = []
+
+        d1 = self.handleRequest(xml)
+        d1.addCallback(results.append)
+        d2 = self.handleRequest(xml)
+        d2.addCallback(results.append)
+        clock.advance(0)
+        self.assertEqual(20, self.service.getPurgeProgress(service, 'test'))
+
+        first.callback(5)
+        clock.advance(0)
+        self.assertEqual([None], results)
+        self.assertEqual(10, self.service.getPurgeProgress(service, 'test'))
+
+        second.callback(5)
+        clock.advance(0)
+        self.assertEqual([None, None], results)
+        self.assertIdentical(None,
+                             self.service.getPurgeProgress(service, 'test'))
+
+
     def test_on_delete(self):
         """
         A delete request should result in L{PubSubResource.delete} being
@@ -2340,6 +3829,325 @@ class PubSubServiceTest(unittest.TestCase, TestableRequestHandlerMixin):
 
 
 
+class PubSubServiceNotificationTest(unittest.TestCase):
+    """
+    Tests for sending notifications with L{pubsub.PubSubService}.
+    """
+
+    def setUp(self):
+        self.stub = XmlStreamStub()
+        self.clock = task.Clock()
+        self.service = pubsub.PubSubService(reactor=self.clock)
+        self.service.send = self.stub.xmlstream.send
+        self.serviceJID = JID('pubsub.example.org')
+        self.subscriber = JID('user@example.org')
+
+
+    def notify(self, itemIdentifiers, options=None):
+        subscription = pubsub.Subscription('test', self.subscriber,
+                                           'subscribed', options)
+        items = [pubsub.Item(itemIdentifier)
+                 for itemIdentifier in itemIdentifiers]
+        self.service.notifyPublish(self.serviceJID, 'test',
+                                   [(self.subscriber, [subscription], items)])
+
+
+    def itemIdentifiers(self, message):
+        return [item['id'] for item in message.event.items.elements()]
+
+
+    def test_notifyPublish(self):
+        """
+        Without digests, every publish is sent right away.
+        """
+        self.notify(['1'])
+        self.notify(['2'])
+        self.assertEqual(2, len(self.stub.output))
+        message = self.stub.output[0]
+        self.assertEqual('user@example.org', message['to'])
+        self.assertEqual('test', message.event.items['node'])
+        self.assertEqual(['1'], self.itemIdentifiers(message))
+
+
+    def test_notifyPublishSerialized(self):
+        """
+        Serialized items end up in notifications as they are.
+        """
+        subscription = pubsub.Subscription('test', self.subscriber,
+                                           'subscribed')
+        item = pubsub.SerializedItem("<item id='1'>\xc3\xa9</item>", '1',
+                                     NS_PUBSUB_EVENT)
+        self.service.notifyPublish(self.serviceJID, 'test',
+                                   [(self.subscriber, [subscription], [item])])
+
+        message = self.stub.output[0]
+        self.assertIn(u"<items node='test'><item id='1'>\u00e9</item></items>",
+                      message.toXml())
+
+
+    def test_notifyPending(self):
+        """
+        Every owner gets an authorization form for every pending
+        subscription.
+        """
+        owners = [JID('owner1@example.org'), JID('owner2@example.org')]
+        subscriptions = [
+            pubsub.Subscription('test', JID('user%d@example.org' % i),
+                                'pending')
+            for i in xrange(2)]
+        d = self.service.notifyPending(self.serviceJID, 'test', owners,
+                                       subscriptions)
+        self.clock.advance(0)
+
+        self.assertEqual(4, len(self.stub.output))
+        message = self.stub.output[1]
+        self.assertEqual('owner2@example.org', message['to'])
+        self.assertEqual('pubsub.example.org', message['from'])
+        form = data_form.Form.fromElement(message.x)
+        self.assertEqual(NS_PUBSUB_SUBSCRIBE_AUTHORIZATION,
+                         form.formNamespace)
+        self.assertEqual('form', form.formType)
+        self.assertEqual(u'test', form.fields['pubsub#node'].value)
+        self.assertEqual(u'user0@example.org',
+                         form.fields['pubsub#subscriber_jid'].value)
+        self.assertEqual(u'false', form.fields['pubsub#allow'].value)
+        self.assertNotIdentical(self.stub.output[0].x, message.x)
+        self.assertIdentical(message, message.x.parent)
+        return d
+
+
+    def test_notifySubscription(self):
+        subscription = pubsub.Subscription('test', self.subscriber,
+                                           'subscribed')
+        self.service.notifySubscription(self.serviceJID, 'test',
+                                        subscription)
+
+        message = self.stub.output[0]
+        self.assertEqual('user@example.org', message['to'])
+        element = message.event.subscription
+        self.assertEqual('test', element['node'])
+        self.assertEqual('user@example.org', element['jid'])
+        self.assertEqual('subscribed', element['subscription'])
+
+
+    def test_coalesceWindow(self):
+        """
+        Items published within the coalesce window are sent together.
+        """
+        self.service.coalesceWindow = 5
+        self.notify(['1'])
+        self.clock.advance(3)
+        self.notify(['2'])
+        self.assertEqual([], self.stub.output)
+
+        self.clock.advance(2)
+        self.assertEqual(1, len(self.stub.output))
+        self.assertEqual(['1', '2'],
+                         self.itemIdentifiers(self.stub.output[0]))
+
+        self.notify(['3'])
+        self.clock.advance(5)
+        self.assertEqual(2, len(self.stub.output))
+
+
+    def test_coalesceRepublish(self):
+        """
+        Only the last version of an item republished in a window is sent.
+        """
+        self.service.coalesceWindow = 5
+        self.notify(['1', '2'])
+        self.notify(['1'])
+        self.clock.advance(5)
+        self.assertEqual(['2', '1'],
+                         self.itemIdentifiers(self.stub.output[0]))
+
+
+    def test_digestOption(self):
+        """
+        Subscriptions with the digest option get digests at their frequency.
+        """
+        options = {'pubsub#digest': True,
+                   'pubsub#digest_frequency': '10000'}
+        self.notify(['1'], options)
+        self.notify(['2'], options)
+        self.clock.advance(9)
+        self.assertEqual([], self.stub.output)
+        self.clock.advance(1)
+        self.assertEqual(['1', '2'],
+                         self.itemIdentifiers(self.stub.output[0]))
+
+
+    def test_digestDefaultFrequency(self):
+        self.service.defaultDigestFrequency = 2000
+        self.notify(['1'], {'pubsub#digest': 'true'})
+        self.clock.advance(2)
+        self.assertEqual(1, len(self.stub.output))
+
+
+    def test_flushDigests(self):
+        self.service.coalesceWindow = 5
+        self.notify(['1'])
+        self.service.flushDigests()
+        self.assertEqual(1, len(self.stub.output))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_notifyDeleteFlushes(self):
+        """
+        Collected items are sent before the node's delete notification.
+        """
+        self.service.coalesceWindow = 5
+        self.notify(['1'])
+        self.service.notifyDelete(self.serviceJID, 'test', [self.subscriber])
+        self.assertEqual(['items', 'delete'],
+                         [message.event.firstChildElement().name
+                          for message in self.stub.output])
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+
+    def sendPresence(self, sender, presenceType=None):
+        presence = domish.Element((None, 'presence'))
+        presence['from'] = sender
+        presence['to'] = 'pubsub.example.org'
+        if presenceType:
+            presence['type'] = presenceType
+        self.stub.send(presence)
+
+
+    def setUpPresence(self):
+        self.service.presenceBasedDelivery = True
+        protocol = pubsub.SubscriberPresenceProtocol(self.service)
+        protocol.xmlstream = self.stub.xmlstream
+        protocol.connectionInitialized()
+
+
+    def test_presenceBasedDelivery(self):
+        """
+        Unavailable subscribers are not notified.
+        """
+        self.setUpPresence()
+        self.notify(['1'])
+        self.assertEqual([], self.stub.output)
+        self.assertEqual(1, self.service.suppressed)
+
+        self.sendPresence('user@example.org/home')
+        self.notify(['2'])
+        self.assertEqual(1, len(self.stub.output))
+
+        self.sendPresence('user@example.org/home', 'unavailable')
+        self.notify(['3'])
+        self.assertEqual(1, len(self.stub.output))
+
+
+    def test_presenceBasedDeliveryOption(self):
+        """
+        The subscription option overrides the service default.
+        """
+        self.setUpPresence()
+        self.notify(['1'], {'pubsub#presence_based_delivery': 'false'})
+        self.assertEqual(1, len(self.stub.output))
+
+
+    def test_holdOffline(self):
+        """
+        Held notifications are sent when the subscriber becomes available.
+        """
+        self.setUpPresence()
+        self.service.holdOffline = True
+        self.service.maxHeld = 2
+        self.notify(['1'])
+        self.notify(['2'])
+        self.notify(['3'])
+        self.assertEqual([], self.stub.output)
+
+        self.sendPresence('user@example.org/home')
+        self.assertEqual([['2'], ['3']],
+                         [self.itemIdentifiers(message)
+                          for message in self.stub.output
+                          if message.name == 'message'])
+
+
+    def test_subscriberPresence(self):
+        """
+        Bare JIDs are available if any resource is.
+        """
+        presence = pubsub.SubscriberPresence()
+        presence.setAvailable(JID('user@example.org/home'), True)
+        presence.setAvailable(JID('user@example.org/work'), True)
+        presence.setAvailable(JID('user@example.org/home'), False)
+
+        self.assertTrue(presence.isAvailable(JID('user@example.org')))
+        self.assertTrue(presence.isAvailable(JID('user@example.org/work')))
+        self.assertFalse(presence.isAvailable(JID('user@example.org/home')))
+
+        presence.setAvailable(JID('user@example.org'), False)
+        self.assertFalse(presence.isAvailable(JID('user@example.org')))
+
+
+    def test_notifyRetract(self):
+        """
+        Retractions are sent in batches, cooperatively.
+        """
+        self.service.retractBatchSize = 2
+        subscription = pubsub.Subscription('test', self.subscriber,
+                                           'subscribed')
+        retractions = []
+        for itemIdentifier in ('1', '2', '3'):
+            retraction = domish.Element((NS_PUBSUB_EVENT, 'retract'))
+            retraction['id'] = itemIdentifier
+            retractions.append(retraction)
+
+        d = self.service.notifyRetract(self.serviceJID, 'test',
+                                       [(self.subscriber, [subscription],
+                                         retractions)])
+        self.assertEqual([], self.stub.output)
+        self.clock.advance(0)
+        self.assertEqual(2, len(self.stub.output))
+        self.assertEqual([['1', '2'], ['3']],
+                         [self.itemIdentifiers(message)
+                          for message in self.stub.output])
+        self.assertEqual('retract',
+                         self.stub.output[0].event.items.retract.name)
+        return d
+
+
+    def test_notifyPurge(self):
+        """
+        Pending digests are sent before the purge notifications.
+        """
+        self.notify(['1'], {'pubsub#digest': True})
+        other = JID('other@example.org')
+        d = self.service.notifyPurge(self.serviceJID, 'test',
+                                     [self.subscriber, other])
+        self.clock.advance(0)
+
+        self.assertEqual(3, len(self.stub.output))
+        self.assertEqual(['1'], self.itemIdentifiers(self.stub.output[0]))
+        message = self.stub.output[2]
+        self.assertEqual('other@example.org', message['to'])
+        self.assertEqual('test', message.event.purge['node'])
+        return d
+
+
+    def test_notifyPurgeCollection(self):
+        """
+        Purges notified through a collection carry a Collection header.
+        """
+        subscription = pubsub.Subscription('collection', self.subscriber,
+                                           'subscribed')
+        d = self.service.notifyPurge(self.serviceJID, 'test',
+                                     [(self.subscriber, [subscription])])
+        self.clock.advance(0)
+
+        message = self.stub.output[-1]
+        self.assertEqual('test', message.event.purge['node'])
+        self.assertEqual({'Collection': ['collection']},
+                         shim.extractHeaders(message))
+        return d
+
+
+
 class PubSubServiceWithoutResourceTest(unittest.TestCase, TestableRequestHandlerMixin):
 
     def setUp(self):
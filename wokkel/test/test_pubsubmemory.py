@@ -0,0 +1,806 @@
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+Tests for L{wokkel.pubsubmemory}.
+"""
+
+import cPickle as pickle
+import os
+
+from zope.interface import verify
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import error
+from twisted.words.protocols.jabber.jid import JID
+
+from wokkel import iwokkel, pubsub
+from wokkel.pubsubmemory import MemoryPubSubResource
+
+SERVICE = JID('pubsub.example.org')
+OWNER = JID('owner@example.org/home')
+USER = JID('user@example.org/home')
+
+class FakeService(object):
+
+    def __init__(self):
+        self.published = []
+        self.retracted = []
+        self.purged = []
+        self.deleted = []
+        self.pending = []
+        self.subscriptions = []
+
+
+    def notifyPublish(self, service, nodeIdentifier, notifications):
+        self.published.append((service, nodeIdentifier, notifications))
+
+
+    def notifyRetract(self, service, nodeIdentifier, notifications):
+        self.retracted.append((service, nodeIdentifier, notifications))
+        return defer.succeed(None)
+
+
+    def notifyPurge(self, service, nodeIdentifier, subscribers):
+        self.purged.append((service, nodeIdentifier, subscribers))
+        return defer.succeed(None)
+
+
+    def notifyDelete(self, service, nodeIdentifier, subscribers,
+                           redirectURI=None):
+        self.deleted.append((service, nodeIdentifier, subscribers))
+
+
+    def notifyPending(self, service, nodeIdentifier, owners, subscriptions):
+        self.pending.append((service, nodeIdentifier, owners, subscriptions))
+        return defer.succeed(None)
+
+
+    def notifySubscription(self, service, nodeIdentifier, subscription):
+        self.subscriptions.append((service, nodeIdentifier, subscription))
+
+
+
+def makeRequest(verb, sender=OWNER, nodeIdentifier='test', **kwargs):
+    request = pubsub.PubSubRequest(verb)
+    request.sender = sender
+    request.recipient = SERVICE
+    request.nodeIdentifier = nodeIdentifier
+    for key, value in kwargs.iteritems():
+        setattr(request, key, value)
+    return request
+
+
+
+def makeItem(itemIdentifier, text=u'payload'):
+    item = pubsub.Item(itemIdentifier)
+    item.addElement(('http://example.org/', 'entry'), content=text)
+    return item
+
+
+
+class MemoryPubSubResourceTest(unittest.TestCase):
+    """
+    Tests for L{MemoryPubSubResource}.
+    """
+
+    def setUp(self):
+        self.resource = MemoryPubSubResource()
+        self.service = FakeService()
+        self.resource.pubsubService = self.service
+        return self.resource.create(makeRequest('create'))
+
+
+    def publish(self, *itemIdentifiers, **kwargs):
+        items = [makeItem(itemIdentifier)
+                 for itemIdentifier in itemIdentifiers]
+        return self.resource.publish(makeRequest('publish', items=items,
+                                                 **kwargs))
+
+
+    def itemIdentifiers(self, items):
+        return [item['id'] for item in items]
+
+
+    def test_interface(self):
+        verify.verifyObject(iwokkel.IPubSubResource, self.resource)
+
+
+    def test_createConflict(self):
+        d = self.resource.create(makeRequest('create'))
+        self.assertFailure(d, error.StanzaError)
+        d.addCallback(lambda exc: self.assertEqual('conflict', exc.condition))
+        return d
+
+
+    def test_createInstant(self):
+        """
+        Nodes created without identifier get one assigned.
+        """
+        d = self.resource.create(makeRequest('create', nodeIdentifier=None))
+        d.addCallback(lambda nodeIdentifier:
+                      self.assertIn(nodeIdentifier, self.resource.nodes))
+        return d
+
+
+    def test_createOwner(self):
+        """
+        The creator of a node becomes its owner.
+        """
+        d = self.resource.affiliations(makeRequest('affiliations'))
+        d.addCallback(self.assertEqual, [('test', 'owner')])
+        return d
+
+
+    def test_publishItems(self):
+        """
+        Published items can be retrieved, oldest first.
+        """
+        self.publish('1', '2', '3')
+        d = self.resource.items(makeRequest('items'))
+        d.addCallback(self.itemIdentifiers)
+        d.addCallback(self.assertEqual, ['1', '2', '3'])
+        return d
+
+
+    def test_publishRepublish(self):
+        """
+        Republishing an item makes it the most recent one.
+        """
+        self.publish('1', '2')
+        self.publish('1')
+        d = self.resource.items(makeRequest('items', maxItems=1))
+        d.addCallback(self.itemIdentifiers)
+        d.addCallback(self.assertEqual, ['1'])
+        return d
+
+
+    def test_publishSerialized(self):
+        """
+        Items are stored serialized, and sent in notifications as they are.
+        """
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER))
+        self.publish('1')
+
+        item = self.resource.nodes['test'].items['1'][1]
+        self.assertIsInstance(item, pubsub.SerializedItem)
+        notifications = self.service.published[0][2]
+        eventItem = notifications[0][2][0]
+        self.assertIsInstance(eventItem, pubsub.SerializedItem)
+        self.assertIdentical(item.data, eventItem.data)
+        self.assertEqual(pubsub.NS_PUBSUB_EVENT, eventItem.uri)
+
+
+    def test_publishNoIdentifier(self):
+        """
+        Items without identifier get one assigned.
+        """
+        self.resource.publish(makeRequest('publish', items=[pubsub.Item()]))
+        self.assertEqual(1, len(self.resource.nodes['test'].items))
+
+
+    def test_publishForbidden(self):
+        """
+        Entities without publisher affiliation cannot publish.
+        """
+        d = self.publish('1', sender=USER)
+        self.assertFailure(d, error.StanzaError)
+        return d
+
+
+    def test_publishUnknownNode(self):
+        d = self.publish('1', nodeIdentifier='unknown')
+        self.assertFailure(d, error.StanzaError)
+        d.addCallback(lambda exc: self.assertEqual('item-not-found',
+                                                   exc.condition))
+        return d
+
+
+    def test_maxItems(self):
+        """
+        Only the configured maximum number of items is kept.
+        """
+        self.resource.configureSet(makeRequest(
+            'configureSet', options={'pubsub#max_items': '2'}))
+        self.publish('1', '2', '3')
+        self.assertEqual(['2', '3'],
+                         self.resource.nodes['test'].getItemIdentifiers())
+
+
+    def test_maxItemsInvalid(self):
+        """
+        A maximum number of items that is not a non-negative integer is
+        rejected.
+        """
+        d1 = self.resource.configureSet(makeRequest(
+            'configureSet', options={'pubsub#max_items': 'many'}))
+        self.assertFailure(d1, pubsub.BadRequest)
+        d2 = self.resource.configureSet(makeRequest(
+            'configureSet', options={'pubsub#max_items': '-1'}))
+        self.assertFailure(d2, pubsub.BadRequest)
+        d3 = self.resource.create(makeRequest(
+            'create', nodeIdentifier='other',
+            options={'pubsub#max_items': 'many'}))
+        self.assertFailure(d3, pubsub.BadRequest)
+
+        def cb(result):
+            self.assertEqual('0',
+                self.resource.nodes['test'].config['pubsub#max_items'])
+            self.assertNotIn('other', self.resource.nodes)
+
+        d = defer.gatherResults([d1, d2, d3])
+        d.addCallback(cb)
+        return d
+
+
+    def test_itemsByIdentifier(self):
+        self.publish('1', '2')
+        d = self.resource.items(makeRequest('items',
+                                            itemIdentifiers=['2', '3']))
+        d.addCallback(self.itemIdentifiers)
+        d.addCallback(self.assertEqual, ['2'])
+        return d
+
+
+    def test_notifyPublish(self):
+        """
+        Subscribers are notified of published items.
+        """
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER))
+        self.publish('1')
+
+        service, nodeIdentifier, notifications = self.service.published[0]
+        self.assertEqual(SERVICE, service)
+        self.assertEqual('test', nodeIdentifier)
+        [(subscriber, subscriptions, items)] = notifications
+        self.assertEqual(USER, subscriber)
+        self.assertEqual(pubsub.NS_PUBSUB_EVENT, items[0].uri)
+        self.assertEqual('1', items[0]['id'])
+        self.assertEqual(u'payload', unicode(items[0].entry))
+
+
+    def test_notifyNoPayloads(self):
+        """
+        Payloads are left out of notifications if so configured.
+        """
+        self.resource.configureSet(makeRequest(
+            'configureSet', options={'pubsub#deliver_payloads': False}))
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER))
+        self.publish('1')
+        items = self.service.published[0][2][0][2]
+        self.assertIdentical(None, items[0].firstChildElement())
+
+
+    def test_retract(self):
+        """
+        Retracted items are removed and subscribers notified.
+        """
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER))
+        self.publish('1', '2')
+        self.resource.retract(makeRequest('retract', itemIdentifiers=['1']))
+
+        self.assertEqual(['2'],
+                         self.resource.nodes['test'].getItemIdentifiers())
+        items = self.service.retracted[-1][2][0][2]
+        self.assertEqual('retract', items[0].name)
+
+
+    def test_retractNotifyFailed(self):
+        """
+        Failures to send retract notifications are logged.
+        """
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER))
+        self.publish('1')
+        self.service.notifyRetract = lambda *args: defer.fail(
+                RuntimeError("Oops"))
+        d = self.resource.retract(makeRequest('retract',
+                                              itemIdentifiers=['1']))
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
+        return d
+
+
+    def test_retractOthersForbidden(self):
+        """
+        Publishers can only retract their own items.
+        """
+        self.resource.affiliationsSet(makeRequest(
+            'affiliationsSet', affiliations={USER: 'publisher'}))
+        self.publish('1')
+        d = self.resource.retract(makeRequest('retract', sender=USER,
+                                              itemIdentifiers=['1']))
+        self.assertFailure(d, error.StanzaError)
+        return d
+
+
+    def test_purge(self):
+        self.publish('1', '2')
+        self.resource.purge(makeRequest('purge'))
+        self.assertEqual([], self.resource.nodes['test'].getItems())
+
+
+    def test_purgeNotify(self):
+        """
+        Subscribers are notified of purges.
+        """
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER))
+        self.resource.purge(makeRequest('purge'))
+
+        [(service, nodeIdentifier, subscribers)] = self.service.purged
+        self.assertEqual((SERVICE, 'test'), (service, nodeIdentifier))
+        [(subscriber, subscriptions)] = subscribers
+        self.assertEqual(USER, subscriber)
+        self.assertEqual(['test'], [subscription.nodeIdentifier
+                                    for subscription in subscriptions])
+
+
+    def test_purgeNotifyFailed(self):
+        """
+        Failures to send purge notifications are logged.
+        """
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER))
+        self.service.notifyPurge = lambda *args: defer.fail(
+                RuntimeError("Oops"))
+        d = self.resource.purge(makeRequest('purge'))
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
+        return d
+
+
+    def test_subscribe(self):
+        d = self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                                subscriber=USER))
+
+        def cb(subscription):
+            self.assertEqual('subscribed', subscription.state)
+            self.assertEqual(USER, subscription.subscriber)
+            return self.resource.subscriptions(makeRequest('subscriptions',
+                                                           sender=USER))
+
+        def cb2(subscriptions):
+            self.assertEqual(['test'], [subscription.nodeIdentifier
+                                        for subscription in subscriptions])
+
+        d.addCallback(cb)
+        d.addCallback(cb2)
+        return d
+
+
+    def test_subscribeOtherJID(self):
+        d = self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                                subscriber=OWNER))
+        self.assertFailure(d, error.StanzaError)
+        return d
+
+
+    def test_subscribeOutcast(self):
+        self.resource.affiliationsSet(makeRequest(
+            'affiliationsSet', affiliations={USER: 'outcast'}))
+        d = self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                                subscriber=USER))
+        self.assertFailure(d, error.StanzaError)
+        return d
+
+
+    def test_unsubscribe(self):
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER))
+        self.resource.unsubscribe(makeRequest('unsubscribe', sender=USER,
+                                              subscriber=USER))
+        self.assertEqual({}, self.resource.nodes['test'].subscriptions)
+        d = self.resource.subscriptions(makeRequest('subscriptions',
+                                                    sender=USER))
+        d.addCallback(self.assertEqual, [])
+        return d
+
+
+    def test_unsubscribeNotSubscribed(self):
+        d = self.resource.unsubscribe(makeRequest('unsubscribe', sender=USER,
+                                                  subscriber=USER))
+        self.assertFailure(d, error.StanzaError)
+        return d
+
+
+    def test_options(self):
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER))
+        self.resource.optionsSet(makeRequest('optionsSet', sender=USER,
+                                             subscriber=USER,
+                                             options={'pubsub#digest': True}))
+        d = self.resource.optionsGet(makeRequest('optionsGet', sender=USER,
+                                                 subscriber=USER))
+        d.addCallback(self.assertEqual, {'pubsub#digest': True})
+        return d
+
+
+    def test_configure(self):
+        self.resource.configureSet(makeRequest(
+            'configureSet', options={'pubsub#persist_items': False,
+                                     'unknown': 'x'}))
+        d = self.resource.configureGet(makeRequest('configureGet'))
+
+        def cb(config):
+            self.assertFalse(config['pubsub#persist_items'])
+            self.assertNotIn('unknown', config)
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_configureForbidden(self):
+        d = self.resource.configureGet(makeRequest('configureGet',
+                                                   sender=USER))
+        self.assertFailure(d, error.StanzaError)
+        return d
+
+
+    def test_transientItems(self):
+        """
+        Items are not stored for nodes that do not persist items.
+        """
+        self.resource.configureSet(makeRequest(
+            'configureSet', options={'pubsub#persist_items': False}))
+        self.publish('1')
+        self.assertEqual({}, self.resource.nodes['test'].items)
+
+
+    def test_applyUnknownNode(self):
+        """
+        Records for nodes that do not exist are ignored.
+        """
+        for record in [('configure', 'other', {}),
+                       ('publish', 'other', [(makeItem('1'), OWNER)]),
+                       ('retract', 'other', ['1']),
+                       ('purge', 'other'),
+                       ('subscribe', 'other', USER.full(), 'subscribed',
+                                     {}),
+                       ('unsubscribe', 'other', USER.full()),
+                       ('affiliate', 'other', USER.userhost(), 'owner'),
+                       ('delete', 'other')]:
+            self.resource._apply(record)
+        self.assertEqual(['test'], self.resource.nodes.keys())
+
+
+    def test_applyCreateExisting(self):
+        """
+        Creating a node that exists leaves it alone.
+        """
+        self.publish('1')
+        self.resource._apply(('create', 'test', 'leaf',
+                              dict(self.resource.defaultConfiguration)))
+        self.assertEqual(['1'],
+                         self.resource.nodes['test'].getItemIdentifiers())
+
+
+    def test_delete(self):
+        """
+        Deleting a node drops its subscriptions and notifies subscribers.
+        """
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER))
+        self.resource.delete(makeRequest('delete'))
+
+        self.assertEqual({}, self.resource.nodes)
+        self.assertEqual([(SERVICE, 'test', [USER])], self.service.deleted)
+        d = self.resource.subscriptions(makeRequest('subscriptions',
+                                                    sender=USER))
+        d.addCallback(self.assertEqual, [])
+        return d
+
+
+    def test_collectionNotifications(self):
+        """
+        Subscribers to a collection are notified of items in its leaves.
+        """
+        self.resource.create(makeRequest(
+            'create', nodeIdentifier='collection',
+            options={'pubsub#node_type': 'collection'}))
+        self.resource.configureSet(makeRequest(
+            'configureSet', options={'pubsub#collection': ['collection']}))
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER,
+                                            nodeIdentifier='collection'))
+        self.publish('1')
+
+        [(subscriber, subscriptions, items)] = self.service.published[0][2]
+        self.assertEqual(USER, subscriber)
+        self.assertEqual(['collection'], [subscription.nodeIdentifier
+                                          for subscription in subscriptions])
+
+        self.resource.purge(makeRequest('purge'))
+        [(subscriber, subscriptions)] = self.service.purged[0][2]
+        self.assertEqual(USER, subscriber)
+        self.assertEqual(['collection'], [subscription.nodeIdentifier
+                                          for subscription in subscriptions])
+
+
+    def test_collectionNodes(self):
+        """
+        Nodes in a collection are listed under it instead of at the root.
+        """
+        self.resource.create(makeRequest(
+            'create', nodeIdentifier='collection',
+            options={'pubsub#node_type': 'collection'}))
+        self.resource.create(makeRequest(
+            'create', nodeIdentifier='child',
+            options={'pubsub#collection': 'collection'}))
+
+        d = self.resource.getNodes(OWNER, SERVICE, '')
+        d.addCallback(self.assertEqual, ['collection', 'test'])
+        d.addCallback(lambda _: self.resource.getNodes(OWNER, SERVICE,
+                                                       'collection'))
+        d.addCallback(self.assertEqual, ['child'])
+        return d
+
+
+    def test_collectionUnknown(self):
+        d = self.resource.configureSet(makeRequest(
+            'configureSet', options={'pubsub#collection': ['unknown']}))
+        self.assertFailure(d, error.StanzaError)
+        return d
+
+
+    def test_collectionCycle(self):
+        """
+        A collection cannot be contained in one of its descendants.
+        """
+        self.resource.create(makeRequest(
+            'create', nodeIdentifier='a',
+            options={'pubsub#node_type': 'collection'}))
+        self.resource.create(makeRequest(
+            'create', nodeIdentifier='b',
+            options={'pubsub#node_type': 'collection',
+                     'pubsub#collection': ['a']}))
+        d = self.resource.configureSet(makeRequest(
+            'configureSet', nodeIdentifier='a',
+            options={'pubsub#collection': ['b']}))
+        self.assertFailure(d, error.StanzaError)
+        d.addCallback(lambda exc: self.assertEqual('not-acceptable',
+                                                   exc.condition))
+        return d
+
+
+    def test_deleteCollection(self):
+        """
+        Deleting a collection removes it from the nodes it contained.
+        """
+        self.resource.create(makeRequest(
+            'create', nodeIdentifier='collection',
+            options={'pubsub#node_type': 'collection'}))
+        self.resource.configureSet(makeRequest(
+            'configureSet', options={'pubsub#collection': ['collection']}))
+        self.resource.delete(makeRequest('delete',
+                                         nodeIdentifier='collection'))
+        config = self.resource.nodes['test'].config
+        self.assertEqual([], config['pubsub#collection'])
+
+
+    def test_subscriptionsSet(self):
+        subscription = pubsub.Subscription('test', USER, 'subscribed')
+        self.resource.subscriptionsSet(makeRequest(
+            'subscriptionsSet', subscriptions=set([subscription])))
+        d = self.resource.subscriptionsGet(makeRequest('subscriptionsGet'))
+        d.addCallback(lambda subscriptions:
+                      self.assertEqual([USER], [s.subscriber
+                                                for s in subscriptions]))
+        return d
+
+
+    def authorize(self):
+        self.resource.configureSet(makeRequest(
+            'configureSet', options={'pubsub#access_model': 'authorize'}))
+        return self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                                   subscriber=USER))
+
+
+    def test_subscribePending(self):
+        """
+        Subscriptions to nodes requiring authorization are pending, and the
+        owners are asked to authorize them.
+        """
+        subscriptions = []
+        self.authorize().addCallback(subscriptions.append)
+
+        [subscription] = subscriptions
+        self.assertEqual('pending', subscription.state)
+        self.assertEqual([(SERVICE, 'test', [JID('owner@example.org')],
+                           [subscription])], self.service.pending)
+
+        self.publish('1')
+        self.assertEqual([], self.service.published)
+
+
+    def test_subscribePendingNotifyFailed(self):
+        """
+        Failures to ask owners for authorization are logged.
+        """
+        self.service.notifyPending = lambda *args: defer.fail(
+                RuntimeError("Oops"))
+        d = self.authorize()
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
+        return d
+
+
+    def test_getPendingSubscriptions(self):
+        """
+        Pending subscriptions are looked up by node owner.
+        """
+        self.authorize()
+        self.assertEqual([USER], [subscription.subscriber for subscription
+                                  in self.resource.getPendingSubscriptions(
+                                      OWNER)])
+        self.assertEqual([], self.resource.getPendingSubscriptions(USER))
+
+
+    def test_resendPending(self):
+        self.authorize()
+        self.resource.resendPending(SERVICE, OWNER)
+        self.assertEqual(2, len(self.service.pending))
+        self.assertEqual([OWNER], self.service.pending[1][2])
+
+
+    def test_authorizeSubscription(self):
+        """
+        An authorized subscription becomes active and the subscriber is
+        notified.
+        """
+        self.authorize()
+        subscription = pubsub.Subscription('test', USER, 'subscribed')
+        self.resource.subscriptionsSet(makeRequest(
+            'subscriptionsSet', subscriptions=set([subscription])))
+
+        self.assertEqual([(SERVICE, 'test', subscription)],
+                         self.service.subscriptions)
+        self.assertEqual([], self.resource.getPendingSubscriptions(OWNER))
+        node = self.resource.nodes['test']
+        self.assertEqual('subscribed', node.subscriptions[USER].state)
+
+
+    def test_rejectSubscription(self):
+        """
+        A rejected subscription is removed and the subscriber is notified.
+        """
+        self.authorize()
+        subscription = pubsub.Subscription('test', USER, 'none')
+        self.resource.subscriptionsSet(makeRequest(
+            'subscriptionsSet', subscriptions=set([subscription])))
+
+        self.assertEqual([(SERVICE, 'test', subscription)],
+                         self.service.subscriptions)
+        self.assertEqual({}, self.resource.nodes['test'].subscriptions)
+        self.assertEqual({}, self.resource.nodes['test'].pending)
+
+
+    def test_affiliationsGet(self):
+        d = self.resource.affiliationsGet(makeRequest('affiliationsGet'))
+        d.addCallback(self.assertEqual, {'owner@example.org': 'owner'})
+        return d
+
+
+
+class MemoryPubSubResourceJournalTest(unittest.TestCase):
+    """
+    Tests for the journal of L{MemoryPubSubResource}.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.resource = self.open()
+        self.resource.create(makeRequest('create'))
+        self.resource.publish(makeRequest('publish', items=[makeItem('1')]))
+        self.resource.subscribe(makeRequest('subscribe', sender=USER,
+                                            subscriber=USER))
+
+
+    def open(self):
+        resource = MemoryPubSubResource(self.path)
+        self.addCleanup(resource.close)
+        return resource
+
+
+    def readRecords(self, path):
+        records = []
+        f = open(path, 'rb')
+        try:
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+        finally:
+            f.close()
+        return records
+
+
+    def assertRestored(self, resource):
+        node = resource.nodes['test']
+        self.assertEqual(['1'], node.getItemIdentifiers())
+        self.assertEqual(u'payload', unicode(node.items['1'][1].entry))
+        self.assertEqual([USER], node.subscriptions.keys())
+        self.assertEqual({'owner@example.org': 'owner'}, node.affiliations)
+
+
+    def test_journal(self):
+        """
+        A new resource replays the journal.
+        """
+        self.resource.close()
+        self.assertRestored(self.open())
+
+
+    def test_journalPreviousFormat(self):
+        """
+        Items journaled as XML text are restored.
+        """
+        self.resource.close()
+        f = open(self.path, 'ab')
+        pickle.dump(('publish', 'test', [(makeItem('2').toXml(), OWNER)]), f,
+                    pickle.HIGHEST_PROTOCOL)
+        f.close()
+
+        resource = self.open()
+        item = resource.nodes['test'].items['2'][1]
+        self.assertEqual('2', item['id'])
+        self.assertEqual(u'payload', unicode(item.entry))
+
+
+    def test_snapshot(self):
+        """
+        After a snapshot, state is restored from the snapshot.
+        """
+        self.resource.snapshot()
+        self.assertEqual([('generation', 1)], self.readRecords(self.path))
+        self.resource.retract(makeRequest('retract', itemIdentifiers=['1']))
+        self.resource.close()
+
+        resource = self.open()
+        self.assertEqual([], resource.nodes['test'].getItemIdentifiers())
+
+
+    def test_snapshotThreshold(self):
+        """
+        A snapshot is made automatically after enough records.
+        """
+        self.resource.snapshotThreshold = 1
+        self.resource.publish(makeRequest('publish', items=[makeItem('2')]))
+        self.assertTrue(os.path.exists(self.path + '.snapshot'))
+        self.assertEqual([('generation', 1)], self.readRecords(self.path))
+
+
+    def test_snapshotJournalNotEmptied(self):
+        """
+        A journal that was folded into the snapshot, but not emptied before
+        a crash, is not applied again.
+        """
+        journal = open(self.path, 'rb').read()
+        self.resource.snapshot()
+        self.resource.close()
+        f = open(self.path, 'wb')
+        f.write(journal)
+        f.close()
+
+        resource = self.open()
+        self.assertRestored(resource)
+        self.assertEqual(0, resource._journalRecords)
+        self.assertEqual([('generation', 1)], self.readRecords(self.path))
+
+
+    def test_damagedJournal(self):
+        """
+        A partially written record at the end of the journal is cut off.
+        """
+        self.resource.close()
+        size = os.path.getsize(self.path)
+        f = open(self.path, 'ab')
+        f.write('\x80\x02(U\x07publish')
+        f.close()
+
+        resource = self.open()
+        self.assertRestored(resource)
+        self.assertEqual(size, os.path.getsize(self.path))
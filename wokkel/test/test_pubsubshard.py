@@ -0,0 +1,368 @@
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+Tests for L{wokkel.pubsubshard}.
+"""
+
+from zope.interface import verify
+
+from twisted.internet import defer, error as ierror, task
+from twisted.protocols import amp
+from twisted.python import failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.words.protocols.jabber.jid import JID
+from twisted.words.protocols.jabber.xmlstream import toResponse
+
+from wokkel import disco, iwokkel, pubsub, pubsubshard
+from wokkel.generic import parseXml
+from wokkel.pubsubmemory import MemoryPubSubResource
+from wokkel.test.helpers import XmlStreamStub
+
+SERVICE = JID('pubsub.example.org')
+OWNER = JID('owner@example.org/home')
+
+class HashRingTest(unittest.TestCase):
+    """
+    Tests for L{pubsubshard.HashRing}.
+    """
+
+    def setUp(self):
+        self.ring = pubsubshard.HashRing(['a', 'b', 'c'])
+        self.keys = [u'node%d' % i for i in xrange(1000)]
+
+
+    def test_getShard(self):
+        """
+        Keys are spread over all shards, the same way every time.
+        """
+        shards = [self.ring.getShard(key) for key in self.keys]
+        self.assertEqual(set(['a', 'b', 'c']), set(shards))
+        for shard in 'abc':
+            self.assertTrue(shards.count(shard) > 200)
+
+        ring = pubsubshard.HashRing(['c', 'b', 'a'])
+        self.assertEqual(shards, [ring.getShard(key) for key in self.keys])
+
+
+    def test_addShard(self):
+        """
+        Adding a shard only moves keys to the new shard.
+        """
+        before = [self.ring.getShard(key) for key in self.keys]
+        self.ring.addShard('d')
+        after = [self.ring.getShard(key) for key in self.keys]
+
+        for old, new in zip(before, after):
+            self.assertIn(new, (old, 'd'))
+        self.assertIn('d', after)
+
+
+    def test_removeShard(self):
+        """
+        Removing a shard only moves the keys of that shard.
+        """
+        before = [self.ring.getShard(key) for key in self.keys]
+        self.ring.removeShard('c')
+        after = [self.ring.getShard(key) for key in self.keys]
+
+        for old, new in zip(before, after):
+            if old != 'c':
+                self.assertEqual(old, new)
+        self.assertNotIn('c', after)
+
+
+    def test_getShardEmpty(self):
+        """
+        Without shards, no key can be assigned.
+        """
+        self.assertRaises(KeyError, pubsubshard.HashRing().getShard, u'node')
+
+
+
+class XMLTest(unittest.TestCase):
+    """
+    Tests for L{pubsubshard.XML}.
+    """
+
+    def test_roundTrip(self):
+        """
+        Values larger than the AMP value limit are split and joined.
+        """
+        argument = pubsubshard.XML()
+        value = u'<message>%s</message>' % (u'\u00e9' * 100000)
+        strings = amp.AmpBox()
+        argument.toBox('stanza', strings, {'stanza': value}, None)
+        self.assertEqual('4', strings['stanza'])
+        strings.serialize()
+
+        objects = {}
+        argument.fromBox('stanza', strings, objects, None)
+        self.assertEqual(value.encode('utf-8'), objects['stanza'])
+
+
+
+class ShardedPubSubServiceTest(unittest.TestCase):
+    """
+    Tests for L{pubsubshard.ShardedPubSubService} with its workers.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.resources = {}
+        self.connections = []
+        shards = {}
+        for name in ('a', 'b'):
+            resource = MemoryPubSubResource()
+            service = pubsub.PubSubService(resource, reactor=self.clock)
+            resource.pubsubService = service
+            worker = pubsubshard.ShardWorker(service)
+            connection = pubsubshard.ShardConnection()
+
+            worker.makeConnection(StringTransport())
+            connection.makeConnection(StringTransport())
+            self.connections.append((connection, worker))
+            self.resources[name] = resource
+            shards[name] = connection
+
+        self.front = pubsubshard.ShardedPubSubService(shards)
+        self.stub = XmlStreamStub()
+        self.front.makeConnection(self.stub.xmlstream)
+        self.front.send = self.stub.output.append
+
+
+    def pump(self):
+        """
+        Deliver data between the front and the workers until done.
+        """
+        moved = True
+        while moved:
+            moved = False
+            for connection, worker in self.connections:
+                for source, destination in ((connection, worker),
+                                            (worker, connection)):
+                    if source.transport is None:
+                        continue
+                    data = source.transport.value()
+                    if data:
+                        source.transport.clear()
+                        destination.dataReceived(data)
+                        moved = True
+
+
+    def request(self, xml):
+        """
+        Pass a request to the front and return the parsed response.
+        """
+        self.stub.send(parseXml(xml))
+        self.pump()
+        return self.output()[-1]
+
+
+    def output(self):
+        return [isinstance(stanza, str) and parseXml(stanza) or stanza
+                for stanza in self.stub.output]
+
+
+    def create(self, nodeIdentifier):
+        """
+        Create a node on the shard owning it.
+        """
+        request = pubsub.PubSubRequest('create')
+        request.sender = OWNER
+        request.recipient = SERVICE
+        request.nodeIdentifier = nodeIdentifier
+        resource = self.resources[self.front.ring.getShard(nodeIdentifier)]
+        return resource.create(request)
+
+
+    def subscribe(self, nodeIdentifier):
+        return self.request("""
+            <iq type='set' to='pubsub.example.org'
+                from='owner@example.org/home' id='subscribe1'>
+              <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+                <subscribe node='%s' jid='owner@example.org/home'/>
+              </pubsub>
+            </iq>
+            """ % nodeIdentifier)
+
+
+    def test_interface(self):
+        verify.verifyObject(iwokkel.IDisco, self.front)
+
+
+    def test_forward(self):
+        """
+        Requests are handled by the shard owning the node.
+        """
+        for nodeIdentifier in (u'node1', u'node2', u'node3', u'node4'):
+            self.create(nodeIdentifier)
+            response = self.subscribe(nodeIdentifier)
+            self.assertEqual('result', response['type'])
+            self.assertEqual('subscribe1', response['id'])
+            self.assertEqual('owner@example.org/home', response['to'])
+            self.assertEqual(nodeIdentifier,
+                             response.pubsub.subscription['node'])
+
+
+    def test_createInstant(self):
+        """
+        Instant nodes get an identifier of the shard they are created on.
+        """
+        stanzas = []
+
+        class FakeShard(object):
+            def callRemote(self, command, stanza):
+                stanzas.append(stanza)
+                response = toResponse(stanza, 'result')
+                return defer.succeed({'response': response.toXml()})
+
+        self.front.shards = {'a': FakeShard(), 'b': FakeShard()}
+        iq = parseXml("""
+            <iq type='set' to='pubsub.example.org'
+                from='owner@example.org/home' id='create1'>
+              <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+                <create/>
+              </pubsub>
+            </iq>
+            """)
+
+        d = self.front._createInstant(iq)
+        d.addCallback(self.front.send)
+
+        response = self.output()[-1]
+        self.assertEqual('result', response['type'])
+        self.assertEqual('create1', response['id'])
+        nodeIdentifier = response.pubsub.create['node']
+        self.assertTrue(nodeIdentifier.startswith('generic/'))
+        self.assertEqual(1, len(stanzas))
+        self.assertEqual(nodeIdentifier, stanzas[0].pubsub.create['node'])
+
+
+    def test_error(self):
+        """
+        Error responses of workers are passed back.
+        """
+        response = self.subscribe(u'unknown')
+        self.assertEqual('error', response['type'])
+        self.assertEqual('subscribe1', response['id'])
+        self.assertNotIdentical(None, response.error)
+
+
+    def test_notifications(self):
+        """
+        Notifications sent by the worker go out over the front's stream.
+        """
+        self.create(u'node1')
+        self.subscribe(u'node1')
+        response = self.request("""
+            <iq type='set' to='pubsub.example.org'
+                from='owner@example.org/home' id='publish1'>
+              <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+                <publish node='node1'>
+                  <item id='item1'><entry xmlns='http://example.org/'/></item>
+                </publish>
+              </pubsub>
+            </iq>
+            """)
+        self.assertEqual('result', response['type'])
+
+        messages = [stanza for stanza in self.output()
+                    if stanza.name == 'message']
+        self.assertEqual(1, len(messages))
+        self.assertEqual('owner@example.org/home', messages[0]['to'])
+        self.assertEqual('node1', messages[0].event.items['node'])
+
+
+    def test_subscriptions(self):
+        """
+        Subscriptions of all shards are combined.
+        """
+        nodeIdentifiers = [u'node1', u'node2', u'node3', u'node4']
+        for nodeIdentifier in nodeIdentifiers:
+            self.create(nodeIdentifier)
+            self.subscribe(nodeIdentifier)
+
+        response = self.request("""
+            <iq type='get' to='pubsub.example.org'
+                from='owner@example.org/home' id='subscriptions1'>
+              <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+                <subscriptions/>
+              </pubsub>
+            </iq>
+            """)
+        self.assertEqual('result', response['type'])
+        self.assertEqual('subscriptions1', response['id'])
+        nodes = [child['node'] for child
+                 in response.pubsub.subscriptions.elements()]
+        self.assertEqual(nodeIdentifiers, sorted(nodes))
+
+
+    def test_badRequest(self):
+        """
+        Requests that cannot be parsed are answered by the front.
+        """
+        response = self.request("""
+            <iq type='set' to='pubsub.example.org'
+                from='owner@example.org/home' id='publish1'>
+              <pubsub xmlns='http://jabber.org/protocol/pubsub'>
+                <publish/>
+              </pubsub>
+            </iq>
+            """)
+        self.assertEqual('error', response['type'])
+        self.assertEqual([], [data for connection, worker in self.connections
+                              for data in connection.transport.value()])
+
+
+    def test_workerLost(self):
+        """
+        If the connection to the worker is lost, an error is returned.
+        """
+        for connection, worker in self.connections:
+            connection.connectionLost(failure.Failure(
+                ierror.ConnectionDone()))
+
+        response = self.subscribe(u'node1')
+        self.assertEqual('error', response['type'])
+        self.assertEqual('internal-server-error',
+                         response.error.firstChildElement().name)
+        self.flushLoggedErrors(ierror.ConnectionDone)
+
+
+    def test_getDiscoInfo(self):
+        """
+        Node information is retrieved from the shard owning the node.
+        """
+        self.create(u'node1')
+
+        d = self.front.getDiscoInfo(OWNER, SERVICE, u'node1')
+        self.pump()
+
+        def cb(info):
+            discoInfo = disco.DiscoInfo()
+            for item in info:
+                discoInfo.append(item)
+            self.assertIn(('pubsub', 'leaf'), discoInfo.identities)
+
+        d.addCallback(cb)
+        return d
+
+
+    def test_getDiscoItems(self):
+        """
+        The nodes of all shards are combined for the root node.
+        """
+        for nodeIdentifier in (u'node1', u'node2', u'node3', u'node4'):
+            self.create(nodeIdentifier)
+
+        d = self.front.getDiscoItems(OWNER, SERVICE, '')
+        self.pump()
+
+        def cb(items):
+            self.assertEqual([u'node1', u'node2', u'node3', u'node4'],
+                             sorted([item.nodeIdentifier for item in items]))
+
+        d.addCallback(cb)
+        return d
@@ -0,0 +1,222 @@
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+Tests for L{wokkel.reconnect}.
+"""
+
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import xmlstream
+
+from wokkel import reconnect
+
+class ReconnectPolicyTest(unittest.TestCase):
+    """
+    Tests for L{reconnect.ReconnectPolicy}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.policy = reconnect.ReconnectPolicy(reactor=self.clock)
+        self.policy.jitter = False
+
+
+    def test_backoff(self):
+        """
+        The delay grows exponentially with consecutive failures.
+        """
+        self.assertEqual(1, self.policy.nextDelay())
+        self.policy.connectionFailed()
+        self.assertEqual(2, self.policy.nextDelay())
+        self.policy.connectionFailed()
+        self.assertEqual(4, self.policy.nextDelay())
+
+
+    def test_maxDelay(self):
+        """
+        The delay does not exceed maxDelay.
+        """
+        self.policy.maxDelay = 10
+        for i in xrange(10):
+            self.policy.connectionFailed()
+        self.assertEqual(10, self.policy.nextDelay())
+
+
+    def test_jitter(self):
+        """
+        With jitter, delays are picked between zero and the computed delay.
+        """
+        self.policy.jitter = True
+        for i in xrange(3):
+            self.policy.connectionFailed()
+        delays = [self.policy.nextDelay() for i in xrange(100)]
+        self.assertTrue(min(delays) >= 0)
+        self.assertTrue(max(delays) <= 8)
+        self.assertNotEqual(1, len(set(delays)))
+
+
+    def test_success(self):
+        """
+        A success resets the delay.
+        """
+        self.policy.connectionFailed()
+        self.policy.connectionSucceeded()
+        self.assertEqual(1, self.policy.nextDelay())
+        self.assertEqual(0, self.policy.consecutiveFailures)
+
+
+    def test_connectionLost(self):
+        """
+        A lost connection is only a failure if it never succeeded.
+        """
+        self.policy.connectionSucceeded()
+        self.policy.connectionLost()
+        self.assertEqual(0, self.policy.failures)
+        self.policy.connectionLost()
+        self.assertEqual(1, self.policy.failures)
+
+
+    def test_schedule(self):
+        """
+        An attempt is scheduled after the computed delay.
+        """
+        attempts = []
+        self.policy.connectionFailed()
+        self.policy.schedule(lambda: attempts.append(None))
+
+        self.clock.advance(1.5)
+        self.assertEqual([], attempts)
+        self.clock.advance(0.5)
+        self.assertEqual([None], attempts)
+        self.assertEqual(1, self.policy.attempts)
+        self.assertEqual(2, self.policy.lastDelay)
+
+
+    def test_breakerOpens(self):
+        """
+        After failureThreshold failures, the breaker opens.
+        """
+        self.policy.failureThreshold = 2
+        self.policy.resetTimeout = 60
+        self.policy.connectionFailed()
+        self.assertEqual(reconnect.CLOSED, self.policy.state)
+        self.policy.connectionFailed()
+        self.assertEqual(reconnect.OPEN, self.policy.state)
+        self.assertEqual(60, self.policy.nextDelay())
+
+
+    def test_breakerHalfOpen(self):
+        """
+        The attempt after the breaker opened is a half-open probe.
+        """
+        self.policy.failureThreshold = 1
+        self.policy.resetTimeout = 60
+        self.policy.connectionFailed()
+        self.policy.schedule(lambda: None)
+        self.clock.advance(60)
+        self.assertEqual(reconnect.HALF_OPEN, self.policy.state)
+
+        self.policy.connectionSucceeded()
+        self.assertEqual(reconnect.CLOSED, self.policy.state)
+
+
+    def test_breakerReopens(self):
+        """
+        A failed half-open probe opens the breaker again.
+        """
+        self.policy.failureThreshold = 3
+        self.policy.state = reconnect.HALF_OPEN
+        self.policy.connectionFailed()
+        self.assertEqual(reconnect.OPEN, self.policy.state)
+
+
+    def test_getStats(self):
+        """
+        Statistics are reported as a dictionary.
+        """
+        self.clock.advance(5)
+        self.policy.connectionFailed()
+        self.policy.schedule(lambda: None)
+        stats = self.policy.getStats()
+        self.assertEqual(reconnect.CLOSED, stats['state'])
+        self.assertEqual(1, stats['attempts'])
+        self.assertEqual(1, stats['failures'])
+        self.assertEqual(0, stats['successes'])
+        self.assertEqual(1, stats['consecutiveFailures'])
+        self.assertEqual(2, stats['lastDelay'])
+        self.assertEqual(5, stats['lastFailure'])
+        self.assertIdentical(None, stats['lastSuccess'])
+
+
+
+class FakeConnector(object):
+
+    def __init__(self):
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+
+    def stopConnecting(self):
+        pass
+
+
+
+class ReconnectingXmlStreamFactoryTest(unittest.TestCase):
+    """
+    Tests for L{reconnect.ReconnectingXmlStreamFactory}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.policy = reconnect.ReconnectPolicy(reactor=self.clock)
+        self.policy.jitter = False
+        self.factory = reconnect.ReconnectingXmlStreamFactory(
+                xmlstream.Authenticator(), self.policy)
+        self.connector = FakeConnector()
+
+
+    def test_defaultPolicy(self):
+        """
+        Without a policy, a default one is created.
+        """
+        factory = reconnect.ReconnectingXmlStreamFactory(
+                xmlstream.Authenticator())
+        self.assertIsInstance(factory.policy, reconnect.ReconnectPolicy)
+
+
+    def test_connectionFailed(self):
+        """
+        A failed connection is retried as scheduled by the policy.
+        """
+        self.factory.clientConnectionFailed(self.connector, None)
+        self.assertEqual(1, self.policy.failures)
+
+        self.clock.advance(1)
+        self.assertEqual(0, self.connector.connects)
+        self.clock.advance(1)
+        self.assertEqual(1, self.connector.connects)
+
+
+    def test_connectionLostAfterInitialized(self):
+        """
+        Losing an initialized stream reconnects without counting a failure.
+        """
+        xs = self.factory.buildProtocol(None)
+        xs.dispatch(xs, xmlstream.STREAM_AUTHD_EVENT)
+        self.assertEqual(1, self.policy.successes)
+
+        self.factory.clientConnectionLost(self.connector, None)
+        self.assertEqual(0, self.policy.failures)
+        self.clock.advance(1)
+        self.assertEqual(1, self.connector.connects)
+
+
+    def test_stopTrying(self):
+        """
+        Stopping cancels a scheduled reconnect.
+        """
+        self.factory.clientConnectionFailed(self.connector, None)
+        self.factory.stopTrying()
+        self.assertEqual([], self.clock.getDelayedCalls())
@@ -5,7 +5,7 @@
 Tests for L{wokkel.server}.
 """
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.python import failure
 from twisted.test.proto_helpers import StringTransport
 from twisted.trial import unittest
@@ -35,6 +35,85 @@ class GenerateKeyTest(unittest.TestCase):
 
 
 
+class KeyGeneratorTest(unittest.TestCase):
+    """
+    Tests for L{server.KeyGenerator}.
+    """
+
+    originating = "example.org"
+    receiving = "xmpp.example.com"
+    sid = "D60000229F"
+    secret = "s3cr3tf0rd14lb4ck"
+    key = '37c69b1cf07a3f67c04a5ef5902fa5114f2c76fe4a2686482ba5b89323075643'
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.generator = server.KeyGenerator(self.secret, self.clock)
+
+
+    def test_generateKey(self):
+        """
+        The generated key is the same as the one from L{server.generateKey}.
+        """
+        key = self.generator.generateKey(self.receiving, self.originating,
+                                         self.sid)
+        self.assertEqual(self.key, key)
+
+
+    def test_generateKeyRepeated(self):
+        """
+        Generating a key does not affect subsequently generated keys.
+        """
+        self.generator.generateKey(self.receiving, self.originating, 'other')
+        key = self.generator.generateKey(self.receiving, self.originating,
+                                         self.sid)
+        self.assertEqual(self.key, key)
+
+
+    def test_verifyKey(self):
+        """
+        Only keys generated for the same hosts and stream are valid.
+        """
+        self.assertTrue(self.generator.verifyKey(self.key, self.receiving,
+                                                 self.originating, self.sid))
+        self.assertFalse(self.generator.verifyKey(self.key, self.receiving,
+                                                  self.originating, 'other'))
+
+
+    def test_rotate(self):
+        """
+        After rotation, keys are generated with the new secret.
+        """
+        self.generator.rotate('newsecret')
+        key = self.generator.generateKey(self.receiving, self.originating,
+                                         self.sid)
+        self.assertEqual(server.generateKey('newsecret', self.receiving,
+                                            self.originating, self.sid),
+                         key)
+        self.assertEqual('newsecret', self.generator.secret)
+
+
+    def test_rotateGracePeriod(self):
+        """
+        Keys from the previous secret are valid during the grace period.
+        """
+        self.generator.rotate('newsecret')
+        self.clock.advance(self.generator.gracePeriod - 1)
+        self.assertTrue(self.generator.verifyKey(self.key, self.receiving,
+                                                 self.originating, self.sid))
+
+
+    def test_rotateGracePeriodExpired(self):
+        """
+        Keys from the previous secret are invalid after the grace period.
+        """
+        self.generator.rotate('newsecret')
+        self.clock.advance(self.generator.gracePeriod)
+        self.assertFalse(self.generator.verifyKey(self.key, self.receiving,
+                                                  self.originating, self.sid))
+
+
+
 class XMPPServerListenAuthenticatorTest(unittest.TestCase):
     """
     Tests for L{server.XMPPServerListenAuthenticator}.
@@ -254,6 +333,82 @@ class XMPPServerListenAuthenticatorTest(unittest.TestCase):
         self.assertEqual(jid.JID('pubsub.xmpp.example.com'),
                          self.xmlstream.thisEntity)
 
+
+    def test_onVerify(self):
+        """
+        A verification request with a valid key gets a valid reply.
+        """
+        verify = domish.Element((NS_DIALBACK, 'verify'))
+        verify['to'] = self.originating
+        verify['from'] = self.receiving
+        verify['id'] = self.sid
+        verify.addContent(self.key)
+
+        self.authenticator.xmlstream = self.xmlstream
+        self.service.domains = [self.originating]
+        self.authenticator.onVerify(verify)
+
+        reply = self.output[-1]
+        self.assertEqual(self.originating, reply['from'])
+        self.assertEqual(self.receiving, reply['to'])
+        self.assertEqual('valid', reply['type'])
+
+
+    def test_onVerifyInvalid(self):
+        """
+        A verification request with an invalid key gets an invalid reply.
+        """
+        verify = domish.Element((NS_DIALBACK, 'verify'))
+        verify['to'] = self.originating
+        verify['from'] = self.receiving
+        verify['id'] = self.sid
+        verify.addContent('0' * 64)
+
+        self.authenticator.xmlstream = self.xmlstream
+        self.service.domains = [self.originating]
+        self.authenticator.onVerify(verify)
+
+        self.assertEqual('invalid', self.output[-1]['type'])
+
+
+    def verify(self, key):
+        verify = domish.Element((NS_DIALBACK, 'verify'))
+        verify['to'] = self.originating
+        verify['from'] = self.receiving
+        verify['id'] = self.sid
+        verify.addContent(key)
+
+        self.authenticator.xmlstream = self.xmlstream
+        self.service.domains = [self.originating]
+        self.authenticator.onVerify(verify)
+        return self.output[-1]['type']
+
+
+    def test_onVerifyKeyGenerator(self):
+        """
+        The key generator of the service is used to verify keys, so that
+        keys from a previous secret are valid during the grace period.
+        """
+        clock = task.Clock()
+        self.service.keyGenerator = server.KeyGenerator(self.secret, clock)
+        self.service.keyGenerator.rotate('newsecret')
+        self.service.secret = 'newsecret'
+        self.assertEqual('valid', self.verify(self.key))
+
+
+    def test_onVerifySecretChanged(self):
+        """
+        If the secret of the service no longer matches its key generator,
+        keys are verified with the secret.
+        """
+        self.service.keyGenerator = server.KeyGenerator(self.secret)
+        self.service.secret = 'newsecret'
+        self.assertEqual('invalid', self.verify(self.key))
+        key = server.generateKey('newsecret', self.receiving,
+                                 self.originating, self.sid)
+        self.assertEqual('valid', self.verify(key))
+
+
     def test_onResult(self):
         def cb(result):
             self.assertEqual(1, len(self.output))
@@ -405,6 +560,298 @@ class XMPPS2SServerFactoryTest(unittest.TestCase):
 
 
 
+class OutgoingStreamPoolTest(unittest.TestCase):
+    """
+    Tests for L{server.OutgoingStreamPool}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.initiated = []
+        self.pool = server.OutgoingStreamPool(self.initiate, self.clock)
+
+
+    def initiate(self, thisHost, otherHost):
+        self.initiated.append((thisHost, otherHost))
+
+
+    def makeStream(self, thisHost, otherHost):
+        xs = xmlstream.XmlStream(xmlstream.Authenticator())
+        xs.thisEntity = jid.JID(thisHost)
+        xs.otherEntity = jid.JID(otherHost)
+        xs.output = []
+        xs.send = xs.output.append
+        xs.transport = StringTransport()
+        return xs
+
+
+    def test_sendNoStream(self):
+        """
+        Sending without a stream queues the stanza and initiates a stream.
+        """
+        stanza = domish.Element((None, "presence"))
+        self.pool.send('example.org', 'example.com', stanza)
+        self.pool.send('example.org', 'example.com', stanza)
+        self.assertEqual([('example.org', 'example.com')], self.initiated)
+        self.assertEqual(0, len(self.pool))
+
+
+    def test_streamInitializedFlushesQueue(self):
+        """
+        Queued stanzas are sent out when the stream has been initialized.
+        """
+        stanza = domish.Element((None, "presence"))
+        self.pool.send('example.org', 'example.com', stanza)
+        xs = self.makeStream('example.org', 'example.com')
+        self.pool.streamInitialized(xs)
+
+        self.assertEqual([stanza], xs.output)
+        self.assertIdentical(xs, self.pool.getStream('example.org',
+                                                     'example.com'))
+
+
+    def test_sendStream(self):
+        """
+        Sending with an initialized stream sends the stanza right away.
+        """
+        xs = self.makeStream('example.org', 'example.com')
+        self.pool.streamInitialized(xs)
+
+        stanza = domish.Element((None, "presence"))
+        self.pool.send('example.org', 'example.com', stanza)
+        self.assertEqual([stanza], xs.output)
+        self.assertEqual([], self.initiated)
+
+
+    def test_streamFailed(self):
+        """
+        A failed stream drops its queue, a new stanza initiates a new stream.
+        """
+        stanza = domish.Element((None, "presence"))
+        self.pool.send('example.org', 'example.com', stanza)
+        dropped = self.pool.streamFailed('example.org', 'example.com')
+        self.assertEqual([stanza], dropped)
+
+        self.pool.send('example.org', 'example.com', stanza)
+        self.assertEqual(2, len(self.initiated))
+
+
+    def test_streamDisconnected(self):
+        """
+        A disconnected stream is removed from the pool.
+        """
+        xs = self.makeStream('example.org', 'example.com')
+        self.pool.streamInitialized(xs)
+        self.pool.streamDisconnected(xs)
+        self.assertEqual(0, len(self.pool))
+
+
+    def test_streamDisconnectedReplaced(self):
+        """
+        A disconnected stream does not remove its replacement.
+        """
+        xs1 = self.makeStream('example.org', 'example.com')
+        xs2 = self.makeStream('example.org', 'example.com')
+        self.pool.streamInitialized(xs1)
+        self.pool.closeStream('example.org', 'example.com')
+        self.pool.streamInitialized(xs2)
+        self.pool.streamDisconnected(xs1)
+        self.assertIdentical(xs2, self.pool.getStream('example.org',
+                                                      'example.com'))
+
+
+    def test_idleTimeout(self):
+        """
+        Streams that are not used for idleTimeout seconds are closed.
+        """
+        self.pool.idleTimeout = 10
+        xs = self.makeStream('example.org', 'example.com')
+        self.pool.streamInitialized(xs)
+
+        self.clock.advance(5)
+        self.pool.send('example.org', 'example.com',
+                       domish.Element((None, "presence")))
+        self.clock.advance(6)
+        self.assertEqual(1, len(self.pool))
+
+        self.clock.advance(5)
+        self.assertEqual(0, len(self.pool))
+        self.assertIn('</stream:stream>', xs.output)
+        self.assertTrue(xs.transport.disconnecting)
+
+
+    def test_idleTimeoutDisabled(self):
+        """
+        With idleTimeout set to C{None}, idle streams are kept open.
+        """
+        self.pool.idleTimeout = None
+        xs = self.makeStream('example.org', 'example.com')
+        self.pool.streamInitialized(xs)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_maxStreams(self):
+        """
+        Exceeding maxStreams closes the least recently used stream.
+        """
+        self.pool.maxStreams = 2
+        xs1 = self.makeStream('example.org', 'one.example.com')
+        xs2 = self.makeStream('example.org', 'two.example.com')
+        self.pool.streamInitialized(xs1)
+        self.clock.advance(1)
+        self.pool.streamInitialized(xs2)
+        self.clock.advance(1)
+        self.pool.send('example.org', 'one.example.com',
+                       domish.Element((None, "presence")))
+
+        self.pool.send('example.org', 'three.example.com',
+                       domish.Element((None, "presence")))
+
+        self.assertIdentical(None, self.pool.getStream('example.org',
+                                                       'two.example.com'))
+        self.assertIdentical(xs1, self.pool.getStream('example.org',
+                                                      'one.example.com'))
+        self.assertTrue(xs2.transport.disconnecting)
+        self.assertEqual([('example.org', 'three.example.com')],
+                         self.initiated)
+
+
+    def test_reconnectOnDemand(self):
+        """
+        A stanza for a closed stream initiates a new stream.
+        """
+        xs = self.makeStream('example.org', 'example.com')
+        self.pool.streamInitialized(xs)
+        self.pool.closeStream('example.org', 'example.com')
+
+        self.pool.send('example.org', 'example.com',
+                       domish.Element((None, "presence")))
+        self.assertEqual([('example.org', 'example.com')], self.initiated)
+
+
+
+class HostFromJIDTest(unittest.TestCase):
+    """
+    Tests for L{server.hostFromJID}.
+    """
+
+    def test_full(self):
+        """
+        The host is extracted from a full JID.
+        """
+        self.assertEqual(u'example.org',
+                         server.hostFromJID(u'user@Example.org/res@ource'))
+
+
+    def test_hostOnly(self):
+        """
+        A JID with only a host part is returned prepared.
+        """
+        self.assertEqual(u'example.org', server.hostFromJID(u'EXAMPLE.ORG'))
+
+
+    def test_emptyHost(self):
+        """
+        An empty host part is rejected.
+        """
+        self.assertRaises(jid.InvalidFormat, server.hostFromJID, u'user@')
+
+
+    def test_invalidHost(self):
+        """
+        A host part containing another at sign is rejected.
+        """
+        self.assertRaises(jid.InvalidFormat, server.hostFromJID,
+                          u'user@other@example.org')
+
+
+
+class DomainRateLimiterTest(unittest.TestCase):
+    """
+    Tests for L{server.DomainRateLimiter}.
+    """
+
+    def setUp(self):
+        self.delivered = []
+        self.clock = task.Clock()
+        self.limiter = server.DomainRateLimiter(self.delivered.append,
+                                                reactor=self.clock)
+        self.limiter.rate = 2
+        self.limiter.burst = 2
+        self.limiter.maxQueued = 2
+
+
+    def test_unlimited(self):
+        """
+        Without a rate, all stanzas are delivered right away.
+        """
+        self.limiter.rate = None
+        for i in xrange(10):
+            self.assertTrue(self.limiter.admit('example.com', i))
+        self.assertEqual(range(10), self.delivered)
+
+
+    def test_burst(self):
+        """
+        Up to burst stanzas are delivered right away, the rest is queued.
+        """
+        for i in xrange(3):
+            self.limiter.admit('example.com', i)
+        self.assertEqual([0, 1], self.delivered)
+
+        self.clock.advance(0.5)
+        self.assertEqual([0, 1, 2], self.delivered)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_perDomain(self):
+        """
+        Each domain has its own bucket.
+        """
+        for i in xrange(3):
+            self.limiter.admit('one.example.com', i)
+        self.limiter.admit('two.example.com', 3)
+        self.assertEqual([0, 1, 3], self.delivered)
+
+
+    def test_queueFull(self):
+        """
+        Stanzas are dropped when the queue of their domain is full.
+        """
+        for i in xrange(4):
+            self.assertTrue(self.limiter.admit('example.com', i))
+        self.assertFalse(self.limiter.admit('example.com', 4))
+
+        self.clock.advance(1)
+        self.assertEqual([0, 1, 2, 3], self.delivered)
+
+
+    def test_order(self):
+        """
+        New stanzas are queued behind waiting ones, even with tokens left.
+        """
+        for i in xrange(3):
+            self.limiter.admit('example.com', i)
+        self.clock.pump([0.25])
+        self.limiter.admit('example.com', 3)
+        self.assertEqual([0, 1], self.delivered)
+
+        self.clock.pump([0.25, 0.5])
+        self.assertEqual([0, 1, 2, 3], self.delivered)
+
+
+    def test_stop(self):
+        """
+        Stopping drops queued stanzas and cancels pending deliveries.
+        """
+        for i in xrange(3):
+            self.limiter.admit('example.com', i)
+        self.limiter.stop()
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertEqual([0, 1], self.delivered)
+
+
+
 class ServerServiceTest(unittest.TestCase):
 
     def setUp(self):
@@ -420,6 +867,7 @@ class ServerServiceTest(unittest.TestCase):
                                             secret='mysecret',
                                             domain='example.org')
         self.service.xmlstream = self.xmlstream
+        self.service.pool._reactor = task.Clock()
 
 
     def test_defaultDomainInDomains(self):
@@ -448,3 +896,122 @@ class ServerServiceTest(unittest.TestCase):
         self.service.dispatch(self.xmlstream, stanza)
 
         self.assertEqual(1, len(errors))
+
+
+    def test_dispatchInvalidFrom(self):
+        """
+        A sender outside of the remote domain of the stream is an error.
+        """
+        errors = []
+        self.xmlstream.sendStreamError = errors.append
+
+        stanza = domish.Element((None, "presence"))
+        stanza['to'] = 'user@example.org'
+        stanza['from'] = 'other@example.net'
+        self.service.dispatch(self.xmlstream, stanza)
+
+        self.assertEqual('invalid-from', errors[0].condition)
+        self.assertEqual([], self.output)
+
+
+    def test_dispatchMalformed(self):
+        """
+        Stanzas with malformed addressing are dropped.
+        """
+        stanza = domish.Element((None, "presence"))
+        stanza['to'] = 'user@'
+        stanza['from'] = 'other@example.com'
+        self.service.dispatch(self.xmlstream, stanza)
+
+        self.assertEqual([], self.output)
+
+
+    def test_dispatchUnknownDomain(self):
+        """
+        Stanzas for domains that are not local are dropped.
+        """
+        stanza = domish.Element((None, "presence"))
+        stanza['to'] = 'user@example.net'
+        stanza['from'] = 'other@example.com'
+        self.service.dispatch(self.xmlstream, stanza)
+
+        self.assertEqual([], self.output)
+
+
+    def test_dispatchAdmission(self):
+        """
+        Stanzas are offered for admission, keyed by the remote domain.
+        """
+        admitted = []
+        self.service.admission.admit = lambda *args: admitted.append(args)
+
+        stanza = domish.Element((None, "presence"))
+        stanza['to'] = 'user@example.org'
+        stanza['from'] = 'other@Example.com'
+        self.service.dispatch(self.xmlstream, stanza)
+
+        self.assertEqual([(u'example.com', stanza)], admitted)
+        self.assertEqual([], self.output)
+
+
+    def test_send(self):
+        """
+        Outgoing stanzas are handed to the pool of outgoing streams.
+        """
+        sent = []
+        self.service.pool.send = lambda *args: sent.append(args)
+
+        stanza = domish.Element((None, "presence"))
+        stanza['to'] = 'other@example.com'
+        stanza['from'] = 'user@example.org'
+        self.service.send(stanza)
+
+        self.assertEqual([('example.org', 'example.com', stanza)], sent)
+
+
+    def test_outgoingInitialized(self):
+        """
+        An initialized outgoing stream is added to the pool.
+        """
+        self.xmlstream.serial = 0
+        self.service.outgoingInitialized(self.xmlstream)
+        self.assertIdentical(self.xmlstream,
+                             self.service.pool.getStream('example.org',
+                                                         'example.com'))
+
+
+    def test_outgoingDisconnected(self):
+        """
+        A disconnected outgoing stream is removed from the pool.
+        """
+        self.xmlstream.serial = 0
+        self.service.outgoingInitialized(self.xmlstream)
+        self.xmlstream.dispatch(None, xmlstream.STREAM_END_EVENT)
+        self.assertEqual(0, len(self.service.pool))
+
+
+    def test_rotateSecret(self):
+        """
+        Rotating the secret updates the secret and the key generator.
+        """
+        self.service.rotateSecret('newsecret')
+        self.assertEqual('newsecret', self.service.secret)
+        self.assertEqual('newsecret', self.service.keyGenerator.secret)
+
+
+    def test_initiateOutgoingStreamSecretChanged(self):
+        """
+        A changed secret is used for keys of new outgoing connections.
+        """
+        factories = []
+
+        def initiateS2S(factory):
+            factories.append(factory)
+            return defer.Deferred()
+
+        self.patch(server, 'initiateS2S', initiateS2S)
+        self.service.secret = 'newsecret'
+        self.service.initiateOutgoingStream('example.org', 'example.com')
+
+        self.assertEqual('newsecret', self.service.keyGenerator.secret)
+        self.assertEqual('newsecret', factories[0].authenticator.secret)
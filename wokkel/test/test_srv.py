@@ -0,0 +1,456 @@
+# Copyright (c) 2003-2009 Ralph Meijer
+# See LICENSE for details.
+
+"""
+Tests for L{wokkel.srv}.
+"""
+
+from twisted.internet import defer, error, protocol, task
+from twisted.names import dns
+from twisted.names.error import DNSNameError, DNSServerError
+from twisted.python import failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.words.protocols.jabber import xmlstream
+
+from wokkel import generic, srv
+
+class FakeResolver(object):
+    """
+    Resolver that answers from local tables and counts the queries.
+
+    @ivar services: Mapping from SRV name to a list of tuples of priority,
+                    weight, port and target.
+    @ivar addresses: Mapping from host name to an address.
+    @ivar queries: List of (method, name) tuples of the received queries.
+    """
+
+    ttl = 600
+
+    def __init__(self):
+        self.services = {}
+        self.addresses = {}
+        self.queries = []
+        self.pending = None
+
+
+    def lookupService(self, name):
+        self.queries.append(('lookupService', name))
+
+        if self.pending is not None:
+            return self.pending
+
+        try:
+            records = self.services[name]
+        except KeyError:
+            return defer.fail(DNSNameError(name))
+
+        answers = [dns.RRHeader(name, dns.SRV, ttl=self.ttl,
+                                payload=dns.Record_SRV(*record))
+                   for record in records]
+        return defer.succeed((answers, [], []))
+
+
+    def lookupAddress(self, name):
+        self.queries.append(('lookupAddress', name))
+
+        try:
+            address = self.addresses[name]
+        except KeyError:
+            return defer.fail(DNSNameError(name))
+
+        answers = [dns.RRHeader(name, dns.A, ttl=self.ttl,
+                                payload=dns.Record_A(address))]
+        return defer.succeed((answers, [], []))
+
+
+
+class SRVCacheTest(unittest.TestCase):
+    """
+    Tests for L{srv.SRVCache}.
+    """
+
+    name = '_xmpp-server._tcp.example.org'
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.resolver = FakeResolver()
+        self.resolver.services[self.name] = [(5, 0, 5269, 'xmpp.example.org')]
+        self.resolver.addresses['xmpp.example.org'] = '10.0.0.1'
+        self.cache = srv.SRVCache(self.resolver, self.clock)
+
+
+    def lookupTwice(self):
+        d = self.cache.lookupService(self.name)
+        d.addCallback(lambda _: self.cache.lookupService(self.name))
+        return d
+
+
+    def test_lookupService(self):
+        """
+        The result of an SRV lookup is passed on from the resolver.
+        """
+        def cb((answers, authority, additional)):
+            self.assertEqual(1, len(answers))
+            self.assertEqual(5269, answers[0].payload.port)
+
+        d = self.cache.lookupService(self.name)
+        d.addCallback(cb)
+        return d
+
+
+    def test_lookupServiceCached(self):
+        """
+        A second lookup within the TTL does not query the resolver.
+        """
+        def cb(_):
+            self.assertEqual(1, len(self.resolver.queries))
+
+        d = self.lookupTwice()
+        d.addCallback(cb)
+        return d
+
+
+    def test_lookupServiceExpired(self):
+        """
+        Expired results past the stale window cause a new query.
+        """
+        def cb(_):
+            self.assertEqual(2, len(self.resolver.queries))
+
+        d = self.cache.lookupService(self.name)
+        self.clock.advance(self.resolver.ttl + self.cache.staleTTL)
+        d.addCallback(lambda _: self.cache.lookupService(self.name))
+        d.addCallback(cb)
+        return d
+
+
+    def test_minTTL(self):
+        """
+        Records with a very low TTL are kept for at least minTTL seconds.
+        """
+        def cb(_):
+            self.assertEqual(1, len(self.resolver.queries))
+
+        self.resolver.ttl = 0
+        d = self.cache.lookupService(self.name)
+        self.clock.advance(self.cache.minTTL - 1)
+        d.addCallback(lambda _: self.cache.lookupService(self.name))
+        d.addCallback(cb)
+        return d
+
+
+    def test_staleWhileRevalidate(self):
+        """
+        Expired results are returned while a new query is done.
+        """
+        self.cache.lookupService(self.name)
+        self.clock.advance(self.resolver.ttl + 1)
+
+        self.resolver.pending = defer.Deferred()
+        d = self.cache.lookupService(self.name)
+
+        self.assertTrue(d.called)
+        self.assertEqual(2, len(self.resolver.queries))
+
+
+    def test_negative(self):
+        """
+        Lookups for names that don't exist are cached for negativeTTL.
+        """
+        def cb(_):
+            self.assertEqual(1, len(self.resolver.queries))
+
+        d = self.cache.lookupService('_xmpp-server._tcp.example.com')
+        self.assertFailure(d, DNSNameError)
+        d.addCallback(lambda _: self.cache.lookupService(
+                                    '_xmpp-server._tcp.example.com'))
+        self.assertFailure(d, DNSNameError)
+        d.addCallback(cb)
+        return d
+
+
+    def test_negativeExpired(self):
+        """
+        Negative results are not used after negativeTTL.
+        """
+        def cb(_):
+            self.assertEqual(2, len(self.resolver.queries))
+
+        d = self.cache.lookupService('_xmpp-server._tcp.example.com')
+        self.assertFailure(d, DNSNameError)
+        self.clock.advance(self.cache.negativeTTL)
+        d.addCallback(lambda _: self.cache.lookupService(
+                                    '_xmpp-server._tcp.example.com'))
+        self.assertFailure(d, DNSNameError)
+        d.addCallback(cb)
+        return d
+
+
+    def test_otherFailureNotCached(self):
+        """
+        Failures other than non-existing names are not cached.
+        """
+        self.resolver.pending = defer.fail(DNSServerError())
+        d = self.cache.lookupService(self.name)
+        self.assertFailure(d, DNSServerError)
+
+        self.resolver.pending = None
+        d.addCallback(lambda _: self.cache.lookupService(self.name))
+        d.addCallback(lambda _: self.assertEqual(2,
+                                                 len(self.resolver.queries)))
+        return d
+
+
+    def test_concurrentLookups(self):
+        """
+        Concurrent lookups for the same name result in a single query.
+        """
+        self.resolver.pending = defer.Deferred()
+        d1 = self.cache.lookupService(self.name)
+        d2 = self.cache.lookupService(self.name)
+        self.assertEqual(1, len(self.resolver.queries))
+
+        self.resolver.pending.callback(([], [], []))
+        self.assertTrue(d1.called)
+        self.assertTrue(d2.called)
+
+
+    def test_getHostByName(self):
+        """
+        Host names are resolved to the address in the A record.
+        """
+        d = self.cache.getHostByName('xmpp.example.org')
+        d.addCallback(self.assertEqual, '10.0.0.1')
+        return d
+
+
+    def test_flush(self):
+        """
+        Flushing the cache causes a new query on the next lookup.
+        """
+        def cb(_):
+            self.assertEqual(2, len(self.resolver.queries))
+
+        d = self.cache.lookupService(self.name)
+        d.addCallback(lambda _: self.cache.flush())
+        d.addCallback(lambda _: self.cache.lookupService(self.name))
+        d.addCallback(cb)
+        return d
+
+
+
+class FakeConnector(object):
+    """
+    Connector that records whether it was asked to disconnect.
+    """
+
+    disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+
+class FakeReactor(task.Clock):
+    """
+    Clock that records TCP connection attempts.
+    """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.tcpClients = []
+        self.connectors = []
+
+
+    def connectTCP(self, host, port, factory, timeout=30, bindAddress=None):
+        self.tcpClients.append((host, port, factory))
+        connector = FakeConnector()
+        self.connectors.append(connector)
+        return connector
+
+
+
+class CachingSRVConnectorTest(unittest.TestCase):
+    """
+    Tests for L{srv.CachingSRVConnector}.
+    """
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.resolver = FakeResolver()
+        self.cache = srv.SRVCache(self.resolver, self.reactor)
+        self.factory = protocol.ClientFactory()
+
+
+    def test_connect(self):
+        """
+        The connector connects to the cached address of the SRV target.
+        """
+        self.resolver.services['_xmpp-server._tcp.example.org'] = [
+                (5, 0, 5269, 'xmpp.example.org')]
+        self.resolver.addresses['xmpp.example.org'] = '10.0.0.1'
+
+        connector = srv.CachingSRVConnector(self.reactor, 'xmpp-server',
+                                            'example.org', self.factory,
+                                            self.cache)
+        connector.connect()
+
+        self.assertEqual(1, len(self.reactor.tcpClients))
+        self.assertEqual(('10.0.0.1', 5269), self.reactor.tcpClients[0][:2])
+
+
+    def test_connectSecondTime(self):
+        """
+        A second connector for the same domain uses the cached results.
+        """
+        self.resolver.services['_xmpp-server._tcp.example.org'] = [
+                (5, 0, 5269, 'xmpp.example.org')]
+        self.resolver.addresses['xmpp.example.org'] = '10.0.0.1'
+
+        for i in xrange(2):
+            connector = srv.CachingSRVConnector(self.reactor, 'xmpp-server',
+                                                'example.org', self.factory,
+                                                self.cache)
+            connector.connect()
+
+        self.assertEqual(2, len(self.reactor.tcpClients))
+        self.assertEqual(2, len(self.resolver.queries))
+
+
+    def test_connectUnresolvedHost(self):
+        """
+        If the target cannot be resolved, the host name is used instead.
+        """
+        connector = srv.CachingSRVConnector(self.reactor, 'xmpp-server',
+                                            'example.org', self.factory,
+                                            self.cache)
+        connector.connect()
+
+        self.assertEqual(1, len(self.reactor.tcpClients))
+        self.assertEqual('example.org', self.reactor.tcpClients[0][0])
+
+
+
+class RacingSRVConnectorTest(unittest.TestCase):
+    """
+    Tests for L{srv.CachingSRVConnector} in racing mode.
+    """
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.resolver = FakeResolver()
+        self.resolver.services['_xmpp-server._tcp.example.org'] = [
+                (5, 0, 5269, 'xmpp1.example.org'),
+                (10, 0, 5269, 'xmpp2.example.org')]
+        self.resolver.addresses['xmpp1.example.org'] = '10.0.0.1'
+        self.resolver.addresses['xmpp2.example.org'] = '10.0.0.2'
+        self.cache = srv.SRVCache(self.resolver, self.reactor)
+
+        self.factory = generic.DeferredXmlStreamFactory(
+                xmlstream.Authenticator())
+        self.connector = srv.CachingSRVConnector(self.reactor, 'xmpp-server',
+                                                 'example.org', self.factory,
+                                                 self.cache, racing=True)
+
+
+    def connectAttempt(self, index):
+        """
+        Make the connection attempt with the given index succeed.
+        """
+        attempt = self.reactor.tcpClients[index][2]
+        xs = attempt.buildProtocol(None)
+        xs.makeConnection(StringTransport())
+        return xs
+
+
+    def test_connectFirst(self):
+        """
+        The first attempt goes to the target with the highest priority.
+        """
+        self.connector.connect()
+        self.assertEqual([('10.0.0.1', 5269)],
+                         [client[:2] for client in self.reactor.tcpClients])
+
+
+    def test_connectStaggered(self):
+        """
+        The next attempt is started after staggerDelay.
+        """
+        self.connector.connect()
+        self.reactor.advance(self.connector.staggerDelay)
+        self.assertEqual([('10.0.0.1', 5269), ('10.0.0.2', 5269)],
+                         [client[:2] for client in self.reactor.tcpClients])
+
+
+    def test_connectFailedStartsNext(self):
+        """
+        If an attempt fails, the next attempt is started right away.
+        """
+        self.connector.connect()
+        attempt = self.reactor.tcpClients[0][2]
+        attempt.clientConnectionFailed(
+                None, failure.Failure(error.ConnectionRefusedError()))
+        self.assertEqual(2, len(self.reactor.tcpClients))
+        self.assertEqual([], self.reactor.getDelayedCalls())
+
+
+    def test_firstAuthenticatedWins(self):
+        """
+        The first initialized stream is passed to the factory.
+        """
+        self.connector.connect()
+        self.reactor.advance(self.connector.staggerDelay)
+        self.connectAttempt(0)
+        xs = self.connectAttempt(1)
+
+        xs.dispatch(xs, xmlstream.STREAM_AUTHD_EVENT)
+
+        self.assertTrue(self.reactor.connectors[0].disconnected)
+        self.assertFalse(self.reactor.connectors[1].disconnected)
+        self.assertIdentical(self.factory, xs.factory)
+        self.assertIdentical(self.reactor.connectors[1],
+                             self.connector.connector)
+
+        self.factory.deferred.addCallback(self.assertIdentical, xs)
+        return self.factory.deferred
+
+
+    def test_separateAuthenticators(self):
+        """
+        Each attempt gets its own copy of the authenticator.
+        """
+        self.connector.connect()
+        self.reactor.advance(self.connector.staggerDelay)
+        xs1 = self.connectAttempt(0)
+        xs2 = self.connectAttempt(1)
+        self.assertNotIdentical(xs1.authenticator, xs2.authenticator)
+        self.assertIdentical(xs1, xs1.authenticator.xmlstream)
+
+
+    def test_allFailed(self):
+        """
+        If all attempts fail, the factory's connection failed.
+        """
+        self.connector.connect()
+        self.reactor.advance(self.connector.staggerDelay)
+        for index in xrange(2):
+            attempt = self.reactor.tcpClients[index][2]
+            attempt.clientConnectionFailed(
+                    None, failure.Failure(error.ConnectionRefusedError()))
+
+        self.assertFailure(self.factory.deferred, error.ConnectionRefusedError)
+        return self.factory.deferred
+
+
+    def test_stopConnecting(self):
+        """
+        Stopping the connector aborts all attempts.
+        """
+        self.connector.connect()
+        self.connector.stopConnecting()
+
+        self.assertTrue(self.reactor.connectors[0].disconnected)
+        self.assertEqual([], self.reactor.getDelayedCalls())
+        self.assertFailure(self.factory.deferred, error.UserError)
+        return self.factory.deferred
@@ -9,11 +9,11 @@ from zope.interface.verify import verifyObject
 
 from twisted.trial import unittest
 from twisted.test import proto_helpers
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.words.xish import domish
 from twisted.words.protocols.jabber import error, xmlstream
 
-from wokkel import iwokkel, subprotocols
+from wokkel import iwokkel, metrics, packetqueue, subprotocols
 
 class DummyFactory(object):
     """
@@ -383,6 +383,646 @@ class StreamManagerTest(unittest.TestCase):
 
 
 
+    def test_replayPaced(self):
+        """
+        Queued data is sent in batches after initialization.
+        """
+        clock = task.Clock()
+        sm = subprotocols.StreamManager(DummyFactory(), reactor=clock)
+        sm.replayBatchSize = 2
+        sm.replayInterval = 1
+        for i in xrange(5):
+            sm.send(str(i))
+
+        output = []
+        xs = xmlstream.XmlStream(xmlstream.Authenticator())
+        xs.send = output.append
+        sm._connected(xs)
+        sm._authd(xs)
+        self.assertEqual(['0', '1'], output)
+
+        sm.send('5')
+        self.assertEqual(['0', '1'], output)
+
+        clock.advance(1)
+        self.assertEqual(['0', '1', '2', '3'], output)
+        clock.advance(1)
+        self.assertEqual(['0', '1', '2', '3', '4', '5'], output)
+        self.assertEqual([], clock.getDelayedCalls())
+
+
+    def test_replayDisconnected(self):
+        """
+        Losing the stream stops replaying, keeping the rest queued.
+        """
+        clock = task.Clock()
+        sm = subprotocols.StreamManager(DummyFactory(), reactor=clock)
+        sm.replayBatchSize = 2
+        for i in xrange(5):
+            sm.send(str(i))
+
+        xs = xmlstream.XmlStream(xmlstream.Authenticator())
+        xs.send = lambda obj: None
+        sm._connected(xs)
+        sm._authd(xs)
+        sm._disconnected(xs)
+
+        self.assertEqual([], clock.getDelayedCalls())
+        self.assertEqual(['2', '3', '4'], sm._packetQueue.take())
+
+
+    def test_packetQueue(self):
+        """
+        An alternative packet queue can be passed in.
+        """
+        queue = packetqueue.MemoryPacketQueue(maxSize=1)
+        sm = subprotocols.StreamManager(DummyFactory(), packetQueue=queue)
+        sm.send('<presence/>')
+        sm.send('<message/>')
+        self.assertEqual(['<message/>'], queue.take())
+
+
+
+class StanzaObserverTest(unittest.TestCase):
+    """
+    Tests for the stanza demultiplexer of L{subprotocols.StreamManager}.
+    """
+
+    def setUp(self):
+        self.streamManager = subprotocols.StreamManager(DummyFactory())
+        self.xmlstream = xmlstream.XmlStream(xmlstream.Authenticator())
+        self.xmlstream.send = lambda obj: None
+        self.streamManager._connected(self.xmlstream)
+        self.received = []
+
+
+    def makeStanza(self, name, stanzaType=None, namespace=None):
+        stanza = domish.Element((None, name))
+        if stanzaType:
+            stanza['type'] = stanzaType
+        if namespace:
+            stanza.addElement((namespace, 'query'))
+        return stanza
+
+
+    def test_dispatch(self):
+        """
+        Stanzas are passed to callbacks matching name, type and namespace.
+        """
+        sm = self.streamManager
+        sm.addStanzaObserver(self.received.append, 'iq', 'get', 'urn:example')
+        sm._authd(self.xmlstream)
+
+        match = self.makeStanza('iq', 'get', 'urn:example')
+        self.xmlstream.dispatch(match)
+        self.xmlstream.dispatch(self.makeStanza('iq', 'set', 'urn:example'))
+        self.xmlstream.dispatch(self.makeStanza('iq', 'get', 'urn:other'))
+        self.xmlstream.dispatch(self.makeStanza('message', 'get',
+                                                'urn:example'))
+
+        self.assertEqual([match], self.received)
+
+
+    def test_dispatchWildcards(self):
+        """
+        Callbacks without type or namespace match any stanza of that name.
+        """
+        sm = self.streamManager
+        sm.addStanzaObserver(self.received.append, 'presence')
+        sm._authd(self.xmlstream)
+
+        stanzas = [self.makeStanza('presence'),
+                   self.makeStanza('presence', 'unavailable', 'urn:example')]
+        for stanza in stanzas:
+            self.xmlstream.dispatch(stanza)
+
+        self.assertEqual(stanzas, self.received)
+
+
+    def test_dispatchOnce(self):
+        """
+        A stanza is passed once, even with several children in a namespace.
+        """
+        sm = self.streamManager
+        sm.addStanzaObserver(self.received.append, 'message',
+                             namespace='urn:example')
+        sm._authd(self.xmlstream)
+
+        stanza = self.makeStanza('message', namespace='urn:example')
+        stanza.addElement(('urn:example', 'other'))
+        self.xmlstream.dispatch(stanza)
+
+        self.assertEqual([stanza], self.received)
+
+
+    def test_dispatchNotInitialized(self):
+        """
+        Stanzas are not passed on before the stream has been initialized.
+        """
+        sm = self.streamManager
+        sm.addStanzaObserver(self.received.append, 'iq')
+        self.xmlstream.dispatch(self.makeStanza('iq', 'result'))
+        self.assertEqual([], self.received)
+
+
+    def test_removeStanzaObserver(self):
+        """
+        Removed callbacks are no longer called.
+        """
+        sm = self.streamManager
+        sm.addStanzaObserver(self.received.append, 'iq')
+        sm.removeStanzaObserver(self.received.append, 'iq')
+        sm._authd(self.xmlstream)
+        self.xmlstream.dispatch(self.makeStanza('iq', 'result'))
+        self.assertEqual([], self.received)
+        self.assertEqual({}, sm._stanzaObservers)
+
+
+    def test_stanzaInterests(self):
+        """
+        Interests declared by handlers are registered with the handler.
+        """
+        received = self.received
+
+        class Handler(subprotocols.XMPPHandler):
+            stanzaInterests = (('iq', 'get', 'urn:example', 'onGet'),)
+
+            def onGet(self, iq):
+                received.append(iq)
+
+        sm = self.streamManager
+        handler = Handler()
+        handler.setHandlerParent(sm)
+        sm._authd(self.xmlstream)
+
+        stanza = self.makeStanza('iq', 'get', 'urn:example')
+        self.xmlstream.dispatch(stanza)
+        self.assertEqual([stanza], received)
+
+        handler.disownHandlerParent(sm)
+        self.xmlstream.dispatch(stanza)
+        self.assertEqual([stanza], received)
+
+
+    def test_demuxOnlyWhenObserved(self):
+        """
+        Observers are only added to the stream for stanza names that
+        callbacks are registered for, also after initialization.
+        """
+        added = []
+        addObserver = self.xmlstream.addObserver
+
+        def recordingAddObserver(event, observerfn, *args, **kwargs):
+            added.append(event)
+            addObserver(event, observerfn, *args, **kwargs)
+
+        self.xmlstream.addObserver = recordingAddObserver
+        sm = self.streamManager
+        sm.addStanzaObserver(self.received.append, 'iq')
+        sm._authd(self.xmlstream)
+        self.assertEqual(['/iq'], added)
+
+        sm.addStanzaObserver(self.received.append, 'message', 'chat')
+        sm.addStanzaObserver(self.received.append, 'message')
+        self.assertEqual(['/iq', '/message'], added)
+
+        stanza = self.makeStanza('message', 'chat')
+        self.xmlstream.dispatch(stanza)
+        self.assertEqual([stanza, stanza], self.received)
+
+
+    def test_demuxRemoved(self):
+        """
+        When the last callback for a stanza name is removed, the observer
+        is removed from the stream.
+        """
+        sm = self.streamManager
+        sm.addStanzaObserver(self.received.append, 'iq')
+        sm._authd(self.xmlstream)
+        sm.removeStanzaObserver(self.received.append, 'iq')
+        self.assertEqual(set(), sm._demuxNames)
+
+        sm.addStanzaObserver(self.received.append, 'iq')
+        stanza = self.makeStanza('iq', 'result')
+        self.xmlstream.dispatch(stanza)
+        self.assertEqual([stanza], self.received)
+
+
+    def test_dispatchHandled(self):
+        """
+        Once a callback has marked a stanza as handled, the remaining
+        callbacks are skipped.
+        """
+        def onMessage(message):
+            self.received.append('first')
+            message.handled = True
+
+        sm = self.streamManager
+        sm.addStanzaObserver(onMessage, 'message')
+        sm.addStanzaObserver(self.received.append, 'message')
+        sm._authd(self.xmlstream)
+
+        self.xmlstream.dispatch(self.makeStanza('message'))
+        self.assertEqual(['first'], self.received)
+
+
+    def test_dispatchSpecificFirst(self):
+        """
+        Callbacks for a namespace are called before those for any namespace,
+        and callbacks for a type before those for any type.
+        """
+        sm = self.streamManager
+        sm.addStanzaObserver(lambda stanza: self.received.append('any'),
+                             'iq')
+        sm.addStanzaObserver(lambda stanza: self.received.append('type'),
+                             'iq', 'get')
+        sm.addStanzaObserver(lambda stanza: self.received.append('ns'),
+                             'iq', namespace='urn:example')
+        sm.addStanzaObserver(lambda stanza: self.received.append('both'),
+                             'iq', 'get', 'urn:example')
+        sm._authd(self.xmlstream)
+
+        self.xmlstream.dispatch(self.makeStanza('iq', 'get', 'urn:example'))
+        self.assertEqual(['both', 'ns', 'type', 'any'], self.received)
+
+
+    def test_observeStanzaInterests(self):
+        """
+        Without a stream manager as parent, handlers observe their stanza
+        interests on the XML stream.
+        """
+        received = self.received
+
+        class Handler(subprotocols.XMPPHandler):
+            stanzaInterests = (('iq', 'get', 'urn:example', 'onGet'),
+                               ('presence', None, None, 'onPresence'))
+
+            def onGet(self, iq):
+                received.append(iq)
+
+            def onPresence(self, presence):
+                received.append(presence)
+
+        handler = Handler()
+        handler.makeConnection(self.xmlstream)
+        handler.observeStanzaInterests()
+
+        stanzas = [self.makeStanza('iq', 'get', 'urn:example'),
+                   self.makeStanza('presence', 'unavailable')]
+        for stanza in stanzas:
+            self.xmlstream.dispatch(stanza)
+        self.xmlstream.dispatch(self.makeStanza('iq', 'set', 'urn:example'))
+        self.xmlstream.dispatch(self.makeStanza('iq', 'get', 'urn:other'))
+
+        self.assertEqual(stanzas, received)
+
+
+    def test_observeStanzaInterestsStreamManager(self):
+        """
+        With a stream manager as parent, no observers are added to the XML
+        stream, as the stream manager passes the stanzas on.
+        """
+        class Handler(subprotocols.XMPPHandler):
+            stanzaInterests = (('presence', None, None, 'onPresence'),)
+
+            def onPresence(self, presence):
+                pass
+
+        added = []
+        self.xmlstream.addObserver = lambda *args, **kwargs: added.append(args)
+        handler = Handler()
+        handler.setHandlerParent(self.streamManager)
+        handler.observeStanzaInterests()
+        self.assertEqual([], added)
+
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    Tests for instrumentation of handlers in L{subprotocols.StreamManager}.
+    """
+
+    def setUp(self):
+        self.metrics = metrics.HandlerMetrics(reactor=task.Clock())
+        self.streamManager = subprotocols.StreamManager(DummyFactory())
+        self.streamManager.metrics = self.metrics
+        self.xmlstream = xmlstream.XmlStream(xmlstream.Authenticator())
+        self.xmlstream.send = lambda obj: None
+
+
+    def test_stanzaObserver(self):
+        """
+        Callbacks registered with the demultiplexer are instrumented.
+        """
+        def onMessage(message):
+            pass
+
+        sm = self.streamManager
+        sm.addStanzaObserver(onMessage, 'message')
+        sm._connected(self.xmlstream)
+        sm._authd(self.xmlstream)
+        self.xmlstream.dispatch(domish.Element((None, 'message')))
+
+        self.assertEqual(1, self.metrics.stats[('onMessage', 'message')].count)
+
+
+    def test_xpathObserver(self):
+        """
+        XPath observers added by handlers are instrumented.
+        """
+        received = []
+
+        def onPresence(presence):
+            received.append(presence)
+
+        sm = self.streamManager
+        sm._connected(self.xmlstream)
+        self.xmlstream.addObserver('/presence', onPresence)
+        presence = domish.Element((None, 'presence'))
+        self.xmlstream.dispatch(presence)
+
+        self.assertEqual([presence], received)
+        self.assertEqual(1,
+                         self.metrics.stats[('onPresence', 'presence')].count)
+
+        self.xmlstream.removeObserver('/presence', onPresence)
+        self.xmlstream.dispatch(presence)
+        self.assertEqual([presence], received)
+
+
+    def test_disabled(self):
+        """
+        Without metrics, observers are not wrapped.
+        """
+        self.streamManager.metrics = None
+        self.streamManager._connected(self.xmlstream)
+        self.assertNotIn('addObserver', vars(self.xmlstream))
+
+
+    def test_iqHandler(self):
+        """
+        Requests handled by L{subprotocols.IQHandlerMixin} are instrumented.
+        """
+        class Handler(DummyIQHandler):
+            def onGet(self, iq):
+                raise NotImplementedError()
+
+        handler = Handler()
+        handler.parent = self.streamManager
+        iq = domish.Element((None, 'iq'))
+        iq['type'] = 'get'
+        iq['id'] = 'r1'
+        handler.handleRequest(iq)
+
+        key = (metrics.handlerName(handler), 'iq:get')
+        self.assertEqual(1, self.metrics.stats[key].errors)
+
+
+
+class StreamManagementTest(unittest.TestCase):
+    """
+    Tests for Stream Management (XEP-0198) in L{subprotocols.StreamManager}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.streamManager = subprotocols.StreamManager(DummyFactory(),
+                                                        reactor=self.clock)
+        self.xmlstream, self.output = self.connect()
+
+
+    def connect(self):
+        """
+        Connect a new stream to the stream manager.
+        """
+        output = []
+        xs = xmlstream.XmlStream(xmlstream.Authenticator())
+        xs.send = output.append
+        self.streamManager._connected(xs)
+        return xs, output
+
+
+    def makeStanza(self, name='message'):
+        return domish.Element((None, name))
+
+
+    def makeAck(self, h):
+        answer = domish.Element((subprotocols.NS_SM, 'a'))
+        answer['h'] = str(h)
+        return answer
+
+
+    def test_enableTracksStanzas(self):
+        """
+        Stanzas sent after enabling are kept until acknowledged.
+        """
+        sm = self.streamManager
+        sm.enableStreamManagement(self.xmlstream, 'sm-1')
+        sm._authd(self.xmlstream)
+
+        stanzas = [self.makeStanza() for i in xrange(3)]
+        for stanza in stanzas:
+            sm.send(stanza)
+        self.xmlstream.send(" ")
+
+        self.assertEqual(stanzas + [" "], self.output)
+        self.assertEqual(stanzas, list(sm._unacked))
+        self.assertEqual('sm-1', sm.smId)
+
+
+    def test_enableTracksDirectSend(self):
+        """
+        Stanzas sent directly over the stream are also tracked.
+        """
+        sm = self.streamManager
+        sm.enableStreamManagement(self.xmlstream)
+        stanza = self.makeStanza('iq')
+        self.xmlstream.send(stanza)
+        self.assertEqual([stanza], list(sm._unacked))
+
+
+    def test_ack(self):
+        """
+        Acknowledged stanzas are dropped from the buffer.
+        """
+        sm = self.streamManager
+        sm.enableStreamManagement(self.xmlstream)
+        sm._authd(self.xmlstream)
+        stanzas = [self.makeStanza() for i in xrange(3)]
+        for stanza in stanzas:
+            sm.send(stanza)
+
+        self.xmlstream.dispatch(self.makeAck(2))
+        self.assertEqual(stanzas[2:], list(sm._unacked))
+
+        self.xmlstream.dispatch(self.makeAck(3))
+        self.assertEqual([], list(sm._unacked))
+
+
+    def test_ackUnknown(self):
+        """
+        Acknowledgements for stanzas that were never sent are ignored.
+        """
+        sm = self.streamManager
+        sm.enableStreamManagement(self.xmlstream)
+        sm._authd(self.xmlstream)
+        sm.send(self.makeStanza())
+
+        self.xmlstream.dispatch(self.makeAck(5))
+        self.assertEqual(1, len(sm._unacked))
+
+
+    def test_maxUnacked(self):
+        """
+        The buffer of unacknowledged stanzas is bounded.
+        """
+        sm = self.streamManager
+        sm.maxUnacked = 2
+        sm.enableStreamManagement(self.xmlstream)
+        sm._authd(self.xmlstream)
+        stanzas = [self.makeStanza() for i in xrange(3)]
+        for stanza in stanzas:
+            sm.send(stanza)
+
+        self.assertEqual(stanzas[1:], list(sm._unacked))
+
+        self.xmlstream.dispatch(self.makeAck(2))
+        self.assertEqual(stanzas[2:], list(sm._unacked))
+
+
+    def test_ackRequest(self):
+        """
+        Requests for acknowledgement are answered with the inbound count.
+        """
+        sm = self.streamManager
+        sm.enableStreamManagement(self.xmlstream)
+        self.xmlstream.dispatch(self.makeStanza('presence'))
+        self.xmlstream.dispatch(self.makeStanza('iq'))
+        self.xmlstream.dispatch(domish.Element((subprotocols.NS_SM, 'r')))
+
+        answer = self.output[-1]
+        self.assertEqual((subprotocols.NS_SM, 'a'), (answer.uri, answer.name))
+        self.assertEqual('2', answer['h'])
+
+
+    def test_requestAckPeriodically(self):
+        """
+        Acknowledgement of outstanding stanzas is requested periodically.
+        """
+        sm = self.streamManager
+        sm.ackRequestInterval = 10
+        sm.enableStreamManagement(self.xmlstream)
+        sm._authd(self.xmlstream)
+
+        self.clock.advance(10)
+        self.assertEqual([], self.output)
+
+        sm.send(self.makeStanza())
+        self.clock.advance(10)
+        request = self.output[-1]
+        self.assertEqual((subprotocols.NS_SM, 'r'),
+                         (request.uri, request.name))
+
+
+    def test_disconnectedStopsRequests(self):
+        """
+        Periodic acknowledgement requests stop when the stream is lost.
+        """
+        sm = self.streamManager
+        sm.enableStreamManagement(self.xmlstream)
+        sm._disconnected(None)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+    def test_resume(self):
+        """
+        On resumption, only unacknowledged stanzas are sent again.
+        """
+        sm = self.streamManager
+        sm.enableStreamManagement(self.xmlstream, 'sm-1')
+        sm._authd(self.xmlstream)
+        stanzas = [self.makeStanza() for i in xrange(3)]
+        for stanza in stanzas:
+            sm.send(stanza)
+        sm._disconnected(None)
+
+        xs, output = self.connect()
+        sm.resumeStreamManagement(xs, 1)
+        self.assertTrue(sm.resumed)
+        sm._authd(xs)
+
+        self.assertEqual(stanzas[1:], output)
+        self.assertEqual(stanzas[1:], list(sm._unacked))
+
+        xs.dispatch(self.makeAck(3))
+        self.assertEqual([], list(sm._unacked))
+
+
+    def test_resumedHandlers(self):
+        """
+        Handlers can see whether the stream was resumed when initialized.
+        """
+        sm = self.streamManager
+        resumed = []
+
+        class Handler(subprotocols.XMPPHandler):
+            def connectionInitialized(self):
+                resumed.append(self.parent.resumed)
+
+        Handler().setHandlerParent(sm)
+        sm.enableStreamManagement(self.xmlstream, 'sm-1')
+        sm._authd(self.xmlstream)
+        sm._disconnected(None)
+
+        xs, output = self.connect()
+        sm.resumeStreamManagement(xs, 0)
+        sm._authd(xs)
+        self.assertEqual([False, True], resumed)
+
+
+    def test_resumptionFailed(self):
+        """
+        If resumption fails, unacknowledged stanzas are sent on the new stream.
+        """
+        sm = self.streamManager
+        sm.enableStreamManagement(self.xmlstream, 'sm-1')
+        sm._authd(self.xmlstream)
+        stanza = self.makeStanza()
+        sm.send(stanza)
+        sm._disconnected(None)
+        queued = self.makeStanza('presence')
+        sm.send(queued)
+
+        xs, output = self.connect()
+        sm.resumptionFailed()
+        sm._authd(xs)
+
+        self.assertEqual([stanza, queued], output)
+        self.assertIdentical(None, sm.smId)
+        self.assertFalse(sm.resumed)
+
+
+    def test_enableRequeues(self):
+        """
+        Enabling on a new stream sends unacknowledged stanzas again.
+        """
+        sm = self.streamManager
+        sm.enableStreamManagement(self.xmlstream, 'sm-1')
+        sm._authd(self.xmlstream)
+        stanza = self.makeStanza()
+        sm.send(stanza)
+        sm._disconnected(None)
+
+        xs, output = self.connect()
+        sm.enableStreamManagement(xs, 'sm-2')
+        sm._authd(xs)
+
+        self.assertEqual([stanza], output)
+        self.assertEqual([stanza], list(sm._unacked))
+        self.assertEqual(0, sm.smInbound)
+
+
+
 class DummyIQHandler(subprotocols.IQHandlerMixin):
     iqHandlers = {'/iq[@type="get"]': 'onGet'}
 
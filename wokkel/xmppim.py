@@ -59,8 +59,12 @@ class UnavailablePresence(Presence):
 
 class PresenceClientProtocol(XMPPHandler):
 
+    stanzaInterests = (
+        ('presence', None, None, '_onPresence'),
+        )
+
     def connectionInitialized(self):
-        self.xmlstream.addObserver('/presence', self._onPresence)
+        self.observeStanzaInterests()
 
     def _getStatuses(self, presence):
         statuses = {}
@@ -387,8 +391,12 @@ class PresenceProtocol(XMPPHandler):
                 'probe': ProbePresence,
         }
 
+    stanzaInterests = (
+        ('presence', None, None, '_onPresence'),
+        )
+
     def connectionInitialized(self):
-        self.xmlstream.addObserver("/presence", self._onPresence)
+        self.observeStanzaInterests()
 
 
     def _onPresence(self, element):
@@ -610,9 +618,12 @@ class RosterClientProtocol(XMPPHandler):
     Client side XMPP roster protocol.
     """
 
+    stanzaInterests = (
+        ('iq', 'set', NS_ROSTER, '_onRosterSet'),
+        )
+
     def connectionInitialized(self):
-        ROSTER_SET = "/iq[@type='set']/query[@xmlns='%s']" % NS_ROSTER
-        self.xmlstream.addObserver(ROSTER_SET, self._onRosterSet)
+        self.observeStanzaInterests()
 
     def _parseRosterItem(self, element):
         jid = JID(element['jid'])
@@ -669,7 +680,7 @@ class RosterClientProtocol(XMPPHandler):
 
 
     def _onRosterSet(self, iq):
-        if iq.handled or \
+        if iq.handled or iq.query is None or \
            iq.hasAttribute('from') and iq['from'] != self.xmlstream:
             return
 
@@ -706,8 +717,12 @@ class MessageProtocol(XMPPHandler):
 
     messageTypes = None, 'normal', 'chat', 'headline', 'groupchat'
 
+    stanzaInterests = (
+        ('message', None, None, '_onMessage'),
+        )
+
     def connectionInitialized(self):
-        self.xmlstream.addObserver("/message", self._onMessage)
+        self.observeStanzaInterests()
 
     def _onMessage(self, message):
         if message.handled: